@@ -1,8 +1,23 @@
 import streamlit as st
 import os
 import tempfile
-import time
-from scripts.local_analysis_helpers import run_preprocessing, run_delineation
+import geopandas as gpd
+import leafmap.foliumap as leafmap
+from scripts.local_analysis_helpers import run_preprocessing, run_delineation, run_flood_sweep
+from scripts.batch_delineation import run_batch_delineation
+from scripts.subbasins import run_subbasin_labelling, assemble_basin
+from scripts.regional_flood import run_regional_flood, DEFAULT_TILE_SIZE as REGIONAL_TILE_SIZE
+from scripts.rating_curves import (run_rating_curves, run_rating_curve_flood, DEFAULT_MAX_STAGE_M,
+                                   DEFAULT_STAGE_STEP_M, DEFAULT_MANNING_N)
+from scripts.terrain_derivatives import DERIVATIVE_OUTPUTS, DEFAULT_OUTPUTS as DEFAULT_TERRAIN_OUTPUTS
+from scripts.raster_output import COMPRESSIONS, DEFAULT_COMPRESSION
+from scripts.priority_flood import CONDITIONING_ENGINES, DEFAULT_CONDITIONING
+from scripts.stream_index import load_stream_index, network_for_threshold
+from scripts.job_runner import submit_job
+from scripts.job_panel import render_jobs_panel, render_profile_report
+from scripts.profiling import RunProfiler
+from scripts.preview import (run_preview, run_preview_delineation, map_outlet_to_native, to_preview_threshold,
+                             PREVIEW_MAX_CELLS)
 
 st.set_page_config(
     page_title="🌊 Análise Hidrológica Local (PySheds)",  # Você pode customizar o título para cada página
@@ -15,6 +30,19 @@ st.set_page_config(
 OUTPUT_DIR = "outputs/2"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# Cache persistente dos artefatos do pré-processamento
+CACHE_DIR = os.path.join("cache", "preprocessamento")
+PREVIEW_DIR = os.path.join(OUTPUT_DIR, "previa")
+
+TERRAIN_LABELS = {
+    'slope': "Declividade",
+    'aspect': "Aspect",
+    'twi': "TWI",
+    'hillshade': "Sombreamento (hillshade)",
+    'plan_curvature': "Curvatura plana",
+    'profile_curvature': "Curvatura de perfil",
+}
+
 # Define o estilo CSS
 st.markdown("""
     <style>
@@ -37,12 +65,158 @@ st.header("Etapa 1: Pré-processamento do MDE")
 st.info(
     "Faça o upload do seu MDE (ex: `srtm_data.tif`). Esta etapa irá condicionar o MDE, calcular direção/acumulação de fluxo, declividade, TWI e extrair a rede de drenagem completa.")
 
+# Parâmetros escolhidos na pré-visualização: aplicados antes de criar os widgets
+for key, value in st.session_state.pop('preview_params', {}).items():
+    st.session_state[key] = value
+st.session_state.setdefault('stream_threshold', 1000)
+st.session_state.setdefault('outlet_lon', -44.118627)
+st.session_state.setdefault('outlet_lat', -20.316243)
+
 uploaded_mde = st.file_uploader("Selecione o arquivo MDE (.tif, .tiff)", type=["tif", "tiff"])
-stream_threshold = st.number_input("Limiar de Drenagem (células)", min_value=100, max_value=10000, value=1000, step=100,
-                                   help="Define a área mínima para formar um 'rio'.")
+stream_threshold = st.number_input("Limiar de Drenagem (células)", min_value=100, max_value=1000000, step=100,
+                                   key="stream_threshold", help="Define a área mínima para formar um 'rio'.")
+tiled_mode = st.checkbox("Processar em blocos (MDE maior que a memória RAM)", value=False,
+                         help="Condiciona o MDE bloco a bloco, com arquivos temporários em disco. "
+                              "Recomendado para MDEs estaduais em 30 m ou 10 m.")
+use_cache = st.checkbox("Reutilizar resultados em cache (mesmo MDE e parâmetros)", value=True,
+                        help=f"Os artefatos ficam em '{CACHE_DIR}' e são recuperados sem recalcular.")
+tile_size = 2048
+conditioning = DEFAULT_CONDITIONING
+if tiled_mode:
+    tile_size = st.number_input("Tamanho do bloco (células)", min_value=256, max_value=8192, value=2048, step=256,
+                                help="Blocos maiores usam mais memória, mas reduzem o número de costuras.")
+else:
+    conditioning = st.radio("Condicionamento do MDE", options=list(CONDITIONING_ENGINES), horizontal=True,
+                            index=list(CONDITIONING_ENGINES).index(DEFAULT_CONDITIONING),
+                            format_func=CONDITIONING_ENGINES.get,
+                            help="O Priority-Flood+ε preenche depressões e áreas planas em uma única passada, "
+                                 "bem mais rápido que o PySheds em MDEs grandes.")
+limit_memory = st.checkbox("Limitar o uso de memória", value=False,
+                           help="Mantém o MDE condicionado em float32, libera as cópias intermediárias e passa "
+                                "ao processamento em blocos se o pico estimado exceder o orçamento.")
+memory_budget_mb = None
+if limit_memory:
+    memory_budget_mb = st.number_input("Orçamento de memória (MB)", min_value=256, max_value=262144, value=4096,
+                                       step=256)
+
+terrain_outputs = st.multiselect("Derivadas do terreno", options=list(DERIVATIVE_OUTPUTS),
+                                 default=list(DEFAULT_TERRAIN_OUTPUTS), format_func=TERRAIN_LABELS.get,
+                                 help="Calculadas em uma única passada sobre o MDE condicionado.")
+gradient_method = st.radio("Operador de gradiente", options=['zt', 'horn'], horizontal=True,
+                           format_func={'zt': "Zevenbergen-Thorne (diferenças centrais)", 'horn': "Horn (3x3)"}.get)
+compression = st.selectbox("Compressão dos rasters (COG)", options=list(COMPRESSIONS),
+                           index=COMPRESSIONS.index(DEFAULT_COMPRESSION),
+                           help="'zstd' é mais rápida; 'deflate' e 'lzw' são lidas por qualquer SIG.")
+overviews = st.checkbox("Gerar overviews internas", value=True,
+                        help="Pirâmides dentro do GeoTIFF para visualização rápida em zoom reduzido.")
+background_preprocessing = st.checkbox("Executar em segundo plano", value=False, key="bg_preprocessing",
+                                       help="A tarefa roda em outro processo: a página continua utilizável, "
+                                            "sobrevive a recarregamentos e pode ser cancelada.")
+
+
+def load_preprocessing_job(results):
+    st.session_state['preprocessing_results'] = results
+    st.session_state['preprocessing_complete'] = True
+
+
+with st.expander("Pré-visualização rápida (baixa resolução)"):
+    st.markdown(
+        "Roda o pré-processamento e o delineamento em uma versão reduzida do MDE, em segundos, para escolher o "
+        "exutório e o limiar de drenagem no mapa. Os parâmetros escolhidos são levados à resolução total, que "
+        "então é processada uma única vez.")
+    preview_cells = st.select_slider("Células na pré-visualização",
+                                     options=[250_000, 500_000, 1_000_000, 2_000_000], value=PREVIEW_MAX_CELLS, format_func=lambda n: f"{n:,}".replace(',', '.'))
+    if st.button("Gerar pré-visualização"):
+        if uploaded_mde is None:
+            st.error("Por favor, faça o upload de um arquivo MDE primeiro.")
+        else:
+            os.makedirs(PREVIEW_DIR, exist_ok=True)
+            preview_mde_path = os.path.join(PREVIEW_DIR, uploaded_mde.name)
+            with open(preview_mde_path, "wb") as f:
+                f.write(uploaded_mde.getbuffer())
+            preview_progress = st.progress(0, text="Gerando pré-visualização...")
+            try:
+                preview = run_preview(preview_mde_path, PREVIEW_DIR, stream_threshold,
+                                      lambda message, pct: preview_progress.progress(pct, text=message),
+                                      max_cells=preview_cells)
+                preview['indice'] = load_stream_index(preview['preprocessamento']['indice_rede_path'])
+                st.session_state['preview'] = preview
+                st.session_state.pop('preview_delineation', None)
+                # Exutório inicial: foz do maior rio da pré-visualização
+                index = preview['indice']
+                row, col = divmod(int(index['cells'][0]), int(index['shape'][1]))
+                x, y = preview['preprocessamento']['acc'].viewfinder.affine * (col + 0.5, row + 0.5)
+                st.session_state['preview_x'], st.session_state['preview_y'] = float(x), float(y)
+            except Exception as e:
+                st.error(f"Erro na pré-visualização: {e}")
+                st.exception(e)
+
+    preview = st.session_state.get('preview')
+    if preview is not None:
+        factor = preview['fator']
+        index = preview['indice']
+        st.caption(f"Nível 1/{factor}: {index['shape'][0]} x {index['shape'][1]} células "
+                   f"(cada célula equivale a {factor} x {factor} células do MDE).")
+        min_preview = int(index['min_threshold']) * factor ** 2
+        max_preview = max(min_preview + factor ** 2, int(index['acc'][0]) * factor ** 2 if len(index['acc']) else 0)
+        preview_threshold = st.slider("Limiar de Drenagem (células do MDE original)", min_value=min_preview,
+                                      max_value=max_preview, step=factor ** 2,
+                                      value=min(max(int(stream_threshold), min_preview), max_preview))
+        col_x, col_y = st.columns(2)
+        with col_x:
+            preview_x = st.number_input("Exutório (X)", format="%.6f", key="preview_x")
+        with col_y:
+            preview_y = st.number_input("Exutório (Y)", format="%.6f", key="preview_y")
+
+        if st.button("Delinear na pré-visualização"):
+            try:
+                st.session_state['preview_delineation'] = run_preview_delineation(
+                    preview, (preview_x, preview_y), preview_threshold, 1.0, PREVIEW_DIR, lambda message, pct: None)
+                st.session_state['preview_delineation']['limiar'] = preview_threshold
+            except Exception as e:
+                st.error(f"Erro no delineamento da pré-visualização: {e}")
+
+        preview_map = leafmap.Map()
+        preview_streams = network_for_threshold(index, to_preview_threshold(preview_threshold, factor))
+        if preview_streams is not None:
+            preview_map.add_gdf(preview_streams.to_crs(4326), layer_name="Rede de drenagem",
+                                style={'color': '#1f78b4', 'weight': 2})
+        preview_delineation = st.session_state.get('preview_delineation')
+        if preview_delineation is not None:
+            preview_map.add_gdf(gpd.read_file(preview_delineation['bacia_path']).to_crs(4326), layer_name="Bacia",
+                                style={'color': '#e31a1c', 'fillOpacity': 0.1, 'weight': 2})
+            preview_map.add_gdf(gpd.read_file(preview_delineation['exutorio_path']).to_crs(4326),
+                                layer_name="Exutório")
+        preview_map.to_streamlit(key="preview_map")
+
+        if preview_delineation is not None:
+            outlet_x, outlet_y = preview_delineation['exutorio_coords']
+            st.write(f"Exutório após o snap: ({outlet_x:.6f}, {outlet_y:.6f}); área de contribuição "
+                     f"≈ {int(preview_delineation['acumulacao_nativa'])} células do MDE original; "
+                     f"limiar {preview_delineation['limiar']} células.")
+            if st.button("Usar estes parâmetros na resolução total", type="primary"):
+                st.session_state['preview_params'] = {'stream_threshold': max(100, int(preview_delineation['limiar'])),
+                                                      'outlet_lon': float(outlet_x), 'outlet_lat': float(outlet_y)}
+                st.session_state['preview_outlet'] = {'coords': (float(outlet_x), float(outlet_y)), 'fator': factor,
+                                                      'acumulacao': preview_delineation['acumulacao_nativa']}
+                st.rerun()
+
 
 if st.button("Executar Pré-processamento", type="primary"):
-    if uploaded_mde is not None:
+    if uploaded_mde is not None and background_preprocessing:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            mde_temp_path = os.path.join(temp_dir, uploaded_mde.name)
+            with open(mde_temp_path, "wb") as f:
+                f.write(uploaded_mde.getbuffer())
+            job_id = submit_job('preprocessamento', dict(
+                mde_path=mde_temp_path, output_dir=OUTPUT_DIR, stream_threshold=stream_threshold,
+                tiled=tiled_mode, tile_size=int(tile_size), cache_dir=CACHE_DIR if use_cache else None,
+                terrain_outputs=terrain_outputs, gradient_method=gradient_method,
+                compression=compression, overviews=overviews, memory_budget_mb=memory_budget_mb,
+                conditioning=conditioning),
+                input_files=('mde_path',), label=f"Pré-processamento de {uploaded_mde.name}")
+        st.success(f"Tarefa '{job_id}' enviada. Acompanhe em 'Tarefas em segundo plano'.")
+    elif uploaded_mde is not None:
         with tempfile.TemporaryDirectory() as temp_dir:
             # Salva o MDE uploadado em um local temporário
             mde_temp_path = os.path.join(temp_dir, uploaded_mde.name)
@@ -60,13 +234,20 @@ if st.button("Executar Pré-processamento", type="primary"):
             def update_progress(message, percentage):
                 status_text.info(message)
                 progress_bar.progress(percentage, text=message)
-                time.sleep(0.1)  # Pequena pausa para UI atualizar
 
 
+            # Mede tempo e memória por etapa e limita as atualizações da interface
+            profiler = RunProfiler(on_update=update_progress, name="Pré-processamento")
+
             try:
                 # Chama a função de lógica pesada
                 with st.spinner("Processando MDE... Isso pode levar vários minutos."):
-                    results = run_preprocessing(mde_temp_path, OUTPUT_DIR, stream_threshold, update_progress)
+                    results = run_preprocessing(mde_temp_path, OUTPUT_DIR, stream_threshold, profiler,
+                                                tiled=tiled_mode, tile_size=int(tile_size),
+                                                cache_dir=CACHE_DIR if use_cache else None,
+                                                terrain_outputs=terrain_outputs, gradient_method=gradient_method,
+                                                compression=compression, overviews=overviews,
+                                                memory_budget_mb=memory_budget_mb, conditioning=conditioning)
 
                 # Armazena os resultados no session_state para a Etapa 2
                 st.session_state['preprocessing_results'] = results
@@ -74,11 +255,26 @@ if st.button("Executar Pré-processamento", type="primary"):
 
                 progress_bar.progress(100, text="Pré-processamento concluído!")
                 status_text.success(f"Pré-processamento concluído com sucesso! Arquivos gerados em '{OUTPUT_DIR}'.")
+                if results.get('from_cache'):
+                    st.info("Resultados recuperados do cache (MDE e parâmetros já processados anteriormente).")
+                if results.get('pico_memoria_mb') is not None or results.get('baixa_memoria'):
+                    memory_note = (f"Pico de memória: {results['pico_memoria_mb']:.0f} MB"
+                                   if results.get('pico_memoria_mb') is not None
+                                   else "Pico de memória não medido (resultado do cache)")
+                    if results.get('baixa_memoria'):
+                        memory_note += (f" (estimado: {results['memoria_estimada_mb']:.0f} MB além do processo; "
+                                        f"modo {results['modo_memoria']})")
+                    st.caption(memory_note + ".")
                 st.success("Pronto para a Etapa 2.")
 
             except Exception as e:
                 st.error(f"Erro durante o pré-processamento: {e}")
                 st.exception(e)
+            render_profile_report(profiler, "desempenho_preprocessamento", key="profile_preproc")
+
+with st.expander("Tarefas em segundo plano (pré-processamento)"):
+    render_jobs_panel(['preprocessamento'], key_prefix="jobs_preproc", on_load=load_preprocessing_job,
+                      load_label="Usar na Etapa 2")
 
 # --- ETAPA 2: DELINEAMENTO DA BACIA E HAND ---
 if 'preprocessing_complete' in st.session_state and st.session_state['preprocessing_complete']:
@@ -89,18 +285,85 @@ if 'preprocessing_complete' in st.session_state and st.session_state['preprocess
 
     col1, col2 = st.columns(2)
     with col1:
-        outlet_lon = st.number_input("Longitude do Exutório (X)", value=-44.118627, format="%.6f")
+        outlet_lon = st.number_input("Longitude do Exutório (X)", format="%.6f", key="outlet_lon")
     with col2:
-        outlet_lat = st.number_input("Latitude do Exutório (Y)", value=-20.316243, format="%.6f")
+        outlet_lat = st.number_input("Latitude do Exutório (Y)", format="%.6f", key="outlet_lat")
+
+    # Exutório vindo da pré-visualização: levado ao canal correspondente da resolução total
+    preview_outlet = st.session_state.get('preview_outlet')
+    use_preview_outlet = preview_outlet is not None and preview_outlet['coords'] == (outlet_lon, outlet_lat)
+    if use_preview_outlet:
+        st.caption(f"Exutório escolhido na pré-visualização (nível 1/{preview_outlet['fator']}): será movido "
+                   f"para o canal com a mesma área de contribuição na resolução total.")
+
+
+    def delineation_outlet(preproc_results):
+        if use_preview_outlet:
+            return map_outlet_to_native(preproc_results, (outlet_lon, outlet_lat), preview_outlet['fator'],
+                                        preview_outlet['acumulacao'])
+        return outlet_lon, outlet_lat
 
     channel_depth = st.number_input("Profundidade do Canal (metros)", min_value=1.0, max_value=50.0, value=10.0,
                                     step=0.5,
                                     help="Altura da água no canal para simulação HAND (ex: 10.0 para TR 100 anos).")
-    
+
+    multi_depth = st.checkbox("Simular vários cenários de profundidade de uma vez", value=False,
+                              help="Calcula o HAND uma única vez e gera um raster multibanda e um vetor com o atributo 'profundidade_m'.")
+    depths_text = "1, 2, 5, 10"
+    if multi_depth:
+        depths_text = st.text_input("Profundidades do Canal (metros, separadas por vírgula)", value=depths_text)
+
+    depth_by_order = False
+    if not multi_depth:
+        depth_by_order = st.checkbox("Profundidade do canal por ordem de Strahler", value=False,
+                                     help="Cada célula recebe a profundidade do trecho para onde drena, conforme a ordem de Strahler do trecho.")
+    order_depths_text = "1: 2, 2: 3, 3: 5, 4: 8, 5: 10"
+    if depth_by_order:
+        order_depths_text = st.text_input("Profundidade por ordem (ordem: metros, separados por vírgula)",
+                                          value=order_depths_text,
+                                          help="Trechos de ordens ausentes não inundam.")
+
+
+    def flood_channel_depth():
+        if not depth_by_order:
+            return channel_depth
+        try:
+            pairs = [item.split(':') for item in order_depths_text.replace(';', ',').split(',') if item.strip()]
+            return {int(order): float(depth) for order, depth in pairs}
+        except ValueError:
+            raise ValueError(f"Tabela de profundidades inválida: '{order_depths_text}'. Use 'ordem: metros' separados por vírgula.")
+
     generate_flu_distance = st.checkbox("Gerar camada de Distância do Fluxo (flu_distance.tif)", value=False,
                                         help="Opcional. Gera a camada de distância de fluxo. Pode consumir muitos recursos para áreas grandes.")
+    smooth_flood = st.checkbox("Suavizar contornos da mancha de inundação", value=False,
+                               help="Remove os degraus de pixel do vetor de inundação (cortes de canto de Chaikin).")
+    smooth_iterations = 2 if smooth_flood else 0
+    background_delineation = st.checkbox("Executar em segundo plano", value=False, key="bg_delineation",
+                                         help="Os resultados ficam disponíveis em 'Tarefas em segundo plano'.")
+
+    run_delineation_clicked = st.button("Executar Delineamento e Simulação HAND", type="primary")
+    if run_delineation_clicked and background_delineation:
+        try:
+            params = dict(preproc_data=st.session_state['preprocessing_results'],
+                          outlet_coords=delineation_outlet(st.session_state['preprocessing_results']),
+                          stream_threshold=stream_threshold,
+                          output_dir=None, generate_flu_distance=generate_flu_distance,
+                          smooth_iterations=smooth_iterations)
+            if multi_depth:
+                try:
+                    params['channel_depths'] = [float(v) for v in depths_text.replace(';', ',').split(',') if v.strip()]
+                except ValueError:
+                    raise ValueError(f"Lista de profundidades inválida: '{depths_text}'. Use números separados por vírgula.")
+                job_id = submit_job('varredura_inundacao', params, label=f"Inundação ({depths_text} m)")
+            else:
+                params['channel_depth'] = flood_channel_depth()
+                depth_label = "por ordem" if depth_by_order else f"{channel_depth} m"
+                job_id = submit_job('delineamento', params, label=f"Delineamento ({depth_label})")
+            st.success(f"Tarefa '{job_id}' enviada. Acompanhe em 'Tarefas em segundo plano'.")
+        except Exception as e:
+            st.error(f"Erro ao enviar a tarefa: {e}")
 
-    if st.button("Executar Delineamento e Simulação HAND", type="primary"):
+    elif run_delineation_clicked:
         # Recupera os dados da Etapa 1
         preproc_results = st.session_state['preprocessing_results']
 
@@ -113,20 +376,38 @@ if 'preprocessing_complete' in st.session_state and st.session_state['preprocess
         def update_progress_2(message, percentage):
             status_text_2.info(message)
             progress_bar_2.progress(percentage, text=message)
-            time.sleep(0.1)
 
 
+        profiler_2 = RunProfiler(on_update=update_progress_2, name="Delineamento e HAND")
+
         try:
             with st.spinner("Calculando bacia, HAND e mancha de inundação..."):
-                delineation_results = run_delineation(
-                    preproc_data=preproc_results,
-                    outlet_coords=(outlet_lon, outlet_lat),
-                    channel_depth=channel_depth,
-                    stream_threshold=stream_threshold,
-                    output_dir=OUTPUT_DIR,
-                    progress_callback=update_progress_2,
-                    generate_flu_distance=generate_flu_distance
-                )
+                if multi_depth:
+                    try:
+                        channel_depths = [float(v) for v in depths_text.replace(';', ',').split(',') if v.strip()]
+                    except ValueError:
+                        raise ValueError(f"Lista de profundidades inválida: '{depths_text}'. Use números separados por vírgula.")
+                    delineation_results = run_flood_sweep(
+                        preproc_data=preproc_results,
+                        outlet_coords=delineation_outlet(preproc_results),
+                        channel_depths=channel_depths,
+                        stream_threshold=stream_threshold,
+                        output_dir=OUTPUT_DIR,
+                        progress_callback=profiler_2,
+                        generate_flu_distance=generate_flu_distance,
+                        smooth_iterations=smooth_iterations
+                    )
+                else:
+                    delineation_results = run_delineation(
+                        preproc_data=preproc_results,
+                        outlet_coords=delineation_outlet(preproc_results),
+                        channel_depth=flood_channel_depth(),
+                        stream_threshold=stream_threshold,
+                        output_dir=OUTPUT_DIR,
+                        progress_callback=profiler_2,
+                        generate_flu_distance=generate_flu_distance,
+                        smooth_iterations=smooth_iterations
+                    )
 
             progress_bar_2.progress(100, text="Processo concluído!")
             status_text_2.success("Delineamento e simulação HAND concluídos!")
@@ -152,13 +433,14 @@ if 'preprocessing_complete' in st.session_state and st.session_state['preprocess
 
             with col_res2:
                 st.markdown("**Mancha de Inundação (HAND)**")
-                suffix = delineation_results.get('suffix', 'simulacao')
+                if delineation_results.get('suffixes'):
+                    st.caption(f"Cenários: {', '.join(delineation_results['suffixes'])}")
                 if delineation_results.get('inundacao_vetor_path'):
-                    fname_vec = f"inundacao_{suffix}.geojson"
+                    fname_vec = os.path.basename(delineation_results['inundacao_vetor_path'])
                     with open(delineation_results['inundacao_vetor_path'], "rb") as f:
                         st.download_button(f"Baixar Inundação (Vetor)", f, file_name=fname_vec)
                 if delineation_results.get('inundacao_raster_path'):
-                    fname_ras = f"inundacao_mapa_{suffix}.tif"
+                    fname_ras = os.path.basename(delineation_results['inundacao_raster_path'])
                     with open(delineation_results['inundacao_raster_path'], "rb") as f:
                         st.download_button(f"Baixar Inundação (Raster)", f, file_name=fname_ras)
 
@@ -173,6 +455,302 @@ if 'preprocessing_complete' in st.session_state and st.session_state['preprocess
         except Exception as e:
             st.error(f"Erro durante o delineamento: {e}")
             st.exception(e)
+        render_profile_report(profiler_2, "desempenho_delineamento", key="profile_delineation")
+
+    with st.expander("Tarefas em segundo plano (delineamento)"):
+        render_jobs_panel(['delineamento', 'varredura_inundacao'], key_prefix="jobs_delineation")
+
+    # --- DELINEAMENTO EM LOTE ---
+    with st.expander("Delineamento em lote (vários exutórios)"):
+        st.markdown(
+            "Envie um CSV (colunas `x`/`y` ou `lon`/`lat`, opcionalmente `id` ou `nome`) ou um GeoJSON de pontos. "
+            "Cada exutório é processado em paralelo com a profundidade do canal definida acima.")
+        uploaded_outlets = st.file_uploader("Arquivo de exutórios", type=["csv", "geojson", "json"])
+        batch_workers = st.number_input("Processos em paralelo", min_value=1, max_value=os.cpu_count() or 1,
+                                        value=os.cpu_count() or 1, step=1)
+
+        if st.button("Executar Delineamento em Lote"):
+            if uploaded_outlets is None:
+                st.warning("Por favor, faça o upload do arquivo de exutórios.")
+            else:
+                progress_bar_lote = st.progress(0, text="Iniciando delineamento em lote...")
+                status_text_lote = st.empty()
+
+
+                def update_progress_lote(message, percentage):
+                    status_text_lote.info(message)
+                    progress_bar_lote.progress(percentage, text=message)
+
+
+                profiler_lote = RunProfiler(on_update=update_progress_lote, name="Delineamento em lote")
+
+                try:
+                    with tempfile.TemporaryDirectory() as temp_dir:
+                        outlets_temp_path = os.path.join(temp_dir, uploaded_outlets.name)
+                        with open(outlets_temp_path, "wb") as f:
+                            f.write(uploaded_outlets.getbuffer())
+
+                        with st.spinner("Delineando bacias e manchas de inundação..."):
+                            batch_results = run_batch_delineation(
+                                preproc_data=st.session_state['preprocessing_results'],
+                                outlets_path=outlets_temp_path,
+                                channel_depth=channel_depth,
+                                stream_threshold=stream_threshold,
+                                output_dir=os.path.join(OUTPUT_DIR, "lote"),
+                                progress_callback=profiler_lote,
+                                max_workers=int(batch_workers),
+                                generate_flu_distance=generate_flu_distance,
+                                smooth_iterations=smooth_iterations
+                            )
+
+                    status_text_lote.success(
+                        f"{len(batch_results['exutorios'])} exutório(s) processado(s). "
+                        f"Arquivos por exutório em `{os.path.join(OUTPUT_DIR, 'lote')}`.")
+                    for outlet_id, error in batch_results['erros'].items():
+                        st.warning(f"Exutório '{outlet_id}': {error}")
+
+                    if batch_results.get('bacias_path'):
+                        with open(batch_results['bacias_path'], "rb") as f:
+                            st.download_button("Baixar Bacias (bacias_lote.geojson)", f,
+                                               file_name="bacias_lote.geojson")
+                    if batch_results.get('inundacao_vetor_path'):
+                        with open(batch_results['inundacao_vetor_path'], "rb") as f:
+                            st.download_button("Baixar Inundações (Vetor)", f,
+                                               file_name=os.path.basename(batch_results['inundacao_vetor_path']))
+
+                except Exception as e:
+                    st.error(f"Erro durante o delineamento em lote: {e}")
+                    st.exception(e)
+                render_profile_report(profiler_lote, "desempenho_lote", key="profile_batch")
+
+    # --- SUB-BACIAS HIERÁRQUICAS ---
+    with st.expander("Sub-bacias em todas as confluências"):
+        st.markdown(
+            "Rotula de uma só vez a sub-bacia de cada trecho da rede de drenagem (entre confluências), com a "
+            "topologia montante/jusante. Qualquer bacia com exutório no fim de um trecho é montada pela união "
+            "das sub-bacias a montante, sem novo traçado.")
+
+        if st.button("Rotular Sub-bacias"):
+            progress_bar_sub = st.progress(0, text="Iniciando rotulagem de sub-bacias...")
+            status_text_sub = st.empty()
+
+
+            def update_progress_sub(message, percentage):
+                status_text_sub.info(message)
+                progress_bar_sub.progress(percentage, text=message)
+
+
+            profiler_sub = RunProfiler(on_update=update_progress_sub, name="Sub-bacias")
+
+            try:
+                with st.spinner("Rotulando sub-bacias..."):
+                    st.session_state['subbasin_results'] = run_subbasin_labelling(
+                        preproc_data=st.session_state['preprocessing_results'],
+                        stream_threshold=stream_threshold,
+                        output_dir=os.path.join(OUTPUT_DIR, "sub_bacias"),
+                        progress_callback=profiler_sub
+                    )
+                status_text_sub.success(f"{st.session_state['subbasin_results']['n_sub_bacias']} sub-bacias rotuladas.")
+            except Exception as e:
+                st.error(f"Erro durante a rotulagem de sub-bacias: {e}")
+                st.exception(e)
+            render_profile_report(profiler_sub, "desempenho_sub_bacias", key="profile_subbasins")
+
+        subbasin_results = st.session_state.get('subbasin_results')
+        if subbasin_results:
+            col_sub1, col_sub2 = st.columns(2)
+            with col_sub1:
+                with open(subbasin_results['sub_bacias_path'], "rb") as f:
+                    st.download_button("Baixar Sub-bacias (sub_bacias.geojson)", f, file_name="sub_bacias.geojson")
+            with col_sub2:
+                with open(subbasin_results['sub_bacias_raster_path'], "rb") as f:
+                    st.download_button("Baixar Rótulos (sub_bacias.tif)", f, file_name="sub_bacias.tif")
+
+            sub_bacia_id = st.number_input("Montar bacia a montante da sub-bacia (sub_bacia_id)", min_value=1,
+                                           max_value=int(subbasin_results['n_sub_bacias']), value=1, step=1)
+            if st.button("Montar Bacia"):
+                try:
+                    subbasins_gdf = gpd.read_file(subbasin_results['sub_bacias_path'])
+                    basin_gdf = assemble_basin(subbasins_gdf, int(sub_bacia_id))
+                    basin_path = os.path.join(OUTPUT_DIR, "sub_bacias", f"bacia_montante_{int(sub_bacia_id)}.geojson")
+                    basin_gdf.to_file(basin_path, driver='GeoJSON')
+                    st.success(f"Bacia montada a partir de {int(basin_gdf['n_sub_bacias'].iloc[0])} sub-bacia(s).")
+                    with open(basin_path, "rb") as f:
+                        st.download_button("Baixar Bacia Montada", f, file_name=os.path.basename(basin_path))
+                except Exception as e:
+                    st.error(f"Erro ao montar a bacia: {e}")
+
+    # --- INUNDAÇÃO REGIONAL ---
+    with st.expander("Inundação regional (todo o MDE, sem exutório)"):
+        st.markdown(
+            "Calcula o HAND e a mancha de inundação para a profundidade do canal definida acima em todo o MDE "
+            "pré-processado, bloco a bloco e em paralelo, reaproveitando a direção e a acumulação de fluxo da "
+            "Etapa 1. Útil para triagem regional, sem delinear bacias.")
+        col_reg1, col_reg2 = st.columns(2)
+        with col_reg1:
+            regional_tile_size = st.number_input("Tamanho do bloco (células)", min_value=256, max_value=8192,
+                                                 value=REGIONAL_TILE_SIZE, step=256, key="regional_tile_size")
+        with col_reg2:
+            regional_workers = st.number_input("Processos em paralelo", min_value=1, max_value=os.cpu_count() or 1,
+                                               value=os.cpu_count() or 1, step=1, key="regional_workers")
+        background_regional = st.checkbox("Executar em segundo plano", value=False, key="bg_regional")
+
+        if st.button("Calcular Inundação Regional"):
+            regional_params = dict(channel_depth=channel_depth, stream_threshold=stream_threshold,
+                                   tile_size=int(regional_tile_size), max_workers=int(regional_workers),
+                                   smooth_iterations=smooth_iterations)
+            if background_regional:
+                try:
+                    job_id = submit_job('inundacao_regional',
+                                        dict(regional_params, preproc_data=st.session_state['preprocessing_results'],
+                                             output_dir=None),
+                                        label=f"Inundação regional ({channel_depth} m)")
+                    st.success(f"Tarefa '{job_id}' enviada. Acompanhe em 'Tarefas em segundo plano'.")
+                except Exception as e:
+                    st.error(f"Erro ao enviar a tarefa: {e}")
+            else:
+                progress_bar_reg = st.progress(0, text="Iniciando inundação regional...")
+                status_text_reg = st.empty()
+
+
+                def update_progress_reg(message, percentage):
+                    status_text_reg.info(message)
+                    progress_bar_reg.progress(percentage, text=message)
+
+
+                profiler_reg = RunProfiler(on_update=update_progress_reg, name="Inundação regional")
+
+                try:
+                    with st.spinner("Calculando HAND e mancha de inundação em todo o MDE..."):
+                        regional_results = run_regional_flood(
+                            preproc_data=st.session_state['preprocessing_results'],
+                            output_dir=os.path.join(OUTPUT_DIR, "regional"),
+                            progress_callback=profiler_reg,
+                            **regional_params
+                        )
+                    status_text_reg.success("Inundação regional concluída.")
+                    col_reg3, col_reg4, col_reg5 = st.columns(3)
+                    with col_reg3:
+                        with open(regional_results['hand_path'], "rb") as f:
+                            st.download_button("Baixar HAND (hand_regional.tif)", f, file_name="hand_regional.tif")
+                    with col_reg4:
+                        with open(regional_results['inundacao_raster_path'], "rb") as f:
+                            st.download_button("Baixar Inundação (Raster)", f,
+                                               file_name=os.path.basename(regional_results['inundacao_raster_path']))
+                    with col_reg5:
+                        if regional_results.get('inundacao_vetor_path'):
+                            with open(regional_results['inundacao_vetor_path'], "rb") as f:
+                                st.download_button("Baixar Inundação (Vetor)", f,
+                                                   file_name=os.path.basename(regional_results['inundacao_vetor_path']))
+                except Exception as e:
+                    st.error(f"Erro durante a inundação regional: {e}")
+                    st.exception(e)
+                render_profile_report(profiler_reg, "desempenho_regional", key="profile_regional")
+        render_jobs_panel(['inundacao_regional'], key_prefix="jobs_regional")
+
+    # --- CURVAS-CHAVE SINTÉTICAS ---
+    with st.expander("Curvas-chave sintéticas por trecho (HAND)"):
+        st.markdown(
+            "Calcula uma única vez, para cada trecho da rede dentro da bacia do exutório acima, a área inundada, "
+            "o volume, a área molhada do leito, a largura e a vazão (Manning) em função da cota. Depois, a mancha "
+            "de qualquer cota ou vazão é obtida por consulta à tabela, sem recalcular a bacia ou o HAND.")
+        col_rc1, col_rc2, col_rc3 = st.columns(3)
+        with col_rc1:
+            rc_max_stage = st.number_input("Cota máxima (m)", min_value=1.0, max_value=100.0,
+                                           value=DEFAULT_MAX_STAGE_M, step=1.0)
+        with col_rc2:
+            rc_stage_step = st.number_input("Passo da cota (m)", min_value=0.05, max_value=5.0,
+                                            value=DEFAULT_STAGE_STEP_M, step=0.05)
+        with col_rc3:
+            rc_manning = st.number_input("Coeficiente de Manning (n)", min_value=0.01, max_value=0.3,
+                                         value=DEFAULT_MANNING_N, step=0.005, format="%.3f")
+
+        if st.button("Calcular Curvas-chave"):
+            progress_bar_rc = st.progress(0, text="Iniciando curvas-chave...")
+            status_text_rc = st.empty()
+
+
+            def update_progress_rc(message, percentage):
+                status_text_rc.info(message)
+                progress_bar_rc.progress(percentage, text=message)
+
+
+            profiler_rc = RunProfiler(on_update=update_progress_rc, name="Curvas-chave")
+
+            try:
+                with st.spinner("Calculando HAND e curvas-chave por trecho..."):
+                    st.session_state['rating_results'] = run_rating_curves(
+                        preproc_data=st.session_state['preprocessing_results'],
+                        outlet_coords=delineation_outlet(st.session_state['preprocessing_results']),
+                        stream_threshold=stream_threshold,
+                        output_dir=os.path.join(OUTPUT_DIR, "curvas_chave"),
+                        progress_callback=profiler_rc,
+                        max_stage=rc_max_stage,
+                        stage_step=rc_stage_step,
+                        manning_n=rc_manning
+                    )
+                status_text_rc.success(f"Curvas-chave de {st.session_state['rating_results']['n_trechos']} "
+                                       f"trechos calculadas.")
+            except Exception as e:
+                st.error(f"Erro durante o cálculo das curvas-chave: {e}")
+                st.exception(e)
+            render_profile_report(profiler_rc, "desempenho_curvas_chave", key="profile_rating")
+
+        rating_results = st.session_state.get('rating_results')
+        if rating_results:
+            col_rc4, col_rc5 = st.columns(2)
+            with col_rc4:
+                with open(rating_results['curvas_chave_csv_path'], "rb") as f:
+                    st.download_button("Baixar Curvas-chave (curvas_chave.csv)", f, file_name="curvas_chave.csv")
+            with col_rc5:
+                with open(rating_results['trechos_path'], "rb") as f:
+                    st.download_button("Baixar Trechos (trechos_curvas.geojson)", f,
+                                       file_name="trechos_curvas.geojson")
+
+            rc_mode = st.radio("Mancha por", ["Cota acima do canal (m)", "Vazão (m³/s)"], horizontal=True)
+            rc_value = st.number_input("Valor (todos os trechos)", min_value=0.0, value=5.0, step=0.5)
+            if st.button("Gerar Mancha pelas Curvas-chave"):
+                try:
+                    lookup = {'stage_m': rc_value} if rc_mode.startswith("Cota") else {'discharge_m3s': rc_value}
+                    flood_results = run_rating_curve_flood(rating_results, os.path.join(OUTPUT_DIR, "curvas_chave"),
+                                                           lambda message, percentage: None, **lookup)
+                    st.success(f"Mancha '{flood_results['suffix']}' gerada.")
+                    if flood_results.get('inundacao_vetor_path'):
+                        with open(flood_results['inundacao_vetor_path'], "rb") as f:
+                            st.download_button("Baixar Inundação (Vetor)", f,
+                                               file_name=os.path.basename(flood_results['inundacao_vetor_path']))
+                    with open(flood_results['inundacao_raster_path'], "rb") as f:
+                        st.download_button("Baixar Inundação (Raster)", f,
+                                           file_name=os.path.basename(flood_results['inundacao_raster_path']))
+                except Exception as e:
+                    st.error(f"Erro ao gerar a mancha: {e}")
+
+    # --- REDE DE DRENAGEM POR LIMIAR ---
+    index_path = st.session_state['preprocessing_results'].get('indice_rede_path')
+    if index_path and os.path.exists(index_path):
+        with st.expander("Rede de drenagem por limiar (instantâneo)"):
+            st.markdown(
+                "Extrai a rede para outro limiar de acumulação a partir do índice gravado no pré-processamento, "
+                "sem recalcular direção e acumulação de fluxo.")
+            if st.session_state.get('stream_index_path') != index_path:
+                st.session_state['stream_index'] = load_stream_index(index_path)
+                st.session_state['stream_index_path'] = index_path
+            stream_index = st.session_state['stream_index']
+
+            min_index_threshold = int(stream_index['min_threshold'])
+            max_index_threshold = max(min_index_threshold + 1, int(stream_index['acc'][0]) if len(stream_index['acc']) else 0)
+            index_threshold = st.slider("Limiar de Acumulação (células)", min_value=min_index_threshold,
+                                        max_value=max_index_threshold,
+                                        value=min(max(int(stream_threshold), min_index_threshold), max_index_threshold),
+                                        help="A rede é recalculada a cada mudança do limiar.")
+            streams_gdf = network_for_threshold(stream_index, index_threshold)
+            if streams_gdf is None:
+                st.warning("Nenhum trecho de drenagem acima deste limiar.")
+            else:
+                st.write(f"{len(streams_gdf)} trechos, {streams_gdf['comprimento_m'].sum() / 1000:.2f} km de canais, "
+                         f"ordem de Strahler máxima {int(streams_gdf['strahler_order'].max())}.")
+                st.download_button("Baixar Rede (GeoJSON)", streams_gdf.to_json(),
+                                   file_name=f"rede_drenagem_{index_threshold}.geojson")
 
 else:
     st.info("Execute a Etapa 1 para habilitar o delineamento da bacia.")
\ No newline at end of file
@@ -1,10 +1,15 @@
 import streamlit as st
 import os
 import tempfile
-import time
 import pandas as pd
 import shutil
-from scripts.local_analysis_helpers import run_soil_intersection, run_proportional_buffer
+from scripts.local_analysis_helpers import run_soil_intersection, run_proportional_buffer, run_area_curves
+from scripts.area_curves import load_area_curves, weight_ensemble, ensemble_class_areas, DEFAULT_MAX_PERCENT
+from scripts.soil_raster import run_soil_raster_weighting
+from scripts.zonal_overlay import INTERSECTION_ENGINES, DEFAULT_INTERSECTION_ENGINE
+from scripts.job_runner import submit_job
+from scripts.job_panel import render_jobs_panel, render_profile_report
+from scripts.profiling import RunProfiler
 
 st.set_page_config(
     page_title="🌱 Modelo de Risco Ponderado por Solo",  # Você pode customizar o título para cada página
@@ -105,7 +110,8 @@ def render_weight_editor(key_prefix: str):
     return weights
 
 # --- FUNÇÃO PARA EXECUTAR O BUFFER (MODIFICADA) ---
-def execute_buffer_logic(input_file_path, reference_column, weights_mapping, temp_dir):
+def execute_buffer_logic(input_file_path, reference_column, weights_mapping, temp_dir, max_workers=1,
+                         curves_path=None):
     """Função reutilizável para executar a lógica de buffer."""
 
     progress_bar = st.progress(0, text="Iniciando buffer proporcional...")
@@ -114,7 +120,8 @@ def execute_buffer_logic(input_file_path, reference_column, weights_mapping, tem
     def update_progress(message, percentage):
         status_text.info(message)
         progress_bar.progress(percentage, text=message)
-        time.sleep(0.1)
+
+    profiler = RunProfiler(on_update=update_progress, name="Buffer proporcional")
 
     try:
         with st.spinner("Calculando buffers proporcionais... (Pode demorar)"):
@@ -123,7 +130,9 @@ def execute_buffer_logic(input_file_path, reference_column, weights_mapping, tem
                 reference_column=reference_column,
                 percentage_mapping=weights_mapping,
                 output_dir=temp_dir,  # Salva resultados no temp_dir
-                progress_callback=update_progress
+                progress_callback=profiler,
+                max_workers=max_workers,
+                curves_path=curves_path
             )
 
         progress_bar.progress(100, text="Buffer concluído!")
@@ -154,12 +163,129 @@ def execute_buffer_logic(input_file_path, reference_column, weights_mapping, tem
     except Exception as e:
         st.error(f"Erro durante o cálculo do buffer: {e}")
         st.exception(e)
+    render_profile_report(profiler, "desempenho_buffer", key="profile_buffer")
+
+
+def render_buffer_workers(key):
+    """Número de processos do buffer proporcional (1 = sequencial, classe a classe)."""
+    return int(st.number_input("Processos em paralelo (buffer)", min_value=1, max_value=os.cpu_count() or 1,
+                               value=1, step=1, key=key,
+                               help="Com mais de 1, as feições são divididas em blocos com o mesmo número de "
+                                    "vértices e processadas em paralelo. Útil para camadas com muitas feições."))
+
+
+# --- SENSIBILIDADE DOS PESOS ---
+def _ensemble_table(summary):
+    """Resumo de `weight_ensemble` em km², com a classe como índice."""
+    table = summary.copy()
+    table['classe'] = table['classe'].map(lambda c: "Total" if isinstance(c, str) else f"Classe {c:g}")
+    table = table.set_index('classe')
+    table[table.columns] = table[table.columns].astype(float) / 1e6
+    table.columns = [column.replace('_m2', '_km2') for column in table.columns]
+    return table
+
+
+def render_weight_sensitivity(key, weights, source_id, write_input=None, reference_column="valor_solo"):
+    """
+    Curvas área x distância da camada (pré-calculadas uma vez) para avaliar
+    os pesos sem refazer os buffers: área por classe com os pesos atuais e
+    um conjunto de Monte Carlo em torno deles. `write_input(pasta)` grava a
+    camada e retorna o caminho (só é chamado ao calcular as curvas);
+    `source_id` identifica a camada para descartar curvas de outra.
+    Retorna o caminho das curvas a usar no buffer, ou None.
+    """
+    state_key = f"{key}_curves"
+    curves_info = st.session_state.get(state_key)
+    if curves_info and curves_info['source'] != source_id:
+        curves_info = None
+
+    with st.expander("📈 Sensibilidade dos pesos (curvas área x distância)"):
+        st.caption("As curvas tabelam a área de cada polígono em função da distância do buffer. Depois de "
+                   "calculadas, qualquer conjunto de pesos é avaliado por interpolação, e o buffer final faz "
+                   "um único buffer por polígono.")
+        max_percent = st.number_input("Variação máxima coberta pelas curvas (%)", min_value=1.0, max_value=100.0,
+                                      value=DEFAULT_MAX_PERCENT, step=5.0, key=f"{key}_max_percent")
+        if st.button("Calcular curvas área x distância", key=f"{key}_curves_btn"):
+            if write_input is None:
+                st.warning("Carregue a camada segmentada antes de calcular as curvas.")
+            else:
+                progress_bar = st.progress(0, text="Calculando curvas...")
+                try:
+                    with tempfile.TemporaryDirectory() as temp_dir:
+                        curves_dir = os.path.join(OUTPUT_DIR, f"curvas_{key}")
+                        os.makedirs(curves_dir, exist_ok=True)
+                        curves_results = run_area_curves(
+                            write_input(temp_dir), reference_column, curves_dir,
+                            lambda message, percentage: progress_bar.progress(percentage, text=message),
+                            max_percent=max_percent)
+                    curves_info = {'path': curves_results['curves_path'], 'source': source_id}
+                    st.session_state[state_key] = curves_info
+                    st.success(f"Curvas de {curves_results['n_poligonos']} polígono(s) calculadas.")
+                except Exception as e:
+                    st.error(f"Erro ao calcular as curvas: {e}")
+
+        if not curves_info or not os.path.exists(curves_info['path']):
+            return None
+
+        curves = load_area_curves(curves_info['path'])
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            spread = st.number_input("Incerteza dos pesos (± p.p.)", min_value=0.0, value=10.0, step=1.0,
+                                     key=f"{key}_spread")
+        with col2:
+            n_samples = int(st.number_input("Amostras de Monte Carlo", min_value=10, max_value=100000,
+                                            value=1000, step=100, key=f"{key}_samples"))
+        with col3:
+            seed = int(st.number_input("Semente", min_value=0, value=0, step=1, key=f"{key}_seed"))
+
+        try:
+            summary, _, _ = weight_ensemble(curves, weights, spread, n_samples, seed=seed)
+            table = _ensemble_table(summary)
+            class_values = sorted(float(value) for value in weights)
+            current = ensemble_class_areas(curves, curves['classes'], class_values,
+                                           [[weights[value] for value in sorted(weights, key=float)]])[0]
+            table.insert(0, 'area_pesos_atuais_km2', [value / 1e6 for value in (*current, current.sum())])
+            st.dataframe(table.round(3), use_container_width=True)
+            st.caption(f"Área inundada por classe: pesos atuais e {n_samples} mapeamentos sorteados com cada "
+                       f"peso em ±{spread:g} p.p. (limitados a ±{curves['max_percent']:g}%).")
+        except ValueError as e:
+            st.error(str(e))
+            return None
+
+        use_curves = st.checkbox("Usar as curvas no buffer da Etapa 2", value=False, key=f"{key}_use_curves",
+                                 help="A busca da distância de cada polígono parte da estimativa das curvas: "
+                                      "mesma tolerância do buffer sem curvas, com menos avaliações de buffer.")
+    return curves_info['path'] if use_curves else None
+
+
+# --- TAREFAS EM SEGUNDO PLANO ---
+def submit_buffer_job(input_file_path, reference_column, weights_mapping, max_workers=1, curves_path=None):
+    """Envia o buffer proporcional como tarefa em segundo plano (o vetor e as curvas são copiados para a tarefa)."""
+    try:
+        job_id = submit_job('buffer_proporcional', dict(
+            geojson_path=input_file_path, reference_column=reference_column,
+            percentage_mapping=dict(weights_mapping), output_dir=None, max_workers=max_workers,
+            curves_path=curves_path),
+            input_files=('geojson_path', 'curves_path') if curves_path else ('geojson_path',),
+            label=f"Buffer proporcional ({os.path.basename(input_file_path)})")
+        st.success(f"Tarefa '{job_id}' enviada. Acompanhe em 'Tarefas em segundo plano'.")
+    except Exception as e:
+        st.error(f"Erro ao enviar a tarefa: {e}")
+
+
+def load_intersection_job(results):
+    """Leva o resultado de uma interseção em segundo plano para a Etapa 2 da Aba 1."""
+    intermediate_dest_path = os.path.join(OUTPUT_DIR, "inundacao_segmentada_por_solo.geojson")
+    shutil.copyfile(results['output_path'], intermediate_dest_path)
+    st.session_state['segmented_file_path_tab1'] = intermediate_dest_path
+    st.session_state['ready_for_buffer_tab1'] = True
 
 
 # --- INTERFACE DE ABAS ---
-tab1, tab2 = st.tabs([
+tab1, tab2, tab3 = st.tabs([
     "Fluxo Completo (Etapa 1 + 2)",
-    "Apenas Etapa 2 (Já tenho os dados)"
+    "Apenas Etapa 2 (Já tenho os dados)",
+    "Motor Raster (etapa única)"
 ])
 
 # --- ABA 1: FLUXO COMPLETO (MODIFICADA) ---
@@ -172,8 +298,36 @@ with tab1:
     uploaded_vector = st.file_uploader("Upload do Vetor de Inundação (ou AOI)", type=["geojson", "gpkg", "zip"],
                                        key="tab1_vector")
 
+    intersection_engine = st.radio("Motor da interseção", options=list(INTERSECTION_ENGINES), horizontal=True,
+                                   index=list(INTERSECTION_ENGINES).index(DEFAULT_INTERSECTION_ENGINE),
+                                   format_func=INTERSECTION_ENGINES.get, key="tab1_intersection_engine",
+                                   help="O motor por janelas lê o raster só onde há feições e recorta cada classe "
+                                        "pela feição, sem vetorizar o recorte inteiro nem usar overlay: mais rápido "
+                                        "e com memória limitada a um bloco do raster. Inclui as células de borda "
+                                        "parcialmente cobertas pela mancha.")
+    background_tab1 = st.checkbox("Executar em segundo plano", value=False, key="tab1_background",
+                                  help="A tarefa roda em outro processo: a página continua utilizável, "
+                                       "sobrevive a recarregamentos e pode ser cancelada.")
+
     if st.button("Executar Etapa 1: Interseção", type="primary"):
-        if uploaded_raster and uploaded_vector:
+        if uploaded_raster and uploaded_vector and background_tab1:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                raster_temp_path = os.path.join(temp_dir, uploaded_raster.name)
+                with open(raster_temp_path, "wb") as f:
+                    f.write(uploaded_raster.getbuffer())
+                vector_temp_path = os.path.join(temp_dir, uploaded_vector.name)
+                with open(vector_temp_path, "wb") as f:
+                    f.write(uploaded_vector.getbuffer())
+                try:
+                    job_id = submit_job('intersecao_solo', dict(raster_path=raster_temp_path,
+                                                                vector_path=vector_temp_path, output_dir=None,
+                                                                engine=intersection_engine),
+                                        input_files=('raster_path', 'vector_path'),
+                                        label=f"Interseção {uploaded_raster.name} x {uploaded_vector.name}")
+                    st.success(f"Tarefa '{job_id}' enviada. Acompanhe em 'Tarefas em segundo plano'.")
+                except Exception as e:
+                    st.error(f"Erro ao enviar a tarefa: {e}")
+        elif uploaded_raster and uploaded_vector:
             with tempfile.TemporaryDirectory() as temp_dir:
                 # Salva arquivos temporários
                 raster_temp_path = os.path.join(temp_dir, uploaded_raster.name)
@@ -193,13 +347,16 @@ with tab1:
                     progress_bar_1.progress(percentage, text=message)
 
 
+                profiler_1 = RunProfiler(on_update=update_progress_1, name="Interseção com solos")
+
                 try:
                     with st.spinner("Processando interseção (rasterio mask)..."):
                         intersect_results = run_soil_intersection(
                             raster_path=raster_temp_path,
                             vector_path=vector_temp_path,
                             output_dir=temp_dir,  # <-- Salva no temp_dir
-                            progress_callback=update_progress_1
+                            progress_callback=profiler_1,
+                            engine=intersection_engine
                         )
 
                     progress_bar_1.progress(100, "Interseção concluída!")
@@ -234,6 +391,7 @@ with tab1:
                 except Exception as e:
                     st.error(f"Erro na Etapa 1: {e}")
                     st.exception(e)
+                render_profile_report(profiler_1, "desempenho_intersecao", key="profile_intersection")
         else:
             st.warning("Por favor, faça o upload do raster e do vetor.")
 
@@ -243,9 +401,19 @@ with tab1:
 
         # Chama a função de pesos com uma CHAVE ÚNICA
         weights = render_weight_editor(key_prefix="tab1_weights")
+        workers_tab1 = render_buffer_workers(key="tab1_buffer_workers")
+        segmented_path = st.session_state.get('segmented_file_path_tab1', '')
+        segmented_exists = os.path.exists(segmented_path)
+        curves_tab1 = render_weight_sensitivity(
+            "tab1_sensitivity", weights,
+            source_id=f"{segmented_path}:{os.path.getmtime(segmented_path)}" if segmented_exists else None,
+            write_input=(lambda temp_dir: segmented_path) if segmented_exists else None)
 
         if st.button("Executar Etapa 2: Buffer Proporcional", type="primary", key="tab1_buffer_btn"):
-            if 'segmented_file_path_tab1' in st.session_state and os.path.exists(
+            if background_tab1 and os.path.exists(st.session_state.get('segmented_file_path_tab1', '')):
+                submit_buffer_job(st.session_state['segmented_file_path_tab1'], "valor_solo", weights, workers_tab1,
+                                  curves_tab1)
+            elif 'segmented_file_path_tab1' in st.session_state and os.path.exists(
                     st.session_state['segmented_file_path_tab1']):
                 # Usamos um novo temp_dir para a lógica do buffer
                 with tempfile.TemporaryDirectory() as temp_dir_2:
@@ -253,7 +421,9 @@ with tab1:
                         input_file_path=st.session_state['segmented_file_path_tab1'],  # <-- Usa o caminho permanente
                         reference_column="valor_solo",  # Padrão da Etapa 1
                         weights_mapping=weights,
-                        temp_dir=temp_dir_2  # Passa o novo temp_dir
+                        temp_dir=temp_dir_2,  # Passa o novo temp_dir
+                        max_workers=workers_tab1,
+                        curves_path=curves_tab1
                     )
             else:
                 st.error(
@@ -271,9 +441,29 @@ with tab2:
 
     # Chama a função de pesos com uma CHAVE ÚNICA diferente
     weights_tab2 = render_weight_editor(key_prefix="tab2_weights")
+    workers_tab2 = render_buffer_workers(key="tab2_buffer_workers")
+
+    def write_uploaded_vector(temp_dir):
+        vector_path = os.path.join(temp_dir, uploaded_segmented_vector.name)
+        with open(vector_path, "wb") as f: f.write(uploaded_segmented_vector.getbuffer())
+        return vector_path
+
+    curves_tab2 = render_weight_sensitivity(
+        "tab2_sensitivity", weights_tab2,
+        source_id=(f"{uploaded_segmented_vector.name}:{uploaded_segmented_vector.size}:{ref_col}"
+                   if uploaded_segmented_vector else None),
+        write_input=write_uploaded_vector if uploaded_segmented_vector and ref_col else None,
+        reference_column=ref_col)
+    background_tab2 = st.checkbox("Executar em segundo plano", value=False, key="tab2_background",
+                                  help="Os resultados ficam disponíveis em 'Tarefas em segundo plano'.")
 
     if st.button("Executar Etapa 2: Buffer Proporcional", type="primary", key="tab2_buffer_btn"):
-        if uploaded_segmented_vector and ref_col:
+        if uploaded_segmented_vector and ref_col and background_tab2:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                vector_temp_path = os.path.join(temp_dir, uploaded_segmented_vector.name)
+                with open(vector_temp_path, "wb") as f: f.write(uploaded_segmented_vector.getbuffer())
+                submit_buffer_job(vector_temp_path, ref_col, weights_tab2, workers_tab2, curves_tab2)
+        elif uploaded_segmented_vector and ref_col:
             with tempfile.TemporaryDirectory() as temp_dir:
                 # Salva o arquivo temporário
                 vector_temp_path = os.path.join(temp_dir, uploaded_segmented_vector.name)
@@ -284,7 +474,96 @@ with tab2:
                     input_file_path=vector_temp_path,
                     reference_column=ref_col,
                     weights_mapping=weights_tab2,
-                    temp_dir=temp_dir
+                    temp_dir=temp_dir,
+                    max_workers=workers_tab2,
+                    curves_path=curves_tab2
                 )
         else:
-            st.warning("Por favor, faça o upload do vetor e especifique a coluna de referência.")
\ No newline at end of file
+            st.warning("Por favor, faça o upload do vetor e especifique a coluna de referência.")
+
+# --- ABA 3: MOTOR RASTER ---
+with tab3:
+    st.header("Modelo por Solo no Raster (Transformada de Distância)")
+    st.info("Aplica os pesos diretamente na grade do raster de solos: a mancha é rasterizada, cada fragmento de "
+            "cada classe cresce ou encolhe pela transformada de distância euclidiana até a área-alvo, e só o "
+            "resultado final é vetorizado. Dispensa a interseção vetorial e os buffers, muito mais lentos em "
+            "planícies extensas. Cada célula fica com uma única classe (sem sobreposição entre classes).")
+
+    uploaded_raster_tab3 = st.file_uploader("Upload do Raster de Solos (ex: ad_solo.tif)", type=["tif", "tiff"],
+                                            key="tab3_raster")
+    uploaded_vector_tab3 = st.file_uploader("Upload do Vetor de Inundação", type=["geojson", "gpkg", "zip"],
+                                            key="tab3_vector")
+    weights_tab3 = render_weight_editor(key_prefix="tab3_weights")
+    background_tab3 = st.checkbox("Executar em segundo plano", value=False, key="tab3_background",
+                                  help="Os resultados ficam disponíveis em 'Tarefas em segundo plano'.")
+
+    if st.button("Executar Modelo Raster", type="primary", key="tab3_run_btn"):
+        if uploaded_raster_tab3 and uploaded_vector_tab3:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                raster_temp_path = os.path.join(temp_dir, uploaded_raster_tab3.name)
+                with open(raster_temp_path, "wb") as f:
+                    f.write(uploaded_raster_tab3.getbuffer())
+                vector_temp_path = os.path.join(temp_dir, uploaded_vector_tab3.name)
+                with open(vector_temp_path, "wb") as f:
+                    f.write(uploaded_vector_tab3.getbuffer())
+
+                if background_tab3:
+                    try:
+                        job_id = submit_job('modelo_solo_raster', dict(
+                            raster_path=raster_temp_path, vector_path=vector_temp_path,
+                            percentage_mapping=dict(weights_tab3), output_dir=None),
+                            input_files=('raster_path', 'vector_path'),
+                            label=f"Modelo raster {uploaded_raster_tab3.name} x {uploaded_vector_tab3.name}")
+                        st.success(f"Tarefa '{job_id}' enviada. Acompanhe em 'Tarefas em segundo plano'.")
+                    except Exception as e:
+                        st.error(f"Erro ao enviar a tarefa: {e}")
+                else:
+                    progress_bar_3 = st.progress(0, text="Iniciando modelo raster...")
+                    status_text_3 = st.empty()
+
+
+                    def update_progress_3(message, percentage):
+                        status_text_3.info(message)
+                        progress_bar_3.progress(percentage, text=message)
+
+
+                    profiler_3 = RunProfiler(on_update=update_progress_3, name="Modelo raster por solo")
+
+                    try:
+                        with st.spinner("Ajustando as classes de solo no raster..."):
+                            raster_results = run_soil_raster_weighting(
+                                raster_path=raster_temp_path,
+                                vector_path=vector_temp_path,
+                                percentage_mapping=weights_tab3,
+                                output_dir=temp_dir,
+                                progress_callback=profiler_3
+                            )
+                        status_text_3.success("Modelo raster concluído!")
+
+                        saved_paths = []
+                        for key in ('merge_path', 'raster_path'):
+                            destination_path = os.path.join(OUTPUT_DIR, os.path.basename(raster_results[key]))
+                            shutil.move(raster_results[key], destination_path)
+                            saved_paths.append(destination_path)
+                        st.success("Arquivos salvos automaticamente em:\n" +
+                                   "\n".join(f"`{path}`" for path in saved_paths))
+
+                        summary = pd.DataFrame.from_dict(raster_results['areas_por_classe'], orient='index')
+                        summary.index.name = 'classe'
+                        st.dataframe(summary)
+                    except Exception as e:
+                        st.error(f"Erro durante o modelo raster: {e}")
+                        st.exception(e)
+                    render_profile_report(profiler_3, "desempenho_modelo_raster", key="profile_raster_model")
+        else:
+            st.warning("Por favor, faça o upload do raster e do vetor.")
+
+# --- TAREFAS EM SEGUNDO PLANO ---
+with st.expander("Tarefas em segundo plano"):
+    st.markdown("**Interseção (Etapa 1)**")
+    render_jobs_panel(['intersecao_solo'], key_prefix="jobs_intersection", on_load=load_intersection_job,
+                      load_label="Usar na Etapa 2 (Aba 1)")
+    st.markdown("**Buffer proporcional (Etapa 2)**")
+    render_jobs_panel(['buffer_proporcional'], key_prefix="jobs_buffer")
+    st.markdown("**Modelo raster por solo (Aba 3)**")
+    render_jobs_panel(['modelo_solo_raster'], key_prefix="jobs_raster_model")
\ No newline at end of file
@@ -1,10 +1,10 @@
 import streamlit as st
 import os
 import tempfile
-import time
 import geopandas as gpd
 import leafmap.foliumap as leafmap
 from scripts.local_analysis_helpers import run_osmnx_download
+from scripts.profiling import RunProfiler
 
 st.set_page_config(
     page_title="🏙️ Downloader de Dados (OpenStreetMap)",
@@ -115,12 +115,13 @@ if st.button("Baixar Dados do OSM", type="primary"):
             def update_progress(message, percentage):
                 status_text.info(message)
                 progress_bar.progress(percentage, text=message)
-                time.sleep(0.1)
 
 
+            profiler = RunProfiler(on_update=update_progress, name="Download OSM")
+
             try:
                 with st.spinner("Baixando e processando dados do OpenStreetMap..."):
-                    osm_results = run_osmnx_download(aoi_temp_path, OUTPUT_DIR, update_progress)
+                    osm_results = run_osmnx_download(aoi_temp_path, OUTPUT_DIR, profiler)
 
                 progress_bar.progress(100, text="Download concluído!")
                 status_text.success("Dados do OSM baixados e processados!")
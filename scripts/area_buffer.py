@@ -0,0 +1,220 @@
+"""
+Buffers proporcionais à área, resolvidos em lote.
+
+Para cada polígono, procura a distância `d` tal que a área de
+`geometria.buffer(d)` seja a área-alvo. Em vez de uma busca `brentq` por
+polígono (cada avaliação é um `buffer` isolado), todos os polígonos são
+resolvidos juntos:
+
+1. estimativa inicial pela fórmula de Steiner, A(d) ≈ A + P·d + π·d²
+   (exata para polígonos convexos com d >= 0);
+2. passos de Newton com avaliações vetorizadas do shapely 2 (`shapely.buffer`,
+   `shapely.area` e `shapely.length` sobre o vetor de geometrias ativas). A
+   derivada dA/dd é o perímetro da geometria com buffer, obtido na mesma
+   avaliação;
+3. salvaguarda por intervalo: cada polígono mantém um intervalo [inferior,
+   superior] que contém a raiz, e passos de Newton fora dele (ou com derivada
+   nula, p. ex. geometria vazia após buffer negativo) são trocados por
+   bisseção.
+
+Alvos de área nula (peso de -100%) não passam pelo Newton, que se
+arrastaria até o colapso da geometria: uma única avaliação no limite
+inferior da busca decide, como na busca `brentq` (que já parava ali).
+
+A tolerância em distância (`xtol`) é a mesma da busca `brentq` anterior, e os
+limites da busca também. Quando a raiz não está no intervalo, a distância é
+NaN, e o chamador mantém a geometria original, como antes.
+
+Em camadas grandes, `parallel_buffer_to_areas` divide as geometrias em blocos
+contíguos com o mesmo número de vértices (o custo de `buffer` cresce com os
+vértices, não com o número de linhas), resolve os blocos em um pool de
+processos e remonta o resultado na ordem de entrada.
+"""
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import shapely
+
+
+BUFFER_SEARCH_LIMIT_M = 500.0
+BUFFER_XTOL_M = 0.01
+# Segmentos por quarto de círculo: o padrão de `geometria.buffer` (o de
+# `shapely.buffer` é 8), para manter as áreas da busca `brentq`
+BUFFER_QUAD_SEGS = 16
+MAX_ITERATIONS = 60
+# Blocos por processo: mais blocos equilibram melhor a carga entre os processos
+CHUNKS_PER_WORKER = 4
+
+
+def steiner_estimate(area, perimeter, target_area):
+    """
+    Raiz de A + P·d + π·d² = alvo mais próxima de zero (forma estável). Onde
+    a parábola não alcança o alvo (encolhimento além do vértice), usa o
+    vértice, d = -P / 2π.
+    """
+    delta = target_area - area
+    discriminant = perimeter ** 2 + 4.0 * np.pi * delta
+    root = np.sqrt(np.maximum(discriminant, 0.0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        estimate = np.where(perimeter + root > 0, 2.0 * delta / (perimeter + root), 0.0)
+    return np.where(discriminant < 0, -perimeter / (2.0 * np.pi), estimate)
+
+
+def solve_buffer_distances(geometries, target_areas, search_min=-BUFFER_SEARCH_LIMIT_M,
+                           search_max=BUFFER_SEARCH_LIMIT_M, xtol=BUFFER_XTOL_M, max_iterations=MAX_ITERATIONS,
+                           initial_distances=None):
+    """
+    Distâncias de buffer que levam cada geometria (CRS métrico) à área-alvo,
+    com `search_min <= 0 <= search_max` (escalares ou um valor por
+    geometria). `initial_distances` (opcional, NaN onde não houver) substitui
+    a estimativa de Steiner como ponto de partida. Retorna (distâncias,
+    número de avaliações de buffer por geometria); a distância é NaN para
+    geometrias vazias, inválidas ou sem raiz no intervalo.
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    target_areas = np.broadcast_to(np.asarray(target_areas, dtype=np.float64), geometries.shape)
+    search_min = np.broadcast_to(np.asarray(search_min, dtype=np.float64), geometries.shape)
+    search_max = np.broadcast_to(np.asarray(search_max, dtype=np.float64), geometries.shape)
+    if np.any(search_min > 0) or np.any(search_max < 0):
+        raise ValueError("O intervalo de busca deve conter zero.")
+
+    distances = np.full(geometries.shape, np.nan)
+    evaluations = np.zeros(geometries.shape, dtype=np.int64)
+    usable = ~(shapely.is_empty(geometries) | ~shapely.is_valid(geometries))
+    if not usable.any():
+        return distances, evaluations
+
+    area = shapely.area(geometries)
+    residual = area - target_areas
+    distances[usable & (residual == 0)] = 0.0
+
+    # Colapso (alvo <= 0): basta saber se o limite inferior já zera a área
+    collapse = np.flatnonzero(usable & (residual != 0) & (target_areas <= 0))
+    if collapse.size:
+        evaluations[collapse] += 1
+        collapsed = shapely.area(shapely.buffer(geometries[collapse], search_min[collapse],
+                                                  quad_segs=BUFFER_QUAD_SEGS)) <= target_areas[collapse]
+        distances[collapse[collapsed]] = search_min[collapse[collapsed]]
+
+    # Intervalo de cada geometria: o lado em d = 0 é conhecido sem buffer; o
+    # outro começa no limite da busca, ainda não verificado
+    index = np.flatnonzero(usable & (residual != 0) & (target_areas > 0))
+    growing = residual[index] < 0
+    floor, ceiling = search_min[index], search_max[index]
+    lower = np.where(growing, 0.0, floor)
+    upper = np.where(growing, ceiling, 0.0)
+    lower_checked, upper_checked = growing.copy(), ~growing
+    targets = target_areas[index]
+    distance = np.clip(steiner_estimate(area[index], shapely.length(geometries[index]), targets), lower, upper)
+    if initial_distances is not None:
+        seed = np.broadcast_to(np.asarray(initial_distances, dtype=np.float64), geometries.shape)[index]
+        distance = np.where(np.isfinite(seed), np.clip(seed, lower, upper), distance)
+
+    for _ in range(max_iterations):
+        if index.size == 0:
+            break
+        buffered = shapely.buffer(geometries[index], distance, quad_segs=BUFFER_QUAD_SEGS)
+        evaluations[index] += 1
+        residual = shapely.area(buffered) - targets
+        slope = shapely.length(buffered)
+
+        below, above = residual < 0, residual > 0
+        lower = np.where(below, distance, lower)
+        upper = np.where(above, distance, upper)
+        lower_checked |= below
+        upper_checked |= above
+
+        # Avaliado no limite da busca sem mudar de sinal: sem raiz no intervalo
+        failed = (below & (distance >= ceiling)) | (above & (distance <= floor))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = np.where(slope > 0, distance - residual / slope, np.nan)
+        inside = (step > lower) & (step < upper)
+        # Fora do intervalo: vai ao limite ainda não verificado ou bisseciona
+        fallback = np.where(below & ~upper_checked, upper,
+                            np.where(above & ~lower_checked, lower, 0.5 * (lower + upper)))
+        following = np.where(inside, step, fallback)
+
+        solved = (residual == 0) | (np.abs(following - distance) <= xtol) | (
+            lower_checked & upper_checked & (upper - lower <= xtol))
+        result = np.where(residual == 0, distance, np.where(inside, following, 0.5 * (lower + upper)))
+        distances[index[solved & ~failed]] = result[solved & ~failed]
+
+        keep = ~(solved | failed)
+        index, distance = index[keep], following[keep]
+        lower, upper, targets = lower[keep], upper[keep], targets[keep]
+        floor, ceiling = floor[keep], ceiling[keep]
+        lower_checked, upper_checked = lower_checked[keep], upper_checked[keep]
+
+    # Sem convergência em `max_iterations`: centro do intervalo, se verificado
+    bracketed = lower_checked & upper_checked
+    distances[index[bracketed]] = 0.5 * (lower[bracketed] + upper[bracketed])
+    return distances, evaluations
+
+
+def buffer_to_areas(geometries, target_areas, **kwargs):
+    """
+    Geometrias com buffer até as áreas-alvo (as sem solução ficam inalteradas)
+    e o número de avaliações de buffer por geometria.
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    distances, evaluations = solve_buffer_distances(geometries, target_areas, **kwargs)
+    buffered = geometries.copy()
+    solved = ~np.isnan(distances)
+    buffered[solved] = shapely.buffer(geometries[solved], distances[solved], quad_segs=BUFFER_QUAD_SEGS)
+    return buffered, evaluations
+
+
+# --- EXECUÇÃO EM PARALELO ---
+
+def balanced_chunks(weights, n_chunks):
+    """
+    Divide `weights` (p. ex. vértices por geometria) em até `n_chunks` blocos
+    contíguos de soma próxima. Retorna uma lista de (início, fim).
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    if weights.size == 0:
+        return []
+    cumulative = np.cumsum(weights)
+    cuts = np.searchsorted(cumulative, cumulative[-1] * np.arange(1, n_chunks) / n_chunks, side='right')
+    bounds = np.unique(np.concatenate(([0], cuts, [weights.size])))
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def _buffer_chunk(geometries, target_areas, search_min, search_max, xtol):
+    """Executado nos workers: geometrias do bloco com buffer e número de avaliações."""
+    return buffer_to_areas(geometries, target_areas, search_min=search_min, search_max=search_max, xtol=xtol)
+
+
+def parallel_buffer_to_areas(geometries, target_areas, search_min=-BUFFER_SEARCH_LIMIT_M,
+                             search_max=BUFFER_SEARCH_LIMIT_M, xtol=BUFFER_XTOL_M, max_workers=None,
+                             chunks_per_worker=CHUNKS_PER_WORKER, progress_callback=None):
+    """
+    `buffer_to_areas` em blocos equilibrados por número de vértices,
+    resolvidos em até `max_workers` processos (None: todos os núcleos; 1: no
+    próprio processo). O resultado segue a ordem de `geometries`.
+    `progress_callback(concluídos, total)` é chamado a cada bloco concluído.
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    arrays = [np.broadcast_to(np.asarray(values, dtype=np.float64), geometries.shape)
+              for values in (target_areas, search_min, search_max)]
+    max_workers = max_workers or os.cpu_count() or 1
+    if max_workers <= 1 or geometries.size == 0:
+        return buffer_to_areas(geometries, arrays[0], search_min=arrays[1], search_max=arrays[2], xtol=xtol)
+
+    chunks = balanced_chunks(shapely.get_num_coordinates(geometries), max_workers * chunks_per_worker)
+    buffered = np.empty(geometries.shape, dtype=object)
+    evaluations = np.zeros(geometries.shape, dtype=np.int64)
+    # 'spawn' pelo mesmo motivo de scripts/batch_delineation.py (numba do PySheds)
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(chunks)),
+                             mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {pool.submit(_buffer_chunk, geometries[start:stop],
+                               *(values[start:stop] for values in arrays), xtol): (start, stop)
+                   for start, stop in chunks}
+        for done, future in enumerate(as_completed(futures), start=1):
+            start, stop = futures[future]
+            buffered[start:stop], evaluations[start:stop] = future.result()
+            if progress_callback is not None:
+                progress_callback(done, len(chunks))
+    return buffered, evaluations
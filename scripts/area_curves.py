@@ -0,0 +1,312 @@
+"""
+Curvas área x distância de buffer, pré-calculadas por polígono.
+
+Ajustar os pesos das classes (página 3) exige refazer o buffer proporcional
+a cada conjunto de pesos. As curvas tabelam, uma única vez, a área A(d) e o
+perímetro P(d) = dA/dd de `geometria.buffer(d)` em uma grade de distâncias
+simétrica e geométrica (passos finos perto de zero), com avaliações
+vetorizadas do shapely 2 sobre todos os polígonos.
+
+Com as curvas, qualquer mapeamento de pesos é resolvido com poucos buffers:
+
+- a distância de cada polígono vem da inversão da interpolação cúbica de
+  Hermite de A(d) entre os dois nós que cercam a área-alvo (com as derivadas
+  exatas P(d)). A(d) tem quebras onde partes do polígono somem
+  (encolhimentos fortes de polígonos em escada de pixels), que a
+  interpolação não vê; por isso a estimativa serve de ponto de partida para
+  `solve_buffer_distances`, que a confirma com um passo de Newton (ou segue
+  iterando, com salvaguarda, nos polígonos perto das quebras) e dá a mesma
+  precisão da busca direta com uma fração das avaliações de buffer;
+- a área inundada por classe de um conjunto de pesos é a soma das áreas-alvo
+  dos polígonos com solução no intervalo tabelado (os demais ficam com a
+  área original, como no buffer proporcional), o que permite conjuntos de
+  Monte Carlo com milhares de mapeamentos em segundos.
+
+A tabela de cada lado para quando todos os polígonos passaram da variação
+`max_percent` (ou do limite de 500 m da busca); pesos acima de
+`max_percent` em módulo exigem novas curvas. As curvas gravadas levam uma
+assinatura das geometrias de entrada e da grade (`curves_signature`), que
+quem as reutiliza confere contra a camada.
+"""
+import hashlib
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from scripts.area_buffer import solve_buffer_distances, BUFFER_SEARCH_LIMIT_M, BUFFER_XTOL_M, BUFFER_QUAD_SEGS
+
+
+DEFAULT_MAX_PERCENT = 100.0
+FIRST_STEP_M = 0.25
+STEP_GROWTH = 1.5
+CURVE_DTYPE = np.float32
+NEWTON_ITERATIONS = 30
+
+
+# --- TABELA ---
+
+def curve_distances(limit_m=BUFFER_SEARCH_LIMIT_M, first_step=FIRST_STEP_M, growth=STEP_GROWTH):
+    """Distâncias dos nós: 0, ±first_step, ±first_step·growth, ... até ±limit_m (inclusive)."""
+    positive = [0.0]
+    step = first_step
+    while positive[-1] < limit_m:
+        positive.append(min(positive[-1] + step, limit_m))
+        step *= growth
+    positive = np.asarray(positive)
+    return np.concatenate((-positive[:0:-1], positive))
+
+
+def build_area_curves(geometries, max_percent=DEFAULT_MAX_PERCENT, limit_m=BUFFER_SEARCH_LIMIT_M,
+                      progress_callback=None):
+    """
+    Tabela A(d) e P(d) dos polígonos (CRS métrico). Retorna um dicionário com
+    `distancias` (k,), `areas` e `perimetros` (n, k, float32; NaN além do
+    ponto em que o polígono passou de `max_percent`) e `area_original` (n,).
+    Geometrias vazias ou inválidas ficam sem curva (NaN).
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    distances = curve_distances(limit_m)
+    zero = int(np.flatnonzero(distances == 0)[0])
+    areas = np.full((geometries.size, distances.size), np.nan, dtype=CURVE_DTYPE)
+    perimeters = np.full_like(areas, np.nan)
+
+    usable = ~(shapely.is_empty(geometries) | ~shapely.is_valid(geometries))
+    area0 = np.where(usable, shapely.area(geometries), np.nan)
+    areas[usable, zero] = area0[usable]
+    perimeters[usable, zero] = shapely.length(geometries[usable])
+    bounds = {1: area0 * (1.0 + max_percent / 100.0), -1: area0 * max(1.0 - max_percent / 100.0, 0.0)}
+
+    total = distances.size - 1
+    done = 0
+    for side, columns in ((1, range(zero + 1, distances.size)), (-1, range(zero - 1, -1, -1))):
+        active = np.flatnonzero(usable)
+        for column in columns:
+            done += 1
+            if active.size == 0:
+                continue
+            buffered = shapely.buffer(geometries[active], distances[column], quad_segs=BUFFER_QUAD_SEGS)
+            area = shapely.area(buffered)
+            areas[active, column] = area
+            perimeters[active, column] = shapely.length(buffered)
+            # Com a variação máxima já coberta, o polígono sai da tabela deste lado
+            passed = area >= bounds[1][active] if side > 0 else (area <= bounds[-1][active]) | (area == 0)
+            active = active[~passed]
+            if progress_callback is not None:
+                progress_callback(done, total)
+    return {'distancias': distances, 'areas': areas, 'perimetros': perimeters, 'area_original': area0,
+            'max_percent': float(max_percent)}
+
+
+def curves_signature(geometries, curves):
+    """
+    Hash (sha256) das geometrias (WKB, na ordem da camada), da grade de
+    distâncias e da variação máxima das curvas: curvas de outra camada, ainda
+    que com o mesmo número de feições, têm outra assinatura.
+    """
+    digest = hashlib.sha256()
+    for wkb in shapely.to_wkb(np.asarray(geometries, dtype=object)):
+        digest.update(wkb or b'')
+    digest.update(np.asarray(curves['distancias'], dtype=np.float64).tobytes())
+    digest.update(repr(float(curves['max_percent'])).encode())
+    return digest.hexdigest()
+
+
+def save_area_curves(path, curves, **extra):
+    """Grava as curvas (e arrays extras, como as classes) em .npz comprimido."""
+    np.savez_compressed(path, **curves, **extra)
+    return path
+
+
+def load_area_curves(path):
+    with np.load(path, allow_pickle=False) as data:
+        curves = {key: data[key] for key in data.files}
+    curves['max_percent'] = float(curves['max_percent'])
+    if 'assinatura' in curves:
+        curves['assinatura'] = str(curves['assinatura'])
+    return curves
+
+
+# --- INVERSÃO ---
+
+def _check_percent(curves, percents):
+    if np.nanmax(np.abs(percents), initial=0.0) > curves['max_percent'] + 1e-9:
+        raise ValueError(f"Pesos acima de ±{curves['max_percent']:g}% estão fora das curvas pré-calculadas; "
+                         f"recalcule as curvas com uma variação máxima maior.")
+
+
+def invert_area_curves(curves, target_areas):
+    """
+    Distância de buffer que leva cada polígono à área-alvo, pela inversão da
+    interpolação de Hermite entre os nós. NaN quando o alvo está fora do
+    intervalo tabelado (sem solução em ±500 m) ou o polígono não tem curva.
+    """
+    distances, areas, slopes = curves['distancias'], curves['areas'], curves['perimetros']
+    targets = np.asarray(target_areas, dtype=np.float64)
+    n, k = areas.shape
+    zero = int(np.flatnonzero(distances == 0)[0])
+
+    # NaN à esquerda do zero (já abaixo do mínimo) vira -inf; à direita, +inf
+    filled = areas.astype(np.float64)
+    filled[:, zero] = curves['area_original']
+    missing = np.isnan(filled)
+    filled[:, :zero][missing[:, :zero]] = -np.inf
+    filled[:, zero + 1:][missing[:, zero + 1:]] = np.inf
+    upper = (filled < targets[:, None]).sum(axis=1)
+    upper = np.where(np.isnan(areas[:, zero]) | np.isnan(targets), 0, upper)
+
+    result = np.full(n, np.nan)
+    result[targets == curves['area_original']] = 0.0
+    exact = filled[np.arange(n), np.minimum(upper, k - 1)] == targets
+    result[exact & (upper < k)] = distances[upper[exact & (upper < k)]]
+    inside = ~exact & (upper > 0) & (upper < k)
+    rows, right = np.flatnonzero(inside), upper[inside]
+    left = right - 1
+    a0, a1 = filled[rows, left], filled[rows, right]
+    bracketed = np.isfinite(a0) & np.isfinite(a1)
+    rows, left, right, a0, a1 = rows[bracketed], left[bracketed], right[bracketed], a0[bracketed], a1[bracketed]
+    width = distances[right] - distances[left]
+    m0 = slopes[rows, left].astype(np.float64) * width
+    m1 = slopes[rows, right].astype(np.float64) * width
+    target = targets[rows]
+
+    # Newton com salvaguarda (bisseção) em s ∈ [0, 1] no polinômio de Hermite
+    s = np.clip((target - a0) / np.where(a1 > a0, a1 - a0, 1.0), 0.0, 1.0)
+    low, high = np.zeros_like(s), np.ones_like(s)
+    for _ in range(NEWTON_ITERATIONS):
+        s2, s3 = s * s, s * s * s
+        value = ((2 * s3 - 3 * s2 + 1) * a0 + (s3 - 2 * s2 + s) * m0 + (-2 * s3 + 3 * s2) * a1
+                 + (s3 - s2) * m1) - target
+        derivative = (6 * s2 - 6 * s) * a0 + (3 * s2 - 4 * s + 1) * m0 + (-6 * s2 + 6 * s) * a1 + (3 * s2 - 2 * s) * m1
+        low = np.where(value < 0, s, low)
+        high = np.where(value > 0, s, high)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = s - value / derivative
+        s = np.where((step > low) & (step < high), step, 0.5 * (low + high))
+    result[rows] = distances[left] + s * width
+    return result
+
+
+def weight_percents(classes, mapping):
+    """Porcentagem de cada polígono pelo mapeamento {classe: %} (NaN para classes sem peso)."""
+    keys = {float(key): float(value) for key, value in mapping.items()}
+    return np.array([keys.get(float(value), np.nan) for value in classes])
+
+
+def buffer_with_curves(geometries, curves, percents, xtol=BUFFER_XTOL_M):
+    """
+    Geometrias com buffer pela porcentagem de cada polígono. A distância das
+    curvas é o ponto de partida de `solve_buffer_distances` (mesma tolerância
+    `xtol` e mesmos limites da busca direta), só nos polígonos com solução
+    dentro da tabela. Polígonos sem solução (ou com porcentagem NaN) ficam
+    inalterados. Retorna (geometrias, distâncias, avaliações de buffer por
+    polígono, sem contar o buffer final).
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    percents = np.asarray(percents, dtype=np.float64)
+    _check_percent(curves, percents)
+    targets = curves['area_original'] * (1.0 + percents / 100.0)
+    estimates = invert_area_curves(curves, targets)
+    distances = np.full(geometries.shape, np.nan)
+    evaluations = np.zeros(geometries.shape, dtype=np.int64)
+    reachable = np.flatnonzero(~np.isnan(estimates))
+    limit = float(curves['distancias'][-1])
+    growing = percents[reachable] >= 0
+    distances[reachable], evaluations[reachable] = solve_buffer_distances(
+        geometries[reachable], targets[reachable], np.where(growing, 0.0, -limit), np.where(growing, limit, 0.0),
+        xtol=xtol, initial_distances=estimates[reachable])
+
+    buffered = geometries.copy()
+    solved = ~np.isnan(distances)
+    buffered[solved] = shapely.buffer(geometries[solved], distances[solved], quad_segs=BUFFER_QUAD_SEGS)
+    return buffered, distances, evaluations
+
+
+# --- SENSIBILIDADE DOS PESOS ---
+
+def reachable_range(curves):
+    """
+    Variação de área (%) mínima e máxima que cada polígono alcança dentro da
+    tabela: pesos fora de [mínimo, máximo] deixam o polígono inalterado.
+    """
+    areas, area0 = curves['areas'].astype(np.float64), curves['area_original']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lowest = (np.nanmin(areas, axis=1) / area0 - 1.0) * 100.0
+        highest = (np.nanmax(areas, axis=1) / area0 - 1.0) * 100.0
+    return lowest, highest
+
+
+def sample_weight_mappings(mapping, spread, n_samples, seed=None):
+    """
+    `n_samples` mapeamentos com cada peso sorteado uniformemente em
+    peso ± `spread` (pontos percentuais). Retorna (classes, matriz
+    n_samples x classes de porcentagens).
+    """
+    rng = np.random.default_rng(seed)
+    classes = np.array(sorted(float(key) for key in mapping))
+    center = np.array([float(mapping[key]) for key in sorted(mapping, key=float)])
+    return classes, center + rng.uniform(-spread, spread, size=(int(n_samples), classes.size))
+
+
+def _solved_area(limits, area0, percent, growing):
+    """Soma de `area0` dos polígonos que alcançam `percent` (limite >= p ao crescer, <= p ao encolher)."""
+    order = np.argsort(limits)
+    limits, cumulative = limits[order], np.concatenate(([0.0], np.cumsum(area0[order])))
+    if growing:
+        return cumulative[-1] - cumulative[np.searchsorted(limits, percent, side='left')]
+    return cumulative[np.searchsorted(limits, percent, side='right')]
+
+
+def ensemble_class_areas(curves, classes, class_values, percent_matrix):
+    """
+    Área inundada (m²) por classe para cada linha de `percent_matrix`
+    (mapeamentos x `class_values`). Cada polígono com solução fica com a
+    área-alvo; os demais, com a área original. Como a solução existe para p
+    entre os limites de `reachable_range`, a soma das áreas resolvidas sai de
+    somas acumuladas dos polígonos ordenados pelo limite, sem percorrer os
+    polígonos a cada mapeamento. Retorna a matriz (mapeamentos x classes).
+    """
+    percent_matrix = np.atleast_2d(np.asarray(percent_matrix, dtype=np.float64))
+    _check_percent(curves, percent_matrix)
+    lowest, highest = reachable_range(curves)
+    area0 = curves['area_original']
+    classes = np.asarray(classes, dtype=np.float64)
+    result = np.zeros(percent_matrix.shape)
+    for column, value in enumerate(np.asarray(class_values, dtype=np.float64)):
+        members = (classes == value) & np.isfinite(lowest) & np.isfinite(highest)
+        percent = percent_matrix[:, column]
+        growing = percent >= 0
+        solved = np.where(growing, _solved_area(highest[members], area0[members], percent, True),
+                          _solved_area(lowest[members], area0[members], percent, False))
+        result[:, column] = np.nansum(area0[classes == value]) + percent / 100.0 * solved
+    return result
+
+
+def weight_ensemble(curves, mapping, spread, n_samples, seed=None, percentiles=(5, 50, 95)):
+    """
+    Monte Carlo dos pesos: `n_samples` mapeamentos em torno de `mapping`
+    (± `spread` pontos percentuais) avaliados pelas curvas, que precisam das
+    classes de cada polígono (`classes`). Retorna (resumo por classe,
+    porcentagens sorteadas, áreas por classe de cada mapeamento).
+    """
+    if 'classes' not in curves:
+        raise ValueError("As curvas não têm as classes dos polígonos; recalcule-as com a coluna de referência.")
+    class_values, percents = sample_weight_mappings(mapping, spread, n_samples, seed)
+    limit = curves['max_percent']
+    percents = np.clip(percents, -limit, limit)
+    class_areas = ensemble_class_areas(curves, curves['classes'], class_values, percents)
+    return ensemble_statistics(class_values, class_areas, percentiles), percents, class_areas
+
+
+def ensemble_statistics(class_values, class_areas, percentiles=(5, 50, 95)):
+    """Resumo por classe (média, desvio-padrão e percentis da área em m²) de um conjunto de Monte Carlo."""
+    class_areas = np.asarray(class_areas, dtype=np.float64)
+    table = {'classe': np.asarray(class_values), 'area_media_m2': class_areas.mean(axis=0),
+             'area_desvio_m2': class_areas.std(axis=0)}
+    for percentile in percentiles:
+        table[f'area_p{percentile:g}_m2'] = np.percentile(class_areas, percentile, axis=0)
+    summary = pd.DataFrame(table)
+    total = class_areas.sum(axis=1)
+    summary.loc[len(summary)] = ['total', total.mean(), total.std(),
+                                 *(np.percentile(total, percentile) for percentile in percentiles)]
+    return summary
@@ -0,0 +1,227 @@
+"""
+Cache persistente (endereçado por conteúdo) dos artefatos do pré-processamento.
+
+Cada entrada é identificada por um hash dos bytes do MDE e dos parâmetros que
+afetam o resultado (dirmap, limiar de drenagem, modo de processamento e versão
+do código). Os arquivos gerados (rasters e rede de drenagem) e os arrays usados
+na Etapa 2 (MDE condicionado, direção e acumulação de fluxo) ficam em disco,
+de modo que um novo clique com o mesmo MDE e parâmetros não recalcula nada.
+
+O tamanho total do cache é limitado; ao ultrapassar o limite, as entradas
+usadas há mais tempo são removidas (LRU).
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+from affine import Affine
+from pyproj import CRS
+
+try:
+    from pysheds.grid import Grid
+    from pysheds.sview import Raster, ViewFinder
+except ImportError:
+    print("Erro: Biblioteca 'pysheds' não encontrada. Instale com 'pip install pysheds'")
+    raise
+
+
+CACHE_FORMAT_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join("cache", "preprocessamento")
+DEFAULT_CACHE_MAX_BYTES = 5 * 1024 ** 3  # 5 GB
+META_FILE = "meta.json"
+IN_MEMORY_RASTERS = ('inflated_dem', 'fdir', 'acc')
+# Valores simples de `results` guardados no meta.json. O modo de memória decide
+# o dtype da direção de fluxo em `load_preprocessing_results`; o pico medido
+# não é guardado (uma entrada recuperada não tem pico próprio)
+EXTRA_KEYS = ('dirmap', 'tiled', 'baixa_memoria', 'memoria_estimada_mb', 'modo_memoria')
+
+_HASH_CHUNK = 8 * 1024 * 1024
+
+
+def file_fingerprint(path):
+    """Hash SHA-256 do conteúdo de um arquivo, lido em blocos."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def code_version(*source_paths):
+    """Versão do código: hash do conteúdo dos módulos que geram os artefatos."""
+    digest = hashlib.sha256(str(CACHE_FORMAT_VERSION).encode())
+    for path in source_paths:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def make_cache_key(mde_path, params):
+    """Chave da entrada: hash do MDE + parâmetros (serializados de forma estável)."""
+    payload = json.dumps({'dem': file_fingerprint(mde_path), 'params': params},
+                         sort_keys=True, default=list)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def _read_meta(entry_dir):
+    try:
+        with open(os.path.join(entry_dir, META_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_meta(entry_dir, meta):
+    tmp_path = os.path.join(entry_dir, META_FILE + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(entry_dir, META_FILE))
+
+
+def load_cached_preprocessing(cache_dir, key, output_dir):
+    """
+    Recupera uma entrada do cache. Os arquivos são copiados para `output_dir` e
+    os objetos PySheds são reconstruídos. Retorna None se não houver entrada.
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    meta = _read_meta(entry_dir)
+    if meta is None:
+        return None
+
+    results = {}
+    for name, file_name in meta['files'].items():
+        source = os.path.join(entry_dir, file_name)
+        if not os.path.exists(source):
+            return None
+        destination = os.path.join(output_dir, file_name)
+        shutil.copyfile(source, destination)
+        results[name] = destination
+
+    if meta.get('grid'):
+        grid_meta = meta['grid']
+        viewfinder = ViewFinder(affine=Affine(*grid_meta['affine']), shape=tuple(grid_meta['shape']),
+                                crs=CRS.from_wkt(grid_meta['crs_wkt']),
+                                nodata=_from_json_number(grid_meta['nodata']))
+        results['grid'] = Grid(viewfinder=viewfinder)
+        for name, raster_meta in meta['rasters'].items():
+            array = np.load(os.path.join(entry_dir, raster_meta['file']))
+            raster_viewfinder = ViewFinder(affine=viewfinder.affine, shape=viewfinder.shape,
+                                           crs=viewfinder.crs,
+                                           nodata=_from_json_number(raster_meta['nodata']))
+            results[name] = Raster(array, viewfinder=raster_viewfinder)
+
+    results.update(meta.get('extra', {}))
+    if 'dirmap' in results:
+        results['dirmap'] = tuple(results['dirmap'])
+    results['from_cache'] = True
+
+    meta['last_access'] = time.time()
+    _write_meta(entry_dir, meta)
+    return results
+
+
+def store_preprocessing(cache_dir, key, results, params, max_bytes=DEFAULT_CACHE_MAX_BYTES, files=True):
+    """
+    Grava os artefatos de `results` no cache (arquivos `*_path` e, se presentes,
+    os arrays em memória) e aplica o limite de tamanho. Com `files=False`, só
+    os arrays são gravados (os arquivos continuam onde estão).
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(entry_dir, META_FILE)):
+        return entry_dir
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = os.path.join(cache_dir, f"{key}.tmp-{os.getpid()}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    meta = {'key': key, 'params': params, 'created': time.time(), 'last_access': time.time(),
+            'files': {}, 'rasters': {}, 'grid': None, 'extra': {}}
+
+    for name, value in results.items():
+        if files and name.endswith('_path') and value and os.path.exists(value):
+            file_name = os.path.basename(value)
+            shutil.copyfile(value, os.path.join(tmp_dir, file_name))
+            meta['files'][name] = file_name
+        elif name in EXTRA_KEYS:
+            meta['extra'][name] = value
+
+    grid = results.get('grid')
+    if grid is not None:
+        viewfinder = grid.viewfinder
+        meta['grid'] = {'affine': list(viewfinder.affine)[:6], 'shape': list(viewfinder.shape),
+                        'crs_wkt': CRS.from_user_input(viewfinder.crs).to_wkt(),
+                        'nodata': _json_number(viewfinder.nodata)}
+        for name in IN_MEMORY_RASTERS:
+            raster = results.get(name)
+            if raster is None:
+                continue
+            file_name = f"{name}.npy"
+            np.save(os.path.join(tmp_dir, file_name), np.asarray(raster))
+            meta['rasters'][name] = {'file': file_name, 'nodata': _json_number(raster.nodata)}
+
+    meta['size_bytes'] = _dir_size(tmp_dir)
+    _write_meta(tmp_dir, meta)
+    try:
+        os.replace(tmp_dir, entry_dir)
+    except OSError:
+        # Outra execução gravou a mesma entrada primeiro
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    enforce_cache_size(cache_dir, max_bytes, protect=(key,))
+    return entry_dir
+
+
+def enforce_cache_size(cache_dir, max_bytes, protect=()):
+    """Remove as entradas menos usadas recentemente até o cache caber em `max_bytes`."""
+    if not os.path.isdir(cache_dir):
+        return []
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, name)
+        meta = _read_meta(entry_dir)
+        if meta is None:
+            continue
+        entries.append((meta.get('last_access', 0.0), name, meta.get('size_bytes') or _dir_size(entry_dir)))
+
+    total = sum(size for _, _, size in entries)
+    removed = []
+    for _, name, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if name in protect:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        total -= size
+        removed.append(name)
+    return removed
+
+
+def clear_cache(cache_dir):
+    """Remove todas as entradas do cache."""
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def _json_number(value):
+    """Converte nodata (possivelmente NaN ou tipo NumPy) para um valor serializável."""
+    if value is None:
+        return None
+    value = value.item() if hasattr(value, 'item') else value
+    if isinstance(value, float) and np.isnan(value):
+        return 'nan'
+    return value
+
+
+def _from_json_number(value):
+    return np.nan if value == 'nan' else value
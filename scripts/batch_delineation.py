@@ -0,0 +1,243 @@
+"""
+Delineamento em lote de vários exutórios sobre o mesmo MDE.
+
+Os rasters do pré-processamento (MDE condicionado, direção e acumulação de
+fluxo) são gravados uma única vez em arquivos .npy e abertos em modo somente
+leitura (memmap) por cada processo do pool, de modo que os workers
+compartilham as páginas do cache do sistema em vez de receber cópias dos
+arrays. Cada exutório é delineado com `run_delineation` no modo de janela
+da bacia (que não altera o grid compartilhado) e grava seus resultados em uma
+pasta própria; ao final, bacias e manchas de inundação são reunidas em uma
+camada única com o atributo `exutorio_id`.
+"""
+import os
+import re
+import shutil
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from affine import Affine
+from pyproj import CRS
+
+try:
+    from pysheds.grid import Grid
+    from pysheds.sview import Raster, ViewFinder
+except ImportError:
+    print("Erro: Biblioteca 'pysheds' não encontrada. Instale com 'pip install pysheds'")
+    raise
+
+from scripts.local_analysis_helpers import load_preprocessing_results, run_delineation
+from scripts.profiling import stage
+
+
+SHARED_RASTERS = ('inflated_dem', 'fdir', 'acc')
+X_COLUMNS = ('x', 'lon', 'longitude')
+Y_COLUMNS = ('y', 'lat', 'latitude')
+ID_COLUMNS = ('id', 'nome', 'name', 'codigo', 'estacao')
+
+# Dados compartilhados carregados uma vez por processo (ver _init_worker)
+_WORKER_DATA = None
+
+
+def read_outlets(outlets_path, target_crs=None, id_column=None):
+    """
+    Lê os exutórios de um CSV (colunas x/y, lon/lat ou longitude/latitude, em
+    coordenadas do MDE) ou de um arquivo vetorial de pontos (GeoJSON, shapefile
+    etc., reprojetado para `target_crs`). Retorna uma lista de (id, x, y).
+    """
+    if not os.path.exists(outlets_path):
+        raise FileNotFoundError(f"Arquivo de exutórios '{outlets_path}' não encontrado.")
+
+    if outlets_path.lower().endswith('.csv'):
+        df = pd.read_csv(outlets_path)
+        columns = {c.lower(): c for c in df.columns}
+        x_col = next((columns[c] for c in X_COLUMNS if c in columns), None)
+        y_col = next((columns[c] for c in Y_COLUMNS if c in columns), None)
+        if x_col is None or y_col is None:
+            raise ValueError(f"O CSV de exutórios deve ter colunas de coordenadas {X_COLUMNS} e {Y_COLUMNS}.")
+        xs, ys = df[x_col].to_numpy(dtype=float), df[y_col].to_numpy(dtype=float)
+    else:
+        df = gpd.read_file(outlets_path)
+        if not (df.geom_type == 'Point').all():
+            raise ValueError("O arquivo de exutórios deve conter apenas geometrias do tipo ponto.")
+        if target_crs is not None and df.crs is not None:
+            df = df.to_crs(target_crs)
+        xs, ys = df.geometry.x.to_numpy(), df.geometry.y.to_numpy()
+        columns = {c.lower(): c for c in df.columns if c != 'geometry'}
+
+    if id_column is None:
+        id_column = next((columns[c] for c in ID_COLUMNS if c in columns), None)
+    elif id_column not in df.columns:
+        raise ValueError(f"Coluna de identificação '{id_column}' não encontrada no arquivo de exutórios.")
+    ids = df[id_column].astype(str).tolist() if id_column else [str(i + 1) for i in range(len(df))]
+
+    if len(set(ids)) != len(ids):
+        raise ValueError("Os identificadores dos exutórios devem ser únicos.")
+    if not ids:
+        raise ValueError("Nenhum exutório encontrado no arquivo.")
+    return [(outlet_id, float(x), float(y)) for outlet_id, x, y in zip(ids, xs, ys)]
+
+
+def _safe_name(outlet_id):
+    return re.sub(r'[^0-9A-Za-z_-]+', '_', outlet_id).strip('_') or 'exutorio'
+
+
+def _share_rasters(preproc_data, shared_dir):
+    """Grava os rasters em .npy e retorna os metadados necessários nos workers."""
+    grid = preproc_data['grid']
+    viewfinder = grid.viewfinder
+    shared = {
+        'affine': tuple(viewfinder.affine)[:6],
+        'shape': tuple(viewfinder.shape),
+        'crs_wkt': CRS.from_user_input(viewfinder.crs).to_wkt(),
+        'nodata': viewfinder.nodata,
+        'dirmap': tuple(preproc_data['dirmap']),
+        'indice_rede_path': preproc_data.get('indice_rede_path'),
+        'rasters': {},
+    }
+    for name in SHARED_RASTERS:
+        raster = preproc_data[name]
+        path = os.path.join(shared_dir, f"{name}.npy")
+        np.save(path, np.asarray(raster))
+        shared['rasters'][name] = (path, raster.nodata)
+    return shared
+
+
+def _init_worker(shared):
+    """Abre os rasters compartilhados (somente leitura) uma vez por processo."""
+    global _WORKER_DATA
+    crs = CRS.from_wkt(shared['crs_wkt'])
+    affine = Affine(*shared['affine'])
+    data = {'grid': Grid(viewfinder=ViewFinder(affine=affine, shape=shared['shape'], crs=crs,
+                                               nodata=shared['nodata'])),
+            'dirmap': shared['dirmap'], 'indice_rede_path': shared['indice_rede_path']}
+    for name, (path, nodata) in shared['rasters'].items():
+        array = np.load(path, mmap_mode='r')
+        data[name] = Raster(array, viewfinder=ViewFinder(affine=affine, shape=shared['shape'], crs=crs,
+                                                         nodata=nodata))
+    _WORKER_DATA = data
+
+
+def _silent_progress(message, percentage):
+    pass
+
+
+def _delineate_outlet(outlet_id, x, y, channel_depth, stream_threshold, outlet_dir, generate_flu_distance,
+                      smooth_iterations):
+    """Executado no worker: delineamento + HAND de um exutório."""
+    os.makedirs(outlet_dir, exist_ok=True)
+    try:
+        # O paralelismo é entre exutórios: a vetorização de cada um roda no próprio worker
+        results = run_delineation(_WORKER_DATA, (x, y), channel_depth, stream_threshold, outlet_dir,
+                                  _silent_progress, generate_flu_distance=generate_flu_distance,
+                                  clip_domain=True, polygonize_workers=1, smooth_iterations=smooth_iterations)
+    except Exception as e:
+        return outlet_id, None, str(e)
+    return outlet_id, results, None
+
+
+def _merge_layers(outlet_results, key, crs):
+    layers = []
+    for outlet_id, results in outlet_results:
+        path = results.get(key)
+        if not path:
+            continue
+        gdf = gpd.read_file(path)
+        gdf.insert(0, 'exutorio_id', outlet_id)
+        layers.append(gdf)
+    if not layers:
+        return None
+    return gpd.GeoDataFrame(pd.concat(layers, ignore_index=True), crs=crs)
+
+
+def run_batch_delineation(preproc_data, outlets_path, channel_depth, stream_threshold, output_dir,
+                          progress_callback, max_workers=None, generate_flu_distance=False, id_column=None,
+                          smooth_iterations=0):
+    """
+    Delineia bacia e mancha de inundação (HAND) para todos os exutórios de
+    `outlets_path`, em paralelo.
+
+    Cada exutório grava seus arquivos em `output_dir/exutorio_<id>`; as bacias e
+    manchas de inundação de todos os exutórios são reunidas em
+    `bacias_lote.geojson` e `inundacao_lote_<profundidade>.geojson`. Exutórios
+    que falharem (ex.: fora do MDE) são listados em `results['erros']` sem
+    interromper os demais.
+    """
+    results = {}
+
+    if 'grid' not in preproc_data:
+        progress_callback("Carregando rasters do pré-processamento em blocos...", 2)
+        with stage(progress_callback, 'load_preprocessing'):
+            preproc_data = load_preprocessing_results(preproc_data)
+    crs = preproc_data['grid'].viewfinder.crs
+
+    progress_callback("Lendo exutórios...", 5)
+    outlets = read_outlets(outlets_path, target_crs=crs, id_column=id_column)
+    names = [_safe_name(outlet_id) for outlet_id, _, _ in outlets]
+    if len(set(names)) != len(names):
+        raise ValueError("Identificadores de exutórios distintos geram o mesmo nome de pasta.")
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = max(1, min(int(max_workers), len(outlets)))
+
+    os.makedirs(output_dir, exist_ok=True)
+    shared_dir = tempfile.mkdtemp(prefix='_lote_tmp', dir=output_dir)
+    outlet_results, errors = [], {}
+    try:
+        progress_callback("Compartilhando rasters do pré-processamento com os workers...", 10)
+        with stage(progress_callback, 'share_rasters'):
+            shared = _share_rasters(preproc_data, shared_dir)
+
+        progress_callback(f"Delineando {len(outlets)} exutórios com {max_workers} processo(s)...", 15)
+        # 'spawn': o PySheds compila kernels numba paralelos na importação e um fork
+        # com o pool de threads do numba ativo pode travar o processo principal
+        with stage(progress_callback, 'delineate_outlets'):
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=_init_worker,
+                                     initargs=(shared,)) as pool:
+                futures = [pool.submit(_delineate_outlet, outlet_id, x, y, channel_depth, stream_threshold,
+                                       os.path.join(output_dir, f"exutorio_{name}"), generate_flu_distance,
+                                       smooth_iterations)
+                           for (outlet_id, x, y), name in zip(outlets, names)]
+                for done, future in enumerate(as_completed(futures), start=1):
+                    outlet_id, outlet_result, error = future.result()
+                    if error is None:
+                        outlet_results.append((outlet_id, outlet_result))
+                    else:
+                        errors[outlet_id] = error
+                    progress_callback(f"Exutório '{outlet_id}' concluído ({done}/{len(outlets)}).",
+                                      15 + int(75 * done / len(outlets)))
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+
+    # Mantém a ordem do arquivo de entrada
+    order = {outlet_id: i for i, (outlet_id, _, _) in enumerate(outlets)}
+    outlet_results.sort(key=lambda item: order[item[0]])
+    results['exutorios'] = dict(outlet_results)
+    results['erros'] = errors
+
+    progress_callback("Reunindo resultados em camadas únicas...", 92)
+    with stage(progress_callback, 'merge_layers'):
+        bacias_gdf = _merge_layers(outlet_results, 'bacia_path', crs)
+        if bacias_gdf is not None:
+            bacias_path = os.path.join(output_dir, 'bacias_lote.geojson')
+            bacias_gdf.to_file(bacias_path, driver='GeoJSON')
+            results['bacias_path'] = bacias_path
+
+        flood_gdf = _merge_layers(outlet_results, 'inundacao_vetor_path', crs)
+        if flood_gdf is not None:
+            suffix = outlet_results[0][1]['suffix']
+            inundacao_vetor_path = os.path.join(output_dir, f'inundacao_lote_{suffix}.geojson')
+            flood_gdf.to_file(inundacao_vetor_path, driver='GeoJSON')
+            results['inundacao_vetor_path'] = inundacao_vetor_path
+
+    if not outlet_results:
+        raise RuntimeError(f"Nenhum exutório foi delineado com sucesso. Erros: {errors}")
+
+    progress_callback("Delineamento em lote concluído.", 100)
+    return results
@@ -0,0 +1,118 @@
+"""
+Benchmark do buffer proporcional (`run_proportional_buffer`): busca `brentq`
+por polígono (como antes) x solucionador em lote de `scripts/area_buffer.py`,
+com 1 e N processos.
+
+Usa uma camada `inundacao_segmentada_por_solo.geojson` existente ou uma
+sintética: a máscara de `scripts/benchmark_polygonize.py` (N x N células de
+30 m) cortada por classes de solo em manchas, vetorizada como na interseção
+com o solo (um polígono por fragmento de inundação em cada classe).
+
+Uso:
+    python -m scripts.benchmark_buffer [--tamanho 3000] [--vetor inundacao_segmentada_por_solo.geojson]
+                                       [--processos 4] [--sem-anterior]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+import geopandas as gpd
+from rasterio import features
+from affine import Affine
+from scipy import ndimage
+from shapely.geometry import shape
+
+from scripts.benchmark_polygonize import synthetic_mask
+
+# scripts.local_analysis_helpers é importado dentro das funções: com 'spawn',
+# cada processo do pool reimporta este módulo (__main__), e o import do osmnx
+# custaria segundos por processo, somados ao tempo medido
+
+
+# Pesos de referência da página 3 (Modelo de Risco por Solo)
+DEFAULT_MAPPING = {1: 55.0, 2: 35.0, 3: 15.0, 4: -15.0, 5: -35.0, 6: -55.0}
+
+
+def write_synthetic_segmented(path, size, n_classes=6, seed=0):
+    """Grava uma camada segmentada por solo sintética (CRS geográfico, como a saída da interseção)."""
+    rng = np.random.default_rng(seed + 1)
+    field = ndimage.gaussian_filter(rng.random((size, size)), 12)
+    soil = np.digitize(field, np.quantile(field, np.linspace(0, 1, n_classes + 1)[1:-1]))
+    labels = np.where(synthetic_mask(size, 4, seed), soil + 1, 0).astype(np.int32)
+    transform = Affine(30, 0, 500000, 0, -30, 7500000)
+    polygons, values = [], []
+    for geom, value in features.shapes(labels, mask=labels > 0, transform=transform):
+        polygons.append(shape(geom))
+        values.append(int(value))
+    gdf = gpd.GeoDataFrame({'valor_solo': values}, geometry=polygons, crs='EPSG:31983').to_crs('EPSG:4326')
+    gdf.to_file(path, driver='GeoJSON')
+    return path
+
+
+def legacy_buffer(gdf, reference_column, mapping):
+    """Buffer anterior: duas buscas `brentq` por polígono (só a do sinal do peso é usada)."""
+    from scripts.local_analysis_helpers import find_buffer_distance_for_area, METRIC_CRS, BRENTQ_UPPER_LIMIT_M
+    gdf_proj = gdf.to_crs(METRIC_CRS)
+    for geom, value in zip(gdf_proj.geometry, gdf_proj[reference_column]):
+        if value not in mapping or geom.is_empty or not geom.is_valid:
+            continue
+        percent = abs(mapping[value])
+        for target, low, high in ((geom.area * (1 + percent / 100), 0.0, BRENTQ_UPPER_LIMIT_M),
+                                  (geom.area * (1 - percent / 100), -BRENTQ_UPPER_LIMIT_M, 0.0)):
+            try:
+                geom.buffer(find_buffer_distance_for_area(geom, target, low, high))
+            except ValueError:
+                pass
+
+
+def _timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def run_benchmark(vector_path, mapping, workers, with_legacy=True):
+    """Retorna uma lista de (descrição, tempo em s) e a maior diferença de área entre 1 e N processos."""
+    from scripts.local_analysis_helpers import run_proportional_buffer, METRIC_CRS
+    rows = []
+    if with_legacy:
+        gdf = gpd.read_file(vector_path)
+        _, elapsed = _timed(lambda: legacy_buffer(gdf, 'valor_solo', mapping))
+        rows.append(("anterior (brentq por polígono)", elapsed))
+    areas = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for n in sorted({1, workers}):
+            results, elapsed = _timed(lambda: run_proportional_buffer(
+                vector_path, 'valor_solo', mapping, temp_dir, lambda message, percentage: None, max_workers=n))
+            rows.append((f"em lote ({n} processo(s))", elapsed))
+            areas[n] = gpd.read_file(results['merge_path']).to_crs(METRIC_CRS).area.to_numpy()
+    difference = float(np.max(np.abs(areas[1] - areas[workers]))) if len(areas[1]) else 0.0
+    return rows, difference
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark do buffer proporcional.")
+    parser.add_argument('--tamanho', type=int, default=3000, help="Lado da máscara sintética (células de 30 m)")
+    parser.add_argument('--vetor', help="Usa esta camada segmentada por solo (coluna 'valor_solo') em vez da sintética")
+    parser.add_argument('--processos', type=int, default=os.cpu_count() or 1, help="Número de processos")
+    parser.add_argument('--sem-anterior', action='store_true', help="Não mede a busca brentq por polígono (lenta)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        vector_path = args.vetor or write_synthetic_segmented(
+            os.path.join(temp_dir, 'inundacao_segmentada_por_solo.geojson'), args.tamanho)
+        n_features = len(gpd.read_file(vector_path, ignore_geometry=True))
+        rows, difference = run_benchmark(vector_path, DEFAULT_MAPPING, args.processos, not args.sem_anterior)
+
+    print(f"Camada com {n_features} feições")
+    print(f"{'método':<36} {'tempo (s)':>10}")
+    for label, elapsed in rows:
+        print(f"{label:<36} {elapsed:>10.2f}")
+    print(f"Maior diferença de área entre 1 e {args.processos} processo(s): {difference:.3e} m²")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
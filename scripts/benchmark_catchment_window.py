@@ -0,0 +1,121 @@
+"""
+Benchmark do modo de janela da bacia (`clip_domain`) da Etapa 2.
+
+Executa o pré-processamento uma vez e, para exutórios escolhidos de modo a
+cobrir várias razões área da bacia / área do MDE, compara o tempo de
+`run_delineation` com HAND e distância de fluxo calculados em toda a extensão
+(`clip_domain=False`) e apenas na janela da bacia (`clip_domain=True`).
+
+Uso:
+    python -m scripts.benchmark_catchment_window caminho/mde.tif [--limiar 1000] [--json saida.json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+
+from scripts.local_analysis_helpers import run_preprocessing, run_delineation
+
+try:
+    from pysheds.grid import Grid
+except ImportError:
+    print("Erro: Biblioteca 'pysheds' não encontrada. Instale com 'pip install pysheds'")
+    raise
+
+
+DEFAULT_AREA_RATIOS = (0.001, 0.01, 0.05, 0.2, 0.5)
+
+
+def _silent_progress(message, percentage):
+    pass
+
+
+def select_outlets(preproc_data, stream_threshold, area_ratios=DEFAULT_AREA_RATIOS):
+    """
+    Escolhe, para cada razão alvo, a célula de canal cuja acumulação mais se
+    aproxima de `razão * células válidas do MDE`. Retorna (x, y, razão obtida).
+    """
+    acc = np.asarray(preproc_data['acc'])
+    affine = preproc_data['grid'].viewfinder.affine
+    valid_cells = np.count_nonzero(np.isfinite(np.asarray(preproc_data['inflated_dem'])))
+
+    stream_rows, stream_cols = np.nonzero(acc > stream_threshold)
+    if stream_rows.size == 0:
+        raise ValueError(f"Nenhuma célula com acumulação > {stream_threshold} no MDE.")
+    stream_acc = acc[stream_rows, stream_cols]
+
+    outlets = []
+    for ratio in area_ratios:
+        i = int(np.argmin(np.abs(stream_acc - ratio * valid_cells)))
+        x, y = affine * (stream_cols[i] + 0.5, stream_rows[i] + 0.5)
+        outlets.append((x, y, float(stream_acc[i]) / valid_cells))
+    return outlets
+
+
+def _timed_delineation(preproc_data, viewfinder, outlet, channel_depth, stream_threshold, clip_domain):
+    # O modo sem janela recorta o grid (clip_to); cada execução recebe um grid novo
+    data = dict(preproc_data, grid=Grid(viewfinder=viewfinder))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        start = time.perf_counter()
+        run_delineation(data, outlet, channel_depth, stream_threshold, temp_dir, _silent_progress,
+                        generate_flu_distance=True, clip_domain=clip_domain)
+        return time.perf_counter() - start
+
+
+def run_benchmark(mde_path, stream_threshold=1000, channel_depth=5.0, area_ratios=DEFAULT_AREA_RATIOS,
+                  repeats=1):
+    """Executa o benchmark e retorna uma lista de dicionários (um por exutório)."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        preproc_data = run_preprocessing(mde_path, temp_dir, stream_threshold, _silent_progress)
+    viewfinder = preproc_data['grid'].viewfinder
+    outlets = select_outlets(preproc_data, stream_threshold, area_ratios)
+
+    # Aquecimento (compilação JIT do PySheds) fora das medições
+    x, y, _ = outlets[0]
+    for clip_domain in (False, True):
+        _timed_delineation(preproc_data, viewfinder, (x, y), channel_depth, stream_threshold, clip_domain)
+
+    rows = []
+    for x, y, ratio in outlets:
+        full = min(_timed_delineation(preproc_data, viewfinder, (x, y), channel_depth, stream_threshold, False)
+                   for _ in range(repeats))
+        window = min(_timed_delineation(preproc_data, viewfinder, (x, y), channel_depth, stream_threshold, True)
+                     for _ in range(repeats))
+        rows.append({'x': x, 'y': y, 'razao_area': ratio, 'tempo_extensao_total_s': full,
+                     'tempo_janela_s': window, 'aceleracao': full / window if window > 0 else None})
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark do cálculo de HAND na janela da bacia.")
+    parser.add_argument('mde', help="Caminho do MDE (.tif)")
+    parser.add_argument('--limiar', type=int, default=1000, help="Limiar de drenagem (células)")
+    parser.add_argument('--profundidade', type=float, default=5.0, help="Profundidade do canal (m)")
+    parser.add_argument('--razoes', type=float, nargs='+', default=list(DEFAULT_AREA_RATIOS),
+                        help="Razões alvo área da bacia / área do MDE")
+    parser.add_argument('--repeticoes', type=int, default=1, help="Repetições por medição (usa o mínimo)")
+    parser.add_argument('--json', help="Grava os resultados neste arquivo JSON")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.mde):
+        raise FileNotFoundError(f"Arquivo MDE '{args.mde}' não encontrado.")
+
+    rows = run_benchmark(args.mde, args.limiar, args.profundidade, args.razoes, args.repeticoes)
+
+    print(f"{'razão área':>12} {'extensão total (s)':>20} {'janela (s)':>12} {'aceleração':>12}")
+    for row in rows:
+        speedup = f"{row['aceleracao']:.1f}x" if row['aceleracao'] else '-'
+        print(f"{row['razao_area']:>12.4f} {row['tempo_extensao_total_s']:>20.3f} "
+              f"{row['tempo_janela_s']:>12.3f} {speedup:>12}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'mde': os.path.abspath(args.mde), 'limiar': args.limiar, 'resultados': rows}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""
+Benchmark do condicionamento do MDE: PySheds (fill_pits + fill_depressions +
+resolve_flats) x motores de `scripts/priority_flood.py` (Priority-Flood +
+resolve_flats e Priority-Flood+ε).
+
+Mede o tempo de cada motor e compara os resultados com o PySheds: diferença
+máxima das cotas preenchidas, células que não drenam, concordância da
+direção de fluxo e da rede de drenagem para o limiar (IoU das células).
+Usa o MDE sintético fractal de `scripts/benchmark_pipeline.py` (N x N
+células) ou o MDE informado.
+
+Uso:
+    python -m scripts.benchmark_conditioning [--tamanho 2000] [--mde caminho.tif] [--limiar 1000] [--json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+from pysheds.grid import Grid
+from pysheds.sview import Raster
+
+from scripts.priority_flood import fill_depressions, count_undrained, CONDITIONING_ENGINES
+from scripts.benchmark_pipeline import write_synthetic_dem
+from scripts.local_analysis_helpers import DIRMAP
+
+
+def _timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def run_benchmark(mde_path, stream_threshold):
+    grid = Grid.from_raster(mde_path, data_name='dem')
+    dem = grid.read_raster(mde_path)
+    nodata = dem.nodata
+
+    # Aquecimento (compilação JIT) fora das medições
+    fill_depressions(np.asarray(dem)[:32, :32], nodata)
+    fill_depressions(np.asarray(dem)[:32, :32], nodata, epsilon=True)
+
+    timings = {}
+    conditioned = {}
+    start = time.perf_counter()
+    pit_filled = grid.fill_pits(dem)
+    reference_fill = grid.fill_depressions(pit_filled)
+    del pit_filled
+    timings['pysheds'] = {'preenchimento': time.perf_counter() - start}
+    conditioned['pysheds'], timings['pysheds']['resolve_flats'] = _timed(lambda: grid.resolve_flats(reference_fill))
+
+    flooded, fill_time = _timed(lambda: Raster(fill_depressions(dem, nodata), viewfinder=dem.viewfinder))
+    timings['priority_flood'] = {'preenchimento': fill_time}
+    conditioned['priority_flood'], timings['priority_flood']['resolve_flats'] = _timed(
+        lambda: grid.resolve_flats(flooded))
+    fills = {'pysheds': reference_fill, 'priority_flood': flooded}
+
+    flooded, fill_time = _timed(lambda: Raster(fill_depressions(dem, nodata, epsilon=True),
+                                               viewfinder=dem.viewfinder))
+    timings['priority_flood_epsilon'] = {'preenchimento': fill_time, 'resolve_flats': 0.0}
+    conditioned['priority_flood_epsilon'] = fills['priority_flood_epsilon'] = flooded
+    for engine_timings in timings.values():
+        engine_timings['total'] = sum(engine_timings.values())
+
+    valid = np.asarray(reference_fill) != nodata
+    fdirs = {engine: np.asarray(grid.flowdir(values, dirmap=DIRMAP)) for engine, values in conditioned.items()}
+    streams = {engine: np.asarray(grid.accumulation(Raster(fdir, viewfinder=dem.viewfinder), dirmap=DIRMAP))
+               > stream_threshold for engine, fdir in fdirs.items()}
+    comparison = {}
+    for engine in conditioned:
+        fill_diff = np.asarray(fills[engine])[valid] - np.asarray(reference_fill)[valid]
+        union = np.count_nonzero(streams[engine] | streams['pysheds'])
+        comparison[engine] = {
+            'diferenca_max_preenchimento_m': float(np.max(np.abs(fill_diff))),
+            'celulas_sem_drenagem': count_undrained(conditioned[engine], nodata),
+            'concordancia_direcao': float(np.mean(fdirs[engine] == fdirs['pysheds'])),
+            'iou_rede_drenagem': float(np.count_nonzero(streams[engine] & streams['pysheds']) / union)
+            if union else 1.0,
+        }
+    return dem.shape, timings, comparison
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark do condicionamento do MDE.")
+    parser.add_argument('--tamanho', type=int, default=2000, help="Lado do MDE sintético (células)")
+    parser.add_argument('--mde', help="Usa este MDE em vez do sintético")
+    parser.add_argument('--limiar', type=int, default=1000, help="Limiar de drenagem para comparar as redes")
+    parser.add_argument('--json', action='store_true', help="Imprime o resultado em JSON")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        mde_path = args.mde or write_synthetic_dem(os.path.join(temp_dir, 'mde.tif'), args.tamanho)
+        shape, timings, comparison = run_benchmark(mde_path, args.limiar)
+
+    if args.json:
+        print(json.dumps({'forma': list(shape), 'tempos_s': timings, 'comparacao': comparison}, indent=2))
+        return 0
+    print(f"MDE {shape[0]} x {shape[1]}")
+    print(f"{'motor':<56} {'preench. (s)':>12} {'flats (s)':>10} {'total (s)':>10} {'acel.':>6}")
+    for engine, engine_timings in timings.items():
+        speedup = timings['pysheds']['total'] / engine_timings['total']
+        print(f"{CONDITIONING_ENGINES[engine]:<56} {engine_timings['preenchimento']:>12.2f} "
+              f"{engine_timings['resolve_flats']:>10.2f} {engine_timings['total']:>10.2f} {speedup:>5.1f}x")
+    print(f"\n{'motor':<56} {'dif. cota (m)':>13} {'sem dren.':>10} {'dir. igual':>10} {'IoU rede':>9}")
+    for engine, metrics in comparison.items():
+        print(f"{CONDITIONING_ENGINES[engine]:<56} {metrics['diferenca_max_preenchimento_m']:>13.2e} "
+              f"{metrics['celulas_sem_drenagem']:>10} {metrics['concordancia_direcao']:>10.3f} "
+              f"{metrics['iou_rede_drenagem']:>9.3f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
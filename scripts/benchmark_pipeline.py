@@ -0,0 +1,369 @@
+"""
+Benchmark do pipeline hidrológico (Etapas 1 e 2) com MDEs sintéticos.
+
+Gera MDEs fractais reprodutíveis (relevo fBm com vales sinuosos e depressões)
+de 1k² a 20k² células, executa `run_preprocessing` e `run_delineation` sem
+interface e registra tempo de parede, tempo de CPU e pico de memória (RSS) de
+cada etapa (ver `scripts/profiling.py`) em um histórico JSON. Cada execução é
+comparada com a anterior de mesmo tamanho e modo, apontando regressões.
+
+Cada tamanho roda em um processo novo (memória e JIT isolados), após um
+aquecimento em um MDE pequeno que compila os kernels numba. Os MDEs gerados
+ficam em disco e são reutilizados. Não requer rede nem GPU.
+
+Uso:
+    python -m scripts.benchmark_pipeline [--tamanhos 1000,2000,4000] [--modo auto|memoria|blocos]
+        [--historico benchmarks/historico_pipeline.json] [--tolerancia 0.1] [--falhar-em-regressao]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+import rasterio
+from affine import Affine
+
+from scripts.profiling import RunProfiler
+from scripts.priority_flood import CONDITIONING_ENGINES, DEFAULT_CONDITIONING
+
+
+DEFAULT_SIZES = (1000, 2000, 4000)
+MAX_SIZE = 20000
+# Acima deste lado o modo 'auto' usa o pré-processamento em blocos
+AUTO_TILED_SIZE = 6000
+DEFAULT_HISTORY = os.path.join("benchmarks", "historico_pipeline.json")
+DEFAULT_DEM_DIR = os.path.join("cache", "benchmarks", "mde")
+DEFAULT_TOLERANCE = 0.10
+# Diferenças absolutas abaixo destes limites são tratadas como ruído
+MIN_SECONDS = 0.5
+MIN_MEGABYTES = 50.0
+
+RESOLUTION = 30.0
+CRS = 'EPSG:31983'
+ORIGIN = (500000.0, 7800000.0)
+RELIEF = 400.0  # m
+HURST = 0.8
+BAND_ROWS = 512
+WARMUP_SIZE = 128
+
+
+# --- MDE SINTÉTICO ---
+
+def _catmull_rom(t):
+    t2, t3 = t * t, t * t * t
+    return (-0.5 * t3 + t2 - 0.5 * t, 1.5 * t3 - 2.5 * t2 + 1.0,
+            -1.5 * t3 + 2.0 * t2 + 0.5 * t, 0.5 * t3 - 0.5 * t2)
+
+
+def _octave_band(lattice, spacing, rows, cols):
+    """Interpolação bicúbica (Catmull-Rom, separável) de uma grade de ruído nas linhas/colunas dadas."""
+    y, x = rows / spacing, cols / spacing
+    iy, ix = np.floor(y).astype(np.int64), np.floor(x).astype(np.int64)
+    wy, wx = _catmull_rom((y - iy).astype(np.float32)), _catmull_rom((x - ix).astype(np.float32))
+    sub = lattice[iy[0]:iy[-1] + 4]
+    along_cols = sum(w * sub[:, ix + k] for k, w in enumerate(wx))
+    return sum(w[:, None] * along_cols[iy - iy[0] + k] for k, w in enumerate(wy))
+
+
+def _dem_features(size, seed):
+    """Grades de ruído por oitava, vales e depressões de um MDE (determinísticos pela semente)."""
+    rng = np.random.default_rng(seed)
+    octaves = []
+    spacing = 2 ** int(np.log2(max(size // 4, 4)))
+    while spacing >= 4:
+        lattice = rng.standard_normal((size // spacing + 5, size // spacing + 5)).astype(np.float32)
+        octaves.append((spacing, float(spacing) ** HURST, lattice))
+        spacing //= 2
+    norm = RELIEF / (3.0 * np.sqrt(sum(amplitude ** 2 for _, amplitude, _ in octaves)))
+
+    n_valleys = 3
+    valleys = {'y0': rng.uniform(0.15, 0.85, n_valleys), 'amplitude': rng.uniform(0.03, 0.08, n_valleys),
+               'frequency': rng.uniform(1.0, 3.0, n_valleys), 'phase': rng.uniform(0, 2 * np.pi, n_valleys),
+               'depth': rng.uniform(0.15, 0.3, n_valleys) * RELIEF, 'width': rng.uniform(0.02, 0.04, n_valleys)}
+
+    n_pits = max(1, size * size // 50000)
+    pits = {'row': rng.uniform(0, size, n_pits), 'col': rng.uniform(0, size, n_pits),
+            'depth': rng.uniform(2.0, 10.0, n_pits), 'sigma': rng.uniform(1.0, 3.0, n_pits)}
+    return octaves, norm, valleys, pits
+
+
+def synthetic_dem_band(size, row_start, row_stop, features):
+    """Linhas [row_start, row_stop) do MDE sintético (float32, metros)."""
+    octaves, norm, valleys, pits = features
+    rows = np.arange(row_start, row_stop, dtype=np.float64)
+    cols = np.arange(size, dtype=np.float64)
+
+    band = np.zeros((row_stop - row_start, size), dtype=np.float32)
+    for spacing, amplitude, lattice in octaves:
+        band += (amplitude * norm) * _octave_band(lattice, spacing, rows, cols)
+
+    # Inclinação regional para leste e vales sinuosos no sentido oeste-leste
+    x, y = cols / size, rows / size
+    band += (RELIEF * 0.5 * (1.0 - x))[None, :].astype(np.float32)
+    for k in range(len(valleys['y0'])):
+        center = valleys['y0'][k] + valleys['amplitude'][k] * np.sin(
+            2 * np.pi * valleys['frequency'][k] * x + valleys['phase'][k])
+        distance = (y[:, None] - center[None, :]) / valleys['width'][k]
+        band -= (valleys['depth'][k] * np.exp(-distance ** 2)).astype(np.float32)
+
+    # Depressões fechadas (gaussianas) que o condicionamento precisa preencher
+    reach = 4 * pits['sigma']
+    near = np.flatnonzero((pits['row'] + reach >= row_start) & (pits['row'] - reach < row_stop))
+    for i in near:
+        r0, r1 = max(int(pits['row'][i] - reach[i]), row_start), min(int(pits['row'][i] + reach[i]) + 1, row_stop)
+        c0, c1 = max(int(pits['col'][i] - reach[i]), 0), min(int(pits['col'][i] + reach[i]) + 1, size)
+        if r0 >= r1 or c0 >= c1:
+            continue
+        rr, cc = np.mgrid[r0:r1, c0:c1]
+        d2 = (rr - pits['row'][i]) ** 2 + (cc - pits['col'][i]) ** 2
+        band[r0 - row_start:r1 - row_start, c0:c1] -= (
+            pits['depth'][i] * np.exp(-d2 / (2 * pits['sigma'][i] ** 2))).astype(np.float32)
+    return band
+
+
+def write_synthetic_dem(path, size, seed=0):
+    """Grava o MDE sintético de `size` x `size` células em faixas de linhas (GeoTIFF float32)."""
+    features = _dem_features(size, seed)
+    profile = {'driver': 'GTiff', 'height': size, 'width': size, 'count': 1, 'dtype': 'float32',
+               'crs': CRS, 'transform': Affine(RESOLUTION, 0, ORIGIN[0], 0, -RESOLUTION, ORIGIN[1]),
+               'nodata': -9999.0, 'tiled': True, 'blockxsize': 512, 'blockysize': 512,
+               'compress': 'deflate', 'predictor': 3, 'BIGTIFF': 'IF_SAFER'}
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with rasterio.open(tmp_path, 'w', **profile) as dst:
+        for row_start in range(0, size, BAND_ROWS):
+            row_stop = min(row_start + BAND_ROWS, size)
+            band = synthetic_dem_band(size, row_start, row_stop, features)
+            dst.write(band, 1, window=rasterio.windows.Window(0, row_start, size, row_stop - row_start))
+    os.replace(tmp_path, path)
+    return path
+
+
+def synthetic_dem_path(size, seed, dem_dir):
+    """Caminho do MDE sintético em `dem_dir`, gerando-o se ainda não existir."""
+    os.makedirs(dem_dir, exist_ok=True)
+    path = os.path.join(dem_dir, f"mde_sintetico_{size}_s{seed}.tif")
+    if not os.path.exists(path):
+        write_synthetic_dem(path, size, seed)
+    return path
+
+
+# --- EXECUÇÃO DE UM CASO ---
+
+def _select_outlet(index_path, area_ratio=0.05):
+    """Exutório na célula de canal com acumulação mais próxima de `area_ratio` das células do MDE."""
+    from scripts.stream_index import load_stream_index
+    index = load_stream_index(index_path)
+    target = area_ratio * float(np.prod(index['shape']))
+    i = int(np.argmin(np.abs(index['acc'] - target)))
+    row, col = divmod(int(index['cells'][i]), int(index['shape'][1]))
+    return Affine(*index['affine']) * (col + 0.5, row + 0.5)
+
+
+def _stage_summary(profiler):
+    """{etapa: métricas} somando etapas repetidas; inclui o total da execução."""
+    summary = {}
+    for row in profiler.report().to_dict(orient='records'):
+        name = row['etapa'].strip()
+        entry = summary.setdefault(name, {'tempo_parede_s': 0.0, 'tempo_cpu_s': 0.0, 'pico_rss_mb': 0.0})
+        entry['tempo_parede_s'] += row['tempo_parede_s']
+        entry['tempo_cpu_s'] += row['tempo_cpu_s']
+        entry['pico_rss_mb'] = max(entry['pico_rss_mb'], row['pico_rss_mb'] or 0.0)
+    return {name: {key: round(value, 3) for key, value in metrics.items()} for name, metrics in summary.items()}
+
+
+def _run_pipeline(dem_path, output_dir, tiled, stream_threshold, tile_size, delineate, channel_depth, conditioning):
+    from scripts.local_analysis_helpers import run_preprocessing, run_delineation
+    stages = {}
+    profiler = RunProfiler(name='preprocessamento')
+    preproc = run_preprocessing(dem_path, output_dir, stream_threshold, profiler, tiled=tiled, tile_size=tile_size,
+                                conditioning=conditioning)
+    stages['preprocessamento'] = _stage_summary(profiler)
+    if delineate:
+        outlet = _select_outlet(preproc['indice_rede_path'])
+        profiler = RunProfiler(name='delineamento')
+        run_delineation(preproc, outlet, channel_depth, stream_threshold, output_dir, profiler)
+        stages['delineamento'] = _stage_summary(profiler)
+    return stages
+
+
+def run_case(dem_path, size, tiled, stream_threshold, tile_size, delineate, channel_depth, conditioning, work_dir):
+    """Executado em um processo novo: aquecimento (JIT) e execução medida de um tamanho de MDE."""
+    warmup_dir = tempfile.mkdtemp(prefix='aquecimento_', dir=work_dir)
+    try:
+        warmup_dem = write_synthetic_dem(os.path.join(warmup_dir, 'mde.tif'), WARMUP_SIZE, seed=1)
+        _run_pipeline(warmup_dem, warmup_dir, tiled, min(stream_threshold, 100), WARMUP_SIZE // 2,
+                      delineate, channel_depth, conditioning)
+    finally:
+        shutil.rmtree(warmup_dir, ignore_errors=True)
+
+    output_dir = tempfile.mkdtemp(prefix=f'saida_{size}_', dir=work_dir)
+    try:
+        stages = _run_pipeline(dem_path, output_dir, tiled, stream_threshold, tile_size, delineate, channel_depth,
+                               conditioning)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return {'tamanho': size, 'modo': 'blocos' if tiled else 'memoria', 'limiar': stream_threshold,
+            'condicionamento': 'blocos' if tiled else conditioning, 'etapas': stages}
+
+
+# --- HISTÓRICO E COMPARAÇÃO ---
+
+def _git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=10,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _machine():
+    total_ram = None
+    if hasattr(os, 'sysconf') and 'SC_PHYS_PAGES' in os.sysconf_names:
+        total_ram = round(os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024 ** 3, 1)
+    return {'plataforma': platform.platform(), 'processador': platform.processor() or platform.machine(),
+            'cpus': os.cpu_count(), 'ram_gb': total_ram, 'python': platform.python_version()}
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_history(path, history):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(history, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _case_key(case):
+    return (case['tamanho'], case['modo'], case['limiar'], case.get('condicionamento', DEFAULT_CONDITIONING))
+
+
+def _baseline_case(history, case, reference=None):
+    """Caso de mesmo tamanho, modo, limiar e condicionamento na execução mais recente do histórico (ou no commit `reference`)."""
+    for run in reversed(history):
+        if reference and not (run.get('commit') or '').startswith(reference):
+            continue
+        for previous in run['casos']:
+            if _case_key(previous) == _case_key(case):
+                return run, previous
+    return None, None
+
+
+def compare_cases(case, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Linhas (fase, etapa, métrica, anterior, atual, razão, regressão) para as
+    etapas presentes nas duas execuções. Há regressão quando a razão passa de
+    `1 + tolerance` e a diferença absoluta supera o limite de ruído.
+    """
+    rows = []
+    for phase, stages in case['etapas'].items():
+        for name, metrics in stages.items():
+            previous = baseline['etapas'].get(phase, {}).get(name)
+            if previous is None:
+                continue
+            for metric, floor in (('tempo_parede_s', MIN_SECONDS), ('pico_rss_mb', MIN_MEGABYTES)):
+                before, after = previous.get(metric) or 0.0, metrics.get(metric) or 0.0
+                ratio = after / before if before > 0 else float('nan')
+                regression = before > 0 and ratio > 1 + tolerance and after - before > floor
+                rows.append((phase, name, metric, before, after, ratio, regression))
+    return rows
+
+
+def _print_case(case):
+    print(f"\nMDE {case['tamanho']} x {case['tamanho']} ({case['modo']}, "
+          f"{case.get('condicionamento', DEFAULT_CONDITIONING)}, limiar {case['limiar']})")
+    print(f"  {'fase/etapa':<42} {'parede (s)':>10} {'CPU (s)':>9} {'RSS (MB)':>9}")
+    for phase, stages in case['etapas'].items():
+        for name, metrics in stages.items():
+            print(f"  {phase + '/' + name:<42} {metrics['tempo_parede_s']:>10.2f} {metrics['tempo_cpu_s']:>9.2f} "
+                  f"{metrics['pico_rss_mb']:>9.0f}")
+
+
+def _print_comparison(rows, baseline_run):
+    print(f"  Comparação com {baseline_run.get('data')} (commit {baseline_run.get('commit') or '?'}):")
+    flagged = [row for row in rows if row[6]]
+    improved = [row for row in rows if row[5] == row[5] and row[5] < 1 / 1.1 and row[2] == 'tempo_parede_s'
+                and row[3] - row[4] > MIN_SECONDS]
+    for phase, name, metric, before, after, ratio, _ in flagged:
+        print(f"    REGRESSÃO {phase}/{name} {metric}: {before:.2f} -> {after:.2f} ({ratio:.2f}x)")
+    for phase, name, metric, before, after, ratio, _ in improved:
+        print(f"    melhora   {phase}/{name} {metric}: {before:.2f} -> {after:.2f} ({ratio:.2f}x)")
+    if not flagged and not improved:
+        print("    sem diferenças acima da tolerância.")
+    return len(flagged)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark do pipeline hidrológico com MDEs sintéticos.")
+    parser.add_argument('--tamanhos', default=",".join(str(s) for s in DEFAULT_SIZES),
+                        help=f"Lados dos MDEs sintéticos, separados por vírgula (até {MAX_SIZE})")
+    parser.add_argument('--modo', choices=['auto', 'memoria', 'blocos'], default='auto',
+                        help=f"Pré-processamento em memória, em blocos ou automático (blocos acima de "
+                             f"{AUTO_TILED_SIZE} células de lado)")
+    parser.add_argument('--condicionamento', choices=list(CONDITIONING_ENGINES), default=DEFAULT_CONDITIONING,
+                        help="Condicionamento do MDE no modo em memória")
+    parser.add_argument('--limiar', type=int, default=1000, help="Limiar de drenagem (células)")
+    parser.add_argument('--bloco', type=int, default=2048, help="Tamanho do bloco no modo em blocos")
+    parser.add_argument('--profundidade', type=float, default=5.0, help="Profundidade do canal no delineamento (m)")
+    parser.add_argument('--sem-delineamento', action='store_true', help="Mede só o pré-processamento")
+    parser.add_argument('--semente', type=int, default=0, help="Semente dos MDEs sintéticos")
+    parser.add_argument('--dir-mde', default=DEFAULT_DEM_DIR, help="Pasta dos MDEs sintéticos (reutilizados)")
+    parser.add_argument('--historico', default=DEFAULT_HISTORY, help="Arquivo JSON do histórico")
+    parser.add_argument('--comparar-com', help="Compara com a execução mais recente deste commit")
+    parser.add_argument('--tolerancia', type=float, default=DEFAULT_TOLERANCE,
+                        help="Aumento relativo tolerado antes de apontar regressão (0.1 = 10%%)")
+    parser.add_argument('--nao-gravar', action='store_true', help="Não acrescenta a execução ao histórico")
+    parser.add_argument('--falhar-em-regressao', action='store_true', help="Sai com código 1 se houver regressão")
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.tamanhos.split(',') if s.strip()]
+    if any(s < WARMUP_SIZE or s > MAX_SIZE for s in sizes):
+        raise ValueError(f"Tamanhos devem estar entre {WARMUP_SIZE} e {MAX_SIZE} células.")
+
+    history = load_history(args.historico)
+    run = {'data': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': _git_commit(), 'maquina': _machine(),
+           'casos': []}
+    regressions = 0
+    work_dir = tempfile.mkdtemp(prefix='benchmark_pipeline_')
+    # 'spawn': cada caso em um processo novo (memória e estado do numba isolados)
+    context = multiprocessing.get_context('spawn')
+    try:
+        for size in sizes:
+            tiled = args.modo == 'blocos' or (args.modo == 'auto' and size > AUTO_TILED_SIZE)
+            print(f"Gerando/reutilizando MDE sintético {size} x {size}...", flush=True)
+            dem_path = synthetic_dem_path(size, args.semente, args.dir_mde)
+            with context.Pool(1) as pool:
+                case = pool.apply(run_case, (dem_path, size, tiled, args.limiar, args.bloco,
+                                             not args.sem_delineamento, args.profundidade, args.condicionamento,
+                                             work_dir))
+            run['casos'].append(case)
+            _print_case(case)
+            baseline_run, baseline = _baseline_case(history, case, args.comparar_com)
+            if baseline is not None:
+                regressions += _print_comparison(compare_cases(case, baseline, args.tolerancia), baseline_run)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if not args.nao_gravar:
+        history.append(run)
+        save_history(args.historico, history)
+        print(f"\nExecução gravada em '{args.historico}' ({len(history)} no histórico).")
+    if regressions:
+        print(f"{regressions} regressão(ões) acima da tolerância.")
+    return 1 if regressions and args.falhar_em_regressao else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
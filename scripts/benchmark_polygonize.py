@@ -0,0 +1,88 @@
+"""
+Benchmark da vetorização de máscaras: `rasterio.features.shapes` sobre o
+array inteiro + `dissolve()` (como antes) x vetorização em blocos de
+`scripts/polygonize.py`, com 1 e N processos.
+
+Usa uma máscara sintética (ruído suavizado, limiarizado) de N x N células ou
+a mancha de um raster de inundação existente (células com valor válido).
+
+Uso:
+    python -m scripts.benchmark_polygonize [--tamanho 4000] [--suavizacao 4] [--raster inundacao.tif]
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import geopandas as gpd
+import rasterio
+from rasterio import features
+from affine import Affine
+from scipy import ndimage
+from shapely.geometry import shape
+
+from scripts.polygonize import polygonize_mask, DEFAULT_TILE_SIZE
+
+
+def synthetic_mask(size, sigma, seed=0):
+    """Máscara com manchas de tamanho controlado por `sigma` (células)."""
+    rng = np.random.default_rng(seed)
+    return ndimage.gaussian_filter(rng.random((size, size)), sigma) > 0.5
+
+
+def legacy_polygonize(mask_array, transform, crs):
+    """Vetorização anterior: shapes no array inteiro + dissolve."""
+    shapes_generator = features.shapes(mask_array.astype(np.uint8), mask=mask_array, transform=transform)
+    geometries = [shape(geom) for geom, value in shapes_generator if value == 1]
+    return gpd.GeoDataFrame(geometry=geometries, crs=crs).dissolve()
+
+
+def _timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def run_benchmark(mask_array, transform, crs, tile_size, workers):
+    """Retorna uma lista de (descrição, tempo em s) e a diferença de área em relação ao anterior."""
+    rows = []
+    legacy, elapsed = _timed(lambda: legacy_polygonize(mask_array, transform, crs))
+    rows.append(("anterior (shapes + dissolve)", elapsed))
+    for n in sorted({1, workers}):
+        tiled, elapsed = _timed(lambda: polygonize_mask(mask_array, transform, crs, tile_size=tile_size,
+                                                        max_workers=n))
+        rows.append((f"em blocos ({n} processo(s))", elapsed))
+    difference = legacy.geometry.iloc[0].symmetric_difference(tiled.geometry.iloc[0]).area
+    return rows, difference
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark da vetorização de máscaras.")
+    parser.add_argument('--tamanho', type=int, default=4000, help="Lado da máscara sintética (células)")
+    parser.add_argument('--suavizacao', type=float, default=4.0,
+                        help="Sigma do filtro gaussiano da máscara sintética (manchas maiores com valores maiores)")
+    parser.add_argument('--raster', help="Usa a mancha de um raster de inundação em vez da máscara sintética")
+    parser.add_argument('--bloco', type=int, default=DEFAULT_TILE_SIZE, help="Tamanho do bloco (células)")
+    parser.add_argument('--processos', type=int, default=os.cpu_count() or 1, help="Número de processos")
+    args = parser.parse_args(argv)
+
+    if args.raster:
+        with rasterio.open(args.raster) as src:
+            data = src.read(1, masked=True)
+            mask_array = ~np.ma.getmaskarray(data) & np.isfinite(data.filled(np.nan))
+            transform, crs = src.transform, src.crs
+    else:
+        mask_array = synthetic_mask(args.tamanho, args.suavizacao)
+        transform, crs = Affine(30, 0, 0, 0, -30, 0), 'EPSG:31983'
+
+    rows, difference = run_benchmark(mask_array, transform, crs, args.bloco, args.processos)
+    print(f"Máscara {mask_array.shape[0]} x {mask_array.shape[1]} ({int(mask_array.sum())} células True)")
+    print(f"{'método':<36} {'tempo (s)':>10}")
+    for label, elapsed in rows:
+        print(f"{label:<36} {elapsed:>10.2f}")
+    print(f"Área da diferença simétrica em relação ao anterior: {difference:.3f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
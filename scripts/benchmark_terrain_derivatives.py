@@ -0,0 +1,105 @@
+"""
+Benchmark das derivadas do terreno: cálculo anterior (np.gradient em float64,
+como no notebook) x kernel de passada única de `scripts/terrain_derivatives.py`.
+
+Mede tempo e pico de memória alocada (tracemalloc) para aspect, declividade e
+TWI, e para todas as derivadas no kernel. Usa um MDE sintético de N x N
+células ou o MDE informado.
+
+Uso:
+    python -m scripts.benchmark_terrain_derivatives [--tamanho 4000] [--mde caminho.tif]
+"""
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+import rasterio
+
+from scripts.terrain_derivatives import compute_terrain_derivatives, DERIVATIVE_OUTPUTS, DEFAULT_OUTPUTS
+
+
+def synthetic_dem(size, seed=0):
+    """Relevo sintético suave com ruído (metros), para medições reproduzíveis."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    dem = 500 + 200 * np.sin(3 * np.pi * x) * np.cos(2 * np.pi * y) + 150 * x + rng.normal(0, 1, (size, size))
+    return dem
+
+
+def legacy_derivatives(dem, acc, x_res, y_res):
+    """Cálculo anterior de aspect, declividade e TWI (duas chamadas a np.gradient)."""
+    gy, gx = np.gradient(dem)
+    aspect_rad = np.arctan2(gy, -gx)
+    aspect_deg = np.degrees(aspect_rad)
+    aspect = (aspect_deg + 360) % 360
+    aspect[((gx == 0) & (gy == 0))] = -1
+
+    gy, gx = np.gradient(dem, y_res, x_res)
+    slope_rad = np.arctan(np.sqrt(gx ** 2 + gy ** 2))
+    slope_deg = np.degrees(slope_rad)
+
+    cell_area = x_res * y_res
+    slope_rad_twi = np.arctan(np.sqrt(gx ** 2 + gy ** 2))
+    slope_rad_twi[slope_rad_twi == 0] = 0.001
+    sca = (acc + 1) * cell_area
+    twi = np.log(sca / np.tan(slope_rad_twi))
+    return {'aspect': aspect, 'slope': slope_deg, 'twi': twi}
+
+
+def _measure(func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def run_benchmark(dem, x_res, y_res):
+    """Retorna uma lista de (descrição, tempo em s, pico de memória em bytes)."""
+    acc = np.ones_like(dem)
+
+    # Aquecimento (compilação JIT) fora das medições
+    compute_terrain_derivatives(dem[:16, :16], x_res, y_res, DERIVATIVE_OUTPUTS, acc=acc[:16, :16])
+
+    rows = []
+    legacy, elapsed, peak = _measure(lambda: legacy_derivatives(dem, acc, x_res, y_res))
+    rows.append(("anterior (aspect, slope, twi)", elapsed, peak))
+    fused, elapsed, peak = _measure(lambda: compute_terrain_derivatives(dem, x_res, y_res, DEFAULT_OUTPUTS, acc=acc))
+    rows.append(("passada única (aspect, slope, twi)", elapsed, peak))
+    _, elapsed, peak = _measure(lambda: compute_terrain_derivatives(dem, x_res, y_res, DERIVATIVE_OUTPUTS, acc=acc))
+    rows.append(("passada única (todas as 6 derivadas)", elapsed, peak))
+
+    max_diff = {name: float(np.max(np.abs(fused[name] - legacy[name]))) for name in DEFAULT_OUTPUTS}
+    return rows, max_diff
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark das derivadas do terreno.")
+    parser.add_argument('--tamanho', type=int, default=4000, help="Lado do MDE sintético (células)")
+    parser.add_argument('--resolucao', type=float, default=30.0, help="Resolução do MDE sintético (m)")
+    parser.add_argument('--mde', help="Usa este MDE em vez do sintético")
+    args = parser.parse_args(argv)
+
+    if args.mde:
+        with rasterio.open(args.mde) as src:
+            dem = src.read(1).astype(np.float64)
+            x_res, y_res = src.transform[0], -src.transform[4]
+    else:
+        dem = synthetic_dem(args.tamanho)
+        x_res = y_res = args.resolucao
+
+    rows, max_diff = run_benchmark(dem, x_res, y_res)
+    print(f"MDE {dem.shape[0]} x {dem.shape[1]} ({dem.nbytes / 1024 ** 2:.0f} MB em float64)")
+    print(f"{'método':<40} {'tempo (s)':>10} {'pico (MB)':>10}")
+    for label, elapsed, peak in rows:
+        print(f"{label:<40} {elapsed:>10.2f} {peak / 1024 ** 2:>10.0f}")
+    print("Diferença máxima em relação ao cálculo anterior (float32):",
+          ", ".join(f"{name}={diff:.2e}" for name, diff in max_diff.items()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
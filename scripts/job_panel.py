@@ -0,0 +1,120 @@
+"""
+Painel Streamlit das tarefas em segundo plano (ver `scripts/job_runner.py`)
+e dos relatórios de desempenho por etapa (ver `scripts/profiling.py`).
+
+O painel é um fragmento reexecutado periodicamente: o progresso das tarefas
+é lido do armazenamento em disco sem rodar a página inteira de novo.
+"""
+import os
+import json
+import pandas as pd
+import streamlit as st
+
+from scripts.job_runner import (list_jobs, cancel_job, delete_job, job_results, DEFAULT_JOBS_DIR,
+                                FINAL_STATES, DONE, FAILED, REPORT_FILE)
+
+
+MAX_DOWNLOAD_BYTES = 50 * 1024 ** 2
+
+STATE_LABELS = {
+    'na_fila': "⏳ Na fila",
+    'executando': "⚙️ Executando",
+    'concluida': "✅ Concluída",
+    'erro': "❌ Erro",
+    'cancelada': "⛔ Cancelada",
+    'interrompida': "⚠️ Interrompida",
+}
+
+
+def render_jobs_panel(kinds, key_prefix, on_load=None, load_label="Usar resultado", jobs_dir=DEFAULT_JOBS_DIR,
+                      limit=10, refresh_seconds=2):
+    """
+    Lista as tarefas dos tipos `kinds` com progresso, cancelamento e
+    downloads dos arquivos gerados. `on_load(resultados)`, se informado, é
+    chamado pelo botão `load_label` de uma tarefa concluída (por exemplo,
+    para levar o resultado ao `st.session_state`).
+    """
+
+    @st.fragment(run_every=refresh_seconds)
+    def _panel():
+        jobs = list_jobs(jobs_dir, kinds=kinds, limit=limit)
+        if not jobs:
+            st.caption("Nenhuma tarefa em segundo plano.")
+            return
+        for job in jobs:
+            with st.container(border=True):
+                st.markdown(f"**{job['rotulo']}** — {STATE_LABELS.get(job['estado'], job['estado'])} "
+                            f"<small>`{job['id']}`</small>", unsafe_allow_html=True)
+                if job['estado'] not in FINAL_STATES:
+                    st.progress(min(max(int(job.get('progresso', 0)), 0), 100), text=job.get('mensagem', ''))
+                    if st.button("Cancelar", key=f"{key_prefix}_cancel_{job['id']}"):
+                        cancel_job(job['id'], jobs_dir)
+                    continue
+
+                if job['estado'] == FAILED:
+                    st.error(job.get('mensagem', ''))
+                    if job.get('traceback'):
+                        with st.expander("Detalhes do erro"):
+                            st.code(job['traceback'])
+                elif job['estado'] != DONE:
+                    st.caption(job.get('mensagem', ''))
+                else:
+                    _render_results(job, key_prefix, on_load, load_label, jobs_dir)
+                _render_job_report(job, key_prefix)
+                if st.button("Remover tarefa", key=f"{key_prefix}_delete_{job['id']}"):
+                    delete_job(job['id'], jobs_dir)
+                    st.rerun(scope="fragment")
+
+    _panel()
+
+
+def render_profile_report(profiler, file_name, key):
+    """Tabela de tempo/memória por etapa de um `RunProfiler` e downloads do relatório (JSON e CSV)."""
+    with st.expander("Relatório de desempenho por etapa"):
+        st.dataframe(profiler.report(), hide_index=True, use_container_width=True)
+        col_json, col_csv = st.columns(2)
+        with col_json:
+            st.download_button("Baixar relatório (JSON)", profiler.report_json(), file_name=f"{file_name}.json",
+                               mime="application/json", key=f"{key}_json")
+        with col_csv:
+            st.download_button("Baixar relatório (CSV)", profiler.report_csv(), file_name=f"{file_name}.csv",
+                               mime="text/csv", key=f"{key}_csv")
+
+
+def _render_job_report(job, key_prefix):
+    report_path = os.path.join(job['dir'], REPORT_FILE)
+    if not os.path.exists(report_path):
+        return
+    with open(report_path, 'r', encoding='utf-8') as f:
+        report = f.read()
+    with st.expander("Desempenho por etapa"):
+        st.dataframe(pd.DataFrame(json.loads(report)['etapas']), hide_index=True, use_container_width=True)
+        st.download_button("Baixar relatório (JSON)", report, file_name=f"desempenho_{job['id']}.json",
+                           mime="application/json", key=f"{key_prefix}_report_{job['id']}")
+
+
+def _render_results(job, key_prefix, on_load, load_label, jobs_dir):
+    if 'iniciada' in job and 'concluida' in job:
+        st.caption(f"Concluída em {job['concluida'] - job['iniciada']:.1f} s.")
+    try:
+        results = job_results(job['id'], jobs_dir, load_arrays=False)
+        paths = {key: value for key, value in results.items()
+                 if key.endswith('_path') and isinstance(value, str) and os.path.isfile(value)}
+    except (ValueError, RuntimeError, FileNotFoundError) as e:
+        st.warning(f"Resultados indisponíveis: {e}")
+        return
+
+    if on_load is not None and st.button(load_label, key=f"{key_prefix}_load_{job['id']}", type="primary"):
+        on_load(job_results(job['id'], jobs_dir))
+        st.rerun()
+    # O fragmento é reexecutado a cada poucos segundos: arquivos grandes só são listados
+    small = {key: path for key, path in paths.items() if os.path.getsize(path) <= MAX_DOWNLOAD_BYTES}
+    columns = st.columns(min(len(small), 3) or 1)
+    for i, (key, path) in enumerate(sorted(small.items())):
+        with columns[i % len(columns)]:
+            with open(path, "rb") as f:
+                st.download_button(f"Baixar {os.path.basename(path)}", f, file_name=os.path.basename(path),
+                                   key=f"{key_prefix}_download_{job['id']}_{key}")
+    for key, path in sorted(paths.items()):
+        if key not in small:
+            st.caption(f"`{path}` ({os.path.getsize(path) / 1024 ** 2:.0f} MB)")
@@ -0,0 +1,374 @@
+"""
+Execução em segundo plano das etapas longas (pré-processamento, delineamento,
+interseção com solos e buffer proporcional).
+
+As funções `run_*` rodam em um pool local de processos, fora da thread do
+script do Streamlit: a sessão não fica bloqueada, a tarefa sobrevive a
+recarregamentos da página e pode ser cancelada.
+
+Cada tarefa tem uma pasta própria no armazenamento de tarefas (`jobs_dir`):
+
+- `tarefa.json`: tipo, parâmetros (resumo legível) e data de criação;
+- `argumentos.pkl`: argumentos da função;
+- `estado.json`: estado, progresso e erro (gravado pelo worker);
+- `eventos.jsonl`: histórico das chamadas de `progress_callback`;
+- `desempenho.json`: relatório de tempo e memória por etapa (`scripts/profiling.py`);
+- `resultado.json`: resultados serializáveis (caminhos, números, textos);
+- `entradas/`: cópias dos arquivos de entrada (uploads em pastas temporárias);
+- `cancelar`: pedido de cancelamento, verificado a cada chamada de progresso.
+
+Os objetos PySheds (grid, MDE condicionado, direção e acumulação) não são
+serializáveis de forma eficiente: são gravados como arrays pelo mesmo formato
+do cache de pré-processamento (`scripts/artifact_cache.py`) e reconstruídos
+quando o resultado é lido ou passado a outra tarefa.
+"""
+import os
+import json
+import time
+import uuid
+import pickle
+import shutil
+import importlib
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from scripts.artifact_cache import store_preprocessing, load_cached_preprocessing, IN_MEMORY_RASTERS
+from scripts.profiling import RunProfiler
+
+
+DEFAULT_JOBS_DIR = os.path.join("cache", "tarefas")
+DEFAULT_JOB_WORKERS = 2
+
+# Tipo de tarefa -> (módulo, função); os argumentos seguem a assinatura da função,
+# sem `progress_callback`
+JOB_FUNCTIONS = {
+    'preprocessamento': ('scripts.local_analysis_helpers', 'run_preprocessing'),
+    'delineamento': ('scripts.local_analysis_helpers', 'run_delineation'),
+    'varredura_inundacao': ('scripts.local_analysis_helpers', 'run_flood_sweep'),
+    'inundacao_regional': ('scripts.regional_flood', 'run_regional_flood'),
+    'intersecao_solo': ('scripts.local_analysis_helpers', 'run_soil_intersection'),
+    'buffer_proporcional': ('scripts.local_analysis_helpers', 'run_proportional_buffer'),
+    'curvas_area': ('scripts.local_analysis_helpers', 'run_area_curves'),
+    'modelo_solo_raster': ('scripts.soil_raster', 'run_soil_raster_weighting'),
+}
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED, INTERRUPTED = (
+    'na_fila', 'executando', 'concluida', 'erro', 'cancelada', 'interrompida')
+FINAL_STATES = (DONE, FAILED, CANCELLED, INTERRUPTED)
+
+JOB_FILE = 'tarefa.json'
+ARGS_FILE = 'argumentos.pkl'
+STATE_FILE = 'estado.json'
+EVENTS_FILE = 'eventos.jsonl'
+RESULT_FILE = 'resultado.json'
+REPORT_FILE = 'desempenho.json'
+STATE_UPDATE_INTERVAL = 0.5  # s entre gravações de `estado.json`
+CANCEL_FILE = 'cancelar'
+INPUTS_DIR = 'entradas'
+OUTPUTS_DIR = 'saidas'
+RESULT_ENTRY = 'resultado_pysheds'
+PREPROC_ENTRY = 'preprocessamento_entrada'
+
+# Pool e futures do processo do servidor (persistem entre reexecuções das páginas)
+_EXECUTOR = None
+_FUTURES = {}
+
+
+class JobCancelled(Exception):
+    """Levantada no worker quando o cancelamento da tarefa é solicitado."""
+
+
+class _PreprocessingRef:
+    """Referência, nos argumentos gravados, a resultados de pré-processamento salvos em disco."""
+
+    def __init__(self, entry_dir, results):
+        self.entry_dir = entry_dir
+        self.results = results
+
+
+# --- ARMAZENAMENTO ---
+
+def _write_json(path, data):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, default=str)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _json_safe(value):
+    """True se o valor sobrevive a json.dump sem perda (caminhos, números, textos e listas deles)."""
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all(_json_safe(item) for item in value)
+    if isinstance(value, dict):
+        return all(isinstance(key, str) and _json_safe(item) for key, item in value.items())
+    return False
+
+
+def _has_pysheds_objects(value):
+    return isinstance(value, dict) and 'grid' in value
+
+
+def _portable(value, job_dir):
+    """
+    Prepara um argumento para o worker: resultados de pré-processamento com
+    objetos PySheds são gravados como arrays na pasta da tarefa (ou
+    referenciados, se já vieram de uma tarefa).
+    """
+    if not _has_pysheds_objects(value):
+        return value
+    plain = {key: item for key, item in value.items()
+             if key != 'grid' and key not in IN_MEMORY_RASTERS and _json_safe(item)}
+    if value.get('tarefa_dir') and os.path.isdir(os.path.join(value['tarefa_dir'], RESULT_ENTRY)):
+        return _PreprocessingRef(os.path.join(value['tarefa_dir'], RESULT_ENTRY), plain)
+    store_preprocessing(job_dir, PREPROC_ENTRY, value, {}, max_bytes=float('inf'), files=False)
+    return _PreprocessingRef(os.path.join(job_dir, PREPROC_ENTRY), plain)
+
+
+def _resolve(value):
+    """Reconstrói, no worker, os argumentos preparados por `_portable`."""
+    if not isinstance(value, _PreprocessingRef):
+        return value
+    parent_dir, entry_key = os.path.split(value.entry_dir)
+    loaded = load_cached_preprocessing(parent_dir, entry_key, None)
+    if loaded is None:
+        raise FileNotFoundError(f"Resultados de pré-processamento '{value.entry_dir}' não encontrados.")
+    results = dict(value.results)
+    results.update({key: loaded[key] for key in ('grid', 'dirmap') + IN_MEMORY_RASTERS if key in loaded})
+    return results
+
+
+def _summary(params):
+    """Resumo legível dos parâmetros para `tarefa.json`."""
+    return {key: (value if _json_safe(value) else type(value).__name__) for key, value in params.items()}
+
+
+# --- SUBMISSÃO E CONSULTA ---
+
+def _submit(job_dir, max_workers):
+    global _EXECUTOR
+    for _ in range(2):
+        if _EXECUTOR is None:
+            # 'spawn' pelo mesmo motivo de scripts/batch_delineation.py (numba do PySheds)
+            _EXECUTOR = ProcessPoolExecutor(max_workers=max_workers,
+                                            mp_context=multiprocessing.get_context('spawn'))
+        try:
+            return _EXECUTOR.submit(_run_job, job_dir)
+        except BrokenProcessPool:
+            # Um worker morreu (ex.: falta de memória): o pool é recriado
+            _EXECUTOR = None
+    raise RuntimeError("Não foi possível iniciar o pool de processos das tarefas.")
+
+
+def submit_job(kind, params, jobs_dir=DEFAULT_JOBS_DIR, input_files=(), label=None,
+               max_workers=DEFAULT_JOB_WORKERS):
+    """
+    Enfileira a função de `kind` (ver `JOB_FUNCTIONS`) com os argumentos
+    `params` e retorna o id da tarefa.
+
+    Os parâmetros listados em `input_files` são caminhos de arquivo copiados
+    para a pasta da tarefa (uploads gravados em pastas temporárias). Se
+    `params['output_dir']` for None, os resultados são gravados na pasta da
+    tarefa. `max_workers` só vale na criação do pool (primeira submissão).
+    """
+    if kind not in JOB_FUNCTIONS:
+        raise ValueError(f"Tipo de tarefa desconhecido: '{kind}'. Tipos válidos: {list(JOB_FUNCTIONS)}")
+
+    job_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    job_dir = os.path.join(jobs_dir, job_id)
+    os.makedirs(os.path.join(job_dir, INPUTS_DIR))
+
+    params = dict(params)
+    for name in input_files:
+        source = params[name]
+        if not os.path.exists(source):
+            raise FileNotFoundError(f"Arquivo de entrada '{source}' não encontrado.")
+        params[name] = shutil.copy(source, os.path.join(job_dir, INPUTS_DIR, os.path.basename(source)))
+    if 'output_dir' in params and params['output_dir'] is None:
+        params['output_dir'] = os.path.join(job_dir, OUTPUTS_DIR)
+    if params.get('output_dir'):
+        os.makedirs(params['output_dir'], exist_ok=True)
+    params = {name: _portable(value, job_dir) for name, value in params.items()}
+
+    with open(os.path.join(job_dir, ARGS_FILE), 'wb') as f:
+        pickle.dump(params, f)
+    _write_json(os.path.join(job_dir, JOB_FILE),
+                {'id': job_id, 'tipo': kind, 'rotulo': label or kind, 'criada': time.time(),
+                 'parametros': _summary(params)})
+    _write_json(os.path.join(job_dir, STATE_FILE),
+                {'estado': QUEUED, 'mensagem': "Na fila...", 'progresso': 0, 'atualizada': time.time()})
+
+    _FUTURES[job_id] = _submit(job_dir, max_workers)
+    return job_id
+
+
+def get_job(job_id, jobs_dir=DEFAULT_JOBS_DIR):
+    """Metadados e estado de uma tarefa (dict) ou None se ela não existir."""
+    job_dir = os.path.join(jobs_dir, job_id)
+    job = _read_json(os.path.join(job_dir, JOB_FILE))
+    if job is None:
+        return None
+    state_path = os.path.join(job_dir, STATE_FILE)
+    state = _read_json(state_path) or {'estado': QUEUED, 'progresso': 0, 'mensagem': ''}
+    if state['estado'] not in FINAL_STATES and not _is_alive(job_id, state):
+        # Relê o estado: o worker pode ter terminado entre a leitura e a verificação
+        state = _read_json(state_path) or state
+        if state['estado'] not in FINAL_STATES:
+            # O servidor foi reiniciado (ou o worker morreu) antes do fim da tarefa
+            state = dict(state, estado=INTERRUPTED,
+                         mensagem="Tarefa interrompida (servidor reiniciado ou worker encerrado).")
+            _write_json(state_path, state)
+    job.update(state)
+    job['dir'] = job_dir
+    return job
+
+
+def _is_alive(job_id, state):
+    future = _FUTURES.get(job_id)
+    if future is not None:
+        return not future.done()
+    pid = state.get('pid')
+    if state['estado'] != RUNNING or pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def list_jobs(jobs_dir=DEFAULT_JOBS_DIR, kinds=None, limit=None):
+    """Tarefas do armazenamento (mais recentes primeiro), opcionalmente filtradas por tipo."""
+    if not os.path.isdir(jobs_dir):
+        return []
+    jobs = []
+    for job_id in sorted(os.listdir(jobs_dir), reverse=True):
+        job = get_job(job_id, jobs_dir)
+        if job is None or (kinds and job['tipo'] not in kinds):
+            continue
+        jobs.append(job)
+        if limit and len(jobs) >= limit:
+            break
+    return jobs
+
+
+def job_events(job_id, jobs_dir=DEFAULT_JOBS_DIR, since=0):
+    """Eventos de progresso a partir do índice `since` (lista de dicts mensagem/progresso/tempo)."""
+    try:
+        with open(os.path.join(jobs_dir, job_id, EVENTS_FILE), 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+    except OSError:
+        return []
+    events = []
+    for line in lines[since:]:
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            break  # Linha ainda sendo gravada pelo worker
+    return events
+
+
+def cancel_job(job_id, jobs_dir=DEFAULT_JOBS_DIR):
+    """
+    Cancela uma tarefa. Tarefas na fila são removidas do pool; tarefas em
+    execução param na próxima chamada de progresso.
+    """
+    job_dir = os.path.join(jobs_dir, job_id)
+    if not os.path.isdir(job_dir):
+        raise ValueError(f"Tarefa '{job_id}' não encontrada.")
+    future = _FUTURES.get(job_id)
+    if future is not None and future.cancel():
+        _write_json(os.path.join(job_dir, STATE_FILE),
+                    {'estado': CANCELLED, 'mensagem': "Cancelada antes de iniciar.", 'progresso': 0,
+                     'atualizada': time.time()})
+        return
+    with open(os.path.join(job_dir, CANCEL_FILE), 'w'):
+        pass
+
+
+def job_results(job_id, jobs_dir=DEFAULT_JOBS_DIR, load_arrays=True):
+    """
+    Resultados de uma tarefa concluída, lidos do disco. Resultados de
+    pré-processamento voltam com os objetos PySheds reconstruídos (exceto
+    com `load_arrays=False`) e com `tarefa_dir`, que permite passá-los a
+    outras tarefas sem regravá-los.
+    """
+    job = get_job(job_id, jobs_dir)
+    if job is None:
+        raise ValueError(f"Tarefa '{job_id}' não encontrada.")
+    if job['estado'] != DONE:
+        raise RuntimeError(f"Tarefa '{job_id}' não foi concluída (estado: {job['estado']}).")
+    results = _read_json(os.path.join(job['dir'], RESULT_FILE)) or {}
+    entry_dir = os.path.join(job['dir'], RESULT_ENTRY)
+    if load_arrays and os.path.isdir(entry_dir):
+        results = _resolve(_PreprocessingRef(entry_dir, results))
+        results['tarefa_dir'] = job['dir']
+    return results
+
+
+def delete_job(job_id, jobs_dir=DEFAULT_JOBS_DIR):
+    """Remove a pasta de uma tarefa finalizada (arquivos gravados em `output_dir` externos são mantidos)."""
+    job = get_job(job_id, jobs_dir)
+    if job is None:
+        return
+    if job['estado'] not in FINAL_STATES:
+        raise RuntimeError(f"Tarefa '{job_id}' ainda está em execução; cancele-a antes de removê-la.")
+    shutil.rmtree(job['dir'], ignore_errors=True)
+    _FUTURES.pop(job_id, None)
+
+
+# --- WORKER ---
+
+def _run_job(job_dir):
+    """Executado no processo do pool: roda a função da tarefa e grava estado e resultados."""
+    state_path = os.path.join(job_dir, STATE_FILE)
+    cancel_path = os.path.join(job_dir, CANCEL_FILE)
+    job = _read_json(os.path.join(job_dir, JOB_FILE))
+    started = time.time()
+
+    def set_state(state, message, percentage, **extra):
+        _write_json(state_path, dict({'estado': state, 'mensagem': message, 'progresso': int(percentage),
+                                      'pid': os.getpid(), 'iniciada': started, 'atualizada': time.time()},
+                                     **extra))
+
+    def on_event(event):
+        if os.path.exists(cancel_path):
+            raise JobCancelled()
+        with open(os.path.join(job_dir, EVENTS_FILE), 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'mensagem': event['mensagem'], 'progresso': int(event['progresso']),
+                                'tempo': event['tempo_s'], 'etapa': event['etapa']}, ensure_ascii=False) + '\n')
+
+    progress_callback = RunProfiler(on_update=lambda message, percentage: set_state(RUNNING, message, percentage),
+                                    min_interval=STATE_UPDATE_INTERVAL, on_event=on_event, name=job['rotulo'])
+    try:
+        progress_callback("Iniciando...", 0)
+        with open(os.path.join(job_dir, ARGS_FILE), 'rb') as f:
+            params = {name: _resolve(value) for name, value in pickle.load(f).items()}
+        module_name, function_name = JOB_FUNCTIONS[job['tipo']]
+        function = getattr(importlib.import_module(module_name), function_name)
+        results = function(progress_callback=progress_callback, **params) or {}
+
+        if _has_pysheds_objects(results):
+            store_preprocessing(job_dir, RESULT_ENTRY, results, {}, max_bytes=float('inf'), files=False)
+        _write_json(os.path.join(job_dir, RESULT_FILE),
+                    {key: value for key, value in results.items()
+                     if key != 'grid' and key not in IN_MEMORY_RASTERS and _json_safe(value)})
+        set_state(DONE, "Concluída.", 100, concluida=time.time())
+    except JobCancelled:
+        set_state(CANCELLED, "Cancelada pelo usuário.", 0, concluida=time.time())
+    except Exception as e:
+        set_state(FAILED, f"Erro: {e}", 0, erro=str(e), traceback=traceback.format_exc(), concluida=time.time())
+    finally:
+        progress_callback.save_report(os.path.join(job_dir, REPORT_FILE))
+    return job_dir
@@ -5,21 +5,49 @@ import geopandas as gpd
 from pyproj import CRS
 import osmnx as ox
 import numpy as np
-from shapely.geometry import box, shape, LineString, Point
+import shapely
+from shapely.geometry import box, shape, Point
 import warnings
 import os
 import zipfile
 import glob
 import pandas as pd
+from affine import Affine
 from scipy.optimize import brentq
 
 # Tenta importar pysheds
 try:
     from pysheds.grid import Grid
+    from pysheds.sview import Raster, ViewFinder
 except ImportError:
     print("Erro: Biblioteca 'pysheds' não encontrada. Instale com 'pip install pysheds'")
     raise
 
+import scripts.tiled_conditioning as tiled_conditioning
+import scripts.terrain_derivatives as terrain_derivatives
+import scripts.raster_output as raster_output
+import scripts.stream_index as stream_index
+import scripts.priority_flood as priority_flood
+import scripts.raster_grid as raster_grid
+from scripts.tiled_conditioning import run_tiled_preprocessing, DEFAULT_TILE_SIZE
+from scripts.terrain_derivatives import write_terrain_derivatives, DEFAULT_OUTPUTS as DEFAULT_TERRAIN_OUTPUTS
+from scripts.river_network import network_to_geodataframe
+from scripts.polygonize import polygonize_mask
+from scripts.zonal_overlay import (windowed_soil_overlay, INTERSECTION_ENGINES, DEFAULT_INTERSECTION_ENGINE,
+                                   DEFAULT_TILE_SIZE as DEFAULT_OVERLAY_TILE_SIZE)
+from scripts.area_buffer import solve_buffer_distances, parallel_buffer_to_areas, BUFFER_XTOL_M, BUFFER_QUAD_SEGS
+from scripts.area_curves import (build_area_curves, save_area_curves, load_area_curves, buffer_with_curves,
+                                 curves_signature, DEFAULT_MAX_PERCENT)
+from scripts.priority_flood import fill_depressions, CONDITIONING_ENGINES, DEFAULT_CONDITIONING
+from scripts.raster_grid import DIRMAP
+from scripts.profiling import stage, PeakRSSMonitor
+from scripts.stream_index import (build_stream_index, save_stream_index, load_stream_index, write_network,
+                                  network_for_threshold, reach_cells, STREAM_INDEX_MIN_THRESHOLD)
+from scripts.raster_output import (open_cog, write_cog, encode_fdir, encode_acc, DEFAULT_COMPRESSION,
+                                   FDIR_NODATA, ACC_NODATA)
+from scripts.artifact_cache import (make_cache_key, code_version, load_cached_preprocessing,
+                                    store_preprocessing, DEFAULT_CACHE_MAX_BYTES)
+
 # Ignorar warnings futuros
 warnings.filterwarnings("ignore", category=FutureWarning)
 warnings.filterwarnings("ignore", category=RuntimeWarning)
@@ -27,10 +55,165 @@ warnings.filterwarnings("ignore", category=RuntimeWarning)
 
 # --- FUNÇÕES DA PÁGINA 2 (HIDROLOGIA) ---
 
-def run_preprocessing(mde_path, output_dir, stream_threshold, progress_callback):
+REACH_DTYPE, REACH_NODATA = np.int32, -1
+DEPTH_KEYS = ('strahler_order', 'trecho_id')
+PREPROCESSING_CODE_VERSION = code_version(__file__, tiled_conditioning.__file__, terrain_derivatives.__file__,
+                                          raster_output.__file__, stream_index.__file__, priority_flood.__file__,
+                                          raster_grid.__file__)
+
+# Pico de memória adicional por célula do MDE (bytes), medido no pré-processamento
+# em memória (o pico ocorre dentro de resolve_flats). No modo com orçamento de
+# memória o MDE condicionado e a direção de fluxo são convertidos para
+# float32/int16 logo após a direção de fluxo.
+IN_MEMORY_BYTES_PER_CELL = 85
+LOW_MEMORY_BYTES_PER_CELL = 70
+# No modo em blocos, por célula do bloco (os rasters globais ficam em disco)
+TILED_BYTES_PER_CELL = 200
+MIN_TILE_SIZE = 256
+
+
+def estimate_preprocessing_memory(mde_path, tiled=False, tile_size=DEFAULT_TILE_SIZE, low_memory=False):
+    """
+    Pico de memória estimado (bytes) do pré-processamento do MDE no modo
+    escolhido, além da memória já ocupada pelo processo.
+    """
+    if not os.path.exists(mde_path):
+        raise FileNotFoundError(f"Arquivo MDE '{mde_path}' não encontrado.")
+    with rasterio.open(mde_path) as src:
+        height, width = src.height, src.width
+    if tiled:
+        return min(tile_size, height) * min(tile_size, width) * TILED_BYTES_PER_CELL
+    return height * width * (LOW_MEMORY_BYTES_PER_CELL if low_memory else IN_MEMORY_BYTES_PER_CELL)
+
+
+def _tile_size_for_budget(budget_bytes, tile_size):
+    """Maior bloco (múltiplo de 256, até `tile_size`) cujo pico estimado cabe no orçamento."""
+    fitting = int(np.sqrt(budget_bytes / TILED_BYTES_PER_CELL)) // MIN_TILE_SIZE * MIN_TILE_SIZE
+    return max(MIN_TILE_SIZE, min(tile_size, fitting))
+
+
+def run_preprocessing(mde_path, output_dir, stream_threshold, progress_callback, tiled=False,
+                      tile_size=DEFAULT_TILE_SIZE, cache_dir=None, cache_max_bytes=DEFAULT_CACHE_MAX_BYTES,
+                      terrain_outputs=DEFAULT_TERRAIN_OUTPUTS, gradient_method='zt',
+                      compression=DEFAULT_COMPRESSION, overviews=True, memory_budget_mb=None,
+                      conditioning=DEFAULT_CONDITIONING):
     """
     Executa a Etapa 1: Pré-processamento do MDE.
     Combina as células 2, 2.5, 2.6 e 3 do notebook.
+
+    Com `tiled=True`, o MDE é processado em blocos de `tile_size` células
+    (ver `scripts/tiled_conditioning.py`), permitindo MDEs maiores que a RAM.
+
+    Com `cache_dir`, os artefatos são guardados em um cache em disco indexado
+    pelo hash do MDE e dos parâmetros (ver `scripts/artifact_cache.py`); uma
+    nova execução com o mesmo MDE e parâmetros é recuperada do cache.
+
+    `terrain_outputs` seleciona as derivadas do terreno geradas (ver
+    `scripts/terrain_derivatives.py`) e `gradient_method` o operador de
+    gradiente ('zt' ou 'horn').
+
+    Os rasters são gravados como COG (ver `scripts/raster_output.py`): direção
+    de fluxo em uint8, acumulação em uint32 e derivadas em float32, com a
+    `compression` escolhida e, se `overviews=True`, overviews internas.
+
+    A rede de drenagem é gerada a partir de um índice por limiar
+    (`indice_rede.npz`, ver `scripts/stream_index.py`); por isso o limiar só
+    entra na chave do cache quando é menor que o limiar mínimo do índice, e
+    uma entrada em cache serve a qualquer limiar acima dele.
+
+    Com `memory_budget_mb`, o pré-processamento roda em modo de baixa memória
+    (MDE condicionado em float32, direção de fluxo em int16). Se o pico
+    estimado (`estimate_preprocessing_memory`) passar do orçamento, muda
+    automaticamente para o modo em blocos, reduzindo o bloco se preciso. O
+    pico de memória medido é informado em `results['pico_memoria_mb']`.
+
+    `conditioning` escolhe o condicionamento do MDE no modo em memória:
+    'pysheds' (fill_pits, fill_depressions e resolve_flats), 'priority_flood'
+    (Priority-Flood em numba + resolve_flats) ou 'priority_flood_epsilon'
+    (Priority-Flood+ε em uma passada); ver `scripts/priority_flood.py`. O modo
+    em blocos usa sempre o seu Priority-Flood por blocos.
+    """
+    if conditioning not in CONDITIONING_ENGINES:
+        raise ValueError(f"Condicionamento '{conditioning}' inválido. Use um de: {', '.join(CONDITIONING_ENGINES)}.")
+    low_memory = memory_budget_mb is not None
+    if low_memory:
+        budget_bytes = memory_budget_mb * 1024 ** 2
+        estimate = estimate_preprocessing_memory(mde_path, low_memory=True)
+        if not tiled and estimate > budget_bytes:
+            tiled = True
+            progress_callback(f"Memória estimada ({estimate / 1024 ** 2:.0f} MB) acima do orçamento "
+                              f"({memory_budget_mb:.0f} MB): processando em blocos.", 1)
+        if tiled:
+            tile_size = _tile_size_for_budget(budget_bytes, tile_size)
+            estimate = estimate_preprocessing_memory(mde_path, tiled=True, tile_size=tile_size)
+
+    cache_key = None
+    if cache_dir:
+        if not os.path.exists(mde_path):
+            raise FileNotFoundError(f"Arquivo MDE '{mde_path}' não encontrado.")
+        progress_callback("Verificando cache de pré-processamento...", 2)
+        # O tamanho do bloco não altera o resultado, portanto não entra na chave
+        cache_params = {'dirmap': DIRMAP, 'index_threshold': min(stream_threshold, STREAM_INDEX_MIN_THRESHOLD),
+                        'tiled': bool(tiled),
+                        'terrain_outputs': sorted(terrain_outputs), 'gradient_method': gradient_method,
+                        'compression': compression, 'overviews': bool(overviews),
+                        'low_memory': low_memory and not tiled,
+                        'conditioning': 'blocos' if tiled else conditioning,
+                        'code_version': PREPROCESSING_CODE_VERSION}
+        os.makedirs(output_dir, exist_ok=True)
+        with stage(progress_callback, 'cache_lookup'):
+            cache_key = make_cache_key(mde_path, cache_params)
+            cached = load_cached_preprocessing(cache_dir, cache_key, output_dir)
+        if cached is not None:
+            # Uma entrada em blocos serve aos dois modos (o modo de memória não entra na chave)
+            _set_memory_mode(cached, low_memory, estimate if low_memory else None, tiled, tile_size)
+            progress_callback("Rede de drenagem para o limiar a partir do índice em cache...", 90)
+            with stage(progress_callback, 'network'):
+                _write_total_network(cached, stream_threshold, output_dir)
+            progress_callback("Resultados recuperados do cache.", 100)
+            return cached
+
+    with PeakRSSMonitor() as monitor:
+        if tiled:
+            results = run_tiled_preprocessing(mde_path, output_dir, stream_threshold, progress_callback,
+                                              tile_size=tile_size, terrain_outputs=terrain_outputs,
+                                              gradient_method=gradient_method, compression=compression,
+                                              overviews=overviews)
+        else:
+            results = _run_preprocessing_in_memory(mde_path, output_dir, stream_threshold, progress_callback,
+                                                   terrain_outputs=terrain_outputs,
+                                                   gradient_method=gradient_method, compression=compression,
+                                                   overviews=overviews, low_memory=low_memory,
+                                                   conditioning=conditioning)
+    results['pico_memoria_mb'] = monitor.peak_mb
+    _set_memory_mode(results, low_memory, estimate if low_memory else None, tiled, tile_size)
+
+    if cache_key is not None:
+        with stage(progress_callback, 'cache_store'):
+            store_preprocessing(cache_dir, cache_key, results, cache_params, max_bytes=cache_max_bytes)
+    return results
+
+
+def _set_memory_mode(results, low_memory, estimate, tiled, tile_size):
+    """Chaves do modo de baixa memória em `results` (removidas fora desse modo)."""
+    if low_memory:
+        results['baixa_memoria'] = True
+        results['memoria_estimada_mb'] = estimate / 1024 ** 2
+        results['modo_memoria'] = f"blocos de {tile_size} células" if tiled else "em memória (float32)"
+    else:
+        for name in ('baixa_memoria', 'memoria_estimada_mb', 'modo_memoria'):
+            results.pop(name, None)
+
+
+def _run_preprocessing_in_memory(mde_path, output_dir, stream_threshold, progress_callback,
+                                 terrain_outputs=DEFAULT_TERRAIN_OUTPUTS, gradient_method='zt',
+                                 compression=DEFAULT_COMPRESSION, overviews=True, low_memory=False,
+                                 conditioning=DEFAULT_CONDITIONING):
+    """
+    Pré-processamento com o MDE inteiro em memória (objetos PySheds). Cada
+    cópia intermediária do MDE é liberada assim que consumida; com
+    `low_memory=True`, o MDE condicionado e a direção de fluxo mantidos para a
+    Etapa 2 são convertidos para float32 e int16.
     """
     results = {}
 
@@ -38,81 +221,77 @@ def run_preprocessing(mde_path, output_dir, stream_threshold, progress_callback)
     if not os.path.exists(mde_path):
         raise FileNotFoundError(f"Arquivo MDE '{mde_path}' não encontrado.")
 
-    grid = Grid.from_raster(mde_path, data_name='dem')
-    dem = grid.read_raster(mde_path)
-
-    progress_callback("Condicionando MDE (fill_pits, resolve_flats)... (Pode demorar)", 15)
-    pit_filled_dem = grid.fill_pits(dem)
-    flooded_dem = grid.fill_depressions(pit_filled_dem)
-    inflated_dem = grid.resolve_flats(flooded_dem)  # MDE condicionado
+    with stage(progress_callback, 'read_dem'):
+        grid = Grid.from_raster(mde_path, data_name='dem')
+        dem = grid.read_raster(mde_path)
+
+    if conditioning in ('priority_flood', 'priority_flood_epsilon'):
+        epsilon = conditioning == 'priority_flood_epsilon'
+        progress_callback(f"Condicionando MDE (Priority-Flood{'+ε' if epsilon else ''})...", 15)
+        with stage(progress_callback, 'priority_flood'):
+            flooded_dem = Raster(fill_depressions(dem, dem.nodata, epsilon=epsilon), viewfinder=dem.viewfinder)
+            del dem
+        if epsilon:
+            inflated_dem = flooded_dem  # MDE condicionado (sem áreas planas)
+        else:
+            with stage(progress_callback, 'resolve_flats'):
+                inflated_dem = grid.resolve_flats(flooded_dem)  # MDE condicionado
+        del flooded_dem
+    else:
+        progress_callback("Condicionando MDE (fill_pits, resolve_flats)... (Pode demorar)", 15)
+        with stage(progress_callback, 'fill_pits'):
+            pit_filled_dem = grid.fill_pits(dem)
+            del dem
+        with stage(progress_callback, 'fill_depressions'):
+            flooded_dem = grid.fill_depressions(pit_filled_dem)
+            del pit_filled_dem
+        with stage(progress_callback, 'resolve_flats'):
+            inflated_dem = grid.resolve_flats(flooded_dem)  # MDE condicionado
+            del flooded_dem
 
     progress_callback("Calculando direção e acumulação do fluxo...", 30)
-    dirmap = (64, 128, 1, 2, 4, 8, 16, 32)
-    fdir = grid.flowdir(inflated_dem, dirmap=dirmap)
-    acc = grid.accumulation(fdir, dirmap=dirmap)
+    dirmap = DIRMAP
+    with stage(progress_callback, 'flowdir'):
+        fdir = grid.flowdir(inflated_dem, dirmap=dirmap)
+        if low_memory:
+            # Os desníveis criados por resolve_flats ficam abaixo da precisão do
+            # float32: a direção é calculada antes da conversão do MDE
+            fdir = _as_raster(fdir, np.int16)
+            inflated_dem = _as_raster(inflated_dem, np.float32)
+    with stage(progress_callback, 'accumulation'):
+        acc = grid.accumulation(fdir, dirmap=dirmap)
 
     # Salvar rasters intermediários
     fdir_path = os.path.join(output_dir, 'flow_direction.tif')
     acc_path = os.path.join(output_dir, 'flow_accumulation.tif')
 
     progress_callback("Salvando rasters de direção e acumulação...", 40)
-    grid.to_raster(fdir, fdir_path, nodata=-9999)
-    grid.to_raster(acc, acc_path, nodata=-9999)
+    profile = {'crs': grid.viewfinder.crs, 'transform': grid.viewfinder.affine}
+    cog_options = {'compression': compression, 'overviews': overviews}
+    with stage(progress_callback, 'write_rasters'):
+        write_cog(fdir_path, encode_fdir(fdir, dirmap), dict(profile, nodata=FDIR_NODATA), resampling='nearest',
+                  **cog_options)
+        write_cog(acc_path, encode_acc(acc), dict(profile, nodata=ACC_NODATA), resampling='nearest', **cog_options)
     results['fdir_path'] = fdir_path
     results['acc_path'] = acc_path
 
-    # Cálculo do Aspect
-    progress_callback("Calculando Aspect...", 45)
-    gy, gx = np.gradient(inflated_dem)
-    aspect_rad = np.arctan2(gy, -gx)
-    aspect_deg = np.degrees(aspect_rad)
-    aspect = (aspect_deg + 360) % 360
-    aspect[((gx == 0) & (gy == 0))] = -1  # Marcar áreas planas
-    aspect_path = os.path.join(output_dir, 'aspect.tif')
-    grid.to_raster(aspect, aspect_path, nodata=-1)
-    results['aspect_path'] = aspect_path
-
-    # Cálculo do Slope (Declividade)
-    progress_callback("Calculando Declividade (Slope)...", 50)
-    x_res = grid.viewfinder.affine[0]
-    y_res = -grid.viewfinder.affine[4]  # É negativo na affine
-    gy, gx = np.gradient(inflated_dem, y_res, x_res)
-    slope_rad = np.arctan(np.sqrt(gx ** 2 + gy ** 2))
-    slope_deg = np.degrees(slope_rad)
-    slope_path = os.path.join(output_dir, 'slope.tif')
-    grid.to_raster(slope_deg, slope_path, nodata=-9999)
-    results['slope_path'] = slope_path
-
-    # Cálculo do TWI (Índice de Umidade Topográfica)
-    progress_callback("Calculando Índice de Umidade Topográfica (TWI)...", 60)
-    cell_area = x_res * y_res
-    slope_rad_twi = np.arctan(np.sqrt(gx ** 2 + gy ** 2))
-    slope_rad_twi[slope_rad_twi == 0] = 0.001  # Evitar divisão por zero
-    sca = (acc + 1) * cell_area
-    twi = np.log(sca / np.tan(slope_rad_twi))
-    twi_path = os.path.join(output_dir, 'twi.tif')
-    grid.to_raster(twi, twi_path, nodata=-9999)
-    results['twi_path'] = twi_path
-
-    # Vetorização da Rede de Drenagem (Total)
-    progress_callback("Vetorizando rede de drenagem total...", 75)
-    streams_mask = acc > stream_threshold
-    network = grid.extract_river_network(fdir, streams_mask, distance=1)
-
-    features_list = network.get('features', [])
-    geometries = []
-    if features_list:
-        for feature in features_list:
-            coords = feature['geometry']['coordinates']
-            if len(coords) >= 2:
-                geometries.append(LineString(coords))
-
-        if geometries:
-            streams_gdf = gpd.GeoDataFrame(geometry=geometries, crs=grid.viewfinder.crs)
-            canais_path = os.path.join(output_dir, 'rede_drenagem_total.geojson')
-            streams_gdf.to_file(canais_path, driver='GeoJSON')
-            results['canais_total_path'] = canais_path
-            progress_callback("Rede de drenagem total salva.", 95)
+    # Derivadas do terreno (declividade, aspect, TWI e opcionais) em uma passada
+    progress_callback("Calculando derivadas do terreno (Declividade, Aspect, TWI)...", 45)
+    with stage(progress_callback, 'terrain_derivatives'):
+        results.update(write_terrain_derivatives(inflated_dem, profile, output_dir, outputs=terrain_outputs,
+                                                 acc=acc, nodata=inflated_dem.nodata, method=gradient_method,
+                                                 **cog_options))
+
+    # Índice da rede por limiar e vetorização da Rede de Drenagem (Total)
+    progress_callback("Indexando e vetorizando rede de drenagem total...", 75)
+    with stage(progress_callback, 'stream_index'):
+        index = build_stream_index(fdir, acc, dirmap, grid.viewfinder.affine, grid.viewfinder.crs, dem=inflated_dem,
+                                   min_threshold=min(stream_threshold, STREAM_INDEX_MIN_THRESHOLD))
+        results['indice_rede_path'] = save_stream_index(index, os.path.join(output_dir, 'indice_rede.npz'))
+    with stage(progress_callback, 'network'):
+        _write_total_network(results, stream_threshold, output_dir, index=index)
+    if 'canais_total_path' in results:
+        progress_callback("Rede de drenagem total salva.", 95)
 
     progress_callback("Pré-processamento concluído.", 100)
 
@@ -126,28 +305,213 @@ def run_preprocessing(mde_path, output_dir, stream_threshold, progress_callback)
     return results
 
 
-def run_delineation(preproc_data, outlet_coords, channel_depth, stream_threshold, output_dir, progress_callback, generate_flu_distance=False):
+def _as_raster(raster, dtype):
+    """Cópia do `Raster` PySheds convertida para `dtype`, com o mesmo viewfinder."""
+    return Raster(np.asarray(raster).astype(dtype), viewfinder=raster.viewfinder)
+
+
+def _write_total_network(results, stream_threshold, output_dir, index=None):
+    """(Re)grava `rede_drenagem_total.geojson` para o limiar a partir do índice da rede."""
+    if index is None:
+        index = load_stream_index(results['indice_rede_path'])
+    canais_path = write_network(index, stream_threshold, os.path.join(output_dir, 'rede_drenagem_total.geojson'))
+    if canais_path is None:
+        results.pop('canais_total_path', None)
+    else:
+        results['canais_total_path'] = canais_path
+
+
+def load_preprocessing_results(preproc_data):
+    """
+    Carrega em memória (objetos PySheds) os rasters gerados pelo pré-processamento
+    em blocos, para uso na Etapa 2. Resultados do modo em memória são retornados
+    sem alteração.
+    """
+    if 'grid' in preproc_data:
+        return preproc_data
+
+    dem_path = preproc_data['dem_condicionado_path']
+    grid = Grid.from_raster(dem_path, data_name='dem')
+    loaded = dict(preproc_data)
+    loaded['grid'] = grid
+    loaded['inflated_dem'] = grid.read_raster(dem_path)
+    loaded['fdir'] = grid.read_raster(preproc_data['fdir_path']).astype(
+        np.int16 if preproc_data.get('baixa_memoria') else np.int64)
+    loaded['acc'] = grid.read_raster(preproc_data['acc_path']).astype(np.float64)
+    return loaded
+
+
+def run_delineation(preproc_data, outlet_coords, channel_depth, stream_threshold, output_dir, progress_callback, generate_flu_distance=False,
+                    clip_domain=True, compression=DEFAULT_COMPRESSION, overviews=True, polygonize_workers=None,
+                    smooth_iterations=0, depth_by='strahler_order'):
     """
     Executa a Etapa 2: Delineamento da Bacia e HAND.
+
+    `channel_depth` pode ser um número ou variar por trecho: dicionário por
+    ordem de Strahler (ou por `trecho_id`, com `depth_by='trecho_id'`),
+    sequência ou função dos canais da bacia (ver `resolve_reach_depths`).
+    Nesse caso cada célula recebe a profundidade do trecho da sua célula de
+    drenagem mais próxima, em uma única passada vetorizada; requer o índice
+    da rede e `clip_domain=True`.
+
+    Com `clip_domain=True`, HAND, distância de fluxo, acumulação e ordem de
+    Strahler são calculados apenas na janela (bounding box) da bacia, em vez de
+    em toda a extensão do pré-processamento.
+
+    Os rasters de inundação e distância de fluxo são gravados como COG float32.
+
+    Bacia e mancha de inundação são vetorizadas em blocos por
+    `polygonize_workers` processos (ver `scripts/polygonize.py`); com
+    `smooth_iterations > 0`, os degraus de pixel da mancha são suavizados.
+    """
+    results = {}
+
+    grid, preproc_data = _delineate_catchment(preproc_data, outlet_coords, stream_threshold, output_dir,
+                                              progress_callback, generate_flu_distance, results,
+                                              clip_domain=clip_domain, compression=compression,
+                                              overviews=overviews, polygonize_workers=polygonize_workers)
+
+    # Cálculo do HAND
+    variable_depth = not np.isscalar(channel_depth)
+    progress_callback("Calculando HAND dentro da bacia...", 80)
+    with stage(progress_callback, 'hand'):
+        if variable_depth:
+            hand_view, reach_view = _compute_hand_reach_view(grid, preproc_data, stream_threshold)
+        else:
+            hand_view = _compute_hand_view(grid, preproc_data, stream_threshold)
+
+    if variable_depth:
+        progress_callback("Calculando mancha de inundação com profundidade por trecho...", 90)
+        depths = resolve_reach_depths(channel_depth, preproc_data['catchment_streams'], depth_by)
+        results['profundidade_por_trecho'] = depths
+        inundation_depth = flood_depth_by_reach(hand_view, reach_view, depths)
+        suffix_nome_arquivo = 'por_ordem' if depth_by == 'strahler_order' else 'por_trecho'
+    else:
+        progress_callback(f"Calculando mancha de inundação para {channel_depth}m...", 90)
+        inundation_depth = np.where(hand_view < channel_depth, channel_depth - hand_view, np.nan)
+        suffix_nome_arquivo = _depth_suffix(channel_depth)
+    results['suffix'] = suffix_nome_arquivo
+
+    # Salvar Raster de Inundação
+    profile = _flood_raster_profile(grid, count=1)
+
+    inundacao_raster_path = os.path.join(output_dir, f'inundacao_mapa_{suffix_nome_arquivo}.tif')
+    with stage(progress_callback, 'write_rasters'):
+        write_cog(inundacao_raster_path, inundation_depth.astype(rasterio.float32), profile,
+                  compression=compression, overviews=overviews)
+    results['inundacao_raster_path'] = inundacao_raster_path
+
+    # Vetorizar Mancha de Inundação
+    progress_callback("Vetorizando mancha de inundação...", 95)
+    with stage(progress_callback, 'polygonize'):
+        flood_gdf = polygonize_mask(~np.isnan(inundation_depth), profile['transform'], profile['crs'],
+                                    max_workers=polygonize_workers, smooth_iterations=smooth_iterations)
+    if flood_gdf is not None:
+        inundacao_vetor_path = os.path.join(output_dir, f'inundacao_{suffix_nome_arquivo}.geojson')
+        flood_gdf.to_file(inundacao_vetor_path, driver='GeoJSON')
+        results['inundacao_vetor_path'] = inundacao_vetor_path
+
+    progress_callback("Delineamento e HAND concluídos.", 100)
+    return results
+
+
+def run_flood_sweep(preproc_data, outlet_coords, channel_depths, stream_threshold, output_dir, progress_callback,
+                    generate_flu_distance=False, clip_domain=True, compression=DEFAULT_COMPRESSION, overviews=True,
+                    polygonize_workers=None, smooth_iterations=0):
+    """
+    Executa a Etapa 2 para vários cenários de profundidade do canal de uma só vez.
+
+    Snap, bacia, recorte e HAND são calculados uma única vez; cada profundidade
+    gera uma banda do raster `inundacao_mapa_multiprofundidade.tif` e uma camada
+    do vetor `inundacao_multiprofundidade.geojson` (atributo `profundidade_m`).
     """
     results = {}
 
+    depths = sorted({float(d) for d in channel_depths})
+    if not depths:
+        raise ValueError("Informe ao menos uma profundidade do canal.")
+    if depths[0] <= 0:
+        raise ValueError("As profundidades do canal devem ser positivas.")
+
+    grid, preproc_data = _delineate_catchment(preproc_data, outlet_coords, stream_threshold, output_dir,
+                                              progress_callback, generate_flu_distance, results,
+                                              clip_domain=clip_domain, compression=compression,
+                                              overviews=overviews, polygonize_workers=polygonize_workers)
+
+    progress_callback("Calculando HAND dentro da bacia...", 80)
+    with stage(progress_callback, 'hand'):
+        hand_view = _compute_hand_view(grid, preproc_data, stream_threshold)
+
+    profile = _flood_raster_profile(grid, count=len(depths))
+    suffixes = [_depth_suffix(depth) for depth in depths]
+    results['suffixes'] = suffixes
+
+    inundacao_raster_path = os.path.join(output_dir, 'inundacao_mapa_multiprofundidade.tif')
+    flood_layers = []
+    with open_cog(inundacao_raster_path, profile, compression=compression, overviews=overviews) as dst:
+        for band, (depth, suffix) in enumerate(zip(depths, suffixes), start=1):
+            progress_callback(f"Calculando mancha de inundação para {depth}m ({band}/{len(depths)})...",
+                              85 + int(10 * (band - 1) / len(depths)))
+            inundation_depth = np.where(hand_view < depth, depth - hand_view, np.nan)
+            with stage(progress_callback, 'write_rasters'):
+                dst.write(inundation_depth.astype(rasterio.float32), band)
+                dst.set_band_description(band, suffix)
+
+            with stage(progress_callback, 'polygonize'):
+                flood_gdf = polygonize_mask(~np.isnan(inundation_depth), profile['transform'], profile['crs'],
+                                            max_workers=polygonize_workers, smooth_iterations=smooth_iterations)
+            if flood_gdf is not None:
+                flood_gdf['profundidade_m'] = depth
+                flood_layers.append(flood_gdf)
+    results['inundacao_raster_path'] = inundacao_raster_path
+
+    progress_callback("Salvando camadas de inundação...", 97)
+    if flood_layers:
+        flood_gdf = gpd.GeoDataFrame(pd.concat(flood_layers, ignore_index=True), crs=profile['crs'])
+        flood_gdf = flood_gdf[['profundidade_m', 'geometry']]
+        inundacao_vetor_path = os.path.join(output_dir, 'inundacao_multiprofundidade.geojson')
+        flood_gdf.to_file(inundacao_vetor_path, driver='GeoJSON')
+        results['inundacao_vetor_path'] = inundacao_vetor_path
+
+    progress_callback("Delineamento e HAND (múltiplas profundidades) concluídos.", 100)
+    return results
+
+
+def _delineate_catchment(preproc_data, outlet_coords, stream_threshold, output_dir, progress_callback,
+                         generate_flu_distance, results, clip_domain=True, compression=DEFAULT_COMPRESSION,
+                         overviews=True, polygonize_workers=None):
+    """
+    Etapas comuns da Etapa 2: snap do exutório, bacia, recorte do grid e canais
+    com ordem de Strahler. Preenche `results` e retorna o grid recortado e os
+    dados do pré-processamento (carregados, se vierem do modo em blocos).
+
+    Com `clip_domain=True`, os rasters são fatiados para a janela da bacia logo
+    após a delimitação, e o grid e os rasters retornados são os da janela (o
+    grid do pré-processamento não é alterado). O índice da rede usado, se
+    houver, segue em `stream_index`, e os canais da bacia (um trecho por
+    linha, na numeração de `reach_cells`) em `catchment_streams`.
+    """
+    if 'grid' not in preproc_data:
+        progress_callback("Carregando rasters do pré-processamento em blocos...", 5)
+        with stage(progress_callback, 'load_preprocessing'):
+            preproc_data = load_preprocessing_results(preproc_data)
+
     # Recupera dados da etapa anterior
     grid = preproc_data['grid']
     fdir = preproc_data['fdir']
     acc = preproc_data['acc']
-    inflated_dem = preproc_data['inflated_dem']
     dirmap = preproc_data['dirmap']
 
     x_outlet, y_outlet = outlet_coords
 
     progress_callback("Realizando snap do exutório...", 10)
-    streams_mask = acc > stream_threshold
-    try:
-        x_snap, y_snap = grid.snap_to_mask(streams_mask, (x_outlet, y_outlet))
-    except ValueError as e:
-        raise ValueError(
-            f"Erro ao fazer snap: {e}. Verifique se as coordenadas estão dentro da área do MDE e próximas a um canal com acumulação > {stream_threshold}.")
+    with stage(progress_callback, 'snap'):
+        streams_mask = acc > stream_threshold
+        try:
+            x_snap, y_snap = grid.snap_to_mask(streams_mask, (x_outlet, y_outlet))
+        except ValueError as e:
+            raise ValueError(
+                f"Erro ao fazer snap: {e}. Verifique se as coordenadas estão dentro da área do MDE e próximas a um canal com acumulação > {stream_threshold}.")
 
     # --- INÍCIO DA EXPORTAÇÃO DO EXUTÓRIO ---
     progress_callback("Exportando exutório...", 15)
@@ -159,120 +523,245 @@ def run_delineation(preproc_data, outlet_coords, channel_depth, stream_threshold
     # --- FIM DA EXPORTAÇÃO DO EXUTÓRIO ---
 
     progress_callback("Delimitando bacia hidrográfica...", 20)
-    catch = grid.catchment(x=x_snap, y=y_snap, fdir=fdir, dirmap=dirmap, xytype='coordinate')
+    with stage(progress_callback, 'catchment'):
+        catch = grid.catchment(x=x_snap, y=y_snap, fdir=fdir, dirmap=dirmap, xytype='coordinate')
+    index = _stream_index_for(preproc_data, stream_threshold)
+    if index is not None:
+        catch_mask = np.asarray(catch) != catch.nodata
+
+    if clip_domain:
+        progress_callback("Recortando rasters para a janela da bacia...", 25)
+        with stage(progress_callback, 'clip'):
+            grid, (fdir, acc, inflated_dem, catch) = _catchment_window(
+                catch, (fdir, acc, preproc_data['inflated_dem'], catch))
+        preproc_data = dict(preproc_data, grid=grid, fdir=fdir, acc=acc, inflated_dem=inflated_dem)
 
     if generate_flu_distance:
         progress_callback("Calculando distância de fluxo...", 30)
-        dist = grid.distance_to_outlet(x=x_snap, y=y_snap, fdir=fdir, dirmap=dirmap, xytype='coordinate')
+        with stage(progress_callback, 'flow_distance'):
+            if clip_domain:
+                dist = _window_flow_distance(fdir, catch, x_snap, y_snap, dirmap)
+            else:
+                dist = grid.distance_to_outlet(x=x_snap, y=y_snap, fdir=fdir, dirmap=dirmap, xytype='coordinate')
 
-    progress_callback("Recortando grid para a bacia...", 40)
-    grid.clip_to(catch)
+    if not clip_domain:
+        progress_callback("Recortando grid para a bacia...", 40)
+        grid.clip_to(catch)
 
     if generate_flu_distance:
         # Salva Distância de Fluxo (recortada)
         dist_view = grid.view(dist)
         dist_path = os.path.join(output_dir, 'flu_distance.tif')
-        grid.to_raster(dist_view, dist_path, dtype=rasterio.float32, nodata=-9999.0)
+        dist_values = np.where(np.isfinite(dist_view), dist_view, -9999.0).astype(rasterio.float32)
+        write_cog(dist_path, dist_values, {'crs': grid.viewfinder.crs, 'transform': grid.viewfinder.affine,
+                                           'nodata': -9999.0}, compression=compression, overviews=overviews)
         results['dist_path'] = dist_path
 
     progress_callback("Extraindo rede de drenagem e ordem de Strahler...", 50)
-    fdir_clipped = grid.view(fdir)
-    clipped_acc = grid.accumulation(fdir_clipped, dirmap=dirmap)
-    clipped_streams_mask = clipped_acc > stream_threshold
-    stream_order_raster = grid.stream_order(fdir_clipped, clipped_streams_mask)
-    network = grid.extract_river_network(fdir_clipped, clipped_streams_mask, distance=1)
+    with stage(progress_callback, 'network'):
+        if index is not None:
+            # Rede, ordem de Strahler e atributos direto do índice, restritos à bacia
+            streams_gdf = network_for_threshold(index, stream_threshold, within=catch_mask)
+        else:
+            fdir_clipped = grid.view(fdir)
+            clipped_acc = grid.accumulation(fdir_clipped, dirmap=dirmap)
+            clipped_streams_mask = clipped_acc > stream_threshold
+            stream_order_raster = grid.stream_order(fdir_clipped, clipped_streams_mask)
+            network = grid.extract_river_network(fdir_clipped, clipped_streams_mask, distance=1)
 
     progress_callback("Vetorizando a bacia...", 60)
-    catch_view = grid.view(catch)
-    catchment_shapes = rasterio.features.shapes(
-        catch_view.astype(np.uint8),
-        mask=catch_view,
-        transform=grid.viewfinder.affine
-    )
-    catchment_geoms = [shape(geom) for geom, value in catchment_shapes if value == 1]
-    if not catchment_geoms:
+    with stage(progress_callback, 'polygonize'):
+        catch_view = grid.view(catch)
+        catchment_gdf = polygonize_mask(np.asarray(catch_view, dtype=bool), grid.viewfinder.affine,
+                                        grid.viewfinder.crs, max_workers=polygonize_workers)
+    if catchment_gdf is None:
         raise RuntimeError("Não foi possível vetorizar a bacia.")
 
-    catchment_gdf = gpd.GeoDataFrame(geometry=catchment_geoms, crs=grid.viewfinder.crs).dissolve()
     bacia_path = os.path.join(output_dir, 'bacia.geojson')
     catchment_gdf.to_file(bacia_path, driver='GeoJSON')
     results['bacia_path'] = bacia_path
 
-    progress_callback("Atribuindo ordem de Strahler aos canais...", 70)
-    features_list = network.get('features', [])
-    geometries, strahler_orders = [], []
-    if features_list:
-        vf_affine = grid.viewfinder.affine
-        inv_vf_affine = ~vf_affine
-        vf_height, vf_width = grid.viewfinder.shape
-
-        for feature in features_list:
-            coords = feature['geometry']['coordinates']
-            if len(coords) >= 2:
-                geometries.append(LineString(coords))
-                start_coord = coords[0]
-                col_frac, row_frac = inv_vf_affine * (start_coord[0], start_coord[1])
-                row, col = int(row_frac), int(col_frac)
-
-                order_val = None
-                if 0 <= row < vf_height and 0 <= col < vf_width:
-                    order_val = stream_order_raster[row, col]
-
-                strahler_orders.append(int(order_val) if order_val is not None and not np.isnan(order_val) else None)
-
-        if geometries:
-            streams_gdf = gpd.GeoDataFrame({'strahler_order': strahler_orders}, geometry=geometries,
-                                           crs=grid.viewfinder.crs)
-            canais_path = os.path.join(output_dir, 'canais_strahler.geojson')
-            streams_gdf.to_file(canais_path, driver='GeoJSON')
-            results['canais_path'] = canais_path
+    if index is None:
+        progress_callback("Atribuindo ordem de Strahler aos canais...", 70)
+        with stage(progress_callback, 'network'):
+            streams_gdf = network_to_geodataframe(network, grid.viewfinder.crs, affine=grid.viewfinder.affine,
+                                                  stream_order=stream_order_raster, acc=clipped_acc,
+                                                  dem=grid.view(preproc_data['inflated_dem']))
+    if streams_gdf is not None:
+        canais_path = os.path.join(output_dir, 'canais_strahler.geojson')
+        streams_gdf.to_file(canais_path, driver='GeoJSON')
+        results['canais_path'] = canais_path
+
+    if index is not None:
+        preproc_data = dict(preproc_data, stream_index=index, catchment_streams=streams_gdf)
+    return grid, preproc_data
+
+
+def _stream_index_for(preproc_data, stream_threshold):
+    """Índice da rede do pré-processamento, se existir e cobrir o limiar; senão None."""
+    path = preproc_data.get('indice_rede_path')
+    if not path or not os.path.exists(path):
+        return None
+    index = load_stream_index(path)
+    if stream_threshold < index['min_threshold'] or tuple(index['shape']) != tuple(preproc_data['grid'].shape):
+        return None
+    return index
+
+
+def _catchment_window(catch, rasters):
+    """
+    Fatia os rasters para o menor retângulo que contém a bacia.
+
+    Retorna um Grid com a mesma referência espacial e máscara que
+    `grid.clip_to(catch)` produziria e os rasters recortados por índice (sem
+    reamostragem), de modo que os cálculos seguintes fiquem restritos à janela.
+    """
+    catch_mask = np.asarray(catch) != catch.nodata
+    rows = np.flatnonzero(catch_mask.any(axis=1))
+    cols = np.flatnonzero(catch_mask.any(axis=0))
+    if rows.size == 0:
+        raise RuntimeError("A bacia delimitada não contém nenhuma célula.")
+    window = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+
+    window_affine = catch.affine * Affine.translation(cols[0], rows[0])
+    window_shape = (rows[-1] - rows[0] + 1, cols[-1] - cols[0] + 1)
+    grid = Grid(viewfinder=ViewFinder(affine=window_affine, shape=window_shape, crs=catch.crs,
+                                      nodata=catch.nodata, mask=catch_mask[window]))
+
+    clipped = []
+    for raster in rasters:
+        viewfinder = ViewFinder(affine=window_affine, shape=window_shape, crs=raster.crs, nodata=raster.nodata)
+        clipped.append(Raster(np.ascontiguousarray(np.asarray(raster)[window]), viewfinder=viewfinder))
+    return grid, clipped
+
+
+def _window_flow_distance(fdir, catch, x, y, dirmap):
+    """
+    Distância de fluxo até o exutório sobre a janela de `_catchment_window`.
 
-    # Cálculo do HAND
-    progress_callback("Calculando HAND dentro da bacia...", 80)
-    streams_mask_global = acc > stream_threshold
-    hand = grid.compute_hand(fdir, inflated_dem, streams_mask_global)
+    O pysheds percorre os vizinhos pelo índice linear, sem checar as bordas:
+    na janela justa, as células da borda leem fora do array ou a coluna oposta
+    da linha vizinha. A direção de fluxo fora da bacia vira nodata e a janela
+    ganha uma moldura de uma célula de nodata antes do cálculo; o resultado
+    volta para a janela original.
+    """
+    catch_mask = np.asarray(catch) != catch.nodata
+    fdir_values = np.where(catch_mask, np.asarray(fdir), fdir.nodata).astype(fdir.dtype)
+    padded = np.pad(fdir_values, 1, constant_values=fdir.nodata)
+    viewfinder = ViewFinder(affine=fdir.affine * Affine.translation(-1, -1), shape=padded.shape,
+                            crs=fdir.crs, nodata=fdir.nodata)
+    dist = Grid(viewfinder=viewfinder).distance_to_outlet(
+        x=x, y=y, fdir=Raster(padded, viewfinder=viewfinder), dirmap=dirmap, xytype='coordinate')
+    window = ViewFinder(affine=fdir.affine, shape=fdir.shape, crs=fdir.crs, nodata=dist.nodata)
+    return Raster(np.ascontiguousarray(np.asarray(dist)[1:-1, 1:-1]), viewfinder=window)
 
-    progress_callback(f"Calculando mancha de inundação para {channel_depth}m...", 90)
-    hand_view = grid.view(hand, nodata=np.nan)
-    inundation_depth = np.where(hand_view < channel_depth, channel_depth - hand_view, np.nan)
 
-    # Salvar Raster de Inundação
-    profile = {
-        'crs': grid.viewfinder.crs, 'transform': grid.viewfinder.affine,
-        'height': grid.viewfinder.shape[0], 'width': grid.viewfinder.shape[1],
-        'driver': 'GTiff', 'count': 1, 'dtype': rasterio.float32, 'nodata': np.nan
-    }
+def _compute_hand_view(grid, preproc_data, stream_threshold):
+    """HAND sobre a extensão dos rasters de `preproc_data`, recortado para a bacia."""
+    streams_mask_global = preproc_data['acc'] > stream_threshold
+    hand = grid.compute_hand(preproc_data['fdir'], preproc_data['inflated_dem'], streams_mask_global)
+    return grid.view(hand, nodata=np.nan)
 
-    if channel_depth == int(channel_depth):
-        suffix_nome_arquivo = f"{int(channel_depth)}m"
-    else:
-        suffix_nome_arquivo = f"{str(channel_depth).replace('.', '_')}m"
 
-    results['suffix'] = suffix_nome_arquivo
+def _window_offset(grid, index):
+    """Linha e coluna, no MDE do índice, do canto superior esquerdo da janela do grid."""
+    affine = grid.viewfinder.affine
+    col_off, row_off = ~Affine(*index['affine']) * (affine.c, affine.f)
+    return int(round(row_off)), int(round(col_off))
 
-    inundacao_raster_path = os.path.join(output_dir, f'inundacao_mapa_{suffix_nome_arquivo}.tif')
-    with rasterio.open(inundacao_raster_path, 'w', **profile) as dst:
-        dst.write(inundation_depth.astype(rasterio.float32), 1)
-    results['inundacao_raster_path'] = inundacao_raster_path
 
-    # Vetorizar Mancha de Inundação
-    progress_callback("Vetorizando mancha de inundação...", 95)
-    inundation_mask = ~np.isnan(inundation_depth)
-    if np.any(inundation_mask):
-        shapes_generator = rasterio.features.shapes(
-            inundation_mask.astype(np.uint8),
-            mask=inundation_mask,
-            transform=profile['transform']
-        )
-        flood_geometries = [shape(geom) for geom, value in shapes_generator if value == 1]
-        if flood_geometries:
-            flood_gdf = gpd.GeoDataFrame(geometry=flood_geometries, crs=profile['crs']).dissolve()
-            inundacao_vetor_path = os.path.join(output_dir, f'inundacao_{suffix_nome_arquivo}.geojson')
-            flood_gdf.to_file(inundacao_vetor_path, driver='GeoJSON')
-            results['inundacao_vetor_path'] = inundacao_vetor_path
+def _compute_hand_reach_view(grid, preproc_data, stream_threshold):
+    """
+    HAND e trecho de cada célula da janela da bacia (`clip_domain=True`), a
+    partir do índice da célula de drenagem mais próxima
+    (`grid.compute_hand(..., return_index=True)`). Os trechos seguem a
+    numeração de `catchment_streams`; fora da bacia, HAND NaN e trecho -1.
+    """
+    index = preproc_data.get('stream_index')
+    if index is None or 'catchment_streams' not in preproc_data:
+        raise ValueError("O HAND por trecho requer o índice da rede do pré-processamento com limiar mínimo "
+                         f"<= {stream_threshold}; refaça o pré-processamento.")
+    height, width = grid.viewfinder.shape
+    if np.shape(preproc_data['acc']) != (height, width):
+        raise ValueError("O HAND por trecho requer os rasters recortados para a bacia (clip_domain=True).")
+    if preproc_data['catchment_streams'] is None:
+        raise RuntimeError(f"Nenhum trecho com acumulação > {stream_threshold} dentro da bacia.")
+
+    row_off, col_off = _window_offset(grid, index)
+    catch_mask = np.asarray(grid.mask, dtype=bool)
+    within = np.zeros(tuple(index['shape']), dtype=bool)
+    within[row_off:row_off + height, col_off:col_off + width] = catch_mask
+    cells, cell_reach = reach_cells(index, stream_threshold, within=within)
+    stream_reach = np.full((height, width), REACH_NODATA, dtype=REACH_DTYPE)
+    rows, cols = np.divmod(cells, int(index['shape'][1]))
+    stream_reach[rows - row_off, cols - col_off] = cell_reach
+
+    streams = preproc_data['acc'] > stream_threshold
+    drainage = np.asarray(grid.compute_hand(preproc_data['fdir'], preproc_data['inflated_dem'], streams,
+                                            dirmap=preproc_data['dirmap'], return_index=True))
+    drains = catch_mask & (drainage >= 0)
+    target = drainage[drains]
+    dem = np.asarray(preproc_data['inflated_dem'], dtype=np.float64)
+    hand = np.full((height, width), np.nan)
+    hand[drains] = dem[drains] - dem.reshape(-1)[target]
+    reach = np.full((height, width), REACH_NODATA, dtype=REACH_DTYPE)
+    reach[drains] = stream_reach.reshape(-1)[target]
+    return hand, reach
+
+
+def resolve_reach_depths(channel_depth, streams_gdf, depth_by='strahler_order'):
+    """
+    Profundidade do canal de cada trecho (linhas de `streams_gdf`) a partir de:
 
-    progress_callback("Delineamento e HAND concluídos.", 100)
-    return results
+    - um número (todos os trechos);
+    - um dicionário {chave: profundidade}, com a chave `depth_by` do trecho
+      ('strahler_order' ou 'trecho_id'); trechos ausentes não inundam;
+    - uma sequência com uma profundidade por trecho;
+    - uma função que recebe `streams_gdf` e retorna uma profundidade por trecho.
+    """
+    n_reaches = len(streams_gdf)
+    if callable(channel_depth):
+        depths = channel_depth(streams_gdf)
+    elif isinstance(channel_depth, dict):
+        if depth_by not in DEPTH_KEYS:
+            raise ValueError(f"Chave de profundidade '{depth_by}' inválida. Opções: {DEPTH_KEYS}.")
+        keys = (pd.Series(np.arange(n_reaches)) if depth_by == 'trecho_id'
+                else streams_gdf[depth_by].reset_index(drop=True))
+        depths = keys.map({int(key): float(value) for key, value in channel_depth.items()})
+    else:
+        depths = channel_depth
+    depths = np.asarray(depths, dtype=np.float64)
+    if depths.ndim == 0:
+        depths = np.full(n_reaches, float(depths))
+    if depths.shape != (n_reaches,):
+        raise ValueError(f"Informe uma profundidade por trecho ({n_reaches} trechos); recebido {depths.shape}.")
+    if np.any(depths <= 0):
+        raise ValueError("As profundidades do canal devem ser positivas.")
+    return depths
+
+
+def flood_depth_by_reach(hand, reach, depth_per_reach):
+    """Lâmina d'água (m) de cada célula para uma profundidade por trecho; NaN fora da mancha."""
+    depth_per_reach = np.asarray(depth_per_reach, dtype=np.float64)
+    if depth_per_reach.size == 0:
+        return np.full(np.shape(hand), np.nan)
+    cell_depth = np.where(reach >= 0, depth_per_reach[np.maximum(reach, 0)], np.nan)
+    return np.where(hand < cell_depth, cell_depth - hand, np.nan)
+
+
+def _flood_raster_profile(grid, count):
+    return {
+        'crs': grid.viewfinder.crs, 'transform': grid.viewfinder.affine,
+        'height': grid.viewfinder.shape[0], 'width': grid.viewfinder.shape[1],
+        'count': count, 'dtype': rasterio.float32, 'nodata': np.nan
+    }
+
+
+def _depth_suffix(channel_depth):
+    """Sufixo de nome de arquivo para uma profundidade (ex.: 10 -> '10m', 2.5 -> '2_5m')."""
+    if channel_depth == int(channel_depth):
+        return f"{int(channel_depth)}m"
+    return f"{str(channel_depth).replace('.', '_')}m"
 
 
 # --- FUNÇÕES DA PÁGINA 3 (OSM) ---
@@ -390,16 +879,26 @@ def _handle_zip(file_path, temp_dir):
     return file_path
 
 
-def run_soil_intersection(raster_path, vector_path, output_dir, progress_callback):
+def run_soil_intersection(raster_path, vector_path, output_dir, progress_callback,
+                          engine=DEFAULT_INTERSECTION_ENGINE, tile_size=DEFAULT_OVERLAY_TILE_SIZE):
+    """
+    Segmenta a mancha de inundação pelas classes do raster de solos (coluna
+    `valor_solo`). `engine` escolhe o motor (`INTERSECTION_ENGINES`): 'overlay'
+    vetoriza o recorte inteiro e cruza com `gpd.overlay`; 'janelas' lê o
+    raster em blocos de `tile_size` células só onde há feições e recorta cada
+    classe diretamente pela feição (`scripts/zonal_overlay.py`).
+    """
+    if engine not in INTERSECTION_ENGINES:
+        raise ValueError(f"Motor de interseção '{engine}' inválido. Use um de: {', '.join(INTERSECTION_ENGINES)}.")
     results = {}
     temp_dir = os.path.join(output_dir, "temp_intersect")
     os.makedirs(temp_dir, exist_ok=True)
 
     progress_callback("Lendo vetor e raster...", 10)
 
-    vector_file_to_read = _handle_zip(vector_path, temp_dir)
-
-    gdf_vector = gpd.read_file(vector_file_to_read)
+    with stage(progress_callback, 'read_inputs'):
+        vector_file_to_read = _handle_zip(vector_path, temp_dir)
+        gdf_vector = gpd.read_file(vector_file_to_read)
 
     with rasterio.open(raster_path) as src_raster:
         raster_crs = src_raster.crs
@@ -409,27 +908,37 @@ def run_soil_intersection(raster_path, vector_path, output_dir, progress_callbac
             progress_callback(f"Reprojetando vetor de {gdf_vector.crs} para {raster_crs}...", 25)
             gdf_vector = gdf_vector.to_crs(raster_crs)
 
+        if engine == 'janelas':
+            progress_callback("Intersectando feições com o raster de solos por janelas...", 30)
+            with stage(progress_callback, 'windowed_overlay'):
+                gdf_intersected = windowed_soil_overlay(src_raster, gdf_vector, tile_size, progress_callback)
+            if gdf_intersected.empty:
+                raise ValueError("Nenhuma feição foi vetorizada. O raster pode estar vazio na área de interseção.")
+            return _write_soil_intersection(gdf_intersected, output_dir, progress_callback, results)
+
         progress_callback("Recortando (mascarando) o raster para a área do vetor...", 30)
         geoms = [feature["geometry"] for feature in gdf_vector.iterfeatures()]
 
         try:
-            out_image, out_transform = mask(
-                src_raster, geoms, crop=True, filled=True, nodata=src_raster.nodata
-            )
+            with stage(progress_callback, 'mask'):
+                out_image, out_transform = mask(
+                    src_raster, geoms, crop=True, filled=True, nodata=src_raster.nodata
+                )
             nodata_value = src_raster.nodata if src_raster.nodata is not None else -9999
 
         except ValueError as e:
             raise ValueError(f"Erro ao mascarar: {e}. Verifique se o vetor sobrepõe o raster.")
 
         progress_callback("Vetorizando o raster recortado...", 50)
-        image = out_image[0].astype('int32')
-        shapes = rasterio.features.shapes(image, transform=out_transform)
+        with stage(progress_callback, 'polygonize'):
+            image = out_image[0].astype('int32')
+            shapes = rasterio.features.shapes(image, transform=out_transform)
 
-        polygons, values = [], []
-        for geom, value in shapes:
-            if value != nodata_value:
-                polygons.append(shape(geom))
-                values.append(value)
+            polygons, values = [], []
+            for geom, value in shapes:
+                if value != nodata_value:
+                    polygons.append(shape(geom))
+                    values.append(value)
 
         if not polygons:
             raise ValueError("Nenhuma feição foi vetorizada. O raster pode estar vazio na área de interseção.")
@@ -442,21 +951,27 @@ def run_soil_intersection(raster_path, vector_path, output_dir, progress_callbac
         progress_callback(f"Foram criados {len(gdf_solos)} polígonos de classes de solo.", 70)
 
         progress_callback("Intersectando feições do vetor com os polígonos de solo...", 85)
-        gdf_intersected = gpd.overlay(
-            gdf_vector,
-            gdf_solos,
-            how='intersection',
-            keep_geom_type=True
-        )
+        with stage(progress_callback, 'overlay'):
+            gdf_intersected = gpd.overlay(
+                gdf_vector,
+                gdf_solos,
+                how='intersection',
+                keep_geom_type=True
+            )
+
+        return _write_soil_intersection(gdf_intersected, output_dir, progress_callback, results)
+
 
-        gdf_intersected['valor_solo'] = pd.to_numeric(gdf_intersected['valor_solo'])
+def _write_soil_intersection(gdf_intersected, output_dir, progress_callback, results):
+    gdf_intersected['valor_solo'] = pd.to_numeric(gdf_intersected['valor_solo']).astype(np.float64)
 
-        output_path = os.path.join(output_dir, "inundacao_segmentada_por_solo.geojson")
+    output_path = os.path.join(output_dir, "inundacao_segmentada_por_solo.geojson")
+    with stage(progress_callback, 'write_vector'):
         gdf_intersected.to_file(output_path, driver="GeoJSON")
-        results['output_path'] = output_path
+    results['output_path'] = output_path
 
-        progress_callback("Interseção concluída!", 100)
-        return results
+    progress_callback("Interseção concluída!", 100)
+    return results
 
 
 METRIC_CRS = 'esri:102033'
@@ -475,51 +990,103 @@ def find_buffer_distance_for_area(geometry, target_area, search_min, search_max)
         raise ValueError(f"Scipy brentq falhou no range [{search_min}, {search_max}m]. {e}")
 
 
-def calculate_area_buffers(gdf, metric_crs, percent_change):
+def calculate_area_buffers(gdf, metric_crs, percent_change, sides=('plus', 'minus')):
+    """
+    Buffers que aumentam ('plus') e reduzem ('minus') a área de cada polígono
+    em `percent_change` %, resolvidos em lote por `solve_buffer_distances`
+    (mesma tolerância e mesmos limites da busca `brentq` por polígono de
+    `find_buffer_distance_for_area`). Geometrias vazias, inválidas ou sem
+    solução ficam inalteradas. Um lado fora de `sides` é retornado como None.
+    """
     if gdf.empty:
         return gdf.copy(), gdf.copy()
 
     gdf_proj = gdf.to_crs(metric_crs)
-    geoms_plus, geoms_minus = [], []
-
-    factor_plus = 1.0 + (percent_change / 100.0)
-    factor_minus = 1.0 - (percent_change / 100.0)
-
-    for index, row in gdf_proj.iterrows():
-        geom = row.geometry
-        if geom.is_empty or not geom.is_valid:
-            geoms_plus.append(geom)
-            geoms_minus.append(geom)
-            continue
-
-        area_original_m2 = geom.area
-        area_target_plus = area_original_m2 * factor_plus
-        area_target_minus = area_original_m2 * factor_minus
-
-        dist_pos, dist_neg = None, None
-
-        try:
-            dist_pos = find_buffer_distance_for_area(geom, area_target_plus, 0.0, BRENTQ_UPPER_LIMIT_M)
-        except ValueError:
-            pass
-
-        try:
-            dist_neg = find_buffer_distance_for_area(geom, area_target_minus, -BRENTQ_UPPER_LIMIT_M, 0.0)
-        except ValueError:
-            pass
-
-        geoms_plus.append(geom.buffer(dist_pos) if dist_pos is not None else geom)
-        geoms_minus.append(geom.buffer(dist_neg) if dist_neg is not None else geom)
-
-    gdf_plus = gdf_proj.copy()
-    gdf_plus['geometry'] = geoms_plus
-    gdf_minus = gdf_proj.copy()
-    gdf_minus['geometry'] = geoms_minus
-
-    return gdf_plus, gdf_minus
-
-
-def run_proportional_buffer(geojson_path, reference_column, percentage_mapping, output_dir, progress_callback):
+    geoms = gdf_proj.geometry.values
+    area_original_m2 = geoms.area
+    factors = {'plus': 1.0 + (percent_change / 100.0), 'minus': 1.0 - (percent_change / 100.0)}
+    search = {'plus': (0.0, BRENTQ_UPPER_LIMIT_M), 'minus': (-BRENTQ_UPPER_LIMIT_M, 0.0)}
+
+    buffered = {}
+    for side in sides:
+        search_min, search_max = search[side]
+        distances, _ = solve_buffer_distances(np.asarray(geoms, dtype=object), area_original_m2 * factors[side],
+                                              search_min, search_max, xtol=BUFFER_XTOL_M)
+        solved = ~np.isnan(distances)
+        gdf_side = gdf_proj.copy()
+        gdf_side.loc[solved, 'geometry'] = shapely.buffer(np.asarray(geoms[solved], dtype=object),
+                                                          distances[solved], quad_segs=BUFFER_QUAD_SEGS)
+        buffered[side] = gdf_side
+
+    return buffered.get('plus'), buffered.get('minus')
+
+
+def _parallel_proportional_buffer(gdf_original, reference_column, mapping_float_keys, values_to_process,
+                                  original_crs, max_workers, progress_callback):
+    """
+    Todas as classes de uma vez, em blocos equilibrados por número de vértices
+    distribuídos entre `max_workers` processos. As feições ficam na mesma
+    ordem do modo sequencial (por classe, na ordem original dentro da classe).
+    """
+    gdf_selected = gdf_original[gdf_original[reference_column].isin(values_to_process)]
+    gdf_proj = gdf_selected.sort_values(reference_column, kind='stable').to_crs(METRIC_CRS)
+    percent = gdf_proj[reference_column].map(mapping_float_keys).to_numpy(dtype=np.float64)
+    geoms = np.asarray(gdf_proj.geometry.values, dtype=object)
+    growing = percent >= 0
+
+    def report(done, total):
+        progress_callback(f"Buffer proporcional: bloco {done}/{total} concluído...", 10 + int(done / total * 80))
+
+    with stage(progress_callback, f'buffer ({max_workers} processos)'):
+        buffered, _ = parallel_buffer_to_areas(
+            geoms, shapely.area(geoms) * (1.0 + percent / 100.0),
+            search_min=np.where(growing, 0.0, -BRENTQ_UPPER_LIMIT_M),
+            search_max=np.where(growing, BRENTQ_UPPER_LIMIT_M, 0.0),
+            xtol=BUFFER_XTOL_M, max_workers=max_workers, progress_callback=report)
+    gdf_proj = gdf_proj.set_geometry(gpd.GeoSeries(buffered, index=gdf_proj.index, crs=gdf_proj.crs))
+    return gdf_proj.to_crs(original_crs).reset_index(drop=True)
+
+
+def _curves_proportional_buffer(gdf_original, reference_column, mapping_float_keys, values_to_process,
+                                original_crs, curves_path, progress_callback):
+    """
+    Todas as classes de uma vez, com a busca da distância partindo das
+    curvas área x distância de `run_area_curves`, na ordem do modo
+    sequencial.
+    """
+    curves = load_area_curves(curves_path)
+    if len(curves['area_original']) != len(gdf_original):
+        raise ValueError(f"As curvas têm {len(curves['area_original'])} polígonos e a camada tem "
+                         f"{len(gdf_original)}; recalcule as curvas para esta camada.")
+    if curves.get('assinatura') != curves_signature(gdf_original.geometry.values, curves):
+        raise ValueError("As curvas não correspondem às geometrias desta camada (ou foram gravadas sem "
+                         "assinatura); recalcule as curvas para esta camada.")
+    selected = gdf_original[reference_column].isin(values_to_process).to_numpy()
+    order = np.flatnonzero(selected)[np.argsort(gdf_original[reference_column].to_numpy()[selected], kind='stable')]
+    gdf_proj = gdf_original.iloc[order].to_crs(METRIC_CRS)
+    percent = gdf_proj[reference_column].map(mapping_float_keys).to_numpy(dtype=np.float64)
+
+    progress_callback("Aplicando buffers pelas curvas área x distância...", 50)
+    subset = {key: curves[key][order] for key in ('areas', 'perimetros', 'area_original')}
+    with stage(progress_callback, 'buffer (curvas)'):
+        buffered, _, _ = buffer_with_curves(np.asarray(gdf_proj.geometry.values, dtype=object),
+                                            {**curves, **subset}, percent)
+    gdf_proj = gdf_proj.set_geometry(gpd.GeoSeries(buffered, index=gdf_proj.index, crs=gdf_proj.crs))
+    return gdf_proj.to_crs(original_crs).reset_index(drop=True)
+
+
+def run_proportional_buffer(geojson_path, reference_column, percentage_mapping, output_dir, progress_callback,
+                            max_workers=1, curves_path=None):
+    """
+    Aplica a cada feição um buffer que altera sua área pela porcentagem da
+    sua classe em `percentage_mapping`. Com `max_workers` > 1 (None: todos os
+    núcleos), as feições de todas as classes são divididas em blocos
+    equilibrados por número de vértices e processadas em paralelo; o
+    resultado é o mesmo do modo sequencial, classe a classe. Com
+    `curves_path` (de `run_area_curves`, para a mesma camada), a busca das
+    distâncias parte das curvas pré-calculadas (mesma precisão, menos
+    avaliações de buffer) e `max_workers` é ignorado.
+    """
     results = {}
     progress_callback("Iniciando buffer proporcional...", 5)
 
@@ -556,28 +1123,41 @@ def run_proportional_buffer(geojson_path, reference_column, percentage_mapping,
 
     total_steps = len(values_to_process)
     current_step = 0
-
-    for col_value in sorted(values_to_process):
-        percent = mapping_float_keys[col_value]
-        current_step += 1
-        progress_percentage = 10 + int((current_step / total_steps) * 80)
-        progress_callback(f"Processando valor '{col_value}' com Buffer de {percent:+}%...", progress_percentage)
-
-        gdf_filtered = gdf_original[gdf_original[reference_column] == col_value].copy()
-        if gdf_filtered.empty:
-            continue
-
-        gdf_plus_proj, gdf_minus_proj = calculate_area_buffers(
-            gdf_filtered,
-            METRIC_CRS,
-            abs(percent)
-        )
-
-        is_positive = percent >= 0
-        gdf_final_proj = gdf_plus_proj if is_positive else gdf_minus_proj
-
-        gdf_final_crs = gdf_final_proj.to_crs(original_crs)
-        buffered_gdfs.append(gdf_final_crs)
+    max_workers = max_workers or os.cpu_count() or 1
+
+    if curves_path:
+        buffered_gdfs.append(_curves_proportional_buffer(gdf_original, reference_column, mapping_float_keys,
+                                                         values_to_process, original_crs, curves_path,
+                                                         progress_callback))
+    elif max_workers > 1:
+        progress_callback(f"Processando {total_steps} classe(s) em {max_workers} processos...", 10)
+        buffered_gdfs.append(_parallel_proportional_buffer(gdf_original, reference_column, mapping_float_keys,
+                                                           values_to_process, original_crs, max_workers,
+                                                           progress_callback))
+    else:
+        for col_value in sorted(values_to_process):
+            percent = mapping_float_keys[col_value]
+            current_step += 1
+            progress_percentage = 10 + int((current_step / total_steps) * 80)
+            progress_callback(f"Processando valor '{col_value}' com Buffer de {percent:+}%...", progress_percentage)
+
+            gdf_filtered = gdf_original[gdf_original[reference_column] == col_value].copy()
+            if gdf_filtered.empty:
+                continue
+
+            with stage(progress_callback, f'buffer (classe {col_value:g})'):
+                is_positive = percent >= 0
+                gdf_plus_proj, gdf_minus_proj = calculate_area_buffers(
+                    gdf_filtered,
+                    METRIC_CRS,
+                    abs(percent),
+                    sides=('plus',) if is_positive else ('minus',)
+                )
+
+            gdf_final_proj = gdf_plus_proj if is_positive else gdf_minus_proj
+
+            gdf_final_crs = gdf_final_proj.to_crs(original_crs)
+            buffered_gdfs.append(gdf_final_crs)
 
     if buffered_gdfs:
         progress_callback("Mesclando resultados...", 95)
@@ -587,10 +1167,55 @@ def run_proportional_buffer(geojson_path, reference_column, percentage_mapping,
         )
 
         final_merge_path = os.path.join(output_dir, "inundacao_adsolo_buffer.geojson")
-        gdf_merged.to_file(final_merge_path, driver='GeoJSON')
+        with stage(progress_callback, 'write_vector'):
+            gdf_merged.to_file(final_merge_path, driver='GeoJSON')
         results['merge_path'] = final_merge_path
         progress_callback("Buffer proporcional concluído!", 100)
     else:
         raise ValueError("Nenhuma geometria foi processada para o merge final.")
 
+    return results
+
+
+def run_area_curves(geojson_path, reference_column, output_dir, progress_callback, max_percent=DEFAULT_MAX_PERCENT):
+    """
+    Pré-calcula as curvas área x distância de buffer de cada feição (ver
+    `scripts/area_curves.py`) para variações de até ±`max_percent` %, com a
+    classe de cada feição. As curvas respondem a qualquer mapeamento de pesos
+    (`run_proportional_buffer(..., curves_path=...)`) e a conjuntos de Monte
+    Carlo (`area_curves.weight_ensemble`), que dispensa a busca da distância.
+    """
+    results = {}
+    progress_callback("Carregando camada para as curvas área x distância...", 5)
+
+    temp_dir = os.path.join(output_dir, "temp_buffer")
+    os.makedirs(temp_dir, exist_ok=True)
+    try:
+        gdf = gpd.read_file(_handle_zip(geojson_path, temp_dir))
+    except Exception as e:
+        raise FileNotFoundError(f"ERRO: Falha ao carregar GeoDataFrame: {e}")
+    if reference_column not in gdf.columns:
+        raise ValueError(
+            f"ERRO: A coluna de referência '{reference_column}' não foi encontrada. Colunas disponíveis: {list(gdf.columns)}")
+    try:
+        classes = pd.to_numeric(gdf[reference_column]).to_numpy(dtype=np.float64)
+    except ValueError:
+        raise ValueError(f"ERRO: Não foi possível converter a coluna '{reference_column}' para numérico.")
+    if gdf.crs is None:
+        gdf = gdf.set_crs('EPSG:4326')
+
+    def report(done, total):
+        progress_callback(f"Curvas área x distância: distância {done}/{total}...", 10 + int(done / total * 80))
+
+    with stage(progress_callback, 'curvas área x distância'):
+        curves = build_area_curves(np.asarray(gdf.to_crs(METRIC_CRS).geometry.values, dtype=object),
+                                   max_percent=max_percent, progress_callback=report)
+
+    curves_path = os.path.join(output_dir, "curvas_area_distancia.npz")
+    with stage(progress_callback, 'write_curves'):
+        save_area_curves(curves_path, curves, classes=classes,
+                         assinatura=curves_signature(gdf.geometry.values, curves))
+    results['curves_path'] = curves_path
+    results['n_poligonos'] = len(gdf)
+    progress_callback("Curvas área x distância concluídas!", 100)
     return results
\ No newline at end of file
@@ -0,0 +1,185 @@
+"""
+Vetorização em blocos (paralela) de máscaras raster.
+
+`rasterio.features.shapes` sobre o array inteiro seguido de `dissolve()` roda
+em uma única thread e fica lento em planícies de inundação com milhões de
+vértices. Aqui a máscara é dividida em blocos, cada bloco é vetorizado em um
+processo do pool e os polígonos são reunidos com `shapely.coverage_union_all`.
+
+Os blocos são vetorizados em coordenadas de pixel (inteiras) e os polígonos
+que tocam uma costura têm as arestas subdivididas a cada pixel, de modo que os
+vértices de blocos vizinhos coincidem exatamente e a união da cobertura
+elimina as costuras sem tolerâncias. A transformação para coordenadas do mapa
+é aplicada uma única vez, no polígono final.
+
+Opcionalmente, os degraus de pixel são suavizados por cortes de canto de
+Chaikin (`smooth_iterations`).
+"""
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import geopandas as gpd
+import shapely
+from shapely import affinity
+from affine import Affine
+from rasterio import features
+
+
+DEFAULT_TILE_SIZE = 1024
+# Abaixo deste número de células o custo de iniciar o pool supera o ganho
+MIN_PARALLEL_CELLS = 4_000_000
+
+
+def _shapes_to_polygons(shapes_generator):
+    """Converte a saída de `features.shapes` em (polígonos, valores), criando as geometrias de uma vez."""
+    rings, ring_owner, values = [], [], []
+    for geom, value in shapes_generator:
+        for ring in geom['coordinates']:
+            rings.append(np.asarray(ring, dtype=np.float64))
+            ring_owner.append(len(values))
+        values.append(value)
+    if not rings:
+        return np.empty(0, dtype=object), np.empty(0)
+
+    # Anéis -> polígonos (o primeiro anel de cada polígono é o externo)
+    counts = np.fromiter((len(r) for r in rings), dtype=np.int64, count=len(rings))
+    linear_rings = shapely.linearrings(np.concatenate(rings), indices=np.repeat(np.arange(len(rings)), counts))
+    return shapely.polygons(linear_rings, indices=np.asarray(ring_owner)), np.asarray(values)
+
+
+def _tile_polygons(tile, row_off, col_off, shape):
+    """Polígonos (coordenadas de pixel da máscara inteira) das células True de um bloco."""
+    pixel_transform = Affine.translation(col_off, row_off)
+    polygons, _ = _shapes_to_polygons(features.shapes(tile, mask=tile.astype(bool), transform=pixel_transform))
+    if polygons.size == 0:
+        return polygons, np.empty(0, dtype=bool)
+
+    # Polígonos que tocam uma borda interna do bloco: vértices em todos os cantos de pixel
+    h, w = tile.shape
+    xmin, ymin, xmax, ymax = shapely.bounds(polygons).T
+    seam = (((xmin == col_off) & (col_off > 0)) | ((xmax == col_off + w) & (col_off + w < shape[1]))
+            | ((ymin == row_off) & (row_off > 0)) | ((ymax == row_off + h) & (row_off + h < shape[0])))
+    polygons[seam] = shapely.segmentize(polygons[seam], 1.0)
+    return polygons, seam
+
+
+def polygonize_tile(tile, row_off, col_off, shape):
+    """Executado no worker: vetoriza um bloco e devolve WKB (mais leve para serializar)."""
+    polygons, seam = _tile_polygons(tile, row_off, col_off, shape)
+    return shapely.to_wkb(polygons), seam
+
+
+def _chaikin(geometry, iterations):
+    """Suaviza os anéis de um (Multi)Polígono por cortes de canto de Chaikin."""
+    polygons = shapely.get_parts(geometry)
+    rings, owner = shapely.get_rings(polygons, return_index=True)
+    for _ in range(iterations):
+        coords, ring_index = shapely.get_coordinates(rings, return_index=True)
+        # Remove o vértice de fechamento de cada anel
+        last = np.r_[ring_index[1:] != ring_index[:-1], True]
+        coords, ring_index = coords[~last], ring_index[~last]
+        starts = np.r_[0, np.flatnonzero(ring_index[1:] != ring_index[:-1]) + 1]
+        following = np.arange(1, len(coords) + 1)
+        following[np.r_[starts[1:] - 1, len(coords) - 1]] = starts
+        nxt = coords[following]
+        cut = np.empty((2 * len(coords), 2))
+        cut[0::2] = 0.75 * coords + 0.25 * nxt
+        cut[1::2] = 0.25 * coords + 0.75 * nxt
+        rings = shapely.linearrings(cut, indices=np.repeat(ring_index, 2))
+    smoothed = shapely.multipolygons(shapely.polygons(rings, indices=owner))
+    return smoothed if shapely.is_valid(smoothed) else shapely.make_valid(smoothed)
+
+
+def polygonize_mask(mask_array, transform, crs, tile_size=DEFAULT_TILE_SIZE, max_workers=None,
+                    smooth_iterations=0):
+    """
+    Vetoriza as células True de uma máscara em um único polígono dissolvido.
+
+    A máscara é dividida em blocos de `tile_size` células, vetorizados em
+    paralelo por `max_workers` processos (padrão: número de CPUs; 1 = sem
+    pool) e costurados por união de cobertura. Com `smooth_iterations > 0`,
+    os degraus de pixel são suavizados (cada iteração dobra os vértices).
+
+    Retorna um GeoDataFrame de uma linha (como `dissolve()`) ou None se a
+    máscara estiver vazia.
+    """
+    mask_array = np.asarray(mask_array, dtype=bool)
+    if not mask_array.any():
+        return None
+
+    height, width = mask_array.shape
+    tiles = [(r, c) for r in range(0, height, tile_size) for c in range(0, width, tile_size)]
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = max(1, min(int(max_workers), len(tiles)))
+
+    def tile_array(r, c):
+        return np.ascontiguousarray(mask_array[r:r + tile_size, c:c + tile_size], dtype=np.uint8)
+
+    occupied = [(r, c) for r, c in tiles if mask_array[r:r + tile_size, c:c + tile_size].any()]
+    if max_workers == 1 or len(occupied) < 2 or mask_array.size < MIN_PARALLEL_CELLS:
+        parts = [_tile_polygons(tile_array(r, c), r, c, mask_array.shape) for r, c in occupied]
+    else:
+        # 'spawn' pelo mesmo motivo de scripts/batch_delineation.py (numba do PySheds)
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as pool:
+            futures = [pool.submit(polygonize_tile, tile_array(r, c), r, c, mask_array.shape) for r, c in occupied]
+            parts = [(shapely.from_wkb(wkb), seam) for wkb, seam in (future.result() for future in futures)]
+    return merge_tile_polygons(parts, transform, crs, smooth_iterations)
+
+
+def merge_tile_polygons(parts, transform, crs, smooth_iterations=0):
+    """
+    Costura os polígonos (coordenadas de pixel) de `_tile_polygons` de vários
+    blocos em um único polígono dissolvido, em coordenadas do mapa.
+    Retorna None se não houver polígonos.
+    """
+    if not parts:
+        return None
+    polygons = np.concatenate([p for p, _ in parts])
+    seam = np.concatenate([s for _, s in parts])
+    if polygons.size == 0:
+        return None
+
+    # Só os polígonos que tocam costuras precisam ser unidos; simplify(0) remove
+    # os vértices colineares criados pela subdivisão
+    stitched = np.empty(0, dtype=object)
+    if seam.any():
+        union = shapely.simplify(shapely.coverage_union_all(polygons[seam]), 0, preserve_topology=False)
+        if not shapely.is_valid(union):
+            # Células vizinhas só pela diagonal, em blocos diferentes, tocam-se em um ponto da costura
+            union = shapely.make_valid(union)
+        stitched = shapely.get_parts(union)
+        stitched = stitched[shapely.get_type_id(stitched) == 3]
+    merged = shapely.multipolygons(np.concatenate([stitched, polygons[~seam]]))
+    if smooth_iterations:
+        merged = _chaikin(merged, int(smooth_iterations))
+
+    a, b, c, d, e, f = tuple(transform)[:6]
+    geometry = affinity.affine_transform(merged, (a, b, d, e, c, f))
+    return gpd.GeoDataFrame(geometry=[geometry], crs=crs)
+
+
+def polygonize_labels(labels, transform, crs, column='rotulo'):
+    """
+    Vetoriza um raster de rótulos inteiros (> 0) em um GeoDataFrame com uma
+    linha por rótulo (coluna `column`), ordenado pelo rótulo.
+
+    Regiões do mesmo rótulo ligadas só pela diagonal viram partes de um
+    MultiPolygon, sem operação de união.
+    """
+    labels = np.asarray(labels)
+    if labels.max(initial=0) > np.iinfo(np.int32).max:
+        raise ValueError("Rótulos excedem o limite de int32 suportado pela vetorização.")
+    labels = labels.astype(np.int32)
+    polygons, values = _shapes_to_polygons(features.shapes(labels, mask=labels > 0, transform=transform))
+    if polygons.size == 0:
+        return None
+
+    order = np.argsort(values, kind='stable')
+    polygons, values = polygons[order], values[order].astype(np.int64)
+    unique, group = np.unique(values, return_inverse=True)
+    geometries = shapely.multipolygons(polygons, indices=group)
+    return gpd.GeoDataFrame({column: unique}, geometry=geometries, crs=crs)
@@ -0,0 +1,187 @@
+"""
+Pré-visualização em baixa resolução das Etapas 1 e 2.
+
+Para escolher exutório e limiar de drenagem sem repetir o pré-processamento
+em resolução total, o MDE é reduzido em uma pirâmide (fatores 2, 4, 8, ...,
+média das células válidas) e toda a cadeia (condicionamento, direção,
+acumulação, índice da rede e delineamento) roda no nível mais fino com até
+`max_cells` células, em segundos.
+
+Os parâmetros escolhidos são levados de volta à grade original:
+
+- o limiar é sempre expresso em células do MDE original; no nível reduzido
+  ele vale `limiar / fator²` (mesma área de contribuição);
+- o exutório escolhido no nível reduzido cobre `fator x fator` células
+  originais, e a média da pirâmide pode deslocar canais em vales largos por
+  várias células reduzidas. Após o pré-processamento em resolução total,
+  `map_outlet_to_native` procura, em um raio de `OUTLET_SEARCH_CELLS` células
+  reduzidas, a célula mais próxima cuja acumulação corresponde à área de
+  contribuição da pré-visualização, antes do snap habitual da Etapa 2.
+"""
+import os
+import numpy as np
+import rasterio
+import geopandas as gpd
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+from scripts.local_analysis_helpers import run_preprocessing, run_delineation
+from scripts.profiling import stage
+
+
+PREVIEW_MAX_CELLS = 1_000_000
+PYRAMID_FACTORS = (2, 4, 8, 16, 32, 64)
+PREVIEW_CONDITIONING = 'priority_flood_epsilon'
+# Raio de busca do exutório na resolução total (em células do nível reduzido)
+# e razão máxima entre a acumulação encontrada e a esperada
+OUTLET_SEARCH_CELLS = 16
+OUTLET_ACC_RATIO = 1.5
+
+
+# --- PIRÂMIDE DO MDE ---
+
+def preview_factor(mde_path, max_cells=PREVIEW_MAX_CELLS):
+    """Menor fator da pirâmide com até `max_cells` células (1 se o MDE já for pequeno)."""
+    if not os.path.exists(mde_path):
+        raise FileNotFoundError(f"Arquivo MDE '{mde_path}' não encontrado.")
+    with rasterio.open(mde_path) as src:
+        height, width = src.height, src.width
+    if height * width <= max_cells:
+        return 1
+    for factor in PYRAMID_FACTORS:
+        if (height // factor) * (width // factor) <= max_cells:
+            return factor
+    raise ValueError(f"MDE de {height} x {width} células grande demais para a pré-visualização "
+                     f"(fator máximo {PYRAMID_FACTORS[-1]}).")
+
+
+def build_dem_pyramid(mde_path, output_dir, max_factor):
+    """
+    Grava os níveis da pirâmide (fatores 2, 4, ... até `max_factor`) em
+    `output_dir`, cada um reduzido à metade do anterior pela média das células
+    válidas.
+    Retorna {fator: caminho}, com o fator 1 apontando para o MDE original.
+    """
+    pyramid = {1: mde_path}
+    source = mde_path
+    for factor in PYRAMID_FACTORS:
+        if factor > max_factor:
+            break
+        path = os.path.join(output_dir, f"mde_previa_f{factor}.tif")
+        with rasterio.open(source) as src:
+            height, width = src.height // 2, src.width // 2
+            nodata = src.nodata if src.nodata is not None else -9999.0
+            values = src.read(1, out_shape=(height, width), resampling=Resampling.average,
+                              masked=True).astype(np.float32)
+            profile = {'driver': 'GTiff', 'height': height, 'width': width, 'count': 1, 'dtype': 'float32',
+                       'crs': src.crs, 'nodata': nodata,
+                       'transform': src.transform * src.transform.scale(src.width / width, src.height / height)}
+        with rasterio.open(path, 'w', **profile) as dst:
+            dst.write(values.filled(nodata), 1)
+        pyramid[factor] = path
+        source = path
+    return pyramid
+
+
+# --- LIMIAR E EXUTÓRIO ---
+
+def to_preview_threshold(stream_threshold, factor):
+    """Limiar (células do MDE original) no nível reduzido: mesma área de contribuição."""
+    return max(1, int(round(stream_threshold / factor ** 2)))
+
+
+def to_native_threshold(preview_threshold, factor):
+    return int(preview_threshold) * factor ** 2
+
+
+def map_outlet_to_native(preproc_data, outlet_coords, factor, expected_acc=None):
+    """
+    Leva à resolução total o exutório escolhido na pré-visualização.
+
+    Com `expected_acc` (acumulação da pré-visualização no exutório, já em
+    células do MDE original), retorna a célula mais próxima, em um raio de
+    `OUTLET_SEARCH_CELLS` células reduzidas, com acumulação até
+    `OUTLET_ACC_RATIO` vezes diferente da esperada. Sem ela (ou sem
+    candidatas), retorna a célula de maior acumulação na janela de
+    `fator x fator` células do exutório.
+    """
+    if factor <= 1:
+        return tuple(outlet_coords)
+    radius = OUTLET_SEARCH_CELLS * factor if expected_acc else factor // 2 + 1
+    if 'acc' in preproc_data:
+        acc = preproc_data['acc']
+        affine = acc.viewfinder.affine
+        window = _outlet_window(affine, acc.shape, outlet_coords, radius)
+        values = np.asarray(acc)[window.toslices()]
+    else:
+        with rasterio.open(preproc_data['acc_path']) as src:
+            affine = src.transform
+            window = _outlet_window(affine, src.shape, outlet_coords, radius)
+            values = src.read(1, window=window)
+    values = np.asarray(values, dtype=np.float64)
+
+    col, row = ~affine * tuple(outlet_coords)
+    rows, cols = np.indices(values.shape)
+    distance = np.hypot(rows + window.row_off + 0.5 - row, cols + window.col_off + 0.5 - col)
+    if expected_acc:
+        matches = (values >= expected_acc / OUTLET_ACC_RATIO) & (values <= expected_acc * OUTLET_ACC_RATIO)
+    else:
+        matches = np.zeros(values.shape, dtype=bool)
+    if matches.any():
+        r, c = np.unravel_index(int(np.argmin(np.where(matches, distance, np.inf))), values.shape)
+    else:
+        near = distance <= factor // 2 + 1
+        r, c = np.unravel_index(int(np.argmax(np.where(near, values, -np.inf))), values.shape)
+    return tuple(affine * (window.col_off + c + 0.5, window.row_off + r + 0.5))
+
+
+def _outlet_window(affine, shape, outlet_coords, radius):
+    col, row = ~affine * tuple(outlet_coords)
+    row0, col0 = max(int(row) - radius, 0), max(int(col) - radius, 0)
+    row1, col1 = min(int(row) + radius + 1, shape[0]), min(int(col) + radius + 1, shape[1])
+    if row0 >= row1 or col0 >= col1:
+        raise ValueError("O exutório da pré-visualização está fora da área do MDE.")
+    return Window(col0, row0, col1 - col0, row1 - row0)
+
+
+# --- EXECUÇÃO ---
+
+def run_preview(mde_path, output_dir, stream_threshold, progress_callback, max_cells=PREVIEW_MAX_CELLS,
+                conditioning=PREVIEW_CONDITIONING):
+    """
+    Executa a Etapa 1 em baixa resolução. `stream_threshold` é dado em
+    células do MDE original. Retorna o fator, o caminho do MDE reduzido, a
+    pirâmide e os resultados do pré-processamento do nível reduzido
+    (`preprocessamento`, com os objetos em memória para a Etapa 2).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    factor = preview_factor(mde_path, max_cells)
+    progress_callback(f"Construindo pirâmide do MDE (fator {factor})...", 3)
+    with stage(progress_callback, 'pyramid'):
+        pyramid = build_dem_pyramid(mde_path, output_dir, factor)
+
+    preproc = run_preprocessing(pyramid[factor], output_dir, to_preview_threshold(stream_threshold, factor),
+                                progress_callback, terrain_outputs=(), overviews=False, conditioning=conditioning)
+    return {'fator': factor, 'mde_previa_path': pyramid[factor], 'piramide': pyramid, 'mde_path': mde_path,
+            'preprocessamento': preproc}
+
+
+def run_preview_delineation(preview, outlet_coords, stream_threshold, channel_depth, output_dir,
+                            progress_callback):
+    """
+    Delineamento e HAND no nível reduzido. `stream_threshold` é dado em
+    células do MDE original. Acrescenta aos resultados de `run_delineation` o
+    exutório após o snap (`exutorio_coords`, nas coordenadas do MDE) e a sua
+    acumulação em células do MDE original (`acumulacao_nativa`), usados por
+    `map_outlet_to_native`.
+    """
+    preproc = preview['preprocessamento']
+    results = run_delineation(preproc, outlet_coords, channel_depth,
+                              to_preview_threshold(stream_threshold, preview['fator']), output_dir,
+                              progress_callback, overviews=False)
+    outlet = gpd.read_file(results['exutorio_path']).geometry.iloc[0]
+    results['exutorio_coords'] = (outlet.x, outlet.y)
+    acc = preproc['acc']
+    col, row = ~acc.viewfinder.affine * results['exutorio_coords']
+    results['acumulacao_nativa'] = float(np.asarray(acc)[int(row), int(col)]) * preview['fator'] ** 2
+    return results
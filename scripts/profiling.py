@@ -0,0 +1,241 @@
+"""
+Perfil de execução por etapa para a cadeia de `progress_callback`.
+
+As funções `run_*` continuam chamando `progress_callback(mensagem, pct)`; o
+`RunProfiler` é um callback com a mesma assinatura que, além disso:
+
+- registra cada chamada como evento estruturado (tempo, mensagem, %, etapa);
+- mede tempo de parede, tempo de CPU e pico de memória (RSS) de cada etapa
+  nomeada, marcada nas funções com `with stage(progress_callback, 'nome'):`;
+- repassa as atualizações à interface (`on_update`) no máximo a cada
+  `min_interval` segundos, sem pausas (`time.sleep`) na thread do cálculo;
+- gera um relatório por execução (tabela, JSON ou CSV).
+
+Callbacks simples (funções) continuam aceitos: para eles `stage()` não faz
+nada. O pico de RSS é amostrado em uma thread auxiliar (psutil, se
+instalado, ou /proc no Linux); o tempo de CPU é o do processo atual e não
+inclui processos filhos (pools).
+"""
+import os
+import json
+import time
+import platform
+import threading
+from contextlib import contextmanager, nullcontext
+
+import pandas as pd
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+DEFAULT_UPDATE_INTERVAL = 0.25  # s entre atualizações da interface
+RSS_SAMPLE_INTERVAL = 0.05  # s entre amostras de memória
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def current_rss():
+    """Memória residente do processo atual em bytes (None se não houver como medir)."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def stage(progress_callback, name):
+    """
+    Contexto que marca uma etapa nomeada no `progress_callback`, se ele for um
+    `RunProfiler` (ou tiver um método `stage`); caso contrário, não faz nada.
+    """
+    stage_method = getattr(progress_callback, 'stage', None)
+    return stage_method(name) if stage_method is not None else nullcontext()
+
+
+class PeakRSSMonitor:
+    """
+    Contexto que amostra a memória residente do processo em uma thread
+    auxiliar e guarda o pico observado (`peak_mb`, None se não houver como
+    medir).
+    """
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        rss = current_rss()
+        if rss is not None:
+            self.peak = max(self.peak or 0, rss)
+
+    def __enter__(self):
+        self._sample()
+        if self.peak is not None:
+            def sample():
+                while not self._stop.wait(self.interval):
+                    self._sample()
+
+            self._thread = threading.Thread(target=sample, name="rss-peak", daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self._sample()
+        return False
+
+    @property
+    def peak_mb(self):
+        return self.peak / 1024 ** 2 if self.peak is not None else None
+
+
+class RunProfiler:
+    """
+    Callback de progresso com perfil por etapa. `on_update(mensagem, pct)`
+    atualiza a interface (limitada por `min_interval`); `on_event(evento)`,
+    se informado, recebe todos os eventos (ex.: verificação de cancelamento).
+    """
+
+    def __init__(self, on_update=None, min_interval=DEFAULT_UPDATE_INTERVAL, on_event=None, name=None):
+        self.on_update = on_update
+        self.on_event = on_event
+        self.min_interval = min_interval
+        self.name = name
+        self.events = []
+        self.stages = []
+        self._open = []
+        self._start = time.perf_counter()
+        self._start_cpu = time.process_time()
+        self._started_at = time.time()
+        self._last_update = None
+        self._pending = None
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._sampler_stop = threading.Event()
+        self._peak_rss = current_rss()
+
+    # --- Protocolo de progress_callback ---
+
+    def __call__(self, message, percentage):
+        now = time.perf_counter()
+        event = {'tempo_s': now - self._start, 'mensagem': message, 'progresso': percentage,
+                 'etapa': self._open[-1]['etapa'] if self._open else None}
+        self.events.append(event)
+        if self.on_event is not None:
+            self.on_event(event)
+        self._pending = (message, percentage)
+        if (self._last_update is None or now - self._last_update >= self.min_interval
+                or percentage >= 100):
+            self.flush()
+
+    def flush(self):
+        """Envia à interface a última atualização pendente."""
+        if self._pending is None or self.on_update is None:
+            return
+        message, percentage = self._pending
+        self._pending = None
+        self._last_update = time.perf_counter()
+        self.on_update(message, percentage)
+
+    # --- Etapas ---
+
+    @contextmanager
+    def stage(self, name):
+        record = {'etapa': name, 'nivel': len(self._open), 'inicio_s': time.perf_counter() - self._start,
+                  'cpu_inicio': time.process_time(), 'pico_rss': current_rss(), 'status': 'ok'}
+        with self._lock:
+            self._open.append(record)
+        self._ensure_sampler()
+        try:
+            yield record
+        except BaseException:
+            record['status'] = 'erro'
+            raise
+        finally:
+            self._close(record)
+
+    def _close(self, record):
+        self._sample_rss()
+        record['tempo_parede_s'] = time.perf_counter() - self._start - record['inicio_s']
+        record['tempo_cpu_s'] = time.process_time() - record.pop('cpu_inicio')
+        with self._lock:
+            self._open.remove(record)
+        self.stages.append(record)
+        if not self._open:
+            self._stop_sampler()
+
+    def _sample_rss(self):
+        rss = current_rss()
+        if rss is None:
+            return
+        with self._lock:
+            self._peak_rss = max(self._peak_rss or 0, rss)
+            for record in self._open:
+                record['pico_rss'] = max(record['pico_rss'] or 0, rss)
+
+    def _ensure_sampler(self):
+        if self._sampler is not None or current_rss() is None:
+            return
+        self._sampler_stop.clear()
+
+        def sample():
+            while not self._sampler_stop.wait(RSS_SAMPLE_INTERVAL):
+                self._sample_rss()
+
+        self._sampler = threading.Thread(target=sample, name="rss-sampler", daemon=True)
+        self._sampler.start()
+
+    def _stop_sampler(self):
+        if self._sampler is None:
+            return
+        self._sampler_stop.set()
+        self._sampler.join()
+        self._sampler = None
+
+    # --- Relatório ---
+
+    def report(self):
+        """Tabela (DataFrame) com uma linha por etapa, na ordem de início, e o total da execução."""
+        rows = [{'etapa': ('  ' * r['nivel']) + r['etapa'], 'inicio_s': r['inicio_s'],
+                 'tempo_parede_s': r['tempo_parede_s'], 'tempo_cpu_s': r['tempo_cpu_s'],
+                 'pico_rss_mb': r['pico_rss'] / 1024 ** 2 if r['pico_rss'] else None, 'status': r['status']}
+                for r in sorted(self.stages, key=lambda r: r['inicio_s'])]
+        self._sample_rss()
+        rows.append({'etapa': 'total', 'inicio_s': 0.0, 'tempo_parede_s': time.perf_counter() - self._start,
+                     'tempo_cpu_s': time.process_time() - self._start_cpu,
+                     'pico_rss_mb': self._peak_rss / 1024 ** 2 if self._peak_rss else None, 'status': ''})
+        columns = ['etapa', 'inicio_s', 'tempo_parede_s', 'tempo_cpu_s', 'pico_rss_mb', 'status']
+        return pd.DataFrame(rows, columns=columns).round(3)
+
+    def report_dict(self):
+        """Relatório completo (etapas, eventos e ambiente) serializável em JSON."""
+        return {
+            'execucao': self.name,
+            'iniciada': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self._started_at)),
+            'ambiente': {'python': platform.python_version(), 'plataforma': platform.platform(),
+                         'cpus': os.cpu_count()},
+            'etapas': self.report().to_dict(orient='records'),
+            'eventos': [dict(e, tempo_s=round(e['tempo_s'], 3)) for e in self.events],
+        }
+
+    def report_json(self):
+        return json.dumps(self.report_dict(), ensure_ascii=False, indent=2)
+
+    def report_csv(self):
+        return self.report().to_csv(index=False)
+
+    def save_report(self, path):
+        """Grava o relatório em JSON (ou CSV, pela extensão) e retorna o caminho."""
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.report_csv() if path.lower().endswith('.csv') else self.report_json())
+        return path
@@ -0,0 +1,37 @@
+"""
+Convenções da grade raster compartilhadas pelos módulos de hidrologia.
+
+`DIRMAP` é a codificação D8 do PySheds (N, NE, E, SE, S, SW, W, NW) usada em
+todo o pré-processamento; a chave do cache de artefatos depende dela.
+`D8_ROW_OFFSETS`/`D8_COL_OFFSETS` são os deslocamentos dos vizinhos na mesma
+ordem, passados aos kernels numba. `cell_sizes_m` dá o tamanho das células
+em metros, também em CRS geográfico ou projetado em outra unidade.
+"""
+import numpy as np
+from pyproj import CRS
+
+from scripts.river_network import EARTH_RADIUS_M
+
+
+DIRMAP = (64, 128, 1, 2, 4, 8, 16, 32)
+# Vizinhança D8 na ordem do dirmap: N, NE, E, SE, S, SW, W, NW
+D8_ROW_OFFSETS = np.array([-1, -1, 0, 1, 1, 1, 0, -1], dtype=np.int64)
+D8_COL_OFFSETS = np.array([0, 1, 1, 1, 0, -1, -1, -1], dtype=np.int64)
+
+
+def cell_sizes_m(affine, crs, height=None, y=None):
+    """
+    Largura das células em cada uma das `height` linhas (ou em cada ordenada
+    `y`) e altura das células (m). Em CRS geográfico a largura varia com a
+    latitude.
+    """
+    x_res, y_res = abs(affine.a), abs(affine.e)
+    if y is None:
+        y = affine.f + affine.e * (np.arange(height) + 0.5)
+    y = np.asarray(y, dtype=np.float64)
+    crs = CRS.from_user_input(crs) if crs is not None else None
+    if crs is not None and crs.is_geographic:
+        meters = np.radians(1.0) * EARTH_RADIUS_M
+        return x_res * meters * np.cos(np.radians(y)), y_res * meters
+    factor = crs.axis_info[0].unit_conversion_factor if crs is not None and crs.is_projected else 1.0
+    return np.full(y.shape, x_res * factor), y_res * factor
@@ -0,0 +1,96 @@
+"""
+Gravação dos rasters de saída em Cloud-Optimized GeoTIFF (COG) compacto.
+
+Cada produto é gravado com o menor tipo de dado que o representa sem perda:
+
+- direção de fluxo: uint8 (códigos D8 do dirmap; 0 = sem direção/sem dado);
+- acumulação de fluxo: uint32 (número de células; 0 = sem dado);
+- derivadas do terreno, distância de fluxo e mancha de inundação: float32.
+
+Os blocos são escritos em um GeoTIFF temporário (tiled, sem compressão) e, ao
+final, convertidos pelo driver COG do GDAL com compressão configurável,
+preditor adequado ao tipo de dado e, opcionalmente, overviews internas.
+"""
+import os
+from contextlib import contextmanager
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+
+
+COMPRESSIONS = ('deflate', 'lzw', 'zstd', 'none')
+DEFAULT_COMPRESSION = 'deflate'
+COG_BLOCK_SIZE = 512
+
+FDIR_DTYPE, FDIR_NODATA = np.uint8, 0
+ACC_DTYPE, ACC_NODATA = np.uint32, 0
+
+
+def encode_fdir(fdir, dirmap, nodata_mask=None):
+    """Direção de fluxo em uint8: códigos fora do dirmap (planos -1, fossos -2, sem dado) viram 0."""
+    fdir = np.asarray(fdir)
+    encoded = np.where(np.isin(fdir, dirmap), fdir, FDIR_NODATA).astype(FDIR_DTYPE)
+    if nodata_mask is not None:
+        encoded[np.asarray(nodata_mask)] = FDIR_NODATA
+    return encoded
+
+
+def encode_acc(acc, nodata_mask=None):
+    """Acumulação (contagem de células) em uint32; células sem dado viram 0."""
+    acc = np.asarray(acc, dtype=np.float64)
+    invalid = ~np.isfinite(acc) | (acc < 0)
+    if nodata_mask is not None:
+        invalid |= np.asarray(nodata_mask)
+    if np.nanmax(np.where(invalid, 0, acc), initial=0) > np.iinfo(ACC_DTYPE).max:
+        raise ValueError("Acumulação de fluxo excede o limite de uint32.")
+    encoded = np.rint(np.where(invalid, ACC_NODATA, acc)).astype(ACC_DTYPE)
+    return encoded
+
+
+def _cog_options(dtype, compression, overviews, resampling):
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Compressão '{compression}' inválida. Opções: {COMPRESSIONS}.")
+    options = {'BLOCKSIZE': COG_BLOCK_SIZE, 'BIGTIFF': 'IF_SAFER',
+               'OVERVIEWS': 'AUTO' if overviews else 'NONE', 'OVERVIEW_RESAMPLING': resampling.upper()}
+    options['COMPRESS'] = compression.upper()
+    if compression != 'none':
+        options['PREDICTOR'] = 'FLOATING_POINT' if np.dtype(dtype).kind == 'f' else 'STANDARD'
+        if compression == 'deflate':
+            options['LEVEL'] = 6
+    return options
+
+
+@contextmanager
+def open_cog(path, profile, compression=DEFAULT_COMPRESSION, overviews=True, resampling='average'):
+    """
+    Abre um raster para escrita (em blocos, com `dst.write(..., window=...)`) e,
+    ao sair do bloco `with`, converte-o em COG no caminho final.
+
+    `profile` precisa de crs, transform, height, width, count, dtype e nodata.
+    """
+    tmp_path = f"{path}.tmp.tif"
+    tmp_profile = {key: value for key, value in profile.items()
+                   if key not in ('driver', 'tiled', 'blockxsize', 'blockysize', 'compress', 'BIGTIFF')}
+    tmp_profile.update(driver='GTiff', tiled=True, blockxsize=COG_BLOCK_SIZE, blockysize=COG_BLOCK_SIZE,
+                       BIGTIFF='IF_SAFER')
+    try:
+        with rasterio.open(tmp_path, 'w', **tmp_profile) as dst:
+            yield dst
+        rasterio.shutil.copy(tmp_path, path, driver='COG',
+                             **_cog_options(profile['dtype'], compression, overviews, resampling))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_cog(path, array, profile, compression=DEFAULT_COMPRESSION, overviews=True, resampling='average'):
+    """Grava um array 2D (uma banda) ou 3D (bandas, linhas, colunas) como COG."""
+    array = np.asarray(array)
+    if array.ndim == 2:
+        array = array[np.newaxis]
+    out_profile = {**profile, 'count': array.shape[0], 'height': array.shape[1], 'width': array.shape[2],
+                   'dtype': array.dtype.name}
+    with open_cog(path, out_profile, compression=compression, overviews=overviews, resampling=resampling) as dst:
+        dst.write(array)
+    return path
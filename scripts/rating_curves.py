@@ -0,0 +1,288 @@
+"""
+Curvas-chave sintéticas por trecho a partir do HAND.
+
+Cada célula da bacia é atribuída ao trecho da rede de drenagem onde fica a
+sua célula de drenagem mais próxima (a mesma usada pelo HAND, obtida de
+`grid.compute_hand(..., return_index=True)`). Para uma lista de cotas `h`
+acima do canal, as células de um trecho com HAND < h formam a seção
+inundada, e em uma única passada (`np.bincount` por trecho e faixa de cota,
+seguido de soma acumulada ao longo das cotas) obtêm-se, por trecho:
+
+- área inundada (m²): soma das áreas das células;
+- volume (m³): soma de (h - HAND) x área da célula;
+- área molhada do leito (m²): área das células corrigida pela declividade
+  do terreno, sqrt(1 + (dz/dx)² + (dz/dy)²);
+- largura da superfície (m): área inundada / comprimento do trecho;
+- vazão (m³/s) pela equação de Manning, com área da seção = volume /
+  comprimento, perímetro molhado = área do leito / comprimento e a
+  declividade do trecho.
+
+A tabela (trechos x cotas, float32) é gravada em `curvas_chave.npz`, junto
+com os rasters de HAND e do trecho de cada célula. A mancha de inundação de
+qualquer cota ou vazão, única ou por trecho, sai depois por consulta à
+tabela, sem recalcular bacia ou HAND.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import rasterio
+
+from scripts.local_analysis_helpers import (_delineate_catchment, _compute_hand_reach_view, _depth_suffix,
+                                            flood_depth_by_reach, REACH_NODATA)
+from scripts.polygonize import polygonize_mask
+from scripts.profiling import stage
+from scripts.raster_output import write_cog, DEFAULT_COMPRESSION
+from scripts.raster_grid import cell_sizes_m
+
+
+DEFAULT_MAX_STAGE_M = 20.0
+DEFAULT_STAGE_STEP_M = 0.25
+DEFAULT_MANNING_N = 0.06
+# Declividade mínima do trecho na equação de Manning (trechos planos ou sem cota)
+MIN_REACH_SLOPE = 1e-4
+CURVE_COLUMNS = ('area_inundada_m2', 'volume_m3', 'area_leito_m2', 'largura_m', 'vazao_m3s')
+
+
+# --- TABELA HIDRÁULICA ---
+
+def stage_levels(max_stage=DEFAULT_MAX_STAGE_M, stage_step=DEFAULT_STAGE_STEP_M):
+    """Cotas da tabela: 0, `stage_step`, ..., até `max_stage` (m)."""
+    if stage_step <= 0 or max_stage <= 0:
+        raise ValueError("A cota máxima e o passo das curvas-chave devem ser positivos.")
+    count = int(np.floor(max_stage / stage_step + 1e-9)) + 1
+    return np.arange(count, dtype=np.float64) * stage_step
+
+
+def bed_area(dem, valid, affine, crs):
+    """Área da superfície do terreno em cada célula (m²): área plana corrigida pela declividade."""
+    dx, dy = cell_sizes_m(affine, crs, dem.shape[0])
+    values = np.where(valid, dem, np.nan)
+    dzdy, dzdx = np.gradient(values)
+    factor = np.sqrt(1.0 + (dzdx / dx[:, None]) ** 2 + (dzdy / dy) ** 2)
+    return np.where(np.isfinite(factor), factor, 1.0) * (dx * dy)[:, None]
+
+
+def hydraulic_table(hand, reach, cell_area, cell_bed_area, stages, n_reaches):
+    """
+    Área inundada, volume e área molhada do leito (trechos x cotas) em uma
+    passada sobre as células. Uma célula com HAND `v` entra em todas as cotas
+    > v: é contada na primeira delas e as colunas são acumuladas ao longo das
+    cotas.
+    """
+    n_stages = len(stages)
+    inside = (reach >= 0) & np.isfinite(hand)
+    values, cells_reach = hand[inside], reach[inside].astype(np.int64)
+    first = np.searchsorted(stages, values, side='right')
+    flooded = first < n_stages
+    key = cells_reach[flooded] * n_stages + first[flooded]
+    size = n_reaches * n_stages
+
+    def accumulate(weights):
+        sums = np.bincount(key, weights=weights[flooded], minlength=size).reshape(n_reaches, n_stages)
+        return np.cumsum(sums, axis=1)
+
+    area = np.broadcast_to(cell_area, hand.shape)[inside]
+    flooded_area = accumulate(area)
+    return {
+        'area_inundada_m2': flooded_area,
+        'volume_m3': stages[None, :] * flooded_area - accumulate(area * values),
+        'area_leito_m2': accumulate(np.broadcast_to(cell_bed_area, hand.shape)[inside]),
+    }
+
+
+def add_reach_hydraulics(table, length, slope, manning_n=DEFAULT_MANNING_N):
+    """Acrescenta largura da superfície e vazão de Manning às colunas de `hydraulic_table`."""
+    length = np.asarray(length, dtype=np.float64)[:, None]
+    slope = np.asarray(slope, dtype=np.float64)
+    slope = np.where(np.isfinite(slope) & (slope > MIN_REACH_SLOPE), slope, MIN_REACH_SLOPE)[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        section = table['volume_m3'] / length
+        perimeter = table['area_leito_m2'] / length
+        radius = np.where(perimeter > 0, section / perimeter, 0.0)
+        table['largura_m'] = np.where(length > 0, table['area_inundada_m2'] / length, 0.0)
+        table['vazao_m3s'] = np.where(length > 0, section * radius ** (2.0 / 3.0) * np.sqrt(slope) / manning_n,
+                                      0.0)
+    return table
+
+
+# --- PERSISTÊNCIA E CONSULTA ---
+
+def save_rating_curves(curves, path):
+    """Grava as curvas em .npz (colunas da tabela em float32)."""
+    arrays = {key: np.asarray(value, dtype=np.float32) if key in CURVE_COLUMNS else np.asarray(value)
+              for key, value in curves.items()}
+    np.savez_compressed(path, **arrays)
+    return path
+
+
+def load_rating_curves(path):
+    """Lê as curvas gravadas por `save_rating_curves`."""
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+def rating_curves_to_dataframe(curves):
+    """Tabela longa (uma linha por trecho e cota), para exportação em CSV."""
+    n_reaches, n_stages = curves['area_inundada_m2'].shape
+    columns = {
+        'trecho_id': np.repeat(curves['trecho_id'], n_stages),
+        'estagio_m': np.tile(curves['estagio_m'], n_reaches),
+    }
+    columns.update({key: np.asarray(curves[key]).reshape(-1) for key in CURVE_COLUMNS})
+    return pd.DataFrame(columns)
+
+
+def _per_reach(curves, values):
+    """Um valor por trecho a partir de um escalar, de um array ou de {trecho_id: valor} (ausentes = NaN)."""
+    n_reaches = len(curves['trecho_id'])
+    if isinstance(values, dict):
+        per_reach = np.full(n_reaches, np.nan)
+        for reach_id, value in values.items():
+            per_reach[int(reach_id)] = float(value)
+        return per_reach
+    return np.broadcast_to(np.asarray(values, dtype=np.float64), (n_reaches,)).copy()
+
+
+def stage_for_discharge(curves, discharge):
+    """
+    Cota (m) de cada trecho para a vazão dada (escalar, array ou dicionário
+    por trecho), por interpolação linear na curva-chave; vazões acima da
+    curva ficam na cota máxima da tabela.
+    """
+    stages = np.asarray(curves['estagio_m'], dtype=np.float64)
+    # A vazão de Manning pode cair quando uma planície larga começa a inundar: usa a envoltória crescente
+    rating = np.maximum.accumulate(np.asarray(curves['vazao_m3s'], dtype=np.float64), axis=1)
+    discharge = _per_reach(curves, discharge)
+    rows = np.arange(len(rating))
+    upper = np.clip(np.sum(rating < discharge[:, None], axis=1), 1, len(stages) - 1)
+    q0, q1 = rating[rows, upper - 1], rating[rows, upper]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.clip(np.where(q1 > q0, (discharge - q0) / (q1 - q0), 1.0), 0.0, 1.0)
+    stage_m = stages[upper - 1] + fraction * (stages[upper] - stages[upper - 1])
+    return np.where(np.isnan(discharge), np.nan, stage_m)
+
+
+# --- ETAPAS ---
+
+def run_rating_curves(preproc_data, outlet_coords, stream_threshold, output_dir, progress_callback,
+                      max_stage=DEFAULT_MAX_STAGE_M, stage_step=DEFAULT_STAGE_STEP_M, manning_n=DEFAULT_MANNING_N,
+                      compression=DEFAULT_COMPRESSION, overviews=True, polygonize_workers=None):
+    """
+    Delineia a bacia do exutório e calcula as curvas-chave sintéticas de
+    todos os trechos da rede dentro dela. Grava:
+
+    - `hand.tif` (float32) e `trechos_hand.tif` (int32, trecho de cada
+      célula, -1 = sem trecho), usados para desenhar manchas por consulta;
+    - `curvas_chave.npz` (tabela compacta) e `curvas_chave.csv`;
+    - `trechos_curvas.geojson`: a rede com `trecho_id`.
+
+    Requer o índice da rede do pré-processamento (limiar >= limiar mínimo do
+    índice).
+    """
+    results = {}
+    stages = stage_levels(max_stage, stage_step)
+    if manning_n <= 0:
+        raise ValueError("O coeficiente de Manning deve ser positivo.")
+
+    os.makedirs(output_dir, exist_ok=True)
+    grid, preproc_data = _delineate_catchment(preproc_data, outlet_coords, stream_threshold, output_dir,
+                                              progress_callback, False, results, clip_domain=True,
+                                              compression=compression, overviews=overviews,
+                                              polygonize_workers=polygonize_workers)
+    progress_callback("Calculando HAND e trecho de drenagem de cada célula...", 70)
+    with stage(progress_callback, 'hand'):
+        hand, reach = _compute_hand_reach_view(grid, preproc_data, stream_threshold)
+    streams_gdf = preproc_data['catchment_streams'].copy()
+
+    progress_callback(f"Calculando curvas-chave de {len(streams_gdf)} trechos...", 80)
+    with stage(progress_callback, 'rating_curves'):
+        affine, crs = grid.viewfinder.affine, grid.viewfinder.crs
+        dx, dy = cell_sizes_m(affine, crs, hand.shape[0])
+        dem = np.asarray(preproc_data['inflated_dem'], dtype=np.float64)
+        table = hydraulic_table(hand, reach, (dx * dy)[:, None], bed_area(dem, np.isfinite(hand), affine, crs),
+                                stages, len(streams_gdf))
+        table = add_reach_hydraulics(table, streams_gdf['comprimento_m'].to_numpy(),
+                                     streams_gdf['declividade'].to_numpy(), manning_n)
+        curves = {
+            'trecho_id': np.arange(len(streams_gdf)), 'estagio_m': stages,
+            'comprimento_m': streams_gdf['comprimento_m'].to_numpy(dtype=np.float64),
+            'declividade': streams_gdf['declividade'].to_numpy(dtype=np.float64),
+            'strahler_order': streams_gdf['strahler_order'].to_numpy(dtype=np.int64, na_value=0),
+            'n_manning': np.float64(manning_n), **table,
+        }
+
+    progress_callback("Salvando curvas-chave e rasters de HAND...", 90)
+    with stage(progress_callback, 'write_rasters'):
+        profile = {'crs': crs, 'transform': affine}
+        hand_path = os.path.join(output_dir, 'hand.tif')
+        write_cog(hand_path, hand.astype(np.float32), {**profile, 'nodata': np.nan},
+                  compression=compression, overviews=overviews)
+        reach_path = os.path.join(output_dir, 'trechos_hand.tif')
+        write_cog(reach_path, reach, {**profile, 'nodata': REACH_NODATA},
+                  compression=compression, overviews=overviews, resampling='nearest')
+    results['hand_path'], results['trechos_raster_path'] = hand_path, reach_path
+
+    results['curvas_chave_path'] = save_rating_curves(curves, os.path.join(output_dir, 'curvas_chave.npz'))
+    results['curvas_chave_csv_path'] = os.path.join(output_dir, 'curvas_chave.csv')
+    rating_curves_to_dataframe(curves).to_csv(results['curvas_chave_csv_path'], index=False)
+    streams_gdf.insert(0, 'trecho_id', curves['trecho_id'])
+    results['trechos_path'] = os.path.join(output_dir, 'trechos_curvas.geojson')
+    streams_gdf.to_file(results['trechos_path'], driver='GeoJSON')
+    results['n_trechos'] = len(streams_gdf)
+
+    progress_callback("Curvas-chave sintéticas concluídas.", 100)
+    return results
+
+
+def run_rating_curve_flood(rating_results, output_dir, progress_callback, stage_m=None, discharge_m3s=None,
+                           compression=DEFAULT_COMPRESSION, overviews=True, polygonize_workers=None,
+                           smooth_iterations=0):
+    """
+    Mancha de inundação por consulta às curvas-chave de `run_rating_curves`.
+    Informe `stage_m` (cota acima do canal) ou `discharge_m3s` (vazão), cada
+    um como escalar, array com um valor por trecho ou {trecho_id: valor}
+    (trechos ausentes não inundam).
+    """
+    if (stage_m is None) == (discharge_m3s is None):
+        raise ValueError("Informe a cota ou a vazão (apenas uma delas).")
+    results = {}
+    curves = load_rating_curves(rating_results['curvas_chave_path'])
+    if stage_m is not None:
+        stage_per_reach = _per_reach(curves, stage_m)
+        suffix = f"cota_{_depth_suffix(float(stage_m))}" if np.isscalar(stage_m) else "cota_por_trecho"
+    else:
+        stage_per_reach = stage_for_discharge(curves, discharge_m3s)
+        suffix = (f"vazao_{_depth_suffix(float(discharge_m3s))[:-1]}m3s" if np.isscalar(discharge_m3s)
+                  else "vazao_por_trecho")
+    results['suffix'] = suffix
+    results['cota_por_trecho'] = stage_per_reach
+
+    progress_callback("Consultando curvas-chave...", 20)
+    with stage(progress_callback, 'flood_lookup'):
+        with rasterio.open(rating_results['hand_path']) as src:
+            hand = src.read(1)
+            transform, crs = src.transform, src.crs
+        with rasterio.open(rating_results['trechos_raster_path']) as src:
+            reach = src.read(1)
+        inundation_depth = flood_depth_by_reach(hand, reach, stage_per_reach)
+
+    os.makedirs(output_dir, exist_ok=True)
+    profile = {'crs': crs, 'transform': transform, 'nodata': np.nan}
+    inundacao_raster_path = os.path.join(output_dir, f'inundacao_mapa_{suffix}.tif')
+    with stage(progress_callback, 'write_rasters'):
+        write_cog(inundacao_raster_path, inundation_depth.astype(rasterio.float32), profile,
+                  compression=compression, overviews=overviews)
+    results['inundacao_raster_path'] = inundacao_raster_path
+
+    progress_callback("Vetorizando mancha de inundação...", 70)
+    with stage(progress_callback, 'polygonize'):
+        flood_gdf = polygonize_mask(~np.isnan(inundation_depth), transform, crs,
+                                    max_workers=polygonize_workers, smooth_iterations=smooth_iterations)
+    if flood_gdf is not None:
+        inundacao_vetor_path = os.path.join(output_dir, f'inundacao_{suffix}.geojson')
+        flood_gdf.to_file(inundacao_vetor_path, driver='GeoJSON')
+        results['inundacao_vetor_path'] = inundacao_vetor_path
+
+    progress_callback("Mancha de inundação das curvas-chave concluída.", 100)
+    return results
@@ -0,0 +1,345 @@
+"""
+HAND e mancha de inundação regionais, sobre todo o MDE pré-processado.
+
+Sem exutório nem `grid.clip_to`: a direção e a acumulação de fluxo gravadas
+pelo pré-processamento (`fdir_path`, `acc_path`, inclusive quando vindas do
+cache) e o MDE condicionado são lidos bloco a bloco por processos paralelos.
+
+O HAND de uma célula é a diferença entre a sua cota e a da primeira célula
+de canal (acumulação > limiar) no seu caminho de fluxo, que pode estar em
+outro bloco. Como na acumulação em blocos (`scripts/tiled_conditioning.py`),
+as costuras são resolvidas em um grafo pequeno:
+
+1. em cada bloco, cada caminho de fluxo é seguido até um canal (cota de
+   drenagem conhecida) ou até sair do bloco (célula de destino no bloco
+   vizinho); só as células do perímetro voltam ao processo principal;
+2. os destinos das células do perímetro são encadeados (saltos de ponteiro)
+   até uma célula com cota de drenagem conhecida;
+3. cada bloco é refeito com as cotas das saídas, e HAND, lâmina d'água e
+   polígonos da mancha (coordenadas de pixel, ver `scripts/polygonize.py`)
+   são devolvidos ao processo principal, que grava os COGs por janela e
+   costura a mancha em um único vetor.
+"""
+import os
+import shutil
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+
+import numpy as np
+import rasterio
+import shapely
+from numba import njit
+from rasterio.windows import Window
+
+from scripts.polygonize import polygonize_tile, merge_tile_polygons
+from scripts.profiling import stage
+from scripts.raster_grid import D8_ROW_OFFSETS, D8_COL_OFFSETS
+from scripts.raster_output import open_cog, DEFAULT_COMPRESSION
+from scripts.tiled_conditioning import iter_tiles
+
+
+DEFAULT_TILE_SIZE = 1024
+
+
+# Cotas de drenagem das células do perímetro, lidas uma vez por processo (ver _exit_levels)
+_EXIT_LEVELS = {}
+
+
+# --- KERNEL NUMBA ---
+
+@njit(cache=True)
+def _drainage_tile(codes, streams, dem, valid, row_off, col_off, height, width, code_index,
+                   row_offsets, col_offsets):
+    """
+    Cota da célula de drenagem de cada célula do bloco (NaN se o caminho sai
+    do bloco ou termina sem canal) e, para os caminhos que saem do bloco, o
+    índice plano (no MDE) da célula de destino; -1 nos demais casos.
+    """
+    h, w = codes.shape
+    n = h * w
+    drain = np.full(n, np.nan)
+    exit_cell = np.full(n, -1, dtype=np.int64)
+    state = np.zeros(n, dtype=np.uint8)  # 0 = pendente, 1 = resolvida, 2 = no caminho atual
+    path = np.empty(n, dtype=np.int64)
+    for start in range(n):
+        if state[start] != 0 or not valid[start // w, start % w]:
+            continue
+        top = 0
+        j = start
+        level = np.nan
+        target = -1
+        while True:
+            if state[j] == 1:
+                level = drain[j]
+                target = exit_cell[j]
+                break
+            if state[j] == 2:
+                break  # ciclo: direção de fluxo inconsistente
+            r = j // w
+            c = j % w
+            path[top] = j
+            top += 1
+            if streams[r, c]:
+                level = dem[r, c]
+                break
+            state[j] = 2
+            k = code_index[codes[r, c]]
+            if k < 0:
+                break
+            nr = r + row_offsets[k]
+            nc = c + col_offsets[k]
+            if nr < 0 or nr >= h or nc < 0 or nc >= w:
+                gr = row_off + nr
+                gc = col_off + nc
+                if 0 <= gr < height and 0 <= gc < width:
+                    target = gr * width + gc
+                break
+            if not valid[nr, nc]:
+                break
+            j = nr * w + nc
+        for s in range(top):
+            drain[path[s]] = level
+            exit_cell[path[s]] = target
+            state[path[s]] = 1
+    return drain.reshape(h, w), exit_cell.reshape(h, w)
+
+
+# --- LEITURA DOS BLOCOS ---
+
+def _code_index(dirmap):
+    """Posição (0-7) de cada código do dirmap na vizinhança D8; -1 para os demais códigos."""
+    index = np.full(256, -1, dtype=np.int64)
+    index[np.asarray(dirmap)] = np.arange(8)
+    return index
+
+
+def _read_tile(sources, row_off, col_off, h, w):
+    """Direção, canais, MDE condicionado e máscara de dados de um bloco."""
+    window = Window(col_off, row_off, w, h)
+    with rasterio.open(sources['fdir_path']) as src:
+        codes = src.read(1, window=window).astype(np.uint8)
+    with rasterio.open(sources['acc_path']) as src:
+        streams = src.read(1, window=window) > sources['stream_threshold']
+    if sources['dem_npy_path']:
+        dem = np.array(np.load(sources['dem_npy_path'], mmap_mode='r')[row_off:row_off + h, col_off:col_off + w],
+                       dtype=np.float64)
+    else:
+        with rasterio.open(sources['dem_path']) as src:
+            dem = src.read(1, window=window).astype(np.float64)
+    valid = np.isfinite(dem)
+    nodata = sources['dem_nodata']
+    if nodata is not None and np.isfinite(nodata):
+        valid &= dem != nodata
+    # Como em `grid.compute_hand`, as células da borda do MDE ficam sem HAND
+    height, width = sources['shape']
+    if row_off == 0:
+        valid[0, :] = False
+    if row_off + h == height:
+        valid[-1, :] = False
+    if col_off == 0:
+        valid[:, 0] = False
+    if col_off + w == width:
+        valid[:, -1] = False
+    return codes, streams, dem, valid
+
+
+def _tile_drainage(sources, row_off, col_off, h, w):
+    codes, streams, dem, valid = _read_tile(sources, row_off, col_off, h, w)
+    height, width = sources['shape']
+    drain, exit_cell = _drainage_tile(codes, streams, dem, valid, row_off, col_off, height, width,
+                                      _code_index(sources['dirmap']), D8_ROW_OFFSETS, D8_COL_OFFSETS)
+    return dem, valid, drain, exit_cell
+
+
+def _perimeter_records(sources, row_off, col_off, h, w):
+    """Executado no worker (passo 1): células do perímetro do bloco, com cota de drenagem e destino."""
+    _, _, drain, exit_cell = _tile_drainage(sources, row_off, col_off, h, w)
+    border = np.zeros((h, w), dtype=bool)
+    border[[0, -1], :] = True
+    border[:, [0, -1]] = True
+    rows, cols = np.nonzero(border)
+    cells = (rows + row_off) * sources['shape'][1] + cols + col_off
+    return cells, drain[rows, cols], exit_cell[rows, cols]
+
+
+def _exit_levels(path):
+    """Células do perímetro (ordenadas) e cotas de drenagem gravadas pelo processo principal."""
+    if path not in _EXIT_LEVELS:
+        with np.load(path) as data:
+            _EXIT_LEVELS[path] = (data['cells'], data['levels'])
+    return _EXIT_LEVELS[path]
+
+
+def _flood_tile(sources, row_off, col_off, h, w, channel_depth, exit_levels_path):
+    """Executado no worker (passo 3): HAND, lâmina d'água e polígonos (WKB) da mancha de um bloco."""
+    dem, valid, drain, exit_cell = _tile_drainage(sources, row_off, col_off, h, w)
+    exits = np.isnan(drain) & (exit_cell >= 0)
+    exit_cells, exit_levels = _exit_levels(exit_levels_path)
+    if exits.any() and len(exit_cells):
+        targets = exit_cell[exits]
+        pos = np.minimum(np.searchsorted(exit_cells, targets), len(exit_cells) - 1)
+        drain[exits] = np.where(exit_cells[pos] == targets, exit_levels[pos], np.nan)
+    hand = np.where(valid, dem - drain, np.nan)
+    depth = np.where(hand < channel_depth, channel_depth - hand, np.nan)
+
+    flooded = ~np.isnan(depth)
+    wkb, seam = np.empty(0, dtype=object), np.empty(0, dtype=bool)
+    if flooded.any():
+        wkb, seam = polygonize_tile(flooded.astype(np.uint8), row_off, col_off, tuple(sources['shape']))
+    return row_off, col_off, hand.astype(np.float32), depth.astype(np.float32), wkb, seam
+
+
+# --- GRAFO DAS COSTURAS ---
+
+def resolve_exit_levels(cells, levels, exit_cells):
+    """
+    Cota de drenagem das células do perímetro dos blocos: células sem canal
+    no próprio bloco herdam a cota da célula de destino, seguindo os destinos
+    por saltos de ponteiro. Retorna (células ordenadas, cotas; NaN = sem canal).
+    """
+    order = np.argsort(cells, kind='stable')
+    cells, levels, exit_cells = cells[order], levels[order].astype(np.float64), exit_cells[order]
+    if len(cells) == 0:
+        return cells, levels
+    pos = np.minimum(np.searchsorted(cells, exit_cells), len(cells) - 1)
+    following = np.where((exit_cells >= 0) & (cells[pos] == exit_cells), pos, -1)
+
+    # Saltos de ponteiro: o comprimento das cadeias pendentes cai pela metade a cada passada
+    pending = np.flatnonzero(np.isnan(levels) & (following >= 0))
+    while pending.size:
+        target = following[pending]
+        known = ~np.isnan(levels[target])
+        jump = following[target[~known]]
+        levels[pending[known]] = levels[target[known]]
+        following[pending[known]] = -1
+        pending = pending[~known]
+        following[pending] = jump
+        pending = pending[jump >= 0]
+    return cells, levels
+
+
+# --- ETAPA COMPLETA ---
+
+def _map_tiles(pool, func, tiles, sources, *args):
+    """Gera (bloco, func(sources, *bloco, *args)) na ordem de conclusão; sem pool, no próprio processo."""
+    if pool is None:
+        for tile in tiles:
+            yield tile, func(sources, *tile, *args)
+        return
+    futures = {pool.submit(func, sources, *tile, *args): tile for tile in tiles}
+    for future in as_completed(futures):
+        yield futures[future], future.result()
+
+
+def _sources(preproc_data, stream_threshold, shared_dir):
+    """Caminhos e metadados lidos pelos workers; o MDE condicionado em memória é gravado em .npy."""
+    with rasterio.open(preproc_data['fdir_path']) as src:
+        shape, transform, crs = (src.height, src.width), src.transform, src.crs
+    sources = {'fdir_path': preproc_data['fdir_path'], 'acc_path': preproc_data['acc_path'],
+               'stream_threshold': float(stream_threshold), 'shape': shape,
+               'dirmap': tuple(preproc_data['dirmap']), 'dem_path': None, 'dem_npy_path': None}
+    if preproc_data.get('dem_condicionado_path'):
+        sources['dem_path'] = preproc_data['dem_condicionado_path']
+        with rasterio.open(sources['dem_path']) as src:
+            sources['dem_nodata'] = src.nodata
+    elif 'inflated_dem' in preproc_data:
+        dem = preproc_data['inflated_dem']
+        sources['dem_npy_path'] = os.path.join(shared_dir, 'inflated_dem.npy')
+        np.save(sources['dem_npy_path'], np.asarray(dem))
+        sources['dem_nodata'] = dem.nodata
+    else:
+        raise ValueError("Resultados do pré-processamento sem o MDE condicionado.")
+    return sources, transform, crs
+
+
+def run_regional_flood(preproc_data, channel_depth, stream_threshold, output_dir, progress_callback,
+                       tile_size=DEFAULT_TILE_SIZE, max_workers=None, compression=DEFAULT_COMPRESSION,
+                       overviews=True, smooth_iterations=0):
+    """
+    HAND e mancha de inundação para `channel_depth` em todo o MDE
+    pré-processado (em memória ou em blocos), sem exutório. Grava:
+
+    - `hand_regional.tif`: HAND (float32, NaN onde o fluxo não chega a um canal);
+    - `inundacao_regional_mapa_<profundidade>.tif`: lâmina d'água (float32);
+    - `inundacao_regional_<profundidade>.geojson`: mancha dissolvida.
+
+    Os blocos de `tile_size` células são processados por `max_workers`
+    processos (padrão: número de CPUs; 1 = sem pool).
+    """
+    # Importado aqui para que os workers não carreguem o módulo da página 2 (osmnx etc.)
+    from scripts.local_analysis_helpers import _depth_suffix
+
+    results = {}
+    if channel_depth <= 0:
+        raise ValueError("A profundidade do canal deve ser positiva.")
+    for key in ('fdir_path', 'acc_path'):
+        if not preproc_data.get(key) or not os.path.exists(preproc_data[key]):
+            raise FileNotFoundError(f"Raster do pré-processamento '{key}' não encontrado; refaça a Etapa 1.")
+
+    os.makedirs(output_dir, exist_ok=True)
+    shared_dir = tempfile.mkdtemp(prefix='_regional_tmp', dir=output_dir)
+    try:
+        progress_callback("Preparando rasters do pré-processamento...", 5)
+        with stage(progress_callback, 'share_rasters'):
+            sources, transform, crs = _sources(preproc_data, stream_threshold, shared_dir)
+        height, width = sources['shape']
+        tiles = list(iter_tiles(height, width, tile_size))
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        max_workers = max(1, min(int(max_workers), len(tiles)))
+        suffix = _depth_suffix(channel_depth)
+        results['suffix'] = suffix
+        hand_path = os.path.join(output_dir, 'hand_regional.tif')
+        inundacao_raster_path = os.path.join(output_dir, f'inundacao_regional_mapa_{suffix}.tif')
+        profile = {'crs': crs, 'transform': transform, 'height': height, 'width': width, 'count': 1,
+                   'dtype': rasterio.float32, 'nodata': np.nan}
+
+        parts = []
+        with ExitStack() as stack:
+            # Um único pool para os dois passos; 'spawn' pelo mesmo motivo de
+            # scripts/batch_delineation.py (numba do PySheds)
+            pool = None
+            if max_workers > 1:
+                pool = stack.enter_context(ProcessPoolExecutor(
+                    max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')))
+
+            progress_callback(f"Seguindo o fluxo até os canais em {len(tiles)} bloco(s)...", 10)
+            with stage(progress_callback, 'tile_drainage'):
+                records = [record for _, record in _map_tiles(pool, _perimeter_records, tiles, sources)]
+            with stage(progress_callback, 'seams'):
+                exit_cells, exit_levels = resolve_exit_levels(*(np.concatenate(column) for column in zip(*records)))
+                exit_levels_path = os.path.join(shared_dir, 'cotas_saidas.npz')
+                np.savez(exit_levels_path, cells=exit_cells, levels=exit_levels)
+            del records, exit_cells, exit_levels
+
+            progress_callback(f"Calculando HAND e mancha para {channel_depth}m...", 40)
+            hand_dst = stack.enter_context(open_cog(hand_path, profile, compression=compression,
+                                                    overviews=overviews))
+            flood_dst = stack.enter_context(open_cog(inundacao_raster_path, profile, compression=compression,
+                                                     overviews=overviews))
+            flood_tiles = _map_tiles(pool, _flood_tile, tiles, sources, channel_depth, exit_levels_path)
+            for done, (_, (row_off, col_off, hand, depth, wkb, seam)) in enumerate(flood_tiles, start=1):
+                window = Window(col_off, row_off, hand.shape[1], hand.shape[0])
+                with stage(progress_callback, 'write_rasters'):
+                    hand_dst.write(hand, 1, window=window)
+                    flood_dst.write(depth, 1, window=window)
+                if len(seam):
+                    parts.append((shapely.from_wkb(wkb), seam))
+                progress_callback(f"Bloco {done}/{len(tiles)} concluído.", 40 + int(45 * done / len(tiles)))
+        results['hand_path'] = hand_path
+        results['inundacao_raster_path'] = inundacao_raster_path
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+
+    progress_callback("Costurando a mancha de inundação dos blocos...", 90)
+    with stage(progress_callback, 'polygonize'):
+        flood_gdf = merge_tile_polygons(parts, transform, crs, smooth_iterations)
+    if flood_gdf is not None:
+        inundacao_vetor_path = os.path.join(output_dir, f'inundacao_regional_{suffix}.geojson')
+        flood_gdf.to_file(inundacao_vetor_path, driver='GeoJSON')
+        results['inundacao_vetor_path'] = inundacao_vetor_path
+
+    progress_callback("HAND e mancha de inundação regionais concluídos.", 100)
+    return results
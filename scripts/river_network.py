@@ -0,0 +1,111 @@
+"""
+Conversão vetorizada da rede de drenagem do PySheds em GeoDataFrame.
+
+`grid.extract_river_network` devolve um dicionário GeoJSON com um segmento por
+feição. Em vez de criar um `LineString` e amostrar os rasters ponto a ponto,
+todas as coordenadas são concatenadas em um único array, as linhas são
+criadas de uma vez com `shapely.linestrings` e os atributos de todos os
+segmentos são amostrados com indexação do NumPy.
+"""
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from pyproj import CRS
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def _flatten_coordinates(features):
+    """Concatena as coordenadas das feições com pelo menos 2 vértices."""
+    coords = [np.asarray(feature['geometry']['coordinates'], dtype=np.float64) for feature in features]
+    coords = [c for c in coords if len(c) >= 2]
+    if not coords:
+        return None, None
+    counts = np.fromiter((len(c) for c in coords), dtype=np.int64, count=len(coords))
+    return np.concatenate(coords)[:, :2], counts
+
+
+def _segment_lengths(flat, counts, geographic):
+    """Comprimento de cada linha: geodésico (m) em CRS geográfico, euclidiano caso contrário."""
+    x, y = flat[:, 0], flat[:, 1]
+    if geographic:
+        lon, lat = np.radians(x), np.radians(y)
+        dlat, dlon = np.diff(lat), np.diff(lon)
+        a = np.sin(dlat / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(dlon / 2) ** 2
+        step = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+    else:
+        step = np.hypot(np.diff(x), np.diff(y))
+    # Descarta os passos entre o último vértice de uma linha e o primeiro da seguinte
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    step = np.append(step, 0.0)
+    step[starts[1:] - 1] = 0.0
+    return np.add.reduceat(step, starts)
+
+
+def line_lengths(flat, counts, crs):
+    """Comprimento de linhas dadas por vértices concatenados (`flat`) e número de vértices por linha."""
+    geographic = CRS.from_user_input(crs).is_geographic if crs is not None else False
+    return _segment_lengths(flat, counts, geographic)
+
+
+def _to_index(inverse, points):
+    """Índices (linha, coluna) dos pontos pela afim inversa (truncados, como `int()`)."""
+    cols = np.trunc(inverse.a * points[:, 0] + inverse.b * points[:, 1] + inverse.c).astype(np.int64)
+    rows = np.trunc(inverse.d * points[:, 0] + inverse.e * points[:, 1] + inverse.f).astype(np.int64)
+    return rows, cols
+
+
+def _sample(raster, rows, cols, inside, dtype=np.float64):
+    values = np.full(rows.shape, np.nan, dtype=dtype)
+    values[inside] = np.asarray(raster)[rows[inside], cols[inside]]
+    return values
+
+
+def network_to_geodataframe(network, crs, affine=None, stream_order=None, acc=None, dem=None):
+    """
+    Converte a saída de `grid.extract_river_network` em GeoDataFrame.
+
+    Com `affine` e os rasters opcionais, cada segmento recebe:
+    - `strahler_order` (Int64): ordem no vértice inicial;
+    - `acumulacao`: acumulação de fluxo no vértice inicial;
+    - `comprimento_m`: comprimento (geodésico se o CRS for geográfico);
+    - `declividade`: desnível entre os vértices inicial e final / comprimento.
+
+    Retorna None se a rede não tiver segmentos.
+    """
+    flat, counts = _flatten_coordinates(network.get('features', []))
+    if flat is None:
+        return None
+
+    geometries = shapely.linestrings(flat, indices=np.repeat(np.arange(len(counts)), counts))
+    if affine is None:
+        return gpd.GeoDataFrame(geometry=geometries, crs=crs)
+
+    ends = np.cumsum(counts) - 1
+    starts = ends - counts + 1
+    columns = {}
+
+    inverse = ~affine
+    rows, cols = _to_index(inverse, flat[starts])
+    reference = next((r for r in (stream_order, acc, dem) if r is not None), None)
+    height, width = np.shape(reference) if reference is not None else (0, 0)
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+
+    if stream_order is not None:
+        order = _sample(stream_order, rows, cols, inside)
+        columns['strahler_order'] = pd.array(order, dtype='Float64').astype('Int64')
+    if acc is not None:
+        columns['acumulacao'] = _sample(acc, rows, cols, inside)
+
+    length = line_lengths(flat, counts, crs)
+    columns['comprimento_m'] = length
+
+    if dem is not None:
+        end_rows, end_cols = _to_index(inverse, flat[ends])
+        end_inside = (end_rows >= 0) & (end_rows < height) & (end_cols >= 0) & (end_cols < width)
+        drop = _sample(dem, rows, cols, inside) - _sample(dem, end_rows, end_cols, end_inside)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            columns['declividade'] = np.where(length > 0, np.maximum(drop, 0.0) / length, np.nan)
+
+    return gpd.GeoDataFrame(columns, geometry=geometries, crs=crs)
@@ -0,0 +1,273 @@
+"""
+Modelo de risco ponderado por solo no domínio raster.
+
+Alternativa ao fluxo vetorial da página 3 (`run_soil_intersection` +
+`run_proportional_buffer`): vetorizar o raster de solos, intersectar com a
+mancha e aplicar um buffer a cada pedaço. Aqui tudo acontece na grade do
+raster de solos, e só o resultado final é vetorizado:
+
+1. a mancha de inundação é rasterizada na grade do raster de solos, em uma
+   janela que cobre a mancha mais o alcance máximo do buffer;
+2. para cada classe com peso, os fragmentos da mancha naquela classe
+   (componentes 4-conexas, como os polígonos de `rasterio.features.shapes`)
+   são expandidos ou reduzidos por transformadas de distância euclidiana
+   (`scipy.ndimage.distance_transform_edt`, em metros). Fora do fragmento,
+   a distância até ele; dentro, a distância até a borda;
+3. cada fragmento ganha (ou perde) as n células mais próximas dele (ou da
+   sua borda), onde n é o número de células que leva à área-alvo (a mesma
+   porcentagem do buffer vetorial), ou seja, cresce até a distância da
+   n-ésima célula, com o último anel preenchido em parte. Empates de
+   distância são desfeitos por uma ordem pseudoaleatória fixa das células,
+   sem viés de direção. Na expansão, cada célula de fora pertence ao
+   fragmento mais próximo (zona de Voronoi). Os n de uma classe são
+   arredondados pelo maior resto: cada fragmento fica a menos de uma célula
+   da sua área-alvo e a soma da classe, a menos de meia célula. Na redução,
+   fragmentos de uma célula somem na proporção do peso (com -55%, 55% deles),
+   em vez de ficarem todos inteiros;
+4. as classes são recompostas em um raster de rótulos e vetorizadas com
+   `polygonize_labels`, um polígono por classe. Uma classe só cresce sobre
+   células livres: fora das classes com peso sob a mancha (ou liberadas por
+   uma redução) e não ganhas por uma classe anterior. Assim a área gravada de
+   cada classe é a do seu ajuste.
+
+Como no buffer vetorial, fragmentos cuja área-alvo exige mais que o alcance
+máximo (`BRENTQ_UPPER_LIMIT_M`) ficam inalterados. Ao contrário do vetor,
+em que os buffers de classes vizinhas se sobrepõem, cada célula fica com uma
+só classe; um fragmento cercado por outras classes, sem células livres
+suficientes ao alcance, fica sem solução.
+"""
+import os
+
+import numpy as np
+import geopandas as gpd
+import rasterio
+from rasterio import features
+from rasterio.windows import Window, from_bounds
+from scipy import ndimage
+
+from scripts.local_analysis_helpers import _handle_zip, BRENTQ_UPPER_LIMIT_M
+from scripts.polygonize import polygonize_labels
+from scripts.profiling import stage
+from scripts.raster_output import write_cog, DEFAULT_COMPRESSION
+from scripts.raster_grid import cell_sizes_m
+
+
+SOIL_CLASS_DTYPE, SOIL_CLASS_NODATA = np.int32, 0
+
+
+# --- GRADE ---
+
+def _analysis_window(src, bounds, margin_m):
+    """
+    Janela do raster com a mancha e `margin_m` metros de folga, recortada à
+    extensão do raster, e o tamanho da célula (linha, coluna) em metros. Em
+    CRS geográfico, vale a escala na latitude central da mancha (a variação
+    dentro da janela é ignorada).
+    """
+    width, height = cell_sizes_m(src.transform, src.crs, y=0.5 * (bounds[1] + bounds[3]))
+    sampling = (float(height), float(width))
+    margin_rows = int(np.ceil(margin_m / sampling[0])) + 1
+    margin_cols = int(np.ceil(margin_m / sampling[1])) + 1
+    window = from_bounds(*bounds, transform=src.transform)
+    row0 = max(int(np.floor(window.row_off)) - margin_rows, 0)
+    col0 = max(int(np.floor(window.col_off)) - margin_cols, 0)
+    row1 = min(int(np.ceil(window.row_off + window.height)) + margin_rows, src.height)
+    col1 = min(int(np.ceil(window.col_off + window.width)) + margin_cols, src.width)
+    if row0 >= row1 or col0 >= col1:
+        raise ValueError("A mancha de inundação não sobrepõe o raster de solos.")
+    return Window(col0, row0, col1 - col0, row1 - row0), sampling
+
+
+# --- AJUSTE POR DISTÂNCIA ---
+
+def _hash(indices):
+    """Ordem pseudoaleatória fixa de índices, para desfazer empates sem viés de posição."""
+    return (np.asarray(indices).astype(np.uint64) * np.uint64(2654435761)) % np.uint64(2 ** 32)
+
+
+def change_counts(sizes, percent):
+    """
+    Células a ganhar ou perder por fragmento para variar a área `percent` %,
+    arredondadas pelo maior resto (empates pela ordem de `_hash`): a soma é a
+    variação total arredondada e cada fragmento fica a menos de uma célula
+    do seu alvo.
+    """
+    exact = sizes * abs(percent) / 100.0
+    counts = np.floor(exact).astype(np.int64)
+    extra = int(np.rint(exact.sum())) - int(counts.sum())
+    if extra > 0:
+        order = np.lexsort((_hash(np.arange(sizes.size)), -(exact - counts)))
+        counts[order[:extra]] += 1
+    return counts
+
+
+def rank_select(owner, distance, cells, target_counts):
+    """
+    Seleciona, para cada rótulo k (1..n), as `target_counts[k - 1]` células de
+    `owner == k` de menor `distance`; empates são desfeitos por um hash de
+    `cells` (índices das células). Rótulos com menos candidatas que o alvo
+    não recebem nenhuma. Retorna (seleção, candidatas por rótulo).
+    """
+    n_labels = len(target_counts)
+    available = np.bincount(owner, minlength=n_labels + 1)
+    if owner.size == 0:
+        return np.zeros(0, dtype=bool), available[1:]
+    order = np.lexsort((_hash(cells), distance, owner))
+    group_start = np.concatenate(([0], np.cumsum(available)[:-1]))
+    rank = np.empty(owner.size, dtype=np.int64)
+    rank[order] = np.arange(owner.size) - group_start[owner[order]]
+
+    targets = np.concatenate(([0], np.asarray(target_counts, dtype=np.int64)))
+    targets[targets > available] = 0
+    return rank < targets[owner], available[1:]
+
+
+def adjust_region(region, percent, sampling, limit_m=BRENTQ_UPPER_LIMIT_M, blocked=None):
+    """
+    Expande (`percent` > 0) ou reduz (`percent` < 0) cada fragmento 4-conexo
+    de `region` até a sua área mudar `percent` %. Na expansão, as células de
+    `blocked` não podem ser ganhas (a distância continua medida através
+    delas). Retorna (máscara ajustada, número de fragmentos, número de
+    fragmentos sem solução em `limit_m`).
+    """
+    labels, n_fragments = ndimage.label(region)
+    if n_fragments == 0 or percent == 0:
+        return region.copy(), n_fragments, 0
+    sizes = np.bincount(labels.ravel(), minlength=n_fragments + 1)[1:]
+    changes = change_counts(sizes, percent)
+
+    if percent > 0:
+        distance, indices = ndimage.distance_transform_edt(~region, sampling=sampling, return_indices=True)
+        owner = labels[indices[0], indices[1]]
+        del indices
+        candidates = ~region & (distance <= limit_m)
+        if blocked is not None:
+            candidates &= ~blocked
+    else:
+        distance = ndimage.distance_transform_edt(region, sampling=sampling)
+        owner = labels
+        candidates = region & (distance <= limit_m)
+
+    cells = np.flatnonzero(candidates)
+    chosen, available = rank_select(owner.ravel()[cells], distance.ravel()[cells], cells, changes)
+    unsolved = int(np.count_nonzero(changes > available))
+    selected = np.zeros(region.shape, dtype=bool)
+    selected.ravel()[cells[chosen]] = True
+    adjusted = region | selected if percent > 0 else region & ~selected
+    return adjusted, n_fragments, unsolved
+
+
+def _padded_bbox(region, pad_rows, pad_cols):
+    rows, cols = np.flatnonzero(region.any(axis=1)), np.flatnonzero(region.any(axis=0))
+    return (slice(max(rows[0] - pad_rows, 0), min(rows[-1] + 1 + pad_rows, region.shape[0])),
+            slice(max(cols[0] - pad_cols, 0), min(cols[-1] + 1 + pad_cols, region.shape[1])))
+
+
+def adjust_soil_classes(flood, soil, percentages, sampling, limit_m=BRENTQ_UPPER_LIMIT_M, progress_callback=None):
+    """
+    Raster de classes (0 = fora) com cada classe de `percentages` ({classe:
+    %}) ajustada dentro da mancha `flood`, e um resumo por classe (células
+    originais e finais no raster, fragmentos e fragmentos sem solução), com
+    as classes como texto (resultados de tarefas são gravados em JSON).
+    """
+    result = np.zeros(flood.shape, dtype=SOIL_CLASS_DTYPE)
+    pad_rows, pad_cols = (int(np.ceil(limit_m / step)) + 1 for step in sampling)
+    summary = {}
+    classes = sorted(percentages)
+    # Células ocupadas: as de origem das classes com peso e as já ganhas
+    assigned = flood & np.isin(soil, classes)
+    for step, soil_class in enumerate(classes, start=1):
+        region = flood & (soil == soil_class)
+        if not region.any():
+            continue
+        if progress_callback is not None:
+            progress_callback(f"Ajustando classe {soil_class:g} ({percentages[soil_class]:+}%)...",
+                              20 + int(step / len(classes) * 60))
+        window = _padded_bbox(region, pad_rows, pad_cols)
+        with stage(progress_callback, f'distancia (classe {soil_class:g})'):
+            adjusted, n_fragments, unsolved = adjust_region(region[window], percentages[soil_class], sampling,
+                                                            limit_m, blocked=assigned[window] & ~region[window])
+        result[window][adjusted] = soil_class
+        # Células perdidas na redução ficam livres para as classes seguintes
+        assigned[window] = (assigned[window] & ~region[window]) | adjusted
+        summary[f"{soil_class:g}"] = {'celulas_originais': int(np.count_nonzero(region)), 'celulas_finais': None,
+                                      'fragmentos': n_fragments, 'fragmentos_sem_solucao': unsolved}
+    # Contagem final no raster recomposto
+    for soil_class in classes:
+        if f"{soil_class:g}" in summary:
+            summary[f"{soil_class:g}"]['celulas_finais'] = int(np.count_nonzero(result == soil_class))
+    return result, summary
+
+
+# --- EXECUÇÃO ---
+
+def run_soil_raster_weighting(raster_path, vector_path, percentage_mapping, output_dir, progress_callback,
+                              limit_m=BRENTQ_UPPER_LIMIT_M, compression=DEFAULT_COMPRESSION):
+    """
+    Modelo de risco por solo inteiramente no raster. Recebe o raster de
+    classes de solo, a mancha de inundação (vetor) e os pesos ({classe: %}),
+    e grava `inundacao_adsolo_raster.tif` (COG de classes) e
+    `inundacao_adsolo_raster.geojson` (um polígono por classe, no CRS do
+    vetor). `merge_path` aponta para o vetor, como em
+    `run_proportional_buffer`.
+    """
+    results = {}
+    os.makedirs(output_dir, exist_ok=True)
+    temp_dir = os.path.join(output_dir, "temp_raster_solo")
+    os.makedirs(temp_dir, exist_ok=True)
+
+    progress_callback("Lendo vetor e raster...", 5)
+    with stage(progress_callback, 'read_inputs'):
+        gdf_vector = gpd.read_file(_handle_zip(vector_path, temp_dir))
+    if gdf_vector.empty:
+        raise ValueError("O vetor de inundação está vazio.")
+    percentages = {float(k): float(v) for k, v in percentage_mapping.items()}
+    vector_crs = gdf_vector.crs if gdf_vector.crs else 'EPSG:4326'
+
+    with rasterio.open(raster_path) as src:
+        if gdf_vector.crs != src.crs:
+            progress_callback(f"Reprojetando vetor de {gdf_vector.crs} para {src.crs}...", 8)
+            gdf_vector = gdf_vector.to_crs(src.crs)
+        window, sampling = _analysis_window(src, gdf_vector.total_bounds, limit_m)
+        transform = src.window_transform(window)
+        with stage(progress_callback, 'read_raster'):
+            soil = src.read(1, window=window, masked=True)
+        profile = {'driver': 'GTiff', 'crs': src.crs, 'transform': transform, 'nodata': SOIL_CLASS_NODATA}
+
+    progress_callback(f"Rasterizando a mancha em {window.height} x {window.width} células...", 12)
+    with stage(progress_callback, 'rasterize'):
+        flood = features.rasterize(((geom, 1) for geom in gdf_vector.geometry if geom is not None and not geom.is_empty),
+                                   out_shape=(int(window.height), int(window.width)), transform=transform,
+                                   dtype=np.uint8).astype(bool)
+        flood &= ~np.ma.getmaskarray(soil)
+        soil = soil.filled(0).astype(SOIL_CLASS_DTYPE)
+    present = set(np.unique(soil[flood]).tolist())
+    percentages = {k: v for k, v in percentages.items() if k in present}
+    if not percentages:
+        raise ValueError(f"Nenhuma classe de solo sob a mancha corresponde às chaves do Mapeamento de Pesos. "
+                         f"Classes encontradas: {sorted(present)}")
+
+    classes, summary = adjust_soil_classes(flood, soil, percentages, sampling, limit_m, progress_callback)
+    cell_area = sampling[0] * sampling[1]
+    for info in summary.values():
+        info['area_original_m2'] = info['celulas_originais'] * cell_area
+        info['area_final_m2'] = info['celulas_finais'] * cell_area
+    results['areas_por_classe'] = summary
+
+    raster_out = os.path.join(output_dir, "inundacao_adsolo_raster.tif")
+    with stage(progress_callback, 'write_raster'):
+        write_cog(raster_out, classes, profile, compression=compression, resampling='nearest')
+    results['raster_path'] = raster_out
+
+    progress_callback("Vetorizando o resultado...", 90)
+    with stage(progress_callback, 'polygonize'):
+        gdf_result = polygonize_labels(classes, transform, profile['crs'], column='valor_solo')
+    if gdf_result is None:
+        raise ValueError("Nenhuma geometria resultou do ajuste por solo.")
+    vector_out = os.path.join(output_dir, "inundacao_adsolo_raster.geojson")
+    with stage(progress_callback, 'write_vector'):
+        gdf_result.to_crs(vector_crs).to_file(vector_out, driver='GeoJSON')
+    results['merge_path'] = vector_out
+
+    progress_callback("Modelo raster por solo concluído!", 100)
+    return results
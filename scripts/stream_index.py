@@ -0,0 +1,263 @@
+"""
+Índice da rede de drenagem por limiar de acumulação.
+
+A rede, a máscara de snap e a ordem de Strahler dependem do limiar de
+drenagem apenas pela seleção `acc > limiar`. O índice guarda, uma única vez,
+as células com acumulação acima de um limiar mínimo, ordenadas por
+acumulação decrescente, com o ponteiro para a célula de jusante e a cota do
+MDE condicionado:
+
+- como a acumulação cresce estritamente para jusante, a ordem decrescente já
+  é uma ordem topológica (jusante antes de montante);
+- as células de qualquer limiar >= limiar mínimo formam um prefixo do índice
+  (busca binária).
+
+Para um limiar, trechos (entre nascentes e confluências, como em
+`grid.extract_river_network`) e ordem de Strahler saem de uma varredura
+linear do prefixo, sem reler os rasters.
+"""
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from numba import njit
+from affine import Affine
+from pyproj import CRS
+
+from scripts.river_network import line_lengths
+from scripts.raster_grid import D8_ROW_OFFSETS, D8_COL_OFFSETS
+
+
+STREAM_INDEX_MIN_THRESHOLD = 100
+INDEX_FORMAT_VERSION = 1
+_SELECTION_CELLS = 16 * 1024 * 1024
+
+
+# --- KERNEL NUMBA ---
+
+@njit(cache=True)
+def _split_reaches(down):
+    """
+    Divide as células (ordenadas de jusante para montante) em trechos.
+
+    Retorna (trecho de cada célula, célula inicial de cada trecho, célula de
+    jusante do último vértice de cada trecho ou -1, ordem de Strahler).
+    """
+    n = len(down)
+    inflow = np.zeros(n, dtype=np.int64)
+    for i in range(n):
+        if down[i] >= 0:
+            inflow[down[i]] += 1
+
+    reach = np.full(n, -1, dtype=np.int64)
+    head = np.empty(n, dtype=np.int64)
+    end_down = np.empty(n, dtype=np.int64)
+    order = np.empty(n, dtype=np.int64)
+    max_in = np.zeros(n, dtype=np.int64)
+    n_max_in = np.zeros(n, dtype=np.int64)
+    n_reaches = 0
+    for i in range(n - 1, -1, -1):
+        if inflow[i] != 1:
+            reach[i] = n_reaches
+            head[n_reaches] = i
+            if inflow[i] == 0:
+                order[n_reaches] = 1
+            else:
+                order[n_reaches] = max_in[i] + (1 if n_max_in[i] > 1 else 0)
+            n_reaches += 1
+        r = reach[i]
+        d = down[i]
+        if d >= 0 and inflow[d] == 1:
+            reach[d] = r
+        else:
+            end_down[r] = d
+            if d >= 0:
+                if order[r] > max_in[d]:
+                    max_in[d] = order[r]
+                    n_max_in[d] = 1
+                elif order[r] == max_in[d]:
+                    n_max_in[d] += 1
+    return reach, head[:n_reaches].copy(), end_down[:n_reaches].copy(), order[:n_reaches].copy()
+
+
+# --- CONSTRUÇÃO E PERSISTÊNCIA ---
+
+def build_stream_index(fdir, acc, dirmap, affine, crs, dem=None, min_threshold=STREAM_INDEX_MIN_THRESHOLD):
+    """
+    Constrói o índice a partir da direção (códigos do `dirmap`) e da
+    acumulação de fluxo (arrays, Rasters ou memmaps). `dem` (opcional) é
+    usado na declividade dos trechos.
+    """
+    shape = np.shape(acc)
+    # Seleção em faixas de linhas: memmaps do modo em blocos não são lidos inteiros
+    step = max(1, _SELECTION_CELLS // shape[1])
+    cells, values = [], []
+    for row_off in range(0, shape[0], step):
+        band = np.asarray(acc[row_off:row_off + step])
+        band_cells = np.flatnonzero(band > min_threshold)
+        cells.append(band_cells + row_off * shape[1])
+        values.append(band.reshape(-1)[band_cells].astype(np.float64))
+    cells, values = np.concatenate(cells), np.concatenate(values)
+    order = np.argsort(-values, kind='stable')
+    cells, values = cells[order], values[order]
+
+    # Célula de jusante pelo código D8
+    codes = np.asarray(fdir).reshape(-1)[cells]
+    dirmap = np.asarray(dirmap)
+    k = np.argmax(codes[:, None] == dirmap[None, :], axis=1)
+    has_dir = np.isin(codes, dirmap)
+    rows, cols = np.divmod(cells, shape[1])
+    down_rows, down_cols = rows + D8_ROW_OFFSETS[k], cols + D8_COL_OFFSETS[k]
+    # Como em `grid.extract_river_network`, células da borda do MDE encerram o trecho
+    interior = (rows > 0) & (rows < shape[0] - 1) & (cols > 0) & (cols < shape[1] - 1)
+    inside = (has_dir & interior & (down_rows >= 0) & (down_rows < shape[0])
+              & (down_cols >= 0) & (down_cols < shape[1]))
+    down_cells = np.where(inside, down_rows * shape[1] + down_cols, -1)
+
+    # Posição da célula de jusante no índice (-1 se não estiver nele)
+    down = np.full(len(cells), -1, dtype=np.int64)
+    if len(cells):
+        by_cell = np.argsort(cells)
+        pos = np.minimum(np.searchsorted(cells, down_cells, sorter=by_cell), len(cells) - 1)
+        found = inside & (cells[by_cell[pos]] == down_cells)
+        down[found] = by_cell[pos[found]]
+    # Acumulação estritamente crescente para jusante: descarta ciclos/empates anômalos
+    down[down >= np.arange(len(cells))] = -1
+
+    elevation = (np.asarray(dem).reshape(-1)[cells].astype(np.float64) if dem is not None
+                 else np.full(len(cells), np.nan))
+    return {
+        'cells': cells, 'acc': values, 'down': down, 'dem': elevation,
+        'shape': np.asarray(shape, dtype=np.int64), 'affine': np.asarray(tuple(affine)[:6], dtype=np.float64),
+        'crs_wkt': CRS.from_user_input(crs).to_wkt() if crs is not None else '',
+        'min_threshold': float(min_threshold), 'version': INDEX_FORMAT_VERSION,
+    }
+
+
+def save_stream_index(index, path):
+    """Grava o índice em .npz."""
+    np.savez(path, **{key: np.asarray(value) for key, value in index.items()})
+    return path
+
+
+def load_stream_index(path):
+    """Lê um índice gravado por `save_stream_index`."""
+    with np.load(path) as data:
+        index = {key: data[key] for key in data.files}
+    if int(index['version']) != INDEX_FORMAT_VERSION:
+        raise ValueError(f"Índice da rede '{path}' em formato incompatível; refaça o pré-processamento.")
+    index['crs_wkt'] = str(index['crs_wkt'])
+    index['min_threshold'] = float(index['min_threshold'])
+    return index
+
+
+# --- CONSULTAS POR LIMIAR ---
+
+def _select(index, threshold, within=None):
+    """Posições do índice com acumulação > limiar (e dentro de `within`) e ponteiros remapeados."""
+    if threshold < index['min_threshold']:
+        raise ValueError(f"Limiar {threshold} menor que o limiar mínimo do índice ({index['min_threshold']:g}).")
+    count = np.searchsorted(-index['acc'], -threshold, side='left')
+    selected = np.arange(count)
+    down = index['down'][:count]
+    if within is not None:
+        keep = np.asarray(within, dtype=bool).reshape(-1)[index['cells'][:count]]
+        selected = selected[keep]
+        new_position = np.cumsum(keep) - 1
+        down = down[keep]
+        valid = down >= 0
+        valid[valid] = keep[down[valid]]
+        down = np.where(valid, new_position[np.where(valid, down, 0)], -1)
+    return selected, down
+
+
+def _reach_vertices(reach, end_down, n_reaches):
+    """
+    Vértices de cada trecho, de montante para jusante, mais a célula de
+    jusante (confluência). Retorna (trecho e posição de cada vértice, número de
+    vértices por trecho, trechos com ao menos 2 vértices, que viram linhas).
+    """
+    positions = np.arange(len(reach))
+    tail = np.flatnonzero(end_down >= 0)
+    vertex_reach = np.concatenate([reach, tail])
+    vertex_position = np.concatenate([positions, end_down[tail]])
+    rank = np.concatenate([-positions, np.ones(len(tail), dtype=np.int64)])
+    sort = np.lexsort((rank, vertex_reach))
+    counts = np.bincount(vertex_reach, minlength=n_reaches)
+    return vertex_reach[sort], vertex_position[sort], counts, counts >= 2
+
+
+def reach_cells(index, threshold, within=None):
+    """
+    Células de canal (índice plano no MDE) e o trecho de cada uma, numerado
+    como as linhas de `network_for_threshold` com os mesmos argumentos
+    (posição na rede). Células de trechos sem linha recebem -1.
+    """
+    selected, down = _select(index, threshold, within)
+    if len(selected) == 0:
+        return index['cells'][selected], np.empty(0, dtype=np.int64)
+    reach, head, end_down, _ = _split_reaches(down)
+    _, _, _, lines = _reach_vertices(reach, end_down, len(head))
+    line_id = np.where(lines, np.cumsum(lines) - 1, -1)
+    return index['cells'][selected], line_id[reach]
+
+
+def stream_mask(index, threshold, within=None):
+    """Máscara booleana (forma do MDE) das células com acumulação > limiar."""
+    selected, _ = _select(index, threshold, within)
+    mask = np.zeros(int(np.prod(index['shape'])), dtype=bool)
+    mask[index['cells'][selected]] = True
+    return mask.reshape(tuple(index['shape']))
+
+
+def network_for_threshold(index, threshold, within=None):
+    """
+    Rede de drenagem para `threshold`, com as mesmas colunas de
+    `network_to_geodataframe` (strahler_order, acumulacao, comprimento_m,
+    declividade). `within` (máscara na forma do MDE) restringe a rede, por
+    exemplo, a uma bacia. Retorna None se não houver trechos.
+    """
+    selected, down = _select(index, threshold, within)
+    if len(selected) == 0:
+        return None
+    reach, head, end_down, order = _split_reaches(down)
+    vertex_reach, vertex_position, counts, lines = _reach_vertices(reach, end_down, len(head))
+    keep_vertex = lines[vertex_reach]
+    vertex_reach, vertex_position = vertex_reach[keep_vertex], vertex_position[keep_vertex]
+    counts = counts[lines]
+    if counts.size == 0:
+        return None
+
+    # Coordenadas no mesmo referencial de `grid.extract_river_network` (canto da célula)
+    affine = Affine(*index['affine'])
+    rows, cols = np.divmod(index['cells'][selected[vertex_position]], int(index['shape'][1]))
+    xs = affine.a * cols + affine.b * rows + affine.c
+    ys = affine.d * cols + affine.e * rows + affine.f
+    flat = np.column_stack([xs, ys])
+    crs = CRS.from_wkt(index['crs_wkt']) if index['crs_wkt'] else None
+
+    ends = np.cumsum(counts) - 1
+    starts = ends - counts + 1
+    start_cell, end_cell = selected[vertex_position[starts]], selected[vertex_position[ends]]
+    length = line_lengths(flat, counts, crs)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        drop = index['dem'][start_cell] - index['dem'][end_cell]
+        slope = np.where(length > 0, np.maximum(drop, 0.0) / length, np.nan)
+
+    geometries = shapely.linestrings(flat, indices=np.repeat(np.arange(len(counts)), counts))
+    columns = {
+        'strahler_order': pd.array(order[lines], dtype='Int64'),
+        'acumulacao': index['acc'][start_cell],
+        'comprimento_m': length,
+        'declividade': slope,
+    }
+    return gpd.GeoDataFrame(columns, geometry=geometries, crs=crs)
+
+
+def write_network(index, threshold, path, within=None):
+    """Grava a rede de `threshold` em GeoJSON; retorna o caminho ou None se não houver trechos."""
+    streams_gdf = network_for_threshold(index, threshold, within=within)
+    if streams_gdf is None:
+        return None
+    streams_gdf.to_file(path, driver='GeoJSON')
+    return path
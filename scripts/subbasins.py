@@ -0,0 +1,282 @@
+"""
+Rotulagem hierárquica de sub-bacias em uma única passada.
+
+Em vez de uma chamada a `grid.catchment` por exutório, toda a rede de
+drenagem é dividida em trechos (entre nascentes, confluências e exutórios) e
+cada célula do MDE recebe o rótulo do trecho para onde drena, em duas
+varreduras lineares da árvore de direções de fluxo:
+
+1. ordem topológica (de montante para jusante) das células; nessa ordem, cada
+   célula de canal abre um novo trecho quando é nascente ou confluência
+   (número de células de canal a montante diferente de 1) e propaga o rótulo
+   para a célula de jusante;
+2. na ordem inversa, cada célula de encosta herda o rótulo da célula de
+   jusante, isto é, do primeiro trecho que encontra.
+
+Como os trechos são numerados na ordem topológica, todo trecho de montante
+tem rótulo menor que o de jusante; atributos acumulados (área de montante,
+ordem de Strahler) são obtidos percorrendo os rótulos em ordem crescente.
+
+Qualquer bacia com exutório no fim de um trecho é a união da sub-bacia do
+trecho com todas as sub-bacias a montante (`upstream_subbasins`,
+`assemble_basin`), sem novo traçado no grid.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from numba import njit
+
+from scripts.local_analysis_helpers import load_preprocessing_results
+from scripts.polygonize import polygonize_labels
+from scripts.profiling import stage
+from scripts.raster_grid import D8_ROW_OFFSETS, D8_COL_OFFSETS, cell_sizes_m
+from scripts.raster_output import write_cog, DEFAULT_COMPRESSION
+
+
+SUBBASIN_DTYPE, SUBBASIN_NODATA = np.uint32, 0
+
+
+# --- KERNEL NUMBA ---
+
+@njit(cache=True)
+def _label_subbasins(fdir, streams, valid, dirmap, row_offsets, col_offsets):
+    """
+    Retorna (rótulos por célula, rótulo de jusante de cada trecho, célula de
+    exutório de cada trecho). Os vetores por trecho têm índice = rótulo - 1.
+    """
+    rows, cols = fdir.shape
+    n = rows * cols
+    down = np.full(n, -1, dtype=np.int64)
+    indegree = np.zeros(n, dtype=np.int32)
+    stream_inflow = np.zeros(n, dtype=np.int32)
+
+    for r in range(rows):
+        for c in range(cols):
+            if not valid[r, c]:
+                continue
+            code = fdir[r, c]
+            for k in range(8):
+                if dirmap[k] == code:
+                    rr = r + row_offsets[k]
+                    cc = c + col_offsets[k]
+                    if 0 <= rr < rows and 0 <= cc < cols and valid[rr, cc]:
+                        d = rr * cols + cc
+                        down[r * cols + c] = d
+                        indegree[d] += 1
+                        if streams[r, c] and streams[rr, cc]:
+                            stream_inflow[d] += 1
+                    break
+
+    # Ordem topológica (Kahn): nascentes da árvore de fluxo primeiro
+    order = np.empty(n, dtype=np.int64)
+    head = 0
+    tail = 0
+    for i in range(n):
+        if indegree[i] == 0 and valid[i // cols, i % cols]:
+            order[tail] = i
+            tail += 1
+    while head < tail:
+        d = down[order[head]]
+        head += 1
+        if d >= 0:
+            indegree[d] -= 1
+            if indegree[d] == 0:
+                order[tail] = d
+                tail += 1
+
+    flat_streams = streams.ravel()
+    labels = np.zeros(n, dtype=np.int64)
+    outlet_cell = np.empty(n, dtype=np.int64)
+    outlet_down = np.empty(n, dtype=np.int64)
+    n_labels = 0
+    for t in range(tail):
+        u = order[t]
+        if not flat_streams[u]:
+            continue
+        if stream_inflow[u] != 1:
+            outlet_cell[n_labels] = -1
+            n_labels += 1
+            labels[u] = n_labels
+        d = down[u]
+        if d >= 0 and flat_streams[d] and stream_inflow[d] == 1:
+            labels[d] = labels[u]
+        else:
+            outlet_cell[labels[u] - 1] = u
+            outlet_down[labels[u] - 1] = d
+
+    # Encostas herdam o rótulo do primeiro trecho a jusante
+    for t in range(tail - 1, -1, -1):
+        u = order[t]
+        if not flat_streams[u] and down[u] >= 0:
+            labels[u] = labels[down[u]]
+
+    parent = np.zeros(n_labels, dtype=np.int64)
+    for i in range(n_labels):
+        d = outlet_down[i]
+        if d >= 0 and flat_streams[d]:
+            parent[i] = labels[d]
+    return labels.reshape(rows, cols), parent, outlet_cell[:n_labels].copy()
+
+
+# --- TOPOLOGIA ---
+
+def label_subbasins(fdir, streams, dirmap, valid=None):
+    """
+    Rotula todas as sub-bacias da rede `streams` (máscara booleana) a partir da
+    direção de fluxo `fdir` (códigos do `dirmap`). Células sem direção válida
+    (planos, fossos, sem dado) terminam o fluxo.
+
+    Retorna (rótulos, jusante, exutório): raster de rótulos (0 = fora de
+    qualquer sub-bacia), rótulo de jusante de cada trecho (0 = exutório da
+    rede) e índice linear da célula de exutório de cada trecho.
+    """
+    fdir = np.asarray(fdir, dtype=np.int64)
+    streams = np.asarray(streams, dtype=bool)
+    valid = np.ones(fdir.shape, dtype=bool) if valid is None else np.asarray(valid, dtype=bool)
+    return _label_subbasins(fdir, streams & valid, valid, np.asarray(dirmap, dtype=np.int64),
+                            D8_ROW_OFFSETS, D8_COL_OFFSETS)
+
+
+def subbasin_topology(labels, parent, outlet_cell, acc=None):
+    """
+    Tabela de topologia (um registro por sub-bacia, `sub_bacia_id` = rótulo):
+    `jusante_id`, `montante_ids` (lista separada por vírgula), `n_celulas`,
+    `celulas_montante` (inclui as sub-bacias a montante), `ordem_strahler` e,
+    com `acc`, `acumulacao` no exutório do trecho.
+    """
+    n_labels = len(parent)
+    ids = np.arange(1, n_labels + 1)
+    n_cells = np.bincount(np.asarray(labels).ravel(), minlength=n_labels + 1)[1:]
+
+    # Trechos de montante têm rótulos menores: acumula em ordem crescente
+    upstream_cells = n_cells.astype(np.int64).copy()
+    strahler = np.ones(n_labels, dtype=np.int64)
+    max_child = np.zeros(n_labels + 1, dtype=np.int64)
+    n_max_child = np.zeros(n_labels + 1, dtype=np.int64)
+    for i in range(n_labels):
+        if max_child[i + 1] > 0:
+            strahler[i] = max_child[i + 1] + (1 if n_max_child[i + 1] > 1 else 0)
+        p = parent[i]
+        if p > 0:
+            upstream_cells[p - 1] += upstream_cells[i]
+            if strahler[i] > max_child[p]:
+                max_child[p], n_max_child[p] = strahler[i], 1
+            elif strahler[i] == max_child[p]:
+                n_max_child[p] += 1
+
+    children = pd.Series(ids[parent > 0]).groupby(parent[parent > 0]).agg(lambda s: ','.join(map(str, s)))
+    topology = pd.DataFrame({
+        'sub_bacia_id': ids,
+        'jusante_id': parent,
+        'montante_ids': pd.Series(ids).map(children).fillna('').to_numpy(),
+        'n_celulas': n_cells,
+        'celulas_montante': upstream_cells,
+        'ordem_strahler': strahler,
+    })
+    if acc is not None:
+        topology['acumulacao'] = np.asarray(acc).ravel()[outlet_cell]
+    return topology
+
+
+def upstream_subbasins(topology, sub_bacia_id):
+    """Rótulos da sub-bacia `sub_bacia_id` e de todas as sub-bacias a montante."""
+    parent = topology.set_index('sub_bacia_id')['jusante_id']
+    if sub_bacia_id not in parent.index:
+        raise ValueError(f"Sub-bacia {sub_bacia_id} não encontrada.")
+    # Rótulos de montante são menores: uma varredura decrescente a partir do id basta
+    selected = {int(sub_bacia_id)}
+    for label in range(int(sub_bacia_id) - 1, 0, -1):
+        if parent.get(label, 0) in selected:
+            selected.add(label)
+    return sorted(selected)
+
+
+def assemble_basin(subbasins_gdf, sub_bacia_id):
+    """
+    Bacia com exutório no fim do trecho `sub_bacia_id`: união das sub-bacias
+    a montante, sem novo traçado no grid. Retorna um GeoDataFrame de uma linha.
+    """
+    ids = upstream_subbasins(subbasins_gdf, sub_bacia_id)
+    parts = subbasins_gdf[subbasins_gdf['sub_bacia_id'].isin(ids)]
+    geometry = shapely.union_all(parts.geometry.to_numpy())
+    return gpd.GeoDataFrame({'sub_bacia_id': [int(sub_bacia_id)], 'n_sub_bacias': [len(ids)]},
+                            geometry=[geometry], crs=subbasins_gdf.crs)
+
+
+# --- ETAPA COMPLETA ---
+
+def _cell_area_km2(affine, crs, shape):
+    """Área de cada linha de células (km²): constante em CRS projetado, função da latitude em geográfico."""
+    widths, height = cell_sizes_m(affine, crs, shape[0])
+    return widths * height / 1e6
+
+
+def run_subbasin_labelling(preproc_data, stream_threshold, output_dir, progress_callback,
+                           compression=DEFAULT_COMPRESSION, overviews=True):
+    """
+    Rotula todas as sub-bacias da rede de drenagem (acumulação >
+    `stream_threshold`) em uma passada e grava:
+
+    - `sub_bacias.tif`: raster de rótulos (uint32, 0 = sem sub-bacia);
+    - `sub_bacias.geojson`: um polígono por sub-bacia com a topologia
+      (`jusante_id`, `montante_ids`), áreas incremental e de montante (km²) e
+      ordem de Strahler.
+    """
+    results = {}
+    if 'grid' not in preproc_data:
+        progress_callback("Carregando rasters do pré-processamento em blocos...", 5)
+        with stage(progress_callback, 'load_preprocessing'):
+            preproc_data = load_preprocessing_results(preproc_data)
+
+    grid = preproc_data['grid']
+    affine, crs = grid.viewfinder.affine, grid.viewfinder.crs
+    fdir, acc = preproc_data['fdir'], preproc_data['acc']
+    dem = preproc_data['inflated_dem']
+    valid = np.isfinite(np.asarray(dem))
+    if dem.nodata is not None and np.isfinite(dem.nodata):
+        valid &= np.asarray(dem) != dem.nodata
+
+    progress_callback("Rotulando sub-bacias em todas as confluências...", 20)
+    with stage(progress_callback, 'label_subbasins'):
+        streams = np.asarray(acc) > stream_threshold
+        labels, parent, outlet_cell = label_subbasins(fdir, streams, preproc_data['dirmap'], valid=valid)
+    if len(parent) == 0:
+        raise RuntimeError(f"Nenhum canal com acumulação > {stream_threshold} encontrado.")
+
+    progress_callback("Calculando topologia das sub-bacias...", 45)
+    with stage(progress_callback, 'topology'):
+        topology = subbasin_topology(labels, parent, outlet_cell, acc=acc)
+        row_area = _cell_area_km2(affine, crs, labels.shape)
+        area = np.bincount(labels.ravel(), weights=np.broadcast_to(row_area[:, None], labels.shape).ravel(),
+                           minlength=len(parent) + 1)[1:]
+        topology.insert(4, 'area_km2', area)
+        upstream_area = area.copy()
+        for i, p in enumerate(parent):
+            if p > 0:
+                upstream_area[p - 1] += upstream_area[i]
+        topology.insert(5, 'area_montante_km2', upstream_area)
+
+    os.makedirs(output_dir, exist_ok=True)
+    progress_callback("Salvando raster de sub-bacias...", 60)
+    sub_bacias_raster_path = os.path.join(output_dir, 'sub_bacias.tif')
+    with stage(progress_callback, 'write_rasters'):
+        write_cog(sub_bacias_raster_path, labels.astype(SUBBASIN_DTYPE),
+                  {'crs': crs, 'transform': affine, 'nodata': SUBBASIN_NODATA},
+                  compression=compression, overviews=overviews, resampling='nearest')
+    results['sub_bacias_raster_path'] = sub_bacias_raster_path
+
+    progress_callback("Vetorizando sub-bacias...", 75)
+    with stage(progress_callback, 'polygonize'):
+        polygons = polygonize_labels(labels, affine, crs, column='sub_bacia_id')
+    subbasins_gdf = gpd.GeoDataFrame(topology.merge(polygons, on='sub_bacia_id', how='inner'),
+                                     geometry='geometry', crs=crs)
+    sub_bacias_path = os.path.join(output_dir, 'sub_bacias.geojson')
+    subbasins_gdf.to_file(sub_bacias_path, driver='GeoJSON')
+    results['sub_bacias_path'] = sub_bacias_path
+    results['n_sub_bacias'] = len(subbasins_gdf)
+
+    progress_callback("Sub-bacias concluídas.", 100)
+    return results
@@ -0,0 +1,269 @@
+"""
+Derivadas do terreno calculadas em uma única passada sobre o MDE condicionado.
+
+Um kernel numba percorre cada célula uma vez, lê a vizinhança 3x3 e grava
+diretamente (float32) apenas as saídas selecionadas:
+
+- slope: declividade em graus;
+- aspect: orientação em graus (0-360, -1 em áreas planas), calculada com o
+  gradiente em unidades de célula, como no notebook original;
+- twi: índice de umidade topográfica, ln(área de contribuição / tan(declividade));
+- hillshade: sombreamento (0-255) para iluminação com azimute/altitude dados;
+- plan_curvature / profile_curvature: curvaturas plana e de perfil
+  (Zevenbergen & Thorne, 1987), em 1/unidade do mapa.
+
+O gradiente pode ser calculado por diferenças centrais (método 'zt',
+Zevenbergen & Thorne, equivalente a `np.gradient`, inclusive as diferenças
+laterais na borda do MDE) ou pelo operador de Horn (1981, método 'horn').
+
+O MDE é processado em blocos com borda de 1 célula, de modo que a memória
+extra é limitada ao tamanho do bloco, e cada saída é gravada em GeoTIFF
+conforme os blocos são concluídos.
+"""
+import os
+from contextlib import ExitStack
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from numba import njit
+
+from scripts.raster_output import open_cog, DEFAULT_COMPRESSION
+
+
+DERIVATIVE_OUTPUTS = ('slope', 'aspect', 'twi', 'hillshade', 'plan_curvature', 'profile_curvature')
+DEFAULT_OUTPUTS = ('aspect', 'slope', 'twi')
+OUTPUT_FILES = {
+    'slope': 'slope.tif',
+    'aspect': 'aspect.tif',
+    'twi': 'twi.tif',
+    'hillshade': 'hillshade.tif',
+    'plan_curvature': 'curvatura_plana.tif',
+    'profile_curvature': 'curvatura_perfil.tif',
+}
+OUTPUT_NODATA = {
+    'slope': -9999.0,
+    'aspect': -1.0,
+    'twi': -9999.0,
+    'hillshade': -9999.0,
+    'plan_curvature': -9999.0,
+    'profile_curvature': -9999.0,
+}
+METHODS = ('zt', 'horn')
+DEFAULT_TILE_SIZE = 1024
+
+
+# --- KERNEL NUMBA ---
+
+@njit(cache=True)
+def _derivatives_kernel(dem, valid, acc, r0, c0, h, w, x_res, y_res, horn, azimuth, altitude, flags, nodata,
+                        slope_out, aspect_out, twi_out, hillshade_out, plan_out, profile_out):
+    """
+    Calcula as derivadas das `h` x `w` células do núcleo (a partir de `r0`, `c0`)
+    de uma janela do MDE com borda. `flags` segue a ordem de DERIVATIVE_OUTPUTS;
+    saídas desligadas não são escritas.
+    """
+    rows, cols = dem.shape
+    cell_area = x_res * y_res
+    tan_flat = np.tan(0.001)
+    sin_alt = np.sin(np.radians(altitude))
+    cos_alt = np.cos(np.radians(altitude))
+    sin_az = np.sin(np.radians(azimuth))
+    cos_az = np.cos(np.radians(azimuth))
+    need_curvature = flags[4] or flags[5]
+
+    for i in range(h):
+        r = r0 + i
+        for j in range(w):
+            c = c0 + j
+            if not valid[r, c]:
+                if flags[0]:
+                    slope_out[i, j] = nodata[0]
+                if flags[1]:
+                    aspect_out[i, j] = nodata[1]
+                if flags[2]:
+                    twi_out[i, j] = nodata[2]
+                if flags[3]:
+                    hillshade_out[i, j] = nodata[3]
+                if flags[4]:
+                    plan_out[i, j] = nodata[4]
+                if flags[5]:
+                    profile_out[i, j] = nodata[5]
+                continue
+
+            # Vizinhos fora do MDE ou sem dado assumem a cota central
+            z5 = dem[r, c]
+            up, down = r > 0, r < rows - 1
+            left, right = c > 0, c < cols - 1
+            has_n = up and valid[r - 1, c]
+            has_s = down and valid[r + 1, c]
+            has_w = left and valid[r, c - 1]
+            has_e = right and valid[r, c + 1]
+            zn = dem[r - 1, c] if has_n else z5
+            zs = dem[r + 1, c] if has_s else z5
+            zw = dem[r, c - 1] if has_w else z5
+            ze = dem[r, c + 1] if has_e else z5
+            znw = dem[r - 1, c - 1] if up and left and valid[r - 1, c - 1] else z5
+            zne = dem[r - 1, c + 1] if up and right and valid[r - 1, c + 1] else z5
+            zsw = dem[r + 1, c - 1] if down and left and valid[r + 1, c - 1] else z5
+            zse = dem[r + 1, c + 1] if down and right and valid[r + 1, c + 1] else z5
+
+            # Gradiente em unidades de célula: gx = dz/dcoluna, gy = dz/dlinha
+            if horn:
+                gx = ((zne + 2.0 * ze + zse) - (znw + 2.0 * zw + zsw)) / 8.0
+                gy = ((zsw + 2.0 * zs + zse) - (znw + 2.0 * zn + zne)) / 8.0
+            else:
+                if has_e and has_w:
+                    gx = (ze - zw) / 2.0
+                elif has_e:
+                    gx = ze - z5
+                elif has_w:
+                    gx = z5 - zw
+                else:
+                    gx = 0.0
+                if has_s and has_n:
+                    gy = (zs - zn) / 2.0
+                elif has_s:
+                    gy = zs - z5
+                elif has_n:
+                    gy = z5 - zn
+                else:
+                    gy = 0.0
+
+            dzdx = gx / x_res
+            dzdy = gy / y_res
+            tan_slope = np.sqrt(dzdx * dzdx + dzdy * dzdy)
+
+            if flags[0]:
+                slope_out[i, j] = np.degrees(np.arctan(tan_slope))
+            if flags[1]:
+                if gx == 0.0 and gy == 0.0:
+                    aspect_out[i, j] = -1.0
+                else:
+                    aspect = np.degrees(np.arctan2(gy, -gx))
+                    aspect_out[i, j] = aspect + 360.0 if aspect < 0.0 else aspect
+            if flags[2]:
+                a = acc[i, j]
+                if np.isnan(a):
+                    twi_out[i, j] = nodata[2]
+                else:
+                    if tan_slope == 0.0:
+                        tan_slope = tan_flat  # Evitar divisão por zero
+                    twi_out[i, j] = np.log((a + 1.0) * cell_area / tan_slope)
+            if flags[3]:
+                # Normal da superfície com x para leste e y para norte
+                p = dzdx
+                q = -dzdy
+                shade = (sin_alt - cos_alt * (p * sin_az + q * cos_az)) / np.sqrt(1.0 + p * p + q * q)
+                hillshade_out[i, j] = 255.0 * shade if shade > 0.0 else 0.0
+            if need_curvature:
+                d = ((zw + ze) / 2.0 - z5) / (x_res * x_res)
+                e = ((zn + zs) / 2.0 - z5) / (y_res * y_res)
+                f = (-znw + zne + zsw - zse) / (4.0 * x_res * y_res)
+                g = (ze - zw) / (2.0 * x_res)
+                hh = (zn - zs) / (2.0 * y_res)
+                den = g * g + hh * hh
+                if den == 0.0:
+                    plan, profile = 0.0, 0.0
+                else:
+                    profile = -2.0 * (d * g * g + e * hh * hh + f * g * hh) / den
+                    plan = 2.0 * (d * hh * hh + e * g * g - f * g * hh) / den
+                if flags[4]:
+                    plan_out[i, j] = plan
+                if flags[5]:
+                    profile_out[i, j] = profile
+
+
+# --- FUNÇÕES PÚBLICAS ---
+
+def _validate(outputs, method, acc):
+    outputs = tuple(dict.fromkeys(outputs))
+    unknown = [name for name in outputs if name not in DERIVATIVE_OUTPUTS]
+    if unknown:
+        raise ValueError(f"Derivadas desconhecidas: {unknown}. Opções: {DERIVATIVE_OUTPUTS}.")
+    if method not in METHODS:
+        raise ValueError(f"Método de gradiente '{method}' inválido. Opções: {METHODS}.")
+    if 'twi' in outputs and acc is None:
+        raise ValueError("O TWI requer o raster de acumulação de fluxo.")
+    return outputs
+
+
+def _valid_mask(values, nodata, nodata_mask):
+    if nodata_mask is not None:
+        return ~np.asarray(nodata_mask, dtype=bool)
+    valid = np.isfinite(values)
+    if nodata is not None and not np.isnan(nodata):
+        valid &= values != nodata
+    return valid
+
+
+def _run_kernel(window_dem, valid, acc_core, r0, c0, h, w, x_res, y_res, outputs, method, azimuth, altitude):
+    """Executa o kernel em uma janela e retorna {nome: array float32 (h, w)}."""
+    flags = np.array([name in outputs for name in DERIVATIVE_OUTPUTS])
+    nodata = np.array([OUTPUT_NODATA[name] for name in DERIVATIVE_OUTPUTS])
+    dummy = np.empty((0, 0), dtype=np.float32)
+    arrays = [np.empty((h, w), dtype=np.float32) if flag else dummy for flag in flags]
+    if acc_core is None:
+        acc_core = np.empty((0, 0), dtype=np.float64)
+    _derivatives_kernel(window_dem, valid, acc_core, r0, c0, h, w, float(x_res), float(y_res), method == 'horn',
+                        float(azimuth), float(altitude), flags, nodata, *arrays)
+    return {name: array for name, array, flag in zip(DERIVATIVE_OUTPUTS, arrays, flags) if flag}
+
+
+def compute_terrain_derivatives(dem, x_res, y_res, outputs=DEFAULT_OUTPUTS, acc=None, nodata=None,
+                                method='zt', azimuth=315.0, altitude=45.0):
+    """
+    Calcula as derivadas selecionadas em memória, em uma única passada.
+    Retorna {nome: array float32}; células sem dado recebem OUTPUT_NODATA.
+    """
+    outputs = _validate(outputs, method, acc)
+    dem = np.asarray(dem, dtype=np.float64)
+    valid = _valid_mask(dem, nodata, None)
+    acc_core = None if acc is None else np.asarray(acc, dtype=np.float64)
+    return _run_kernel(dem, valid, acc_core, 0, 0, dem.shape[0], dem.shape[1], x_res, y_res, outputs, method,
+                       azimuth, altitude)
+
+
+def write_terrain_derivatives(dem, profile, output_dir, outputs=DEFAULT_OUTPUTS, acc=None, nodata=None,
+                              nodata_mask=None, method='zt', azimuth=315.0, altitude=45.0,
+                              tile_size=DEFAULT_TILE_SIZE, compression=DEFAULT_COMPRESSION, overviews=True):
+    """
+    Calcula as derivadas selecionadas bloco a bloco e grava um COG float32 por
+    saída em `output_dir` (ver `scripts/raster_output.py`).
+
+    `dem`, `acc` e `nodata_mask` podem ser arrays em memória ou memmaps (apenas
+    o bloco atual, com borda de 1 célula, é lido). `profile` deve conter `crs` e
+    `transform`. Retorna {'<nome>_path': caminho}.
+    """
+    outputs = _validate(outputs, method, acc)
+    height, width = dem.shape
+    transform = profile['transform']
+    x_res = transform[0]
+    y_res = -transform[4]  # É negativo na affine
+
+    out_profile = {'crs': profile['crs'], 'transform': transform, 'height': height, 'width': width,
+                   'count': 1, 'dtype': rasterio.float32}
+    paths = {name: os.path.join(output_dir, OUTPUT_FILES[name]) for name in outputs}
+    with ExitStack() as stack:
+        datasets = {name: stack.enter_context(open_cog(path, {**out_profile, 'nodata': OUTPUT_NODATA[name]},
+                                                       compression=compression, overviews=overviews))
+                    for name, path in paths.items()}
+        for row_off in range(0, height, tile_size):
+            h = min(tile_size, height - row_off)
+            for col_off in range(0, width, tile_size):
+                w = min(tile_size, width - col_off)
+                r_start, r_stop = max(row_off - 1, 0), min(row_off + h + 1, height)
+                c_start, c_stop = max(col_off - 1, 0), min(col_off + w + 1, width)
+                window_dem = np.asarray(dem[r_start:r_stop, c_start:c_stop], dtype=np.float64)
+                window_mask = None if nodata_mask is None else nodata_mask[r_start:r_stop, c_start:c_stop]
+                valid = _valid_mask(window_dem, nodata, window_mask)
+                acc_core = None
+                if 'twi' in outputs:
+                    acc_core = np.asarray(acc[row_off:row_off + h, col_off:col_off + w], dtype=np.float64)
+
+                blocks = _run_kernel(window_dem, valid, acc_core, row_off - r_start, col_off - c_start, h, w,
+                                     x_res, y_res, outputs, method, azimuth, altitude)
+                out_window = Window(col_off, row_off, w, h)
+                for name, block in blocks.items():
+                    datasets[name].write(block, 1, window=out_window)
+
+    return {f"{name}_path": path for name, path in paths.items()}
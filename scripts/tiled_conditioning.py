@@ -0,0 +1,768 @@
+"""
+Pré-processamento hidrológico do MDE em blocos (out-of-core).
+
+Permite condicionar o MDE e calcular direção/acumulação de fluxo para rasters
+maiores que a memória RAM. O MDE é lido em janelas e os resultados
+intermediários ficam em arquivos mapeados em disco (np.memmap), de modo que
+apenas um bloco (mais uma borda de 1 célula) fica em memória por vez.
+
+Etapas:
+1. Priority-Flood com rótulos em cada bloco: cada célula do perímetro do bloco
+   é uma semente com rótulo próprio e as ligações entre rótulos registram a
+   cota de transbordamento (Barnes et al., 2016);
+2. Junção dos grafos dos blocos pelas costuras e Priority-Flood no grafo global,
+   obtendo a cota de transbordamento de cada rótulo a partir da borda do MDE;
+3. Elevação final de cada célula para a cota de transbordamento do seu rótulo;
+4. Distância (em células) até a saída de cada área plana, propagada entre
+   blocos até convergir, usada para direcionar o fluxo nas áreas planas;
+5. Direção de fluxo D8 por bloco;
+6. Acumulação por bloco, com a vazão que atravessa as costuras resolvida em um
+   grafo de células de saída (Barnes, 2017);
+7. Índice da rede de drenagem por limiar (`scripts/stream_index.py`), a partir
+   do qual a rede total é vetorizada sem interrupções nas costuras.
+"""
+import os
+import shutil
+import heapq
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from numba import njit, types
+from numba.typed import Dict
+
+from scripts.terrain_derivatives import write_terrain_derivatives, DEFAULT_OUTPUTS as DEFAULT_TERRAIN_OUTPUTS
+from scripts.stream_index import build_stream_index, save_stream_index, write_network, STREAM_INDEX_MIN_THRESHOLD
+from scripts.profiling import stage
+from scripts.raster_grid import DIRMAP, D8_ROW_OFFSETS, D8_COL_OFFSETS
+from scripts.raster_output import (open_cog, encode_fdir, encode_acc, DEFAULT_COMPRESSION,
+                                   FDIR_DTYPE, FDIR_NODATA, ACC_DTYPE, ACC_NODATA)
+
+
+OCEAN_LABEL = 1
+FLAT_INF = np.iinfo(np.int32).max
+DEFAULT_TILE_SIZE = 2048
+
+
+# --- KERNELS NUMBA ---
+
+@njit(cache=True)
+def _fill_tile_labels(dem, nodata_halo, global_edges, row_offsets, col_offsets):
+    """
+    Priority-Flood com rótulos em um bloco. `nodata_halo` tem 1 célula de borda
+    a mais em cada lado. `global_edges` indica (topo, base, esquerda, direita)
+    que coincidem com a borda do MDE.
+    """
+    rows, cols = dem.shape
+    filled = dem.copy()
+    labels = np.zeros((rows, cols), dtype=np.int32)
+    edges = Dict.empty(key_type=types.int64, value_type=types.float64)
+
+    heap = [(np.float64(0.0), np.int64(0), np.int64(0))]
+    heap.pop()
+    order = 0
+    next_label = 2
+
+    # Sementes: perímetro do bloco e vizinhos de nodata
+    for r in range(rows):
+        for c in range(cols):
+            if nodata_halo[r + 1, c + 1]:
+                continue
+            ocean = ((r == 0 and global_edges[0]) or (r == rows - 1 and global_edges[1]) or
+                     (c == 0 and global_edges[2]) or (c == cols - 1 and global_edges[3]))
+            if not ocean:
+                for k in range(8):
+                    if nodata_halo[r + 1 + row_offsets[k], c + 1 + col_offsets[k]]:
+                        ocean = True
+                        break
+            if ocean:
+                labels[r, c] = OCEAN_LABEL
+            elif r == 0 or r == rows - 1 or c == 0 or c == cols - 1:
+                labels[r, c] = next_label
+                next_label += 1
+            else:
+                continue
+            heapq.heappush(heap, (filled[r, c], np.int64(order), np.int64(r * cols + c)))
+            order += 1
+
+    # Fila FIFO para células preenchidas (otimização de Barnes et al., 2014)
+    pit_queue = np.empty(rows * cols, dtype=np.int64)
+    head = 0
+    tail = 0
+    while head < tail or len(heap) > 0:
+        if head < tail:
+            idx = pit_queue[head]
+            head += 1
+            if head == tail:
+                head = 0
+                tail = 0
+        else:
+            idx = heapq.heappop(heap)[2]
+        r = idx // cols
+        c = idx % cols
+        label = labels[r, c]
+        elev = filled[r, c]
+        for k in range(8):
+            nr = r + row_offsets[k]
+            nc = c + col_offsets[k]
+            if nr < 0 or nr >= rows or nc < 0 or nc >= cols:
+                continue
+            if nodata_halo[nr + 1, nc + 1]:
+                continue
+            n_label = labels[nr, nc]
+            if n_label != 0:
+                if n_label != label:
+                    a = min(label, n_label)
+                    b = max(label, n_label)
+                    key = (np.int64(a) << 32) | np.int64(b)
+                    spill = max(elev, filled[nr, nc])
+                    if key not in edges or spill < edges[key]:
+                        edges[key] = spill
+                continue
+            labels[nr, nc] = label
+            if filled[nr, nc] <= elev:
+                filled[nr, nc] = elev
+                pit_queue[tail] = nr * cols + nc
+                tail += 1
+            else:
+                heapq.heappush(heap, (filled[nr, nc], np.int64(order), np.int64(nr * cols + nc)))
+                order += 1
+
+    n_edges = len(edges)
+    edge_a = np.empty(n_edges, dtype=np.int64)
+    edge_b = np.empty(n_edges, dtype=np.int64)
+    edge_w = np.empty(n_edges, dtype=np.float64)
+    i = 0
+    for key, spill in edges.items():
+        edge_a[i] = key >> 32
+        edge_b[i] = key & 0xFFFFFFFF
+        edge_w[i] = spill
+        i += 1
+    return filled, labels, edge_a, edge_b, edge_w, next_label
+
+
+@njit(cache=True)
+def _spill_levels(n_labels, indptr, indices, weights):
+    """Priority-Flood no grafo de rótulos a partir do oceano (borda do MDE)."""
+    spill = np.full(n_labels, np.inf)
+    done = np.zeros(n_labels, dtype=np.bool_)
+    spill[OCEAN_LABEL] = -np.inf
+    heap = [(-np.inf, np.int64(OCEAN_LABEL))]
+    while len(heap) > 0:
+        level, label = heapq.heappop(heap)
+        if done[label]:
+            continue
+        done[label] = True
+        for p in range(indptr[label], indptr[label + 1]):
+            other = indices[p]
+            if done[other]:
+                continue
+            candidate = max(level, weights[p])
+            if candidate < spill[other]:
+                spill[other] = candidate
+                heapq.heappush(heap, (candidate, np.int64(other)))
+    # Rótulos sem ligação com o oceano não são elevados
+    for i in range(n_labels):
+        if not done[i]:
+            spill[i] = -np.inf
+    return spill
+
+
+@njit(cache=True)
+def _flat_distance_tile(elev, nodata, dist, r0, c0, core_rows, core_cols,
+                        row_offsets, col_offsets):
+    """
+    Distância (em células) de cada célula plana do núcleo do bloco até a borda
+    baixa da sua área plana. `elev`, `nodata` e `dist` são janelas com borda;
+    (r0, c0) é a posição do núcleo dentro da janela. Retorna a distância do núcleo.
+    """
+    rows, cols = elev.shape
+    core = np.full((core_rows, core_cols), FLAT_INF, dtype=np.int32)
+    flat = np.zeros((core_rows, core_cols), dtype=np.bool_)
+    for i in range(core_rows):
+        for j in range(core_cols):
+            wi = i + r0
+            wj = j + c0
+            if nodata[wi, wj]:
+                continue
+            e = elev[wi, wj]
+            has_lower = False
+            for k in range(8):
+                ni = wi + row_offsets[k]
+                nj = wj + col_offsets[k]
+                if ni < 0 or ni >= rows or nj < 0 or nj >= cols or nodata[ni, nj]:
+                    continue
+                if elev[ni, nj] < e:
+                    has_lower = True
+                    break
+            # Células planas na borda do MDE ou junto a nodata drenam para fora
+            on_edge = ((wi == 0 and r0 == 0) or (wi == rows - 1 and rows - r0 == core_rows) or
+                       (wj == 0 and c0 == 0) or (wj == cols - 1 and cols - c0 == core_cols))
+            if not on_edge:
+                for k in range(8):
+                    ni = wi + row_offsets[k]
+                    nj = wj + col_offsets[k]
+                    if 0 <= ni < rows and 0 <= nj < cols and nodata[ni, nj]:
+                        on_edge = True
+                        break
+            if has_lower or on_edge:
+                core[i, j] = 0
+            if not has_lower:
+                flat[i, j] = True
+
+    work = np.full((rows, cols), FLAT_INF, dtype=np.int32)
+    for i in range(rows):
+        for j in range(cols):
+            work[i, j] = dist[i, j]
+    for i in range(core_rows):
+        for j in range(core_cols):
+            work[i + r0, j + c0] = core[i, j]
+
+    heap = [(np.int64(0), np.int64(0))]
+    heap.pop()
+    for wi in range(rows):
+        for wj in range(cols):
+            d = work[wi, wj]
+            if d == FLAT_INF or nodata[wi, wj]:
+                continue
+            # Apenas sementes vizinhas de células planas do núcleo com mesma cota
+            for k in range(8):
+                ci = wi + row_offsets[k] - r0
+                cj = wj + col_offsets[k] - c0
+                if ci < 0 or ci >= core_rows or cj < 0 or cj >= core_cols:
+                    continue
+                if flat[ci, cj] and elev[ci + r0, cj + c0] == elev[wi, wj]:
+                    heapq.heappush(heap, (np.int64(d), np.int64(wi * cols + wj)))
+                    break
+
+    while len(heap) > 0:
+        d, idx = heapq.heappop(heap)
+        wi = idx // cols
+        wj = idx % cols
+        if d > work[wi, wj]:
+            continue
+        for k in range(8):
+            ci = wi + row_offsets[k] - r0
+            cj = wj + col_offsets[k] - c0
+            if ci < 0 or ci >= core_rows or cj < 0 or cj >= core_cols:
+                continue
+            if not flat[ci, cj] or elev[ci + r0, cj + c0] != elev[wi, wj]:
+                continue
+            if d + 1 < work[ci + r0, cj + c0]:
+                work[ci + r0, cj + c0] = d + 1
+                heapq.heappush(heap, (np.int64(d + 1), np.int64((ci + r0) * cols + cj + c0)))
+
+    for i in range(core_rows):
+        for j in range(core_cols):
+            core[i, j] = work[i + r0, j + c0]
+    return core
+
+
+@njit(cache=True)
+def _flowdir_tile(elev, nodata, dist, r0, c0, core_rows, core_cols, dx, dy, dirmap,
+                  row_offsets, col_offsets, flat_value, pit_value, nodata_out):
+    """Direção D8 de maior declive (mesma regra do PySheds) com saída das áreas planas."""
+    rows, cols = elev.shape
+    dd = np.sqrt(dx ** 2 + dy ** 2)
+    distances = np.array([dy, dd, dx, dd, dy, dd, dx, dd])
+    fdir = np.full((core_rows, core_cols), nodata_out, dtype=np.int16)
+    for i in range(core_rows):
+        for j in range(core_cols):
+            wi = i + r0
+            wj = j + c0
+            if nodata[wi, wj]:
+                continue
+            e = elev[wi, wj]
+            max_slope = -np.inf
+            best = -1
+            for k in range(8):
+                ni = wi + row_offsets[k]
+                nj = wj + col_offsets[k]
+                if ni < 0 or ni >= rows or nj < 0 or nj >= cols or nodata[ni, nj]:
+                    continue
+                slope = (e - elev[ni, nj]) / distances[k]
+                if slope > max_slope:
+                    max_slope = slope
+                    best = k
+            if max_slope > 0:
+                fdir[i, j] = dirmap[best]
+            elif max_slope == 0:
+                # Área plana: segue para o vizinho de mesma cota mais próximo da saída
+                best = -1
+                best_dist = dist[wi, wj]
+                for k in range(8):
+                    ni = wi + row_offsets[k]
+                    nj = wj + col_offsets[k]
+                    if ni < 0 or ni >= rows or nj < 0 or nj >= cols or nodata[ni, nj]:
+                        continue
+                    if elev[ni, nj] == e and dist[ni, nj] < best_dist:
+                        best_dist = dist[ni, nj]
+                        best = k
+                fdir[i, j] = dirmap[best] if best >= 0 else flat_value
+            else:
+                fdir[i, j] = pit_value
+    return fdir
+
+
+@njit(cache=True)
+def _tile_accumulation(fdir, valid, inflow, dirmap, row_offsets, col_offsets):
+    """
+    Acumulação D8 restrita a um bloco. Retorna a acumulação (incluindo a vazão
+    recebida de outros blocos em `inflow`), o índice da célula de saída do bloco
+    alcançada a partir de cada célula (-1 se o caminho termina dentro do bloco)
+    e o deslocamento (linha, coluna) de quem sai do bloco.
+    """
+    rows, cols = fdir.shape
+    n = rows * cols
+    down = np.full(n, -1, dtype=np.int64)
+    leave_k = np.full(n, -1, dtype=np.int64)
+    for r in range(rows):
+        for c in range(cols):
+            if not valid[r, c]:
+                continue
+            code = fdir[r, c]
+            k = -1
+            for m in range(8):
+                if dirmap[m] == code:
+                    k = m
+                    break
+            if k < 0:
+                continue
+            nr = r + row_offsets[k]
+            nc = c + col_offsets[k]
+            if nr < 0 or nr >= rows or nc < 0 or nc >= cols:
+                leave_k[r * cols + c] = k
+            elif valid[nr, nc]:
+                down[r * cols + c] = nr * cols + nc
+
+    indegree = np.zeros(n, dtype=np.int32)
+    for idx in range(n):
+        if down[idx] >= 0:
+            indegree[down[idx]] += 1
+
+    acc = np.zeros(n, dtype=np.float64)
+    topo = np.empty(n, dtype=np.int64)
+    head = 0
+    tail = 0
+    for r in range(rows):
+        for c in range(cols):
+            idx = r * cols + c
+            if valid[r, c]:
+                acc[idx] = 1.0 + inflow[r, c]
+                if indegree[idx] == 0:
+                    topo[tail] = idx
+                    tail += 1
+    while head < tail:
+        idx = topo[head]
+        head += 1
+        d = down[idx]
+        if d >= 0:
+            acc[d] += acc[idx]
+            indegree[d] -= 1
+            if indegree[d] == 0:
+                topo[tail] = d
+                tail += 1
+
+    exit_idx = np.full(n, -1, dtype=np.int64)
+    for p in range(tail - 1, -1, -1):
+        idx = topo[p]
+        if leave_k[idx] >= 0:
+            exit_idx[idx] = idx
+        elif down[idx] >= 0:
+            exit_idx[idx] = exit_idx[down[idx]]
+    return acc.reshape((rows, cols)), exit_idx, leave_k
+
+
+@njit(cache=True)
+def _accumulate_exits(values, down):
+    """Acumula valores ao longo da floresta de células de saída (ordem topológica)."""
+    n = values.size
+    acc = values.copy()
+    indegree = np.zeros(n, dtype=np.int32)
+    for i in range(n):
+        if down[i] >= 0:
+            indegree[down[i]] += 1
+    topo = np.empty(n, dtype=np.int64)
+    head = 0
+    tail = 0
+    for i in range(n):
+        if indegree[i] == 0:
+            topo[tail] = i
+            tail += 1
+    while head < tail:
+        i = topo[head]
+        head += 1
+        d = down[i]
+        if d >= 0:
+            acc[d] += acc[i]
+            indegree[d] -= 1
+            if indegree[d] == 0:
+                topo[tail] = d
+                tail += 1
+    return acc
+
+
+# --- FUNÇÕES AUXILIARES ---
+
+def iter_tiles(height, width, tile_size):
+    """Gera (linha, coluna, altura, largura) de cada bloco do raster."""
+    for row_off in range(0, height, tile_size):
+        for col_off in range(0, width, tile_size):
+            yield row_off, col_off, min(tile_size, height - row_off), min(tile_size, width - col_off)
+
+
+def _halo_bounds(row_off, col_off, h, w, height, width, halo=1):
+    """Janela do bloco expandida pela borda, limitada à extensão do MDE."""
+    r_start = max(row_off - halo, 0)
+    c_start = max(col_off - halo, 0)
+    r_stop = min(row_off + h + halo, height)
+    c_stop = min(col_off + w + halo, width)
+    return r_start, r_stop, c_start, c_stop
+
+
+def _perimeter_indices(row_off, col_off, h, w, width):
+    """Índices globais (linearizados) das células do perímetro do bloco."""
+    rr, cc = np.mgrid[0:h, 0:w]
+    on_perimeter = (rr == 0) | (rr == h - 1) | (cc == 0) | (cc == w - 1)
+    local = (rr * w + cc)[on_perimeter]
+    glob = (rr[on_perimeter] + row_off).astype(np.int64) * width + (cc[on_perimeter] + col_off)
+    return local, glob
+
+
+def _read_nodata_mask(values, nodata):
+    if nodata is None:
+        return np.zeros(values.shape, dtype=bool)
+    if np.isnan(nodata):
+        return np.isnan(values)
+    return values == nodata
+
+
+def _seam_edges(filled, labels, nodata_mask, height, width, tile_size):
+    """Ligações entre rótulos de blocos vizinhos ao longo das costuras."""
+    edge_a, edge_b, edge_w = [], [], []
+
+    def add_pairs(la, lb, ea, eb, valid):
+        keep = valid & (la != lb)
+        edge_a.append(la[keep].astype(np.int64))
+        edge_b.append(lb[keep].astype(np.int64))
+        edge_w.append(np.maximum(ea[keep], eb[keep]).astype(np.float64))
+
+    # Costuras verticais (entre colunas x-1 e x)
+    for x in range(tile_size, width, tile_size):
+        la, lb = np.asarray(labels[:, x - 1]), np.asarray(labels[:, x])
+        ea, eb = np.asarray(filled[:, x - 1]), np.asarray(filled[:, x])
+        na, nb = np.asarray(nodata_mask[:, x - 1]), np.asarray(nodata_mask[:, x])
+        for d in (-1, 0, 1):
+            a = slice(max(0, -d), height - max(0, d))
+            b = slice(max(0, d), height - max(0, -d))
+            add_pairs(la[a], lb[b], ea[a], eb[b], ~na[a] & ~nb[b])
+
+    # Costuras horizontais (entre linhas y-1 e y)
+    for y in range(tile_size, height, tile_size):
+        la, lb = np.asarray(labels[y - 1, :]), np.asarray(labels[y, :])
+        ea, eb = np.asarray(filled[y - 1, :]), np.asarray(filled[y, :])
+        na, nb = np.asarray(nodata_mask[y - 1, :]), np.asarray(nodata_mask[y, :])
+        for d in (-1, 0, 1):
+            a = slice(max(0, -d), width - max(0, d))
+            b = slice(max(0, d), width - max(0, -d))
+            add_pairs(la[a], lb[b], ea[a], eb[b], ~na[a] & ~nb[b])
+
+    if not edge_a:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float64)
+    return np.concatenate(edge_a), np.concatenate(edge_b), np.concatenate(edge_w)
+
+
+def _build_csr(n_labels, edge_a, edge_b, edge_w):
+    """Grafo não direcionado de rótulos em formato CSR."""
+    src = np.concatenate([edge_a, edge_b])
+    dst = np.concatenate([edge_b, edge_a])
+    weights = np.concatenate([edge_w, edge_w])
+    order = np.argsort(src, kind='stable')
+    indptr = np.zeros(n_labels + 1, dtype=np.int64)
+    np.add.at(indptr, src + 1, 1)
+    return np.cumsum(indptr), dst[order].astype(np.int64), weights[order]
+
+
+def _write_memmap_to_raster(array, path, profile, dtype, nodata, tile_size, fill_mask=None, encode=None,
+                            compression=DEFAULT_COMPRESSION, overviews=True, resampling='average'):
+    """
+    Escreve um memmap em COG, bloco a bloco. `encode(bloco, máscara)` converte
+    o bloco para o tipo de saída (ex.: `encode_fdir`, `encode_acc`).
+    """
+    out_profile = profile.copy()
+    out_profile.update(count=1, dtype=np.dtype(dtype).name, nodata=nodata)
+    height, width = array.shape
+    with open_cog(path, out_profile, compression=compression, overviews=overviews, resampling=resampling) as dst:
+        for row_off, col_off, h, w in iter_tiles(height, width, tile_size):
+            block = np.asarray(array[row_off:row_off + h, col_off:col_off + w])
+            mask = None if fill_mask is None else np.asarray(fill_mask[row_off:row_off + h, col_off:col_off + w])
+            if encode is not None:
+                block = encode(block, mask)
+            else:
+                block = block.astype(dtype)
+                if mask is not None:
+                    block[mask] = nodata
+            dst.write(block, 1, window=Window(col_off, row_off, w, h))
+
+
+# --- PIPELINE EM BLOCOS ---
+
+def run_tiled_preprocessing(mde_path, output_dir, stream_threshold, progress_callback,
+                            tile_size=DEFAULT_TILE_SIZE, keep_workdir=False,
+                            terrain_outputs=DEFAULT_TERRAIN_OUTPUTS, gradient_method='zt',
+                            compression=DEFAULT_COMPRESSION, overviews=True):
+    """
+    Executa a Etapa 1 (pré-processamento do MDE) em blocos, com memória limitada
+    pelo tamanho do bloco. Gera o MDE condicionado, direção e acumulação de
+    fluxo, as derivadas do terreno selecionadas em `terrain_outputs` (por padrão
+    aspect, declividade e TWI) e a rede de drenagem total.
+
+    Diferente de `run_preprocessing`, não mantém objetos PySheds em memória:
+    os resultados são apenas os caminhos dos arquivos gerados.
+    """
+    results = {}
+    dirmap = DIRMAP
+
+    progress_callback("Abrindo MDE para processamento em blocos...", 2)
+    if not os.path.exists(mde_path):
+        raise FileNotFoundError(f"Arquivo MDE '{mde_path}' não encontrado.")
+
+    work_dir = os.path.join(output_dir, '_blocos_tmp')
+    os.makedirs(work_dir, exist_ok=True)
+
+    with rasterio.open(mde_path) as src:
+        profile = src.profile.copy()
+        height, width = src.height, src.width
+        src_nodata = src.nodata
+        transform = src.transform
+        crs = src.crs
+        work_dtype = np.result_type(src.dtypes[0], np.float32)
+
+        def memmap(name, dtype, fill=None):
+            arr = np.lib.format.open_memmap(os.path.join(work_dir, f'{name}.npy'), mode='w+',
+                                            dtype=dtype, shape=(height, width))
+            if fill is not None:
+                arr[:] = fill
+            return arr
+
+        filled = memmap('filled', work_dtype)
+        labels = memmap('labels', np.int32)
+        nodata_mask = memmap('nodata', np.bool_)
+
+        # 1. Priority-Flood com rótulos em cada bloco
+        with stage(progress_callback, 'fill_depressions'):
+            tiles = list(iter_tiles(height, width, tile_size))
+            edge_a, edge_b, edge_w = [], [], []
+            next_global = 2
+            for t, (row_off, col_off, h, w) in enumerate(tiles):
+                progress_callback(f"Preenchendo depressões no bloco {t + 1}/{len(tiles)}...",
+                                  5 + int(20 * t / len(tiles)))
+                r_start, r_stop, c_start, c_stop = _halo_bounds(row_off, col_off, h, w, height, width)
+                window = Window(c_start, r_start, c_stop - c_start, r_stop - r_start)
+                values = src.read(1, window=window)
+                halo_mask = _read_nodata_mask(values, src_nodata)
+                nodata_halo = np.zeros((h + 2, w + 2), dtype=np.bool_)
+                nodata_halo[1 + r_start - row_off:1 + r_stop - row_off,
+                            1 + c_start - col_off:1 + c_stop - col_off] = halo_mask
+                core = values[row_off - r_start:row_off - r_start + h,
+                              col_off - c_start:col_off - c_start + w].astype(np.float64)
+                global_edges = np.array([row_off == 0, row_off + h == height,
+                                         col_off == 0, col_off + w == width])
+                tile_filled, tile_labels, ea, eb, ew, n_local = _fill_tile_labels(
+                    core, nodata_halo, global_edges, D8_ROW_OFFSETS, D8_COL_OFFSETS)
+
+                # Rótulos locais (>= 2) viram globais; o oceano é compartilhado
+                offset = next_global - 2
+                tile_labels = np.where(tile_labels >= 2, tile_labels + offset, tile_labels)
+                ea = np.where(ea >= 2, ea + offset, ea)
+                eb = np.where(eb >= 2, eb + offset, eb)
+                next_global += n_local - 2
+                if next_global >= np.iinfo(np.int32).max:
+                    raise ValueError("Número de rótulos excede o limite. Aumente o tamanho do bloco.")
+
+                filled[row_off:row_off + h, col_off:col_off + w] = tile_filled
+                labels[row_off:row_off + h, col_off:col_off + w] = tile_labels
+                nodata_mask[row_off:row_off + h, col_off:col_off + w] = nodata_halo[1:-1, 1:-1]
+                edge_a.append(ea)
+                edge_b.append(eb)
+                edge_w.append(ew)
+
+    # 2. Grafo global de transbordamento
+    progress_callback("Propagando cotas de transbordamento entre blocos...", 27)
+    with stage(progress_callback, 'spill_levels'):
+        sa, sb, sw = _seam_edges(filled, labels, nodata_mask, height, width, tile_size)
+        edge_a.append(sa)
+        edge_b.append(sb)
+        edge_w.append(sw)
+        n_labels = next_global
+        indptr, indices, weights = _build_csr(n_labels, np.concatenate(edge_a),
+                                              np.concatenate(edge_b), np.concatenate(edge_w))
+        spill = _spill_levels(n_labels, indptr, indices, weights)
+        del edge_a, edge_b, edge_w, indptr, indices, weights
+
+    # 3. Elevação final (MDE condicionado)
+    progress_callback("Aplicando cotas de transbordamento...", 30)
+    with stage(progress_callback, 'apply_spill'):
+        for row_off, col_off, h, w in tiles:
+            tile_labels = np.asarray(labels[row_off:row_off + h, col_off:col_off + w])
+            tile_filled = np.asarray(filled[row_off:row_off + h, col_off:col_off + w])
+            raised = np.maximum(tile_filled, spill[tile_labels].astype(work_dtype))
+            filled[row_off:row_off + h, col_off:col_off + w] = np.where(tile_labels > 0, raised, tile_filled)
+        del labels, spill
+
+    # 4. Distância até a saída das áreas planas (iterada até convergir entre blocos)
+    progress_callback("Resolvendo áreas planas entre blocos...", 35)
+    with stage(progress_callback, 'resolve_flats'):
+        flat_dist = memmap('flat_dist', np.int32, fill=FLAT_INF)
+        n_rows_t = (height + tile_size - 1) // tile_size
+        n_cols_t = (width + tile_size - 1) // tile_size
+        pending = set(range(len(tiles)))
+        while pending:
+            changed = set()
+            for t in sorted(pending):
+                row_off, col_off, h, w = tiles[t]
+                r_start, r_stop, c_start, c_stop = _halo_bounds(row_off, col_off, h, w, height, width)
+                old = np.array(flat_dist[row_off:row_off + h, col_off:col_off + w])
+                core = _flat_distance_tile(
+                    np.asarray(filled[r_start:r_stop, c_start:c_stop], dtype=np.float64),
+                    np.asarray(nodata_mask[r_start:r_stop, c_start:c_stop]),
+                    np.asarray(flat_dist[r_start:r_stop, c_start:c_stop]),
+                    row_off - r_start, col_off - c_start, h, w, D8_ROW_OFFSETS, D8_COL_OFFSETS)
+                flat_dist[row_off:row_off + h, col_off:col_off + w] = core
+                border_changed = (np.any(old[0] != core[0]) or np.any(old[-1] != core[-1]) or
+                                  np.any(old[:, 0] != core[:, 0]) or np.any(old[:, -1] != core[:, -1]))
+                if border_changed:
+                    changed.add(t)
+            # Reprocessa apenas os vizinhos de blocos cuja borda mudou
+            pending = set()
+            for t in changed:
+                ti, tj = divmod(t, n_cols_t)
+                for di in (-1, 0, 1):
+                    for dj in (-1, 0, 1):
+                        ni, nj = ti + di, tj + dj
+                        if (di or dj) and 0 <= ni < n_rows_t and 0 <= nj < n_cols_t:
+                            pending.add(ni * n_cols_t + nj)
+
+    # 5. Direção de fluxo
+    progress_callback("Calculando direção do fluxo por bloco...", 45)
+    with stage(progress_callback, 'flowdir'):
+        dx, dy = abs(transform.a), abs(transform.e)
+        fdir = memmap('fdir', np.int16)
+        for row_off, col_off, h, w in tiles:
+            r_start, r_stop, c_start, c_stop = _halo_bounds(row_off, col_off, h, w, height, width)
+            fdir[row_off:row_off + h, col_off:col_off + w] = _flowdir_tile(
+                np.asarray(filled[r_start:r_stop, c_start:c_stop], dtype=np.float64),
+                np.asarray(nodata_mask[r_start:r_stop, c_start:c_stop]),
+                np.asarray(flat_dist[r_start:r_stop, c_start:c_stop]),
+                row_off - r_start, col_off - c_start, h, w, dx, dy, np.array(dirmap),
+                D8_ROW_OFFSETS, D8_COL_OFFSETS, -1, -2, 0)
+        del flat_dist
+
+    # 6. Acumulação: 1ª passada local, grafo de saídas e 2ª passada com a vazão recebida
+    progress_callback("Calculando acumulação do fluxo por bloco...", 55)
+    with stage(progress_callback, 'accumulation'):
+        dirmap_arr = np.array(dirmap)
+        exit_cells, exit_acc, exit_target = [], [], []
+        perimeter_cells, perimeter_exit = [], []
+        for row_off, col_off, h, w in tiles:
+            tile_fdir = np.asarray(fdir[row_off:row_off + h, col_off:col_off + w])
+            valid = ~np.asarray(nodata_mask[row_off:row_off + h, col_off:col_off + w])
+            acc_local, exit_idx, leave_k = _tile_accumulation(
+                tile_fdir, valid, np.zeros((h, w)), dirmap_arr, D8_ROW_OFFSETS, D8_COL_OFFSETS)
+
+            leaving = np.flatnonzero(leave_k >= 0)
+            lr, lc = np.divmod(leaving, w)
+            tr = lr + row_off + D8_ROW_OFFSETS[leave_k[leaving]]
+            tc = lc + col_off + D8_COL_OFFSETS[leave_k[leaving]]
+            target = np.where((tr >= 0) & (tr < height) & (tc >= 0) & (tc < width),
+                              tr.astype(np.int64) * width + tc, -1)
+            exit_cells.append((lr + row_off).astype(np.int64) * width + lc + col_off)
+            exit_acc.append(acc_local.ravel()[leaving])
+            exit_target.append(target)
+
+            local, glob = _perimeter_indices(row_off, col_off, h, w, width)
+            link = exit_idx[local]
+            lr, lc = np.divmod(np.maximum(link, 0), w)
+            perimeter_cells.append(glob)
+            perimeter_exit.append(np.where(link >= 0, (lr + row_off).astype(np.int64) * width + lc + col_off, -1))
+
+        exit_cells = np.concatenate(exit_cells)
+        exit_acc = np.concatenate(exit_acc)
+        exit_target = np.concatenate(exit_target)
+        perimeter_cells = np.concatenate(perimeter_cells)
+        perimeter_exit = np.concatenate(perimeter_exit)
+
+        perim_order = np.argsort(perimeter_cells)
+        perimeter_cells = perimeter_cells[perim_order]
+        perimeter_exit = perimeter_exit[perim_order]
+        exit_order = np.argsort(exit_cells)
+        exit_sorted = exit_cells[exit_order]
+
+        # Saída a jusante de cada saída: a saída alcançada a partir da célula de destino
+        has_target = exit_target >= 0
+        pos = np.clip(np.searchsorted(perimeter_cells, exit_target), 0, len(perimeter_cells) - 1)
+        down_exit_cell = np.where(has_target & (perimeter_cells[pos] == exit_target), perimeter_exit[pos], -1)
+        has_down = down_exit_cell >= 0
+        down_pos = np.clip(np.searchsorted(exit_sorted, down_exit_cell), 0, max(len(exit_sorted) - 1, 0))
+        down = np.where(has_down, exit_order[down_pos] if len(exit_order) else -1, -1).astype(np.int64)
+        exit_final = _accumulate_exits(exit_acc.astype(np.float64), down)
+
+        # Vazão recebida por cada célula de entrada
+        inflow_cells = exit_target[has_target]
+        inflow_values = exit_final[has_target]
+
+        acc = memmap('acc', np.float64)
+        for row_off, col_off, h, w in tiles:
+            tile_fdir = np.asarray(fdir[row_off:row_off + h, col_off:col_off + w])
+            valid = ~np.asarray(nodata_mask[row_off:row_off + h, col_off:col_off + w])
+            inflow = np.zeros((h, w))
+            ir, ic = np.divmod(inflow_cells, width)
+            inside = (ir >= row_off) & (ir < row_off + h) & (ic >= col_off) & (ic < col_off + w)
+            np.add.at(inflow, (ir[inside] - row_off, ic[inside] - col_off), inflow_values[inside])
+            tile_acc, _, _ = _tile_accumulation(tile_fdir, valid, inflow, dirmap_arr, D8_ROW_OFFSETS, D8_COL_OFFSETS)
+            acc[row_off:row_off + h, col_off:col_off + w] = tile_acc
+
+    # Salvar rasters condicionados
+    progress_callback("Salvando MDE condicionado, direção e acumulação...", 65)
+    dem_path = os.path.join(output_dir, 'mde_condicionado.tif')
+    fdir_path = os.path.join(output_dir, 'flow_direction.tif')
+    acc_path = os.path.join(output_dir, 'flow_accumulation.tif')
+    cog_options = {'compression': compression, 'overviews': overviews}
+    with stage(progress_callback, 'write_rasters'):
+        _write_memmap_to_raster(filled, dem_path, profile, work_dtype, -9999, tile_size, fill_mask=nodata_mask,
+                                **cog_options)
+        _write_memmap_to_raster(fdir, fdir_path, profile, FDIR_DTYPE, FDIR_NODATA, tile_size, fill_mask=nodata_mask,
+                                encode=lambda block, mask: encode_fdir(block, dirmap, mask), resampling='nearest',
+                                **cog_options)
+        _write_memmap_to_raster(acc, acc_path, profile, ACC_DTYPE, ACC_NODATA, tile_size, fill_mask=nodata_mask,
+                                encode=encode_acc, resampling='nearest', **cog_options)
+    results['dem_condicionado_path'] = dem_path
+    results['fdir_path'] = fdir_path
+    results['acc_path'] = acc_path
+
+    # Derivadas do terreno por bloco (borda de 1 célula)
+    progress_callback("Calculando derivadas do terreno por bloco...", 70)
+    with stage(progress_callback, 'terrain_derivatives'):
+        results.update(write_terrain_derivatives(filled, profile, output_dir, outputs=terrain_outputs, acc=acc,
+                                                 nodata_mask=nodata_mask, method=gradient_method,
+                                                 tile_size=tile_size, **cog_options))
+
+    # Índice da rede por limiar (só as células de canal) e rede de drenagem total, sem costuras
+    progress_callback("Indexando e vetorizando a rede de drenagem total...", 85)
+    with stage(progress_callback, 'stream_index'):
+        index = build_stream_index(fdir, acc, dirmap, transform, crs, dem=filled,
+                                   min_threshold=min(stream_threshold, STREAM_INDEX_MIN_THRESHOLD))
+        results['indice_rede_path'] = save_stream_index(index, os.path.join(output_dir, 'indice_rede.npz'))
+    with stage(progress_callback, 'network'):
+        canais_path = write_network(index, stream_threshold, os.path.join(output_dir, 'rede_drenagem_total.geojson'))
+    if canais_path is not None:
+        results['canais_total_path'] = canais_path
+        progress_callback("Rede de drenagem total salva.", 95)
+
+    del filled, fdir, acc, nodata_mask
+    if not keep_workdir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    progress_callback("Pré-processamento em blocos concluído.", 100)
+    results['dirmap'] = dirmap
+    results['tiled'] = True
+    return results
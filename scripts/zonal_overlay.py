@@ -0,0 +1,158 @@
+"""
+Interseção da mancha de inundação com o raster de solos por janelas.
+
+O motor anterior de `run_soil_intersection` recorta o raster pela união das
+feições (`rasterio.mask`), vetoriza todas as células do recorte e cruza o
+resultado com o vetor em `gpd.overlay`. A memória e o tempo crescem com a
+área de interesse inteira, mesmo quando a mancha é estreita.
+
+Aqui o raster é lido só onde há feições, em blocos de `tile_size` células
+alinhados à grade do raster:
+
+1. as feições (já no CRS do raster) são indexadas em uma `STRtree`; os blocos
+   que cobrem a janela de alguma feição são percorridos em ordem, e a árvore
+   dá as feições de cada bloco;
+2. em cada bloco, o contorno de cada feição é rasterizado (`all_touched`,
+   para incluir as células de borda) e as células com solo válido são
+   vetorizadas por classe (`rasterio.features.shapes`);
+3. os polígonos de cada classe são recortados pela feição (já recortada pelo
+   retângulo do bloco), o que dá a interseção exata sem `overlay`;
+4. as partes que tocam uma costura entre blocos são unidas por (feição,
+   classe), e o resultado é explodido em polígonos simples, com os
+   atributos da feição e a coluna `valor_solo`.
+
+A memória fica limitada a um bloco do raster mais as geometrias de saída.
+Diferenças em relação ao `overlay`: as células de borda com centro fora da
+mancha entram na interseção (recortadas pela feição), e cada parte
+desconexa de uma classe é uma linha própria.
+"""
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from rasterio import features
+from rasterio.windows import Window, from_bounds
+
+from scripts.polygonize import _shapes_to_polygons
+
+
+INTERSECTION_ENGINES = {
+    'overlay': "Recorte + vetorização do recorte + gpd.overlay",
+    'janelas': "Janelas por feição (sem overlay)",
+}
+DEFAULT_INTERSECTION_ENGINE = 'overlay'
+DEFAULT_TILE_SIZE = 1024
+
+
+def _feature_tiles(src, bounds, tile_size):
+    """Blocos (linha, coluna) da grade de `tile_size` que cobrem as janelas das feições."""
+    tiles = set()
+    for minx, miny, maxx, maxy in bounds:
+        window = from_bounds(minx, miny, maxx, maxy, transform=src.transform)
+        row0, col0 = max(int(np.floor(window.row_off)), 0), max(int(np.floor(window.col_off)), 0)
+        row1 = min(int(np.ceil(window.row_off + window.height)), src.height)
+        col1 = min(int(np.ceil(window.col_off + window.width)), src.width)
+        if row0 >= row1 or col0 >= col1:
+            continue
+        for r in range(row0 // tile_size, (row1 - 1) // tile_size + 1):
+            for c in range(col0 // tile_size, (col1 - 1) // tile_size + 1):
+                tiles.add((r * tile_size, c * tile_size))
+    return sorted(tiles)
+
+
+def _tile_pieces(data, valid, transform, geometry, tile_box):
+    """Polígonos (classe, geometria) da feição `geometry` no bloco, já recortados por ela."""
+    clipped = shapely.clip_by_rect(geometry, *tile_box)
+    if shapely.is_empty(clipped):
+        return np.empty(0, dtype=object), np.empty(0)
+    footprint = features.rasterize([(clipped, 1)], out_shape=data.shape, transform=transform, all_touched=True,
+                                   dtype=np.uint8).astype(bool) & valid
+    if not footprint.any():
+        return np.empty(0, dtype=object), np.empty(0)
+    polygons, values = _shapes_to_polygons(features.shapes(data, mask=footprint, transform=transform))
+    shapely.prepare(clipped)
+    inside = shapely.contains_properly(clipped, polygons)
+    # Os polígonos da borda são recortados em uma operação por classe (e não
+    # um por polígono): cada recorte percorre a feição inteira do bloco
+    order = np.argsort(values[~inside], kind='stable')
+    border_classes, border_group = np.unique(values[~inside][order], return_inverse=True)
+    border = shapely.intersection(shapely.multipolygons(polygons[~inside][order], indices=border_group), clipped)
+    parts, part_index = shapely.get_parts(border, return_index=True)
+    return np.concatenate([polygons[inside], parts]), np.concatenate([values[inside], border_classes[part_index]])
+
+
+def windowed_soil_overlay(src, gdf_vector, tile_size=DEFAULT_TILE_SIZE, progress_callback=None):
+    """
+    Interseção das feições de `gdf_vector` (no CRS de `src`) com as classes
+    do raster de solos aberto em `src`. Retorna um GeoDataFrame com os
+    atributos das feições e `valor_solo`, como o `overlay` do motor anterior.
+    """
+    gdf_vector = gdf_vector[~(gdf_vector.geometry.isna() | gdf_vector.geometry.is_empty)].reset_index(drop=True)
+    geometries = np.asarray(gdf_vector.geometry.values, dtype=object)
+    tree = shapely.STRtree(geometries)
+    tiles = _feature_tiles(src, shapely.bounds(geometries), tile_size)
+    nodata = src.nodata
+
+    pieces, owners, values, on_seam = [], [], [], []
+    for done, (row_off, col_off) in enumerate(tiles, start=1):
+        window = Window(col_off, row_off, min(tile_size, src.width - col_off), min(tile_size, src.height - row_off))
+        transform = src.window_transform(window)
+        tile_box = src.window_bounds(window)
+        candidates = tree.query(shapely.box(*tile_box), predicate='intersects')
+        if candidates.size == 0:
+            continue
+        data = src.read(1, window=window)
+        valid = data != nodata if nodata is not None else np.ones(data.shape, dtype=bool)
+        if np.issubdtype(data.dtype, np.floating):
+            valid &= np.isfinite(data)
+        data = data.astype(np.int32)
+
+        # Partes que tocam as bordas internas do bloco podem continuar no vizinho
+        half_x, half_y = abs(transform.a) / 2, abs(transform.e) / 2
+        interior = np.array([tile_box[0] + half_x if col_off > 0 else -np.inf,
+                             tile_box[1] + half_y if row_off + window.height < src.height else -np.inf,
+                             tile_box[2] - half_x if col_off + window.width < src.width else np.inf,
+                             tile_box[3] - half_y if row_off > 0 else np.inf])
+        for index in np.sort(candidates):
+            polygons, classes = _tile_pieces(data, valid, transform, geometries[index], tile_box)
+            if polygons.size == 0:
+                continue
+            bounds = shapely.bounds(polygons)
+            pieces.append(polygons)
+            values.append(classes)
+            owners.append(np.full(polygons.size, index, dtype=np.int64))
+            on_seam.append((bounds[:, 0] <= interior[0]) | (bounds[:, 1] <= interior[1]) |
+                           (bounds[:, 2] >= interior[2]) | (bounds[:, 3] >= interior[3]))
+        if progress_callback is not None and (done % 10 == 0 or done == len(tiles)):
+            progress_callback(f"Interseção por janelas: bloco {done}/{len(tiles)}...",
+                              30 + int(done / len(tiles) * 50))
+
+    if not pieces:
+        return gpd.GeoDataFrame(columns=[*gdf_vector.columns.drop('geometry'), 'valor_solo', 'geometry'],
+                                geometry='geometry', crs=src.crs)
+    pieces, owners = np.concatenate(pieces), np.concatenate(owners)
+    values, on_seam = np.concatenate(values).astype(np.int64), np.concatenate(on_seam)
+
+    # União por (feição, classe) só das partes nas costuras
+    seam_pieces = pieces[on_seam]
+    seam_frame = pd.DataFrame({'owner': owners[on_seam], 'valor': values[on_seam]})
+    merged, merged_owner, merged_value = [], [], []
+    for (owner, value), group in seam_frame.groupby(['owner', 'valor'], sort=True):
+        merged.append(shapely.union_all(seam_pieces[group.index.to_numpy()]))
+        merged_owner.append(owner)
+        merged_value.append(value)
+    geometries = np.concatenate([pieces[~on_seam], np.asarray(merged, dtype=object)])
+    owners = np.concatenate([owners[~on_seam], np.asarray(merged_owner, dtype=np.int64)])
+    values = np.concatenate([values[~on_seam], np.asarray(merged_value, dtype=np.int64)])
+
+    # Polígonos simples, na ordem das feições
+    parts, part_index = shapely.get_parts(geometries, return_index=True)
+    polygon = shapely.get_type_id(parts) == 3
+    parts, part_index = parts[polygon], part_index[polygon]
+    order = np.lexsort((values[part_index], owners[part_index]))
+    parts, part_index = parts[order], part_index[order]
+
+    attributes = gdf_vector.drop(columns='geometry').iloc[owners[part_index]].reset_index(drop=True)
+    # Classes como float, igual aos valores de `rasterio.features.shapes` do motor 'overlay'
+    attributes['valor_solo'] = values[part_index].astype(np.float64)
+    return gpd.GeoDataFrame(attributes, geometry=parts, crs=src.crs)
@@ -0,0 +1,69 @@
+"""
+Buffers proporcionais em lote contra a busca `brentq` com `geometria.buffer`.
+"""
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import Polygon, box
+
+from scripts.area_buffer import solve_buffer_distances, buffer_to_areas, BUFFER_XTOL_M
+from scripts.local_analysis_helpers import (find_buffer_distance_for_area, calculate_area_buffers,
+                                            BRENTQ_UPPER_LIMIT_M)
+
+
+# Crescimento grande sobre polígonos pequenos: o buffer é quase um círculo, e
+# a área depende dos segmentos por quarto de círculo
+GROWTH, SHRINK = 20.0, 0.6
+
+
+def _polygons(n=30, seed=0):
+    rng = np.random.default_rng(seed)
+    polygons = []
+    for i in range(n):
+        x0, y0 = 500000 + 1000 * i, 7500000
+        if i % 3 == 0:
+            polygons.append(box(x0, y0, x0 + rng.uniform(10, 60), y0 + rng.uniform(10, 60)))
+        else:
+            # Estrela: cantos convexos e côncavos
+            angles = np.sort(rng.uniform(0, 2 * np.pi, 12))
+            radii = rng.uniform(5, 40, 12)
+            polygons.append(Polygon(np.column_stack((x0 + radii * np.cos(angles), y0 + radii * np.sin(angles)))))
+    return [polygon for polygon in polygons if polygon.is_valid]
+
+
+def _reference(polygons, factor, search_min, search_max):
+    distances = np.array([find_buffer_distance_for_area(polygon, polygon.area * factor, search_min, search_max)
+                          for polygon in polygons])
+    areas = np.array([polygon.buffer(distance).area for polygon, distance in zip(polygons, distances)])
+    return distances, areas
+
+
+@pytest.mark.parametrize('factor, search', [(GROWTH, (0.0, BRENTQ_UPPER_LIMIT_M)),
+                                            (SHRINK, (-BRENTQ_UPPER_LIMIT_M, 0.0))])
+def test_batch_buffer_matches_brentq(factor, search):
+    polygons = _polygons()
+    geometries = np.array(polygons, dtype=object)
+    expected_distances, expected_areas = _reference(polygons, factor, *search)
+    targets = np.array([polygon.area for polygon in polygons]) * factor
+
+    distances, _ = solve_buffer_distances(geometries, targets, *search, xtol=BUFFER_XTOL_M)
+    np.testing.assert_allclose(distances, expected_distances, atol=2 * BUFFER_XTOL_M)
+
+    # A área aceita pela busca: a do alvo, a menos de xtol vezes o perímetro
+    buffered, _ = buffer_to_areas(geometries, targets, search_min=search[0], search_max=search[1])
+    areas = np.array([geometry.area for geometry in buffered])
+    perimeters = np.array([geometry.length for geometry in buffered])
+    np.testing.assert_array_less(np.abs(areas - expected_areas), 2 * BUFFER_XTOL_M * perimeters)
+    np.testing.assert_array_less(np.abs(areas - targets), 2 * BUFFER_XTOL_M * perimeters)
+
+
+def test_calculate_area_buffers_matches_brentq():
+    polygons = _polygons(seed=1)
+    gdf = gpd.GeoDataFrame(geometry=polygons, crs='EPSG:31983')
+    plus, _ = calculate_area_buffers(gdf, 'EPSG:31983', (GROWTH - 1) * 100, sides=('plus',))
+    expected_distances, _ = _reference(polygons, GROWTH, 0.0, BRENTQ_UPPER_LIMIT_M)
+    # Mesma geometria do `geometria.buffer` na distância do `brentq`
+    expected = gpd.GeoSeries([polygon.buffer(distance) for polygon, distance in zip(polygons, expected_distances)],
+                             crs='EPSG:31983')
+    difference = plus.geometry.symmetric_difference(expected).area.values
+    np.testing.assert_array_less(difference, 2 * BUFFER_XTOL_M * expected.length.values)
@@ -0,0 +1,71 @@
+"""
+Buffer pelas curvas área x distância: precisão contra a busca `brentq` e
+validação das curvas gravadas contra a camada.
+"""
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely import affinity
+from shapely.geometry import Polygon, box
+
+from scripts.area_buffer import BUFFER_XTOL_M
+from scripts.area_curves import build_area_curves, buffer_with_curves
+from scripts.local_analysis_helpers import (find_buffer_distance_for_area, run_area_curves, run_proportional_buffer,
+                                            BRENTQ_UPPER_LIMIT_M)
+
+
+# Crescimento grande sobre polígonos pequenos: a área depende dos segmentos
+# por quarto de círculo do buffer
+GROWTH_PERCENT = 1900.0
+
+
+def _polygons(n=20, seed=0):
+    rng = np.random.default_rng(seed)
+    polygons = []
+    for i in range(n):
+        x0, y0 = 500000 + 1000 * i, 7500000
+        if i % 2 == 0:
+            polygons.append(box(x0, y0, x0 + rng.uniform(10, 60), y0 + rng.uniform(10, 60)))
+        else:
+            angles = np.sort(rng.uniform(0, 2 * np.pi, 12))
+            radii = rng.uniform(5, 40, 12)
+            polygons.append(Polygon(np.column_stack((x0 + radii * np.cos(angles), y0 + radii * np.sin(angles)))))
+    return [polygon for polygon in polygons if polygon.is_valid]
+
+
+def test_buffer_with_curves_matches_brentq():
+    polygons = _polygons()
+    geometries = np.array(polygons, dtype=object)
+    curves = build_area_curves(geometries, max_percent=GROWTH_PERCENT)
+    buffered, distances, _ = buffer_with_curves(geometries, curves, np.full(len(polygons), GROWTH_PERCENT))
+
+    factor = 1 + GROWTH_PERCENT / 100
+    expected_distances = np.array([find_buffer_distance_for_area(polygon, polygon.area * factor, 0.0,
+                                                                 BRENTQ_UPPER_LIMIT_M) for polygon in polygons])
+    np.testing.assert_allclose(distances, expected_distances, atol=2 * BUFFER_XTOL_M)
+    for geometry, polygon, distance in zip(buffered, polygons, expected_distances):
+        expected = polygon.buffer(distance)
+        assert geometry.symmetric_difference(expected).area < 2 * BUFFER_XTOL_M * expected.length
+
+
+def _write_layer(path, polygons):
+    gpd.GeoDataFrame({'valor_solo': np.arange(len(polygons)) % 3 + 1}, geometry=polygons,
+                     crs='EPSG:31983').to_file(path, driver='GeoJSON')
+    return path
+
+
+def test_cached_curves_are_tied_to_the_layer(tmp_path):
+    polygons = _polygons(seed=1)
+    layer = _write_layer(str(tmp_path / 'camada.geojson'), polygons)
+    # Outra camada com o mesmo número de feições
+    other = _write_layer(str(tmp_path / 'outra.geojson'), [affinity.scale(polygon, 1.5, 1.5) for polygon in polygons])
+    callback = lambda message, percentage: None
+    curves_path = run_area_curves(layer, 'valor_solo', str(tmp_path / 'curvas'), callback)['curves_path']
+    mapping = {1: 30.0, 2: -20.0, 3: 10.0}
+
+    results = run_proportional_buffer(layer, 'valor_solo', mapping, str(tmp_path / 'saida'), callback,
+                                      curves_path=curves_path)
+    assert len(gpd.read_file(results['merge_path'])) == len(polygons)
+    with pytest.raises(ValueError, match='recalcule as curvas'):
+        run_proportional_buffer(other, 'valor_solo', mapping, str(tmp_path / 'saida_outra'), callback,
+                                curves_path=curves_path)
@@ -0,0 +1,98 @@
+"""
+Delineamento com `clip_domain=True` (rasters fatiados para a janela da bacia)
+contra o domínio completo, numa bacia que toca as bordas da sua janela.
+"""
+import numpy as np
+import rasterio
+import pytest
+from rasterio.transform import from_origin
+from scipy.ndimage import gaussian_filter
+
+from scripts.local_analysis_helpers import (run_preprocessing, run_delineation, _catchment_window,
+                                            _window_flow_distance)
+
+
+STREAM_THRESHOLD = 200
+OUTLET_COL = 6
+OUTLET_COL_ROW_MARGIN = 3
+N_WINDOW_OUTLETS = 60
+
+
+def _write_dem(path, n=160, seed=0):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:n, 0:n] / n
+    z = 800 + 200 * y + 60 * np.abs(x - 0.5) + 20 * np.sin(8 * x) * np.cos(6 * y)
+    z += gaussian_filter(rng.normal(0, 1, (n, n)), 3) * 30
+    profile = dict(driver='GTiff', height=n, width=n, count=1, dtype='float32', crs='EPSG:31983',
+                   transform=from_origin(500000, 7500000, 30, 30), nodata=-9999)
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(z.astype('float32'), 1)
+    return path
+
+
+@pytest.fixture(scope='module')
+def delineations(tmp_path_factory):
+    base = tmp_path_factory.mktemp('bacia')
+    dem_path = _write_dem(str(base / 'mde.tif'))
+    callback = lambda message, percentage: None
+    results = {}
+    for clip_domain in (False, True):
+        # `clip_domain=False` recorta o grid do pré-processamento: um por execução
+        pre_dir = base / f'pre_{clip_domain}'
+        pre_dir.mkdir()
+        preproc = run_preprocessing(dem_path, str(pre_dir), STREAM_THRESHOLD, callback)
+        acc = np.asarray(preproc['acc'])
+        # Exutório no canal principal, perto da borda oeste: a bacia ocupa
+        # quase todo o MDE e encosta nas quatro bordas da sua janela
+        row = OUTLET_COL_ROW_MARGIN + np.argmax(acc[OUTLET_COL_ROW_MARGIN:-OUTLET_COL_ROW_MARGIN, OUTLET_COL])
+        outlet = preproc['grid'].viewfinder.affine * (OUTLET_COL, row)
+        out_dir = base / f'out_{clip_domain}'
+        out_dir.mkdir()
+        results[clip_domain] = run_delineation(preproc, outlet, 2.0, STREAM_THRESHOLD, str(out_dir), callback,
+                                               generate_flu_distance=True, clip_domain=clip_domain)
+    return results
+
+
+def _read(path):
+    with rasterio.open(path) as src:
+        return src.read(1), src.transform
+
+
+def test_windowed_flow_distance_matches_full_domain(delineations):
+    full, full_transform = _read(delineations[False]['dist_path'])
+    window, window_transform = _read(delineations[True]['dist_path'])
+    assert full.shape == window.shape
+    assert full_transform == window_transform
+    basin = full != -9999
+    # A bacia ocupa as quatro bordas da janela
+    assert basin[0].any() and basin[-1].any() and basin[:, 0].any() and basin[:, -1].any()
+    np.testing.assert_array_equal(window != -9999, basin)
+    np.testing.assert_allclose(window[basin], full[basin])
+
+
+@pytest.fixture(scope='module')
+def preprocessing(tmp_path_factory):
+    base = tmp_path_factory.mktemp('janelas')
+    dem_path = _write_dem(str(base / 'mde.tif'), seed=1)
+    return run_preprocessing(dem_path, str(base), STREAM_THRESHOLD, lambda message, percentage: None)
+
+
+def test_window_flow_distance_on_many_outlets(preprocessing):
+    grid, fdir, dirmap = preprocessing['grid'], preprocessing['fdir'], preprocessing['dirmap']
+    acc = np.asarray(preprocessing['acc'])
+    # Canais de maior acumulação: bacias largas, com células nas bordas da janela
+    rows, cols = np.unravel_index(np.argsort(acc, axis=None)[::-1], acc.shape)
+    inner = (np.minimum(rows, cols) >= 3) & (np.maximum(rows, cols) < acc.shape[0] - 3)
+    for row, col in list(zip(rows[inner], cols[inner]))[:N_WINDOW_OUTLETS * 5:5]:
+        x, y = grid.viewfinder.affine * (col, row)
+        catch = grid.catchment(x=x, y=y, fdir=fdir, dirmap=dirmap, xytype='coordinate')
+        full = np.asarray(grid.distance_to_outlet(x=x, y=y, fdir=fdir, dirmap=dirmap, xytype='coordinate'))
+        _, (window_fdir, window_catch) = _catchment_window(catch, (fdir, catch))
+        dist = np.asarray(_window_flow_distance(window_fdir, window_catch, x, y, dirmap))
+
+        basin = np.asarray(catch) != catch.nodata
+        window_basin = np.asarray(window_catch) != window_catch.nodata
+        window_rows, window_cols = np.flatnonzero(basin.any(axis=1)), np.flatnonzero(basin.any(axis=0))
+        expected = full[window_rows[0]:window_rows[-1] + 1, window_cols[0]:window_cols[-1] + 1]
+        np.testing.assert_allclose(dist[window_basin], expected[window_basin])
+        assert np.isinf(dist[~window_basin]).all()
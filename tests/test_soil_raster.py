@@ -0,0 +1,53 @@
+"""
+Modelo raster por solo: a área gravada de cada classe contra a área-alvo.
+"""
+import geopandas as gpd
+import numpy as np
+import rasterio
+import pytest
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+from scripts.soil_raster import run_soil_raster_weighting
+
+
+CELL_M = 10.0
+PERCENTAGES = {1: 55.0, 2: 35.0, 3: 15.0, 4: -15.0, 5: -35.0, 6: -55.0}
+
+
+def _write_inputs(base, n=300, stripe=20):
+    # Faixas verticais de classes alternando crescimento e redução; a mancha
+    # cruza todas, e cada classe tem células livres acima e abaixo dela
+    order = np.array([1, 6, 2, 5, 3, 4])
+    soil = np.broadcast_to(order[(np.arange(n) // stripe) % order.size], (n, n))
+    transform = from_origin(500000, 7500000, CELL_M, CELL_M)
+    raster_path = str(base / 'solo.tif')
+    with rasterio.open(raster_path, 'w', driver='GTiff', height=n, width=n, count=1, dtype='uint8',
+                       crs='EPSG:31983', transform=transform, nodata=255) as dst:
+        dst.write(soil.astype('uint8'), 1)
+    x0, y0 = transform * (30, 200)
+    x1, y1 = transform * (270, 100)
+    vector_path = str(base / 'mancha.geojson')
+    gpd.GeoDataFrame(geometry=[box(x0, y0, x1, y1)], crs='EPSG:31983').to_file(vector_path, driver='GeoJSON')
+    return raster_path, vector_path
+
+
+@pytest.fixture(scope='module')
+def weighting(tmp_path_factory):
+    base = tmp_path_factory.mktemp('solo')
+    raster_path, vector_path = _write_inputs(base)
+    return run_soil_raster_weighting(raster_path, vector_path, PERCENTAGES, str(base / 'saida'),
+                                     lambda message, percentage: None)
+
+
+def test_written_class_areas_match_targets(weighting):
+    with rasterio.open(weighting['raster_path']) as src:
+        classes = src.read(1)
+        cell_area = abs(src.transform.a * src.transform.e)
+    for key, info in weighting['areas_por_classe'].items():
+        written = np.count_nonzero(classes == int(float(key))) * cell_area
+        assert info['area_final_m2'] == pytest.approx(written)
+        assert info['fragmentos_sem_solucao'] == 0
+        target = info['area_original_m2'] * (1 + PERCENTAGES[int(float(key))] / 100)
+        # Soma da classe arredondada pelo maior resto: menos de meia célula
+        assert abs(written - target) <= 0.5 * cell_area